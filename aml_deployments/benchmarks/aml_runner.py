@@ -0,0 +1,169 @@
+"""Local emulation of an AML ``parallel`` step with a ``run_function`` task.
+
+The plan folder (one JSON file per item, or a JSONL manifest) is cut into
+mini-batches that ``--workers`` processes pull from a shared queue. Every worker
+loads the entry script with the program arguments in ``sys.argv``, calls
+``init()`` once, ``run(mini_batch)`` per mini-batch and ``shutdown()`` at the
+end, like the AML parallel runner. The returned rows are appended to
+``--output_file`` (``append_row_to``).
+
+Usage::
+
+    python -m benchmarks.aml_runner --entry_script pc_prep/parallel_pc_prep_script.py \
+        --input_dir items --output_file out.jsonl -- --pc_raw ... (program args)
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import runpy
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from gsm_common.plan_io import MANIFEST_NAME
+
+
+def mini_batches(input_dir: str, size: int) -> List[List[Any]]:
+    """Mini-batches of item files, or of rows for a manifest plan."""
+    manifest = Path(input_dir) / MANIFEST_NAME
+    items: List[Any]
+    if manifest.exists():
+        with manifest.open(encoding="utf-8") as f:
+            items = [json.loads(line) for line in f if line.strip()]
+    else:
+        items = sorted(str(p) for p in Path(input_dir).glob("*.json"))
+    size = max(1, size)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _worker(
+    index: int,
+    entry_script: str,
+    program_args: List[str],
+    batches: List[List[Any]],
+    queue: Any,
+    output_file: str,
+    stub_sam: bool,
+    results: Any,
+) -> None:
+    """Run init / run per mini-batch / shutdown of ``entry_script``."""
+    sys.argv = [entry_script, *program_args]
+    if stub_sam:
+        import pc_segment.segment_pc as segment_pc
+
+        from benchmarks.stub_sam import StubPredictor
+
+        segment_pc.initialize_model = lambda model_path: StubPredictor()
+    t0 = time.perf_counter()
+    entry = runpy.run_path(entry_script, run_name="__aml_entry__")
+    entry["init"]()
+    timings: Dict[str, Any] = {"worker": index, "init_s": time.perf_counter() - t0}
+    items = rows = 0
+    t0 = time.perf_counter()
+    with open(f"{output_file}.worker{index}", "w", encoding="utf-8") as out:
+        while True:
+            i = queue.get()
+            if i is None:
+                break
+            items += len(batches[i])
+            for row in entry["run"](batches[i]):
+                out.write((row if isinstance(row, str) else json.dumps(row)) + "\n")
+                rows += 1
+    timings["run_s"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    entry["shutdown"]()
+    timings.update(
+        shutdown_s=time.perf_counter() - t0,
+        items=items,
+        rows=rows,
+        max_rss_mb=_max_rss_mb(),
+    )
+    results.put(timings)
+
+
+def main() -> None:
+    """Main script."""
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--entry_script", required=True)
+    ap.add_argument("--input_dir", required=True)
+    ap.add_argument("--output_file", required=True)
+    ap.add_argument("--mini_batch_size", type=int, default=1)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument(
+        "--stub_sam",
+        action="store_true",
+        help="Replace the SAM model of the installed pc_segment with a stub",
+    )
+    ap.add_argument(
+        "--summary", default=None, help="Write the per-worker timings as JSON"
+    )
+    ap.add_argument("program_args", nargs=argparse.REMAINDER)
+    args = ap.parse_args()
+    program_args = args.program_args
+    if program_args[:1] == ["--"]:
+        program_args = program_args[1:]
+
+    batches = mini_batches(args.input_dir, args.mini_batch_size)
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    results = ctx.Queue()
+    workers = max(1, min(args.workers, len(batches)))
+    for i in range(len(batches)):
+        queue.put(i)
+    for _ in range(workers):
+        queue.put(None)
+    Path(args.output_file).parent.mkdir(parents=True, exist_ok=True)
+    procs = [
+        ctx.Process(
+            target=_worker,
+            args=(
+                i,
+                os.path.abspath(args.entry_script),
+                program_args,
+                batches,
+                queue,
+                args.output_file,
+                args.stub_sam,
+                results,
+            ),
+        )
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    # the timings are small, so joining before reading them cannot block
+    for p in procs:
+        p.join()
+    failed = [p.exitcode for p in procs if p.exitcode]
+    timings = [results.get() for _ in range(workers - len(failed))]
+    with open(args.output_file, "w", encoding="utf-8") as out:
+        for i in range(workers):
+            part = f"{args.output_file}.worker{i}"
+            if os.path.exists(part):
+                with open(part, encoding="utf-8") as f:
+                    out.writelines(f)
+                os.remove(part)
+    summary = {
+        "mini_batches": len(batches),
+        "workers": sorted(timings, key=lambda t: t["worker"]),
+        "failed_workers": len(failed),
+    }
+    if args.summary:
+        Path(args.summary).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+    if failed:
+        sys.exit(f"{len(failed)} worker(s) failed: exit codes {failed}")
+
+
+if __name__ == "__main__":
+    main()
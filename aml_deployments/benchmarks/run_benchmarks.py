@@ -0,0 +1,898 @@
+"""Offline benchmarks of the parallel pipeline on synthetic tiles.
+
+For every scale (number of tiles) a synthetic dataset is generated and each
+stage is driven the way AML runs it: the plan script, the parallel entry script
+through :mod:`benchmarks.aml_runner` (``init`` / ``run`` per mini-batch /
+``shutdown``), or the distributed pc_ops script as a single rank, followed by the
+merge script. Every phase runs in its own process; its wall time, items per
+second and peak RSS (largest process of the phase) are recorded.
+
+By default the stage packages are replaced by the stand-ins in
+``benchmarks/stand_ins``, which do the same file I/O with trivial compute and a
+stub SAM predictor, so the orchestration (planning, mini-batching, metadata
+handling, merging) is measured on any machine. ``--packages installed`` uses
+the installed packages instead (``--stub_sam`` for a CPU-only segment step).
+``--streaming sqlite|directory`` replaces the plan/run phases after pc_prep's
+plan with one ``streaming/stream_runner.py local`` phase on that queue.
+``--import_ms`` makes every stand-in stage module take that long to import, and
+``--start_method forkserver`` shows what preloading saves on worker start-up.
+``--admission`` runs the dist pc_ops phase with memory-aware admission.
+``--sam_server`` shares one stub model between the segment workers through
+:mod:`gsm_common.sam_server`; compared with ``--segment_workers 1`` (one worker
+per node, as without the server) it shows what cross-worker batching gains.
+
+Results are written as JSON with the package versions and the git commit, and
+two result files are compared with ``compare``::
+
+    python -m benchmarks.run_benchmarks run --scales 100 1000 --out new.json
+    python -m benchmarks.run_benchmarks compare base.json new.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from benchmarks.stub_sam import DECODE_MS_ENV, ENCODE_MS_ENV
+from benchmarks.synthetic import (
+    IMPORT_MS_ENV,
+    INTERMEDIATE_FORMAT_ENV,
+    SyntheticDataset,
+    generate,
+)
+from gsm_common.columnar import INTERMEDIATE_FORMATS
+from gsm_common.ledger import package_version
+from gsm_common.metadata_store import open_metadata
+from gsm_common.plan_io import PLAN_FORMATS, read_plan
+from gsm_common.sharding import SHARDING_MODES
+from gsm_common.warm_start import START_METHODS
+from gsm_common.work_units import WORK_UNITS
+
+ROOT = Path(__file__).resolve().parents[1]
+STAND_INS = Path(__file__).resolve().parent / "stand_ins"
+PACKAGES = ("pc_prep", "pc_segment", "pc_ops", "tree_modeling")
+SCHEMA_VERSION = 1
+
+
+@dataclass
+class Phase:
+    """One process to run and how to count the items it handled."""
+
+    stage: str
+    phase: str
+    cmd: List[str]
+    count: Callable[[], int | None]
+    env: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class Measurement:
+    """Result of one phase at one scale."""
+
+    scale: int
+    stage: str
+    phase: str
+    ok: bool
+    seconds: float
+    items: int | None = None
+    items_per_sec: float | None = None
+    max_rss_mb: float | None = None
+
+
+def _count_lines(path: str) -> int | None:
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def _count_plan(items_dir: str) -> int | None:
+    return len(read_plan(items_dir)) if os.path.isdir(items_dir) else None
+
+
+def _count_keys(path: str) -> int | None:
+    return len(open_metadata(path)) if os.path.isfile(path) else None
+
+
+def _script(rel: str) -> str:
+    return str(ROOT / rel)
+
+
+def _runner(
+    args: argparse.Namespace,
+    entry: str,
+    items_dir: str,
+    output: str,
+    program_args: List[str],
+) -> List[str]:
+    workers = args.workers
+    if "segment" in entry and args.segment_workers:
+        workers = args.segment_workers
+    cmd = [
+        sys.executable,
+        "-m",
+        "benchmarks.aml_runner",
+        "--entry_script",
+        _script(entry),
+        "--input_dir",
+        items_dir,
+        "--output_file",
+        output,
+        "--mini_batch_size",
+        str(args.mini_batch_size),
+        "--workers",
+        str(workers),
+    ]
+    if args.stub_sam and args.packages == "installed" and "segment" in entry:
+        cmd.append("--stub_sam")
+    return [*cmd, "--", *program_args]
+
+
+def _sam_server_args(args: argparse.Namespace, folder: str) -> List[str]:
+    if not args.sam_server:
+        return []
+    out = ["--sam_server", "--sam_server_dir", folder, "--sam_server_idle_s", "1"]
+    if args.stub_sam and args.packages == "installed":
+        # the server loads the model itself, without aml_runner's patch
+        out += ["--sam_server_factory", "benchmarks.stub_sam:from_environment"]
+    return out
+
+
+def _entry_args(
+    args: argparse.Namespace, data: SyntheticDataset, work: str
+) -> Dict[str, List[str]]:
+    """Program arguments of the entry script of each stage."""
+
+    def w(*parts: str) -> str:
+        return os.path.join(work, *parts)
+
+    stage = ["--stage_cache_dir", w("stage_cache")] if args.stage_cache else []
+    return {
+        "pc_prep": [
+            "--reference_trees_path",
+            data.trees,
+            "--pc_raw_metadata",
+            data.pc_raw_metadata,
+            "--bgt_pavements_raw",
+            data.bgt_pavements,
+            "--pc_raw",
+            data.pc_raw,
+            "--img_dir",
+            w("img"),
+            "--pc_dir",
+            w("pc"),
+            "--bgt_dir",
+            w("bgt"),
+            *stage,
+        ],
+        "pc_segment": [
+            "--model_mount",
+            w("model"),
+            "--img_dir_mount",
+            w("img"),
+            "--segment_dir",
+            w("segment"),
+            *stage,
+            *(["--skip_empty_prompts"] if args.skip_empty_prompts else []),
+            *_sam_server_args(args, w("sam_server")),
+            *args.segment_args,
+        ],
+        "pc_ops": [
+            "--segment_dir",
+            w("segment"),
+            "--img_dir",
+            w("img"),
+            "--pc_dir",
+            w("pc"),
+            "--ops_dir",
+            w("ops"),
+        ],
+        "tree_modeling": [
+            "--ops_dir_mount",
+            w("ops"),
+            "--bgt_dir_mount",
+            w("bgt"),
+            "--modeling_dir",
+            w("modeling"),
+            *stage,
+        ],
+    }
+
+
+def _streaming_phases(
+    args: argparse.Namespace,
+    work: str,
+    entry_args: Dict[str, List[str]],
+    sam_env: Dict[str, str],
+) -> List[Phase]:
+    """All stages in one streaming run, followed by the merge steps."""
+
+    def w(*parts: str) -> str:
+        return os.path.join(work, *parts)
+
+    py = sys.executable
+    queue = w("queue.sqlite") if args.streaming == "sqlite" else w("queue")
+    run = [
+        py,
+        _script("streaming/stream_runner.py"),
+        "local",
+        "--queue",
+        queue,
+        "--prep_items",
+        w("prep_items"),
+        "--partials_dir",
+        w("stream"),
+        "--work_unit",
+        args.work_unit,
+        "--workers",
+        str(args.workers),
+        "--mini_batch_size",
+        str(args.mini_batch_size),
+        "--poll_s",
+        "0.05",
+        "--start_method",
+        args.start_method,
+    ]
+    for name, program_args in entry_args.items():
+        run += [f"--{name}_args", shlex.join(program_args)]
+    return [
+        Phase("streaming", "run", run, lambda: _count_plan(w("prep_items")), sam_env),
+        Phase(
+            "pc_prep",
+            "merge",
+            [
+                py,
+                _script("pc_prep/pc_prep_parallel_merge_script.py"),
+                "--partial",
+                w("stream", "pc_prep.jsonl"),
+                "--img_metadata",
+                w("img_metadata.json"),
+                "--pc_metadata",
+                w("pc_metadata.json"),
+                "--bgt_metadata",
+                w("bgt_metadata.json"),
+                "--telemetry_summary",
+                w("telemetry", "pc_prep.json"),
+            ],
+            lambda: _count_lines(w("stream", "pc_prep.jsonl")),
+        ),
+        Phase(
+            "pc_segment",
+            "merge",
+            [
+                py,
+                _script("pc_segment/pc_segment_parallel_merge_script.py"),
+                "--partial",
+                w("stream", "pc_segment.jsonl"),
+                "--segment_metadata",
+                w("segment_metadata.json"),
+                "--telemetry_summary",
+                w("telemetry", "pc_segment.json"),
+            ],
+            lambda: _count_lines(w("stream", "pc_segment.jsonl")),
+        ),
+        Phase(
+            "pc_ops",
+            "merge",
+            [
+                py,
+                _script("pc_ops/pc_ops_parallel_merge_script.py"),
+                "--partials_dir",
+                w("stream", "pc_ops"),
+                "--final_path",
+                w("ops_metadata.json"),
+                "--telemetry_summary",
+                w("telemetry", "pc_ops.json"),
+            ],
+            lambda: _count_keys(w("ops_metadata.json")),
+        ),
+        Phase(
+            "tree_modeling",
+            "merge",
+            [
+                py,
+                _script("tree_modeling/tree_modeling_parallel_merge_script.py"),
+                "--partial",
+                w("stream", "tree_modeling.jsonl"),
+                "--modeling_index",
+                w("modeling_index.json"),
+                "--modeling_dir",
+                w("modeling"),
+                "--telemetry_summary",
+                w("telemetry", "tree_modeling.json"),
+                *(
+                    ["--city_dataset", w("city_dataset.gpkg")]
+                    if args.city_dataset
+                    else []
+                ),
+            ],
+            lambda: _count_lines(w("stream", "tree_modeling.jsonl")),
+        ),
+    ]
+
+
+def build_phases(
+    args: argparse.Namespace, data: SyntheticDataset, work: str
+) -> List[Phase]:
+    """The phases of the whole pipeline for one dataset, in execution order."""
+
+    def w(*parts: str) -> str:
+        return os.path.join(work, *parts)
+
+    py = sys.executable
+    plan = ["--plan_format", args.plan_format]
+    stage = ["--stage_cache_dir", w("stage_cache")] if args.stage_cache else []
+    entry_args = _entry_args(args, data, work)
+    sam_env = {
+        ENCODE_MS_ENV: str(args.sam_encode_ms),
+        DECODE_MS_ENV: str(args.sam_decode_ms),
+    }
+    prep_plan = Phase(
+        "pc_prep",
+        "plan",
+        [
+            py,
+            _script("pc_prep/pc_prep_parallel_plan_script.py"),
+            "--tree_df_path",
+            data.trees,
+            "--pc_raw_metadata",
+            data.pc_raw_metadata,
+            "--pc_raw",
+            data.pc_raw,
+            "--out_items_folder",
+            w("prep_items"),
+            *plan,
+        ],
+        lambda: _count_plan(w("prep_items")),
+    )
+    if args.streaming:
+        return [prep_plan, *_streaming_phases(args, work, entry_args, sam_env)]
+    phases = [
+        prep_plan,
+        Phase(
+            "pc_prep",
+            "run",
+            _runner(
+                args,
+                "pc_prep/parallel_pc_prep_script.py",
+                w("prep_items"),
+                w("prep_partial.jsonl"),
+                entry_args["pc_prep"],
+            ),
+            lambda: _count_plan(w("prep_items")),
+        ),
+        Phase(
+            "pc_prep",
+            "merge",
+            [
+                py,
+                _script("pc_prep/pc_prep_parallel_merge_script.py"),
+                "--partial",
+                w("prep_partial.jsonl"),
+                "--img_metadata",
+                w("img_metadata.json"),
+                "--pc_metadata",
+                w("pc_metadata.json"),
+                "--bgt_metadata",
+                w("bgt_metadata.json"),
+                "--telemetry_summary",
+                w("telemetry", "pc_prep.json"),
+            ],
+            lambda: _count_lines(w("prep_partial.jsonl")),
+        ),
+        Phase(
+            "pc_segment",
+            "plan",
+            [
+                py,
+                _script("pc_segment/pc_segment_parallel_plan_script.py"),
+                "--img_metadata",
+                w("img_metadata.json"),
+                "--out_items_folder",
+                w("segment_items"),
+                *(
+                    ["--img_dir", w("img"), "--skip_empty_prompts"]
+                    if args.skip_empty_prompts
+                    else []
+                ),
+                *plan,
+            ],
+            lambda: _count_plan(w("segment_items")),
+        ),
+        Phase(
+            "pc_segment",
+            "run",
+            _runner(
+                args,
+                "pc_segment/parallel_pc_segment_script.py",
+                w("segment_items"),
+                w("segment_partial.jsonl"),
+                entry_args["pc_segment"],
+            ),
+            lambda: _count_plan(w("segment_items")),
+            sam_env,
+        ),
+        Phase(
+            "pc_segment",
+            "merge",
+            [
+                py,
+                _script("pc_segment/pc_segment_parallel_merge_script.py"),
+                "--partial",
+                w("segment_partial.jsonl"),
+                "--segment_metadata",
+                w("segment_metadata.json"),
+                "--telemetry_summary",
+                w("telemetry", "pc_segment.json"),
+            ],
+            lambda: _count_lines(w("segment_partial.jsonl")),
+        ),
+    ]
+
+    ops_stage = "pc_ops_tree_modeling" if args.fused else "pc_ops"
+    ops_cmd = [
+        py,
+        _script("pc_ops/dist_pc_ops_script.py"),
+        "--segment_dir",
+        w("segment"),
+        "--segment_metadata",
+        w("segment_metadata.json"),
+        "--img_dir",
+        w("img"),
+        "--img_metadata",
+        w("img_metadata.json"),
+        "--pc_dir",
+        w("pc"),
+        "--pc_metadata",
+        w("pc_metadata.json"),
+        "--ops_dir",
+        w("ops"),
+        "--partials_dir",
+        w("ops_partials"),
+        "--num_workers",
+        str(args.workers),
+        "--sharding",
+        args.sharding,
+        "--start_method",
+        args.start_method,
+        *(["--admission"] if args.admission else []),
+        *stage,
+    ]
+    merge_cmd = [
+        py,
+        _script("pc_ops/pc_ops_parallel_merge_script.py"),
+        "--partials_dir",
+        w("ops_partials"),
+        "--final_path",
+        w("ops_metadata.json"),
+        "--telemetry_summary",
+        w("telemetry", f"{ops_stage}.json"),
+    ]
+    if args.fused:
+        ops_cmd += [
+            "--fuse_tree_modeling",
+            "--bgt_dir",
+            w("bgt"),
+            "--bgt_metadata",
+            w("bgt_metadata.json"),
+            "--modeling_dir",
+            w("modeling"),
+        ]
+        merge_cmd += ["--modeling_index", w("modeling_index.json")]
+    phases += [
+        Phase(
+            ops_stage,
+            "run",
+            ops_cmd,
+            lambda: _count_keys(w("segment_metadata.json")),
+            # a single rank of the MPI job
+            {"PMI_RANK": "0", "PMI_SIZE": "1"},
+        ),
+        Phase(
+            ops_stage,
+            "merge",
+            merge_cmd,
+            lambda: _count_keys(w("ops_metadata.json")),
+        ),
+    ]
+    if args.fused:
+        return phases
+
+    return [
+        *phases,
+        Phase(
+            "tree_modeling",
+            "plan",
+            [
+                py,
+                _script("tree_modeling/tree_modeling_parallel_plan_script.py"),
+                "--ops_metadata",
+                w("ops_metadata.json"),
+                "--bgt_metadata",
+                w("bgt_metadata.json"),
+                "--out_items_folder",
+                w("tree_items"),
+                "--work_unit",
+                args.work_unit,
+                *plan,
+            ],
+            lambda: _count_plan(w("tree_items")),
+        ),
+        Phase(
+            "tree_modeling",
+            "run",
+            _runner(
+                args,
+                "tree_modeling/parallel_tree_modeling_script.py",
+                w("tree_items"),
+                w("tree_partial.jsonl"),
+                [
+                    *entry_args["tree_modeling"],
+                    "--ops_metadata",
+                    w("ops_metadata.json"),
+                    "--bgt_metadata",
+                    w("bgt_metadata.json"),
+                ],
+            ),
+            lambda: _count_plan(w("tree_items")),
+        ),
+        Phase(
+            "tree_modeling",
+            "merge",
+            [
+                py,
+                _script("tree_modeling/tree_modeling_parallel_merge_script.py"),
+                "--partial",
+                w("tree_partial.jsonl"),
+                "--modeling_index",
+                w("modeling_index.json"),
+                "--modeling_dir",
+                w("modeling"),
+                "--telemetry_summary",
+                w("telemetry", "tree_modeling.json"),
+                *(
+                    ["--city_dataset", w("city_dataset.gpkg")]
+                    if args.city_dataset
+                    else []
+                ),
+            ],
+            lambda: _count_lines(w("tree_partial.jsonl")),
+        ),
+    ]
+
+
+def _child_env(args: argparse.Namespace, extra: Dict[str, str]) -> Dict[str, str]:
+    paths = [str(ROOT)]
+    if args.packages == "stand_in":
+        paths.insert(0, str(STAND_INS))
+    if os.environ.get("PYTHONPATH"):
+        paths.append(os.environ["PYTHONPATH"])
+    return {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(paths),
+        INTERMEDIATE_FORMAT_ENV: args.intermediate_format,
+        **extra,
+    }
+
+
+def measure(cmd: List[str], log_path: str, env: Dict[str, str]) -> Dict[str, Any]:
+    """Run ``cmd`` through the ``measure`` subcommand in a fresh process.
+
+    The wrapper process only waits for ``cmd``, so its children's peak RSS is the
+    peak of the phase (including the worker processes ``cmd`` waited for).
+    """
+    stats_path = log_path + ".stats.json"
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.run_benchmarks",
+            "measure",
+            "--log",
+            log_path,
+            "--stats",
+            stats_path,
+            "--",
+            *cmd,
+        ],
+        env=env,
+        cwd=str(ROOT),
+        check=False,
+    )
+    if proc.returncode or not os.path.exists(stats_path):
+        return {"returncode": proc.returncode or 1, "seconds": 0.0}
+    stats: Dict[str, Any] = json.loads(Path(stats_path).read_text(encoding="utf-8"))
+    return stats
+
+
+def _measure_main(args: argparse.Namespace) -> None:
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    t0 = time.perf_counter()
+    with open(args.log, "w", encoding="utf-8") as log:
+        rc = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - t0
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    Path(args.stats).write_text(
+        json.dumps({"returncode": rc, "seconds": seconds, "max_rss_mb": rss}),
+        encoding="utf-8",
+    )
+
+
+def run_scale(args: argparse.Namespace, scale: int, root: str) -> List[Measurement]:
+    """Generate a dataset of ``scale`` tiles and run every phase on it."""
+    work = os.path.join(root, f"tiles_{scale}")
+    os.makedirs(os.path.join(work, "logs"), exist_ok=True)
+    t0 = time.perf_counter()
+    data = generate(
+        os.path.join(work, "input"),
+        scale,
+        points_per_tile=args.points_per_tile,
+        trees_per_tile=args.trees_per_tile,
+        seed=args.seed,
+    )
+    out = [Measurement(scale, "synthetic", "generate", True, time.perf_counter() - t0)]
+    # a reused --work_dir would otherwise resume the dist pc_ops run
+    shutil.rmtree(os.path.join(work, "ops_partials"), ignore_errors=True)
+    for ph in build_phases(args, data, work):
+        log = os.path.join(work, "logs", f"{ph.stage}.{ph.phase}.log")
+        stats = measure(ph.cmd, log, _child_env(args, ph.env))
+        ok = stats["returncode"] == 0
+        m = Measurement(
+            scale,
+            ph.stage,
+            ph.phase,
+            ok,
+            round(stats["seconds"], 3),
+            max_rss_mb=stats.get("max_rss_mb"),
+        )
+        if ok:
+            m.items = ph.count()
+            if m.items is not None and m.seconds > 0:
+                m.items_per_sec = round(m.items / m.seconds, 2)
+        out.append(m)
+        print(_format(m), flush=True)  # noqa: T201
+        if not ok:
+            print(f"  failed, see {log}; skipping the remaining phases")  # noqa: T201
+            break
+    return out
+
+
+def _format(m: Measurement) -> str:
+    rate = f"{m.items_per_sec:.1f}/s" if m.items_per_sec is not None else "-"
+    rss = f"{m.max_rss_mb:.0f} MB" if m.max_rss_mb is not None else "-"
+    status = "" if m.ok else " FAILED"
+    return (
+        f"{m.scale:>6} {m.stage:<22} {m.phase:<8} {m.seconds:>9.2f}s "
+        f"{m.items if m.items is not None else '-':>7} items {rate:>10} {rss:>8}"
+        f"{status}"
+    )
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=str(ROOT),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_main(args: argparse.Namespace) -> None:
+    versions = {
+        p: "stand-in" if args.packages == "stand_in" else package_version(p)
+        for p in PACKAGES
+    }
+    root = args.work_dir or tempfile.mkdtemp(prefix="gsm_bench_")
+    # inherited by every phase; only the stand-ins read it
+    os.environ[IMPORT_MS_ENV] = str(args.import_ms)
+    results: List[Measurement] = []
+    try:
+        for scale in args.scales:
+            results += run_scale(args, scale, root)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(root, ignore_errors=True)
+    report = {
+        "schema": SCHEMA_VERSION,
+        "label": args.label or _git_commit() or "unlabelled",
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "versions": versions,
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {
+            k: v
+            for k, v in vars(args).items()
+            if k not in ("command", "func", "out", "work_dir", "keep", "label")
+        },
+        "results": [asdict(m) for m in results],
+    }
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    Path(args.out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Wrote {args.out}")  # noqa: T201
+
+
+def compare(
+    base: Dict[str, Any], new: Dict[str, Any], threshold: float
+) -> Tuple[List[str], int]:
+    """Lines comparing two result files and the number of regressions."""
+
+    def key(r: Dict[str, Any]) -> Tuple[int, str, str]:
+        return r["scale"], r["stage"], r["phase"]
+
+    before = {key(r): r for r in base["results"] if r["ok"]}
+    lines = [f"{base['label']} -> {new['label']}"]
+    regressions = 0
+    for r in new["results"]:
+        b = before.get(key(r))
+        if b is None or not r["ok"]:
+            continue
+        ratio = r["seconds"] / b["seconds"] if b["seconds"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold and r["seconds"] - b["seconds"] > 0.05:
+            flag = "  REGRESSION"
+            regressions += 1
+        rss = ""
+        if b.get("max_rss_mb") and r.get("max_rss_mb"):
+            rss = f" | rss {b['max_rss_mb']:.0f} -> {r['max_rss_mb']:.0f} MB"
+        lines.append(
+            f"{r['scale']:>6} {r['stage']:<22} {r['phase']:<8} "
+            f"{b['seconds']:>8.2f}s -> {r['seconds']:>8.2f}s (x{ratio:.2f}){rss}{flag}"
+        )
+    return lines, regressions
+
+
+def _compare_main(args: argparse.Namespace) -> None:
+    base, new = (
+        json.loads(Path(p).read_text(encoding="utf-8")) for p in (args.base, args.new)
+    )
+    lines, regressions = compare(base, new, args.threshold)
+    for line in lines:
+        print(line)  # noqa: T201
+    if regressions and args.fail_on_regression:
+        sys.exit(f"{regressions} phase(s) slower by more than {args.threshold:.0%}")
+
+
+def main() -> None:
+    """Main script."""
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="Run the benchmarks")
+    run.add_argument("--scales", type=int, nargs="+", default=[100, 1000, 10000])
+    run.add_argument("--out", default="benchmark_results.json")
+    run.add_argument("--label", default=None, help="Name of this run (default: commit)")
+    run.add_argument(
+        "--work_dir", default=None, help="Keep the generated data and logs here"
+    )
+    run.add_argument("--keep", action="store_true", help="Keep the temporary work dir")
+    run.add_argument(
+        "--packages", choices=("stand_in", "installed"), default="stand_in"
+    )
+    run.add_argument(
+        "--stub_sam",
+        action="store_true",
+        help="With --packages installed, replace the SAM model with a CPU stub",
+    )
+    run.add_argument("--sam_encode_ms", type=float, default=0.0)
+    run.add_argument("--sam_decode_ms", type=float, default=0.0)
+    run.add_argument(
+        "--import_ms",
+        type=float,
+        default=0.0,
+        help="Import time of each stand-in stage module (emulates heavy packages)",
+    )
+    run.add_argument("--points_per_tile", type=int, default=1000)
+    run.add_argument("--trees_per_tile", type=int, default=5)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--mini_batch_size", type=int, default=8)
+    run.add_argument(
+        "--workers", type=int, default=2, help="Processes per parallel/dist step"
+    )
+    run.add_argument("--plan_format", choices=PLAN_FORMATS, default="folder")
+    run.add_argument("--sharding", choices=SHARDING_MODES, default="modulo")
+    run.add_argument(
+        "--fused", action="store_true", help="Benchmark the fused pc_ops stage"
+    )
+    run.add_argument(
+        "--stage_cache",
+        action="store_true",
+        help="Read the inputs of the parallel and dist steps through the staging cache",
+    )
+    run.add_argument(
+        "--intermediate_format",
+        choices=INTERMEDIATE_FORMATS,
+        default="las",
+        help="Point cloud format the stand-in packages write between the stages",
+    )
+    run.add_argument(
+        "--work_unit",
+        choices=WORK_UNITS,
+        default="tile",
+        help="tree_modeling items: whole tiles or single tree segments",
+    )
+    run.add_argument(
+        "--streaming",
+        choices=("sqlite", "directory"),
+        default=None,
+        help="Run all stages at once with streaming/stream_runner.py and this queue",
+    )
+    run.add_argument(
+        "--start_method",
+        choices=START_METHODS,
+        default="spawn",
+        help="Start method of the dist pc_ops and streaming workers",
+    )
+    run.add_argument(
+        "--admission",
+        action="store_true",
+        help="Admit dist pc_ops tiles to the pool by predicted memory",
+    )
+    run.add_argument(
+        "--city_dataset",
+        action="store_true",
+        help="Also write the city-wide GeoPackage in the tree_modeling merge",
+    )
+    run.add_argument(
+        "--skip_empty_prompts",
+        action="store_true",
+        help="Leave images without prompts out of the segment plan and run",
+    )
+    run.add_argument(
+        "--segment_workers",
+        type=int,
+        default=None,
+        help="Processes of the segment step (default: --workers)",
+    )
+    run.add_argument(
+        "--sam_server",
+        action="store_true",
+        help="Share one SAM model between the segment workers (stub server)",
+    )
+    run.add_argument(
+        "--segment_args",
+        nargs="*",
+        default=[],
+        help="Extra arguments for the segment entry script, e.g. --prefetch_depth=2",
+    )
+    run.set_defaults(func=_run_main)
+
+    cmp = sub.add_parser("compare", help="Compare two result files")
+    cmp.add_argument("base")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=0.1)
+    cmp.add_argument("--fail_on_regression", action="store_true")
+    cmp.set_defaults(func=_compare_main)
+
+    meas = sub.add_parser("measure", help=argparse.SUPPRESS)
+    meas.add_argument("--log", required=True)
+    meas.add_argument("--stats", required=True)
+    meas.add_argument("cmd", nargs=argparse.REMAINDER)
+    meas.set_defaults(func=_measure_main)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
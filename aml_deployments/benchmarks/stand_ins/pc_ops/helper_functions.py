@@ -0,0 +1,18 @@
+"""Stand-in for pc_ops.helper_functions."""
+
+from __future__ import annotations
+
+import argparse
+import json
+from typing import Any, Dict, Tuple
+
+
+def load_processed_files(
+    args: argparse.Namespace,
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """Load the segment, img and pc metadata JSON files."""
+    loaded = []
+    for path in (args.segment_metadata, args.img_metadata, args.pc_metadata):
+        with open(path, encoding="utf-8") as f:
+            loaded.append(json.load(f))
+    return loaded[0], loaded[1], loaded[2]
@@ -0,0 +1,5 @@
+"""Logger of the pc_ops stand-in."""
+
+import logging
+
+logger = logging.getLogger("pc_ops")
@@ -0,0 +1,79 @@
+"""Stand-in for pc_ops.ops_pc.
+
+Splits the points of a tile into one point cloud per mask prompt (a stand-in
+for clipping the tile to the tree masks) and writes them under ``ops_dir``.
+Columnar tiles are split into columnar point clouds, like a package that reads
+and writes them natively.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.synthetic import emulate_import_cost, split_las
+from gsm_common.columnar import is_columnar, read_columns, write_columnar
+
+emulate_import_cost()
+
+
+def configure_arg_parser() -> argparse.Namespace:
+    """Parse the pc_ops command line."""
+    p = argparse.ArgumentParser()
+    p.add_argument("--segment_dir", required=True)
+    p.add_argument("--segment_metadata", required=True)
+    p.add_argument("--img_dir", required=True)
+    p.add_argument("--img_metadata", required=True)
+    p.add_argument("--pc_dir", required=True)
+    p.add_argument("--pc_metadata", required=True)
+    p.add_argument("--ops_dir", required=True)
+    p.add_argument("--resolution", type=float, default=0.05)
+    p.add_argument("--num_workers", type=int, default=None)
+    p.add_argument("--resolve_overlapping_trees", action="store_true")
+    p.add_argument("--debug", action="store_true")
+    p.add_argument("--overwrite", action="store_true")
+    return p.parse_args()
+
+
+def process_point_cloud_wrapper(
+    args_tuple: Tuple[Any, ...],
+) -> Dict[str, Dict[str, List[str]]] | None:
+    """Process one tile; returns ``{pc_path: {"trees": [file, ...]}}`` or None."""
+    pc_path, segment_metadata, _, pc_metadata, args = args_tuple
+    mask_files = segment_metadata.get(pc_path)
+    pc_rel = pc_metadata.get(pc_path)
+    if not mask_files or not pc_rel:
+        return None
+    prompts: List[Any] = []
+    for rel in mask_files:
+        prompts += json.loads(Path(args.segment_dir, rel).read_text(encoding="utf-8"))
+    if not prompts:
+        return None
+    tile = os.path.join(args.pc_dir, pc_rel)
+    if is_columnar(tile):
+        return {pc_path: {"trees": _split_columnar(pc_path, tile, len(prompts), args)}}
+    trees: List[str] = []
+    for i, data in enumerate(split_las(tile, len(prompts))):
+        rel = f"{pc_path}.trees/tree_{i:03d}.las"
+        out = Path(args.ops_dir, rel)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_bytes(data)
+        trees.append(rel)
+    return {pc_path: {"trees": trees}}
+
+
+def _split_columnar(pc_path: str, tile: str, parts: int, args: Any) -> List[str]:
+    columns = read_columns(tile)
+    n = len(columns["x"])
+    trees: List[str] = []
+    for i in range(parts):
+        lo, hi = n * i // parts, n * (i + 1) // parts
+        rel = f"{pc_path}.trees/tree_{i:03d}.npc"
+        out = Path(args.ops_dir, rel)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        write_columnar(str(out), {k: v[lo:hi] for k, v in columns.items()})
+        trees.append(rel)
+    return trees
@@ -0,0 +1,5 @@
+"""Logger of the pc_prep stand-in."""
+
+import logging
+
+logger = logging.getLogger("pc_prep")
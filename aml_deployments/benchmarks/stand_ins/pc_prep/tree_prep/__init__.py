@@ -0,0 +1 @@
+"""Stand-in for pc_prep.tree_prep."""
@@ -0,0 +1,35 @@
+"""Stand-in for pc_prep.tree_prep.metadata_handler."""
+
+from __future__ import annotations
+
+import csv
+import math
+import os
+from typing import List, Set, Tuple
+
+from benchmarks.synthetic import TILE_SIZE
+
+
+def prepare_pc_paths(
+    tree_df_path: str, pc_metadata_df_path: str, mounted_pc_path: str
+) -> List[str]:
+    """Absolute paths of the tiles that contain at least one reference tree."""
+    cells: Set[Tuple[int, int]] = set()
+    with open(tree_df_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            cells.add(
+                (
+                    math.floor(float(row["x"]) / TILE_SIZE),
+                    math.floor(float(row["y"]) / TILE_SIZE),
+                )
+            )
+    paths: List[str] = []
+    with open(pc_metadata_df_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            cell = (
+                math.floor(float(row["minx"]) / TILE_SIZE),
+                math.floor(float(row["miny"]) / TILE_SIZE),
+            )
+            if cell in cells:
+                paths.append(os.path.join(mounted_pc_path, row["rel_path"]))
+    return paths
@@ -0,0 +1,121 @@
+"""Stand-in for pc_prep.tree_prep.prep_pc.
+
+Per tile it copies the point cloud to ``pc_dir``, renders a small raster with
+the reference trees as point prompts to ``img_dir`` and cuts the pavements of
+the tile out of the BGT file into ``bgt_dir``. With ``GSM_BENCH_INTERMEDIATE_FORMAT``
+set to ``columnar`` the tile is written as a columnar point cloud instead, like
+a package that writes the format natively.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import math
+import os
+import shutil
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from benchmarks.synthetic import (
+    INTERMEDIATE_FORMAT_ENV,
+    TILE_SIZE,
+    emulate_import_cost,
+    write_png,
+)
+from gsm_common.columnar import columnar_path, las_to_columnar
+from gsm_common.las_header import read_las_header
+
+emulate_import_cost()
+
+IMAGE_SIZE = 128
+
+_CACHE: Dict[str, Any] = {}
+
+
+def _cell(x: float, y: float) -> Tuple[int, int]:
+    return math.floor(x / TILE_SIZE), math.floor(y / TILE_SIZE)
+
+
+def _trees(path: str) -> Dict[Tuple[int, int], List[Tuple[float, float]]]:
+    key = "trees:" + path
+    if key not in _CACHE:
+        by_cell: Dict[Tuple[int, int], List[Tuple[float, float]]] = {}
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                x, y = float(row["x"]), float(row["y"])
+                by_cell.setdefault(_cell(x, y), []).append((x, y))
+        _CACHE[key] = by_cell
+    by_cell_cached: Dict[Tuple[int, int], List[Tuple[float, float]]] = _CACHE[key]
+    return by_cell_cached
+
+
+def _pavements(path: str) -> Dict[Tuple[int, int], List[Any]]:
+    key = "bgt:" + path
+    if key not in _CACHE:
+        with open(path, encoding="utf-8") as f:
+            features = json.load(f)["features"]
+        by_cell: Dict[Tuple[int, int], List[Any]] = {}
+        for feat in features:
+            x, y = feat["geometry"]["coordinates"][0][0]
+            by_cell.setdefault(_cell(x, y), []).append(feat)
+        _CACHE[key] = by_cell
+    by_cell_cached: Dict[Tuple[int, int], List[Any]] = _CACHE[key]
+    return by_cell_cached
+
+
+def process_single_pc(pc_path: str, args: argparse.Namespace) -> Dict[str, Any] | None:
+    """Prepare one tile; returns its pc/img/bgt metadata rows or None."""
+    try:
+        header = read_las_header(pc_path)
+    except (OSError, ValueError):
+        return None
+    rel = os.path.relpath(pc_path, args.pc_raw)
+    # the centre, as a tile with halo points extends into its neighbours
+    minx, miny, maxx, maxy = header.bounds_2d
+    cell = _cell((minx + maxx) / 2, (miny + maxy) / 2)
+    x0, y0 = cell[0] * TILE_SIZE, cell[1] * TILE_SIZE
+
+    pc_rel = rel
+    if os.environ.get(INTERMEDIATE_FORMAT_ENV) == "columnar":
+        pc_rel = columnar_path(rel)
+    dst = os.path.join(args.pc_dir, pc_rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if pc_rel == rel:
+        shutil.copyfile(pc_path, dst)
+    else:
+        las_to_columnar(pc_path, dst)
+
+    img_rel = rel + ".png"
+    prompt_rel = rel + ".prompts.json"
+    # a raster per tile, so image embeddings are only reused where SAM would
+    seed = zlib.crc32(rel.encode())
+    write_png(os.path.join(args.img_dir, img_rel), IMAGE_SIZE, IMAGE_SIZE, seed)
+    px = IMAGE_SIZE / TILE_SIZE
+    prompts = [
+        [round((x - x0) * px, 1), round((y - y0) * px, 1)]
+        for x, y in _trees(args.reference_trees_path).get(cell, [])
+    ]
+    Path(args.img_dir, prompt_rel).write_text(
+        json.dumps({"points": prompts}), encoding="utf-8"
+    )
+
+    bgt_rel = rel + ".geojson"
+    bgt_path = Path(args.bgt_dir, bgt_rel)
+    bgt_path.parent.mkdir(parents=True, exist_ok=True)
+    bgt_path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": _pavements(args.bgt_pavements_raw).get(cell, []),
+            }
+        ),
+        encoding="utf-8",
+    )
+    return {
+        "pc": {rel: pc_rel},
+        "img": {rel: {"img_path": img_rel, "prompt_path": prompt_rel}},
+        "bgt": {rel: bgt_rel},
+    }
@@ -0,0 +1 @@
+"""Benchmark stand-in for the pc_segment package."""
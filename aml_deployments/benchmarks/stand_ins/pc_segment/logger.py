@@ -0,0 +1,5 @@
+"""Logger of the pc_segment stand-in."""
+
+import logging
+
+logger = logging.getLogger("pc_segment")
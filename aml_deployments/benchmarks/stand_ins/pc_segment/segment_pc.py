@@ -0,0 +1,59 @@
+"""Stand-in for pc_segment.segment_pc.
+
+Decodes every image, sets it on the predictor and predicts one mask per point
+prompt, in batches of ``batch_size`` images. The masks of a tile are written as
+one JSON file under ``segment_dir``.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks.stub_sam import StubPredictor, from_environment
+from benchmarks.synthetic import read_png
+
+
+def initialize_model(model_path: str) -> StubPredictor:
+    """Stub predictor; latencies come from the environment (milliseconds)."""
+    return from_environment(model_path)
+
+
+def segment_batch_items(
+    keys: List[str],
+    preprocessing_list: List[Dict[str, str]],
+    img_dir: str,
+    segment_dir: str,
+    predictor: Any,
+    debug: bool = False,
+    batch_size: int = 2,
+) -> Dict[str, List[str]]:
+    """Segment the images of ``keys``; returns ``{key: [mask file, ...]}``."""
+    mapping: Dict[str, List[str]] = {}
+    for start in range(0, len(keys), max(1, batch_size)):
+        for key, prep in zip(
+            keys[start : start + batch_size],
+            preprocessing_list[start : start + batch_size],
+        ):
+            try:
+                _, _, pixels = read_png(os.path.join(img_dir, prep["img_path"]))
+                prompts = json.loads(
+                    Path(img_dir, prep["prompt_path"]).read_text(encoding="utf-8")
+                )["points"]
+            except (OSError, KeyError, ValueError):
+                continue
+            predictor.set_image(pixels)
+            masks = []
+            for point in prompts:
+                _, scores, _ = predictor.predict(
+                    point_coords=[point], point_labels=[1], multimask_output=False
+                )
+                masks.append({"point": point, "score": float(scores[0])})
+            rel = key + ".masks.json"
+            out = Path(segment_dir, rel)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            out.write_text(json.dumps(masks), encoding="utf-8")
+            mapping[key] = [rel]
+    return mapping
@@ -0,0 +1 @@
+"""Benchmark stand-in for the tree_modeling package."""
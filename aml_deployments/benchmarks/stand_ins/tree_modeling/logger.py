@@ -0,0 +1,5 @@
+"""Logger of the tree_modeling stand-in."""
+
+import logging
+
+logger = logging.getLogger("tree_modeling")
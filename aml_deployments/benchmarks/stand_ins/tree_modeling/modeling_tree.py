@@ -0,0 +1,64 @@
+"""Stand-in for tree_modeling.modeling_tree.
+
+Reads the tree point clouds of a tile and the BGT pavements, and writes the
+point count and height of every tree to ``modeling_dir``, and the trees as
+points (at the mean of their XY) to a GeoJSON next to it.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+
+from benchmarks.synthetic import emulate_import_cost, las_points
+from gsm_common.columnar import is_columnar, read_columns
+
+emulate_import_cost()
+
+
+def process_point_cloud(
+    pc_path: str, pc_ops_files: Any, bgt_pavements_path: str, args: Any
+) -> None:
+    """Model the trees of one tile."""
+    files: List[str] = (
+        pc_ops_files.get("trees", [])
+        if isinstance(pc_ops_files, dict)
+        else pc_ops_files
+    )
+    with open(os.path.join(args.bgt_dir, bgt_pavements_path), encoding="utf-8") as f:
+        pavements = len(json.load(f)["features"])
+    trees: List[Dict[str, Any]] = []
+    features: List[Dict[str, Any]] = []
+    for rel in files:
+        path = Path(args.ops_dir, rel)
+        if is_columnar(str(path)):
+            cols = read_columns(str(path), ["x", "y", "z"])
+            points = list(zip(*(map(float, cols[c]) for c in ("x", "y", "z"))))
+        else:
+            points = las_points(path.read_bytes())
+        tree = {
+            "file": rel,
+            "points": len(points),
+            "height": max((p[2] for p in points), default=0.0),
+        }
+        trees.append(tree)
+        if points:
+            xy = [sum(p[i] for p in points) / len(points) for i in (0, 1)]
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": xy},
+                    "properties": tree,
+                }
+            )
+    out = Path(args.modeling_dir, pc_path + ".json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(
+        json.dumps({"trees": trees, "pavements": pavements}), encoding="utf-8"
+    )
+    Path(args.modeling_dir, pc_path + ".geojson").write_text(
+        json.dumps({"type": "FeatureCollection", "features": features}),
+        encoding="utf-8",
+    )
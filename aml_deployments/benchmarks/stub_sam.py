@@ -0,0 +1,105 @@
+"""CPU-only stand-in for the SAM predictor.
+
+:class:`StubPredictor` has the ``set_image`` / ``predict`` interface of
+``segment_anything.SamPredictor`` and the state attributes that
+:class:`gsm_common.embedding_cache.CachingPredictor` stores, so the segment entry
+script runs unchanged without a GPU or model weights. ``encode_ms`` and
+``decode_ms`` emulate the encoder and decoder latency of the real model;
+``encode_batch`` (used by :mod:`gsm_common.sam_server`) emulates a GPU that
+encodes a batch of images in less time than one after the other.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+ENCODE_MS_ENV = "GSM_BENCH_SAM_ENCODE_MS"
+DECODE_MS_ENV = "GSM_BENCH_SAM_DECODE_MS"
+# cost of every further image of a batch, relative to the first
+BATCH_COST = 0.25
+
+
+class StubPredictor:
+    """SAM-style predictor that hashes the image instead of encoding it."""
+
+    def __init__(self, encode_ms: float = 0.0, decode_ms: float = 0.0) -> None:
+        """Sleep ``encode_ms`` per ``set_image`` and ``decode_ms`` per ``predict``."""
+        self.encode_ms = encode_ms
+        self.decode_ms = decode_ms
+        self.features: bytes | None = None
+        self.original_size: Tuple[int, ...] | None = None
+        self.input_size: Tuple[int, ...] | None = None
+        self.is_image_set = False
+
+    def set_image(self, image: Any, image_format: str = "RGB") -> None:
+        """Compute the "embedding" of ``image``."""
+        if self.encode_ms:
+            time.sleep(self.encode_ms / 1000.0)
+        self._embed(image)
+
+    def encode_batch(self, images: Sequence[Tuple[Any, str]]) -> List[Dict[str, Any]]:
+        """States of several images, at ``BATCH_COST`` per image after the first."""
+        if self.encode_ms and images:
+            time.sleep(self.encode_ms * (1 + BATCH_COST * (len(images) - 1)) / 1000.0)
+        states = []
+        for image, _ in images:
+            self._embed(image)
+            states.append(
+                {
+                    "features": self.features,
+                    "original_size": self.original_size,
+                    "input_size": self.input_size,
+                    "is_image_set": True,
+                }
+            )
+        return states
+
+    def _embed(self, image: Any) -> None:
+        shape = tuple(getattr(image, "shape", (len(image),)))
+        self.features = hashlib.blake2b(bytes(image), digest_size=32).digest()
+        self.original_size = shape[:2]
+        self.input_size = shape[:2]
+        self.is_image_set = True
+
+    def predict(
+        self,
+        point_coords: Any = None,
+        point_labels: Any = None,
+        box: Any = None,
+        mask_input: Any = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[Any, Any, Any]:
+        """Return ``(masks, scores, low_res_logits)`` for the current image.
+
+        Arrays are numpy when it is installed (as in the segment environment),
+        nested lists otherwise.
+        """
+        if not self.is_image_set or self.original_size is None:
+            raise RuntimeError("An image must be set with set_image before predict")
+        if self.decode_ms:
+            time.sleep(self.decode_ms / 1000.0)
+        n = 3 if multimask_output else 1
+        size = self.original_size if len(self.original_size) == 2 else (1, 1)
+        try:
+            import numpy as np
+        except ImportError:
+            h, w = size
+            masks = [[[False] * w for _ in range(h)] for _ in range(n)]
+            return masks, [0.5] * n, [[[0.0] * 256 for _ in range(256)]] * n
+        masks_np = np.zeros((n, *size), dtype=bool)
+        masks_np[:, : size[0] // 2, : size[1] // 2] = True
+        scores = np.full(n, 0.5, dtype=np.float32)
+        logits = np.zeros((n, 256, 256), dtype=np.float32)
+        return masks_np, scores, logits
+
+
+def from_environment(model_path: str) -> StubPredictor:
+    """Stub predictor; latencies come from the environment (milliseconds)."""
+    return StubPredictor(
+        encode_ms=float(os.environ.get(ENCODE_MS_ENV, "0")),
+        decode_ms=float(os.environ.get(DECODE_MS_ENV, "0")),
+    )
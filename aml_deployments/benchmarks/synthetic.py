@@ -0,0 +1,276 @@
+"""Synthetic inputs for the offline benchmarks.
+
+Generates, for ``n`` tiles on a regular grid:
+
+- uncompressed LAS 1.2 tiles (point format 0) with Cyclomedia-style names,
+  ``pc_raw/nl-rott-240101-aXXX-laz/filtered_xxxx_yyyy.las``,
+- ``pc_raw_metadata.csv`` with the relative path and bounds of every tile,
+- ``trees.csv`` with reference tree locations,
+- ``bgt_pavements.geojson`` with one pavement polygon per tile.
+
+Raster images and prompts are written by the stage that produces them
+(:func:`write_png` is shared with the stand-in packages). The stand-in stage
+modules call :func:`emulate_import_cost` on import, so worker start-up can be
+benchmarked with the import time of the real packages.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import os
+import random
+import struct
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+TILE_SIZE = 50.0
+_TILES_PER_AREA = 100
+_LAS_HEADER = struct.Struct("<4sHH16sBB32s32sHHHIIBHI5I3d3d6d")
+_LAS_POINT = struct.Struct("<iiiHBBbBH")
+_SCALE = 0.01
+IMPORT_MS_ENV = "GSM_BENCH_IMPORT_MS"
+# point cloud format the stand-in packages write between the stages
+INTERMEDIATE_FORMAT_ENV = "GSM_BENCH_INTERMEDIATE_FORMAT"
+
+
+@dataclass(frozen=True)
+class SyntheticDataset:
+    """Paths of a generated dataset."""
+
+    root: str
+    pc_raw: str
+    pc_raw_metadata: str
+    trees: str
+    bgt_pavements: str
+    tiles: int
+
+
+def tile_origin(i: int, grid: int) -> Tuple[float, float]:
+    """Lower-left corner of tile ``i`` on a ``grid`` x ``grid`` layout."""
+    return 90000.0 + (i % grid) * TILE_SIZE, 430000.0 + (i // grid) * TILE_SIZE
+
+
+def write_las(path: str, n_points: int, origin: Tuple[float, float], seed: int) -> None:
+    """Write an uncompressed LAS 1.2 file with ``n_points`` random points."""
+    rng = random.Random(seed)
+    x0, y0 = origin
+    buf = bytearray(_LAS_HEADER.size + n_points * _LAS_POINT.size)
+    zmax = 0.0
+    for k in range(n_points):
+        z = rng.random() * 25.0
+        zmax = max(zmax, z)
+        _LAS_POINT.pack_into(
+            buf,
+            _LAS_HEADER.size + k * _LAS_POINT.size,
+            int(rng.random() * TILE_SIZE / _SCALE),
+            int(rng.random() * TILE_SIZE / _SCALE),
+            int(z / _SCALE),
+            rng.randrange(65536),
+            1,
+            rng.choice((1, 2, 5)),
+            0,
+            0,
+            0,
+        )
+    _LAS_HEADER.pack_into(
+        buf,
+        0,
+        b"LASF",
+        0,
+        0,
+        bytes(16),
+        1,
+        2,
+        b"gsm benchmark",
+        b"gsm benchmark",
+        1,
+        2024,
+        _LAS_HEADER.size,
+        _LAS_HEADER.size,
+        0,
+        0,
+        _LAS_POINT.size,
+        n_points,
+        n_points,
+        0,
+        0,
+        0,
+        0,
+        _SCALE,
+        _SCALE,
+        _SCALE,
+        x0,
+        y0,
+        0.0,
+        x0 + TILE_SIZE,
+        x0,
+        y0 + TILE_SIZE,
+        y0,
+        zmax,
+        0.0,
+    )
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_bytes(bytes(buf))
+
+
+def write_png(path: str, width: int, height: int, seed: int) -> None:
+    """Write a random 8-bit grayscale PNG."""
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(width) for _ in range(height))
+
+    def _chunk(tag: bytes, data: bytes) -> bytes:
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+        + _chunk(b"IDAT", zlib.compress(raw, 1))
+        + _chunk(b"IEND", b"")
+    )
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_bytes(png)
+
+
+def read_png(path: str) -> Tuple[int, int, bytes]:
+    """Read a PNG written by :func:`write_png` as ``(width, height, pixels)``."""
+    data = Path(path).read_bytes()
+    width, height = struct.unpack(">II", data[16:24])
+    pos, idat = 8, b""
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        if data[pos + 4 : pos + 8] == b"IDAT":
+            idat += data[pos + 8 : pos + 8 + length]
+        pos += length + 12
+    raw = zlib.decompress(idat)
+    # every scanline starts with its filter byte (always 0 here)
+    pixels = b"".join(
+        raw[r * (width + 1) + 1 : (r + 1) * (width + 1)] for r in range(height)
+    )
+    return width, height, pixels
+
+
+def split_las(path: str, parts: int) -> List[bytes]:
+    """Split the points of a LAS file into ``parts`` files' worth of bytes.
+
+    Each part gets a copy of the header with its point count updated.
+    """
+    data = Path(path).read_bytes()
+    header = bytearray(data[: _LAS_HEADER.size])
+    points = data[_LAS_HEADER.size :]
+    n = len(points) // _LAS_POINT.size
+    out: List[bytes] = []
+    for k in range(parts):
+        lo, hi = n * k // parts, n * (k + 1) // parts
+        # legacy point count and the first "points by return" entry
+        struct.pack_into("<I", header, 107, hi - lo)
+        struct.pack_into("<I", header, 111, hi - lo)
+        out.append(bytes(header) + points[lo * _LAS_POINT.size : hi * _LAS_POINT.size])
+    return out
+
+
+def las_points(data: bytes) -> List[Tuple[float, float, float]]:
+    """XYZ of the points in LAS bytes from :func:`write_las` or :func:`split_las`."""
+    scales = struct.unpack_from("<3d", data, 131)
+    offsets = struct.unpack_from("<3d", data, 155)
+    return [
+        (
+            rec[0] * scales[0] + offsets[0],
+            rec[1] * scales[1] + offsets[1],
+            rec[2] * scales[2] + offsets[2],
+        )
+        for rec in _LAS_POINT.iter_unpack(data[_LAS_HEADER.size :])
+    ]
+
+
+def generate(
+    root: str,
+    tiles: int,
+    points_per_tile: int = 1000,
+    trees_per_tile: int = 5,
+    seed: int = 0,
+) -> SyntheticDataset:
+    """Generate a dataset of ``tiles`` tiles under ``root``."""
+    rng = random.Random(seed)
+    grid = max(1, int(tiles**0.5 + 0.999))
+    pc_raw = os.path.join(root, "pc_raw")
+    rows: List[Dict[str, object]] = []
+    trees: List[Tuple[int, float, float]] = []
+    features = []
+    for i in range(tiles):
+        rel = (
+            f"nl-rott-240101-a{i // _TILES_PER_AREA:03d}-laz/"
+            f"filtered_{i % grid:04d}_{i // grid:04d}.las"
+        )
+        x0, y0 = tile_origin(i, grid)
+        write_las(os.path.join(pc_raw, rel), points_per_tile, (x0, y0), seed + i)
+        rows.append(
+            {
+                "rel_path": rel,
+                "minx": x0,
+                "miny": y0,
+                "maxx": x0 + TILE_SIZE,
+                "maxy": y0 + TILE_SIZE,
+            }
+        )
+        for _ in range(trees_per_tile):
+            trees.append(
+                (
+                    len(trees),
+                    x0 + rng.random() * TILE_SIZE,
+                    y0 + rng.random() * TILE_SIZE,
+                )
+            )
+        features.append(
+            {
+                "type": "Feature",
+                "properties": {"tile": rel},
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [x0, y0],
+                            [x0 + TILE_SIZE, y0],
+                            [x0 + TILE_SIZE, y0 + 5.0],
+                            [x0, y0 + 5.0],
+                            [x0, y0],
+                        ]
+                    ],
+                },
+            }
+        )
+
+    meta_path = os.path.join(root, "pc_raw_metadata.csv")
+    with open(meta_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["rel_path"])
+        writer.writeheader()
+        writer.writerows(rows)
+    trees_path = os.path.join(root, "trees.csv")
+    with open(trees_path, "w", newline="", encoding="utf-8") as f:
+        tw = csv.writer(f)
+        tw.writerow(["tree_id", "x", "y"])
+        tw.writerows(trees)
+    bgt_path = os.path.join(root, "bgt_pavements.geojson")
+    Path(bgt_path).write_text(
+        json.dumps({"type": "FeatureCollection", "features": features}),
+        encoding="utf-8",
+    )
+    return SyntheticDataset(
+        root=root,
+        pc_raw=pc_raw,
+        pc_raw_metadata=meta_path,
+        trees=trees_path,
+        bgt_pavements=bgt_path,
+        tiles=tiles,
+    )
+
+
+def emulate_import_cost() -> None:
+    """Sleep for the import time set in ``GSM_BENCH_IMPORT_MS`` (stand-ins)."""
+    ms = float(os.environ.get(IMPORT_MS_ENV, "0"))
+    if ms > 0:
+        time.sleep(ms / 1000.0)
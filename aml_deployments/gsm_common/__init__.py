@@ -0,0 +1,5 @@
+"""Shared helpers for the AML entry scripts in aml_deployments.
+
+Only the standard library is used here, so the modules can be imported from
+the lightweight merge components as well as from the package environments.
+"""
@@ -0,0 +1,416 @@
+"""Memory-aware admission of tiles to a pool of worker processes.
+
+A plain ``multiprocessing.Pool`` starts a tile on every free worker. When a few
+dense tiles run at the same time the node runs out of memory and the kernel
+kills the whole rank. :class:`AdmissionPool` sits between the shard and its
+workers:
+
+- :class:`MemoryModel` predicts the peak resident memory of a worker on a tile
+  from the tile's size (the sharding cost, i.e. point count or file size) and
+  refines the prediction from the peaks the workers report.
+- A tile only starts while the predicted memory of all running tiles, plus the
+  idle workers, fits the memory budget (by default 85% of the cgroup or
+  physical memory limit). A tile that does not fit waits for the running ones;
+  smaller tiles behind it may start meanwhile only if they leave room for it,
+  so a large tile is never starved. With nothing running a tile always starts,
+  so tiles over the budget run alone.
+- A worker that ends a tile with its resident memory far above an idle
+  worker's, or that has run ``max_tasks_per_worker`` tiles, is replaced by a
+  fresh one.
+- A worker that dies on a tile (usually killed for memory) only loses that tile:
+  it is retried once on its own and the worker is replaced.
+
+Workers are started from the given multiprocessing context, so the thread caps,
+CPU pinning and start-up probe initializers of the pool apply as well. Every
+worker has a slot; a replacement takes over the slot of the worker it replaces
+(:func:`gsm_common.resources.set_worker_slot`), and with it that worker's CPUs.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import os
+import resource
+import threading
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+from gsm_common.cli import str_to_bool
+from gsm_common.resources import set_worker_slot
+from gsm_common.sharding import COST_BYTES_PER_POINT
+
+logger = logging.getLogger(__name__)
+
+# resident bytes per point assumed before any tile was observed
+DEFAULT_BYTES_PER_POINT = 200.0
+DEFAULT_BUDGET_FRACTION = 0.85
+_LOOKAHEAD = 64
+_MIN_SAMPLES = 3
+_PAGE = os.sysconf("SC_PAGE_SIZE")
+
+
+def current_rss() -> int:
+    """Resident bytes of this process."""
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as f:
+            return int(f.read().split()[1]) * _PAGE
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KiB on Linux; the peak is the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRss:
+    """Track the peak resident memory of this process over the enclosed block."""
+
+    def __init__(self, interval_s: float = 0.05) -> None:
+        """Sample every ``interval_s`` seconds from a background thread."""
+        self.interval_s = interval_s
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self) -> PeakRss:
+        """Start sampling."""
+        self.start = self.peak = current_rss()
+        self._maxrss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        """Stop sampling; a new lifetime peak of the process counts too."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if maxrss > self._maxrss0:
+            self.peak = max(self.peak, maxrss * 1024)
+        self.peak = max(self.peak, current_rss())
+
+
+class MemoryModel:
+    """Predicted peak resident memory of a worker per tile size.
+
+    ``peak = baseline + safety * bytes_per_cost * size``, where ``baseline`` is
+    the largest resident memory seen at the start of a tile and
+    ``bytes_per_cost`` the ``quantile`` of the observed ``(peak - start) /
+    size`` once a few tiles were seen, else the prior.
+    """
+
+    def __init__(
+        self,
+        bytes_per_cost: float = DEFAULT_BYTES_PER_POINT / COST_BYTES_PER_POINT,
+        baseline: float = 0.0,
+        safety: float = 1.25,
+        quantile: float = 0.9,
+    ) -> None:
+        """Start from the prior ``bytes_per_cost`` and ``baseline``."""
+        self.prior = bytes_per_cost
+        self.baseline = baseline
+        self.safety = safety
+        self.quantile = quantile
+        self._ratios: List[float] = []
+        # tiles that killed their worker: at least this much next time
+        self._floor: Dict[str, float] = {}
+
+    @property
+    def bytes_per_cost(self) -> float:
+        """Current estimate of the resident bytes per unit of size."""
+        if len(self._ratios) < _MIN_SAMPLES:
+            return max([self.prior, *self._ratios])
+        ratios = sorted(self._ratios)
+        return ratios[min(len(ratios) - 1, math.ceil(self.quantile * len(ratios)) - 1)]
+
+    def predict(self, key: str, size: float) -> float:
+        """Predicted peak resident bytes of a worker on tile ``key``."""
+        predicted = self.baseline + self.safety * self.bytes_per_cost * size
+        return max(predicted, self._floor.get(key, 0.0))
+
+    def observe(self, size: float, start: int, peak: int) -> None:
+        """Learn from a finished tile."""
+        self.baseline = max(self.baseline, float(start))
+        if size > 0 and peak > start:
+            self._ratios.append((peak - start) / size)
+
+    def killed(self, key: str, predicted: float, budget: float) -> None:
+        """The worker died on ``key``: assume it needs the whole budget."""
+        self._floor[key] = max(budget, 2 * predicted)
+
+
+def _worker_main(
+    conn: Any,
+    func: Callable[[Any], Any],
+    initializer: Any,
+    initargs: Tuple[Any, ...],
+    slot: int,
+) -> None:
+    set_worker_slot(slot)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        key, task = msg
+        with PeakRss() as rss:
+            try:
+                value, ok = func(task), True
+            except Exception as ex:  # reported to the parent, the worker goes on
+                value, ok = repr(ex), False
+        conn.send((key, ok, value, rss.start, rss.peak, current_rss()))
+
+
+class _Worker:
+    def __init__(
+        self,
+        ctx: Any,
+        func: Callable[[Any], Any],
+        initializer: Any,
+        initargs: Tuple[Any, ...],
+        slot: int,
+    ) -> None:
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child, func, initializer, initargs, slot)
+        )
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        self.key: str | None = None
+        self.predicted = 0.0
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class AdmissionPool:
+    """Run tiles on worker processes while their predicted memory fits.
+
+    Use as a context manager; :meth:`imap` yields ``(key, ok, value)`` per tile,
+    with ``value`` the result of ``func(task)``, or the error if not ``ok``.
+    """
+
+    def __init__(
+        self,
+        ctx: Any,
+        processes: int,
+        func: Callable[[Any], Any],
+        budget_bytes: float,
+        model: MemoryModel | None = None,
+        initializer: Any = None,
+        initargs: Tuple[Any, ...] = (),
+        max_tasks_per_worker: int | None = None,
+        recycle_rss_bytes: float | None = None,
+    ) -> None:
+        """Start ``processes`` workers that run ``func`` on the tasks.
+
+        A worker is replaced after ``max_tasks_per_worker`` tiles, or when its
+        resident memory after a tile exceeds an idle worker's by more than
+        ``recycle_rss_bytes`` (default: a quarter of its share of the budget).
+        """
+        self.ctx = ctx
+        self.func = func
+        self.budget = budget_bytes
+        self.model = model or MemoryModel()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_tasks = max_tasks_per_worker
+        self.recycle_rss = (
+            recycle_rss_bytes
+            if recycle_rss_bytes is not None
+            else budget_bytes / max(1, processes) / 4
+        )
+        self.processes = processes
+        self.workers: List[_Worker] = []
+        self.stats = {"held_back": 0, "recycled": 0, "killed": 0, "peak_predicted": 0.0}
+
+    def __enter__(self) -> AdmissionPool:
+        """Start the workers."""
+        self.workers = [self._spawn(slot) for slot in range(self.processes)]
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        """Stop the workers."""
+        for w in self.workers:
+            w.stop()
+        self.workers = []
+
+    def _spawn(self, slot: int) -> _Worker:
+        return _Worker(self.ctx, self.func, self.initializer, self.initargs, slot)
+
+    def _replace(self, worker: _Worker) -> None:
+        worker.stop()
+        slot = self.workers.index(worker)
+        self.workers[slot] = self._spawn(slot)
+
+    def _committed(self) -> float:
+        """Predicted memory of the running tiles plus the idle workers."""
+        return sum(w.predicted if w.key else self.model.baseline for w in self.workers)
+
+    def _pick(
+        self, pending: List[str], sizes: Mapping[str, float]
+    ) -> Tuple[int, float] | None:
+        """Index and prediction of the next tile to start, if any fits."""
+        busy = any(w.key for w in self.workers)
+        committed = self._committed() - self.model.baseline  # one idle worker starts
+        head = self.model.predict(pending[0], sizes.get(pending[0], 0.0))
+        if not busy or committed + head <= self.budget:
+            return 0, head
+        # backfill only while the head still fits once the running tiles end
+        reserve = head - self.model.baseline
+        for i, key in enumerate(pending[1:_LOOKAHEAD], start=1):
+            predicted = self.model.predict(key, sizes.get(key, 0.0))
+            if committed + predicted + reserve <= self.budget:
+                return i, predicted
+        return None
+
+    def imap(
+        self,
+        keys: Sequence[str],
+        make_task: Callable[[str], Any],
+        sizes: Mapping[str, float],
+        claim: Callable[[str], bool] | None = None,
+        claimed: List[str] | None = None,
+    ) -> Iterator[Tuple[str, bool, Any]]:
+        """Run ``make_task(key)`` for the keys, in order as far as memory allows.
+
+        With ``claim``, a key is only run if ``claim(key)`` is true when it is
+        about to start; started keys are appended to ``claimed``.
+        """
+        pending = list(keys)
+        owned: set[str] = set()
+        retried: set[str] = set()
+        while pending or any(w.key for w in self.workers):
+            for worker in self.workers:
+                if worker.key or not pending:
+                    continue
+                pick = self._pick(pending, sizes)
+                if pick is None:
+                    self.stats["held_back"] += 1
+                    break
+                i, predicted = pick
+                key = pending.pop(i)
+                if key not in owned:
+                    if claim is not None and not claim(key):
+                        continue
+                    owned.add(key)
+                    if claimed is not None:
+                        claimed.append(key)
+                worker.key, worker.predicted = key, predicted
+                worker.conn.send((key, make_task(key)))
+                self.stats["peak_predicted"] = max(
+                    self.stats["peak_predicted"], self._committed()
+                )
+            busy = [w for w in self.workers if w.key]
+            if not busy:
+                continue
+            ready = wait([w.conn for w in busy] + [w.process.sentinel for w in busy])
+            for worker in busy:
+                if worker.conn not in ready and worker.process.sentinel not in ready:
+                    continue
+                try:
+                    key, ok, value, start, peak, after = worker.conn.recv()
+                except EOFError:
+                    yield from self._died(worker, pending, retried)
+                    continue
+                self.model.observe(sizes.get(key, 0.0), start, peak)
+                worker.key = None
+                worker.tasks += 1
+                yield key, ok, value
+                if (self.max_tasks and worker.tasks >= self.max_tasks) or (
+                    after - self.model.baseline > self.recycle_rss
+                ):
+                    self.stats["recycled"] += 1
+                    self._replace(worker)
+
+    def _died(
+        self, worker: _Worker, pending: List[str], retried: set[str]
+    ) -> Iterator[Tuple[str, bool, Any]]:
+        """Replace a worker that died on its tile; retry the tile once, alone."""
+        worker.process.join()
+        key = worker.key or ""
+        code = worker.process.exitcode
+        self.stats["killed"] += 1
+        logger.warning(
+            "Worker died on %s (exit code %s, predicted %.1f GB).",
+            key,
+            code,
+            worker.predicted / 1e9,
+        )
+        self.model.killed(key, worker.predicted, self.budget)
+        worker.key = None
+        self._replace(worker)
+        if key in retried:
+            yield key, False, f"worker died (exit code {code})"
+            return
+        retried.add(key)
+        pending.insert(0, key)
+
+    def describe(self) -> str:
+        """One line for the log."""
+        return (
+            f"budget {self.budget / 1e9:.1f} GB, peak predicted "
+            f"{self.stats['peak_predicted'] / 1e9:.1f} GB, "
+            f"{self.model.bytes_per_cost:.3g} B per cost unit, baseline "
+            f"{self.model.baseline / 1e6:.0f} MB, held back "
+            f"{self.stats['held_back']}x, {self.stats['recycled']} workers "
+            f"recycled, {self.stats['killed']} killed"
+        )
+
+
+def memory_budget(
+    limit_bytes: int | None, fraction: float = DEFAULT_BUDGET_FRACTION
+) -> float:
+    """Bytes the workers may use: ``fraction`` of the limit minus this process."""
+    if not limit_bytes:
+        return math.inf
+    return max(0.0, fraction * limit_bytes - current_rss())
+
+
+def add_admission_arguments(ap: Any) -> None:
+    """Add the admission control options of the entry scripts."""
+    ap.add_argument(
+        "--admission",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help="Start tiles only while their predicted memory fits the node",
+    )
+    ap.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=None,
+        help="Memory for the workers (default: 85%% of the cgroup/physical limit)",
+    )
+    ap.add_argument(
+        "--memory_per_point_bytes",
+        type=float,
+        default=DEFAULT_BYTES_PER_POINT,
+        help="Resident bytes per point assumed before tiles were observed",
+    )
+    ap.add_argument(
+        "--max_tasks_per_worker",
+        type=int,
+        default=None,
+        help="Replace a worker after this many tiles",
+    )
+    ap.add_argument(
+        "--recycle_rss_gb",
+        type=float,
+        default=None,
+        help="Replace a worker whose memory after a tile grew by more than this",
+    )
@@ -0,0 +1,652 @@
+"""City-wide tree dataset: one GeoPackage with an R-tree, and a query API.
+
+The tree_modeling merge step streams the per-tile outputs in ``modeling_dir``
+into a single GeoPackage (:class:`CityDatasetWriter`):
+
+- ``trees`` — one row per feature, with its geometry (GeoPackage binary with an
+  envelope), the tile it came from, the source file and its attributes as
+  columns. Tiles are written one after another in Z-order, so the rows of a
+  tile, and of neighbouring tiles, are stored together.
+- ``rtree_trees_geom`` — the GeoPackage R-tree spatial index of the features.
+- ``tiles`` — one row per tile (partition) with its bounds, feature count and
+  fid range.
+
+:func:`query` reads only the features whose bounding box intersects a bbox
+(through the R-tree) and that match attribute filters; :func:`tiles_in_bbox`
+lists the partitions. Everything uses the standard library (sqlite3), so it
+runs on the merge image; GIS tools open the file as any GeoPackage.
+
+Per-tile outputs are read from GeoPackages (all feature tables), GeoJSON
+feature collections and CSV files with ``x``/``y`` columns.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Tuple,
+)
+
+from gsm_common.tile_index import tile_code, zorder
+
+logger = logging.getLogger(__name__)
+
+TABLE = "trees"
+TILES_TABLE = "tiles"
+GEOM_COLUMN = "geom"
+RTREE = f"rtree_{TABLE}_{GEOM_COLUMN}"
+FEATURE_SUFFIXES = (".gpkg", ".geojson", ".csv")
+# Amersfoort / RD New
+DEFAULT_SRS_ID = 28992
+
+BBox = Tuple[float, float, float, float]  # minx, miny, maxx, maxy
+Feature = Tuple[bytes, BBox, Dict[str, Any]]  # WKB, bounds, attributes
+
+_RESERVED = {"fid", GEOM_COLUMN, "tile", "source"}
+_OPS = {"=", "!=", "<", "<=", ">", ">=", "like", "in"}
+_WKB_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+}
+
+
+# ----------------------------------------------------------------- geometry
+
+
+def _geojson_wkb(geom: Mapping[str, Any]) -> Tuple[bytes, List[Tuple[float, float]]]:
+    """2D little-endian WKB of a GeoJSON geometry and its vertices."""
+    kind = geom["type"]
+    coords = geom["coordinates"]
+    points: List[Tuple[float, float]] = []
+
+    def _ring(ring: Sequence[Sequence[float]]) -> bytes:
+        pts = [(float(p[0]), float(p[1])) for p in ring]
+        points.extend(pts)
+        return struct.pack("<I", len(pts)) + b"".join(
+            struct.pack("<2d", *p) for p in pts
+        )
+
+    def _body(kind: str, coords: Any) -> bytes:
+        if kind == "Point":
+            points.append((float(coords[0]), float(coords[1])))
+            return struct.pack("<2d", *points[-1])
+        if kind == "LineString":
+            return _ring(coords)
+        if kind == "Polygon":
+            return struct.pack("<I", len(coords)) + b"".join(_ring(r) for r in coords)
+        part = kind[len("Multi") :]
+        return struct.pack("<I", len(coords)) + b"".join(
+            struct.pack("<BI", 1, _WKB_TYPES[part]) + _body(part, c) for c in coords
+        )
+
+    if kind not in _WKB_TYPES:
+        raise ValueError(f"Unsupported geometry type {kind}")
+    wkb = struct.pack("<BI", 1, _WKB_TYPES[kind]) + _body(kind, coords)
+    return wkb, points
+
+
+def _wkb_bounds(wkb: bytes) -> BBox | None:
+    """Bounds of a (2D, Z, M or ZM; ISO or EWKB) WKB geometry."""
+    xs: List[float] = []
+    ys: List[float] = []
+
+    def _read(pos: int) -> int:
+        order = "<" if wkb[pos] == 1 else ">"
+        (code,) = struct.unpack_from(order + "I", wkb, pos + 1)
+        pos += 5
+        dims = 2
+        if code & 0x20000000:  # EWKB SRID
+            pos += 4
+        dims += bool(code & 0x80000000) + bool(code & 0x40000000)
+        code &= 0x0FFFFFFF
+        dims += {1: 1, 2: 1, 3: 2}.get(code // 1000, 0)
+        kind = code % 1000
+        step = 8 * dims
+
+        def _coords(n: int, pos: int) -> int:
+            for i in range(n):
+                x, y = struct.unpack_from(order + "2d", wkb, pos + i * step)
+                xs.append(x)
+                ys.append(y)
+            return pos + n * step
+
+        if kind == 1:
+            return _coords(1, pos)
+        (n,) = struct.unpack_from(order + "I", wkb, pos)
+        pos += 4
+        if kind == 2:
+            return _coords(n, pos)
+        if kind == 3:
+            for _ in range(n):
+                (m,) = struct.unpack_from(order + "I", wkb, pos)
+                pos = _coords(m, pos + 4)
+            return pos
+        if kind in (4, 5, 6, 7):
+            for _ in range(n):
+                pos = _read(pos)
+            return pos
+        raise ValueError(f"Unsupported WKB type {code}")
+
+    _read(0)
+    # NaN coordinates mark an empty point
+    pts = [(x, y) for x, y in zip(xs, ys) if x == x and y == y]
+    if not pts:
+        return None
+    return (
+        min(p[0] for p in pts),
+        min(p[1] for p in pts),
+        max(p[0] for p in pts),
+        max(p[1] for p in pts),
+    )
+
+
+def gpkg_blob(wkb: bytes, bbox: BBox | None, srs_id: int) -> bytes:
+    """GeoPackage binary geometry with an ``[minx, maxx, miny, maxy]`` envelope."""
+    if bbox is None:
+        return b"GP" + struct.pack("<BBi", 0, 0x11, srs_id) + wkb  # empty, no envelope
+    minx, miny, maxx, maxy = bbox
+    header = b"GP" + struct.pack("<BBi4d", 0, 0x03, srs_id, minx, maxx, miny, maxy)
+    return header + wkb
+
+
+def split_gpkg_blob(blob: bytes) -> Tuple[bytes, BBox | None]:
+    """WKB and envelope (if any) of a GeoPackage binary geometry."""
+    if blob[:2] != b"GP":
+        raise ValueError("Not a GeoPackage geometry")
+    flags = blob[3]
+    order = "<" if flags & 1 else ">"
+    envelope = (flags >> 1) & 0x7
+    size = {0: 0, 1: 4, 2: 6, 3: 6, 4: 8}[envelope]
+    wkb = blob[8 + 8 * size :]
+    if size:
+        minx, maxx, miny, maxy = struct.unpack_from(order + "4d", blob, 8)
+        return wkb, (minx, miny, maxx, maxy)
+    return wkb, _wkb_bounds(wkb)
+
+
+# ------------------------------------------------------------------ readers
+
+
+def _read_gpkg(path: str) -> Iterator[Feature]:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = con.execute(
+            "SELECT c.table_name, g.column_name FROM gpkg_contents c "
+            "JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+            "WHERE c.data_type = 'features'"
+        ).fetchall()
+        for table, geom_col in tables:
+            cur = con.execute(f'SELECT * FROM "{table}"')
+            names = [d[0] for d in cur.description]
+            for row in cur:
+                attrs = dict(zip(names, row))
+                blob = attrs.pop(geom_col)
+                attrs.pop("fid", None)
+                if not blob:
+                    continue
+                wkb, bbox = split_gpkg_blob(blob)
+                if bbox is not None:
+                    yield wkb, bbox, attrs
+    finally:
+        con.close()
+
+
+def _read_geojson(path: str) -> Iterator[Feature]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get("type") != "FeatureCollection":
+        return
+    for feat in data.get("features", []):
+        if not feat.get("geometry"):
+            continue
+        wkb, pts = _geojson_wkb(feat["geometry"])
+        if pts:
+            bbox = (
+                min(p[0] for p in pts),
+                min(p[1] for p in pts),
+                max(p[0] for p in pts),
+                max(p[1] for p in pts),
+            )
+            yield wkb, bbox, dict(feat.get("properties") or {})
+
+
+def _read_csv(path: str) -> Iterator[Feature]:
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        fields = {c.lower(): c for c in reader.fieldnames or []}
+        if "x" not in fields or "y" not in fields:
+            return
+        for row in reader:
+            try:
+                x, y = float(row[fields["x"]]), float(row[fields["y"]])
+            except (TypeError, ValueError):
+                continue
+            attrs: Dict[str, Any] = {k: _parse_scalar(v) for k, v in row.items()}
+            yield struct.pack("<BI2d", 1, 1, x, y), (x, y, x, y), attrs
+
+
+def _parse_scalar(value: str | None) -> Any:
+    if value is None or value == "":
+        return None
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            continue
+    return value
+
+
+def read_features(path: str) -> Iterator[Feature]:
+    """Features of a per-tile output file (GeoPackage, GeoJSON or CSV)."""
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".gpkg":
+        return _read_gpkg(path)
+    if suffix == ".geojson":
+        return _read_geojson(path)
+    if suffix == ".csv":
+        return _read_csv(path)
+    return iter(())
+
+
+# ------------------------------------------------------------------- writer
+
+
+def _column_name(name: str) -> str:
+    clean = re.sub(r"[^0-9A-Za-z_]", "_", str(name)) or "_"
+    return f"attr_{clean}" if clean.lower() in _RESERVED else clean
+
+
+def _sql_type(value: Any) -> str:
+    if isinstance(value, bool) or isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+
+def _sql_value(value: Any) -> Any:
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    return json.dumps(value)
+
+
+class CityDatasetWriter:
+    """Write features tile by tile into one GeoPackage.
+
+    Use as a context manager; the spatial index and tile table are complete
+    once it is closed.
+    """
+
+    def __init__(self, path: str, srs_id: int = DEFAULT_SRS_ID) -> None:
+        """Create (or replace) the GeoPackage at ``path``."""
+        self.path = path
+        self.srs_id = srs_id
+        # SQLite needs file locking, which mounted outputs may not support:
+        # build the file on local disk and move it into place when closed
+        fd, self._tmp = tempfile.mkstemp(suffix=".gpkg")
+        os.close(fd)
+        os.remove(self._tmp)
+        self.con = sqlite3.connect(self._tmp)
+        self.columns: Dict[str, str] = {}
+        self.features = 0
+        self.tiles = 0
+        self._bounds: List[float] | None = None
+        self._create()
+
+    def _create(self) -> None:
+        c = self.con
+        c.execute("PRAGMA application_id = 1196444487")  # 'GPKG'
+        c.execute("PRAGMA user_version = 10300")
+        c.execute("PRAGMA journal_mode = MEMORY")
+        c.execute("PRAGMA synchronous = OFF")
+        c.executescript(
+            """
+            CREATE TABLE gpkg_spatial_ref_sys (
+                srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY,
+                organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+                definition TEXT NOT NULL, description TEXT);
+            CREATE TABLE gpkg_contents (
+                table_name TEXT PRIMARY KEY, data_type TEXT NOT NULL,
+                identifier TEXT UNIQUE, description TEXT DEFAULT '',
+                last_change DATETIME NOT NULL
+                    DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                srs_id INTEGER);
+            CREATE TABLE gpkg_geometry_columns (
+                table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+                geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+                z TINYINT NOT NULL, m TINYINT NOT NULL,
+                PRIMARY KEY (table_name, column_name));
+            CREATE TABLE gpkg_extensions (
+                table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+                definition TEXT NOT NULL, scope TEXT NOT NULL);
+            """
+        )
+        c.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+                ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ],
+        )
+        if self.srs_id > 0:
+            c.execute(
+                "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, 'EPSG', ?, ?, NULL)",
+                (f"EPSG:{self.srs_id}", self.srs_id, self.srs_id, "undefined"),
+            )
+        c.execute(
+            f'CREATE TABLE "{TABLE}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, '
+            f'"{GEOM_COLUMN}" BLOB, tile TEXT, source TEXT)'
+        )
+        c.execute(
+            f"CREATE TABLE {TILES_TABLE} (tile TEXT PRIMARY KEY, min_x REAL, "
+            "min_y REAL, max_x REAL, max_y REAL, features INTEGER, "
+            "first_fid INTEGER, last_fid INTEGER)"
+        )
+        try:
+            c.execute(
+                f"CREATE VIRTUAL TABLE {RTREE} USING rtree(id, minx, maxx, miny, maxy)"
+            )
+            c.execute(
+                "INSERT INTO gpkg_extensions VALUES (?, ?, 'gpkg_rtree_index', "
+                "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                (TABLE, GEOM_COLUMN),
+            )
+        except sqlite3.OperationalError:
+            # SQLite without R-tree: same columns, so queries work unchanged
+            logger.warning("SQLite has no R-tree module; using a plain bbox table")
+            c.execute(
+                f"CREATE TABLE {RTREE} (id INTEGER PRIMARY KEY, minx REAL, maxx REAL, "
+                "miny REAL, maxy REAL)"
+            )
+            c.execute(f"CREATE INDEX {RTREE}_x ON {RTREE} (minx, maxx)")
+
+    def _ensure_columns(self, attrs: Mapping[str, Any]) -> None:
+        for name, value in attrs.items():
+            col = _column_name(name)
+            if col not in self.columns and value is not None:
+                self.con.execute(
+                    f'ALTER TABLE "{TABLE}" ADD COLUMN "{col}" {_sql_type(value)}'
+                )
+                self.columns[col] = _sql_type(value)
+
+    def add_tile(self, tile: str, source: str, features: Iterable[Feature]) -> int:
+        """Append the features of one output file of ``tile``; returns their count.
+
+        The file is added in one transaction: if reading it fails, none of its
+        features are kept and the error is raised.
+        """
+        try:
+            count = self._add(tile, source, features)
+        except Exception:
+            self.con.rollback()
+            info = self.con.execute(f'PRAGMA table_info("{TABLE}")').fetchall()
+            self.columns = {r[1]: r[2] for r in info if r[1] in self.columns}
+            raise
+        self.features += count
+        return count
+
+    def _add(self, tile: str, source: str, features: Iterable[Feature]) -> int:
+        count = 0
+        bounds: List[float] | None = None
+        first = last = None
+        for wkb, bbox, attrs in features:
+            self._ensure_columns(attrs)
+            values = {_column_name(k): _sql_value(v) for k, v in attrs.items()}
+            values = {k: v for k, v in values.items() if k in self.columns}
+            cols = ", ".join(f'"{c}"' for c in values)
+            marks = ", ".join("?" for _ in values)
+            cur = self.con.execute(
+                f'INSERT INTO "{TABLE}" ("{GEOM_COLUMN}", tile, source'
+                f"{', ' + cols if cols else ''}) VALUES (?, ?, ?"
+                f"{', ' + marks if marks else ''})",
+                (gpkg_blob(wkb, bbox, self.srs_id), tile, source, *values.values()),
+            )
+            last = cur.lastrowid
+            first = last if first is None else first
+            minx, miny, maxx, maxy = bbox
+            self.con.execute(
+                f"INSERT INTO {RTREE} VALUES (?, ?, ?, ?, ?)",
+                (last, minx, maxx, miny, maxy),
+            )
+            bounds = _grow(bounds, bbox)
+            count += 1
+        if bounds is not None:
+            self.con.execute(
+                f"INSERT INTO {TILES_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(tile) DO UPDATE SET "
+                "min_x = min(min_x, excluded.min_x), min_y = min(min_y, excluded.min_y), "
+                "max_x = max(max_x, excluded.max_x), max_y = max(max_y, excluded.max_y), "
+                "features = features + excluded.features, "
+                "last_fid = excluded.last_fid",
+                (tile, *bounds, count, first, last),
+            )
+            self._bounds = _grow(self._bounds, bounds)
+            self.con.commit()
+        return count
+
+    def close(self) -> None:
+        """Register the feature table and move the file into place."""
+        b: Sequence[float | None] = self._bounds or (None, None, None, None)
+        self.con.execute(
+            "INSERT INTO gpkg_contents (table_name, data_type, identifier, "
+            "min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'features', ?, ?, ?, ?, ?, ?)",
+            (TABLE, TABLE, *b, self.srs_id),
+        )
+        self.con.execute(
+            "INSERT INTO gpkg_geometry_columns VALUES (?, ?, 'GEOMETRY', ?, 0, 0)",
+            (TABLE, GEOM_COLUMN, self.srs_id),
+        )
+        self.con.execute(f'CREATE INDEX "{TABLE}_tile" ON "{TABLE}" (tile)')
+        self.tiles = self.con.execute(f"SELECT count(*) FROM {TILES_TABLE}").fetchone()[
+            0
+        ]
+        self.con.commit()
+        self.con.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        shutil.move(self._tmp, self.path)
+
+    def __enter__(self) -> "CityDatasetWriter":
+        """Return the writer."""
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        """Close on success; drop the partial file on error."""
+        if exc_type is None:
+            self.close()
+            return
+        self.con.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+def _grow(bounds: List[float] | None, bbox: Sequence[float]) -> List[float]:
+    if bounds is None:
+        return list(bbox)
+    return [
+        min(bounds[0], bbox[0]),
+        min(bounds[1], bbox[1]),
+        max(bounds[2], bbox[2]),
+        max(bounds[3], bbox[3]),
+    ]
+
+
+def find_feature_files(modeling_dir: str, skip: Sequence[str] = ()) -> List[str]:
+    """Per-tile feature files under ``modeling_dir`` (relative POSIX paths).
+
+    Top-level folders in ``skip`` (e.g. the tree unit folders) are not listed.
+    """
+    out: List[str] = []
+    for folder, dirs, files in os.walk(modeling_dir):
+        if folder == modeling_dir:
+            dirs[:] = [d for d in dirs if d not in skip]
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(FEATURE_SUFFIXES):
+                rel = os.path.relpath(os.path.join(folder, f), modeling_dir)
+                out.append(rel.replace(os.sep, "/"))
+    return out
+
+
+def write_city_dataset(
+    modeling_dir: str,
+    path: str,
+    srs_id: int = DEFAULT_SRS_ID,
+    skip: Sequence[str] = (),
+) -> CityDatasetWriter:
+    """Stream the per-tile feature files of ``modeling_dir`` into ``path``.
+
+    Files are written in Z-order of their tiles; a file's tile is the tile code
+    in its name (or its path without suffix). Returns the closed writer, whose
+    ``features`` and ``tiles`` count what was written.
+    """
+    files = zorder(find_feature_files(modeling_dir, skip))
+    with CityDatasetWriter(path, srs_id) as writer:
+        for rel in files:
+            tile = tile_code(os.path.splitext(rel)[0]) or os.path.splitext(rel)[0]
+            try:
+                writer.add_tile(
+                    tile, rel, read_features(os.path.join(modeling_dir, rel))
+                )
+            except (
+                ValueError,
+                KeyError,
+                sqlite3.DatabaseError,
+                json.JSONDecodeError,
+            ) as e:
+                logger.warning("Skipping %s: %s", rel, e)
+    return writer
+
+
+# -------------------------------------------------------------------- query
+
+
+def _filters(
+    where: Mapping[str, Any] | Sequence[Tuple[str, str, Any]] | None,
+    columns: Sequence[str],
+) -> Tuple[List[str], List[Any]]:
+    if not where:
+        return [], []
+    terms = (
+        [
+            (k, "in" if isinstance(v, (list, tuple, set)) else "=", v)
+            for k, v in where.items()
+        ]
+        if isinstance(where, Mapping)
+        else list(where)
+    )
+    clauses: List[str] = []
+    params: List[Any] = []
+    for col, op, value in terms:
+        op = op.lower()
+        if col not in columns:
+            raise KeyError(f"Unknown column {col!r}; columns are {sorted(columns)}")
+        if op not in _OPS:
+            raise ValueError(f"Unsupported operator {op!r}")
+        if op == "in":
+            values = list(value)
+            clauses.append(f't."{col}" IN ({", ".join("?" for _ in values)})')
+            params += values
+        else:
+            clauses.append(f't."{col}" {op} ?')
+            params.append(value)
+    return clauses, params
+
+
+def query(
+    path: str,
+    bbox: BBox | None = None,
+    where: Mapping[str, Any] | Sequence[Tuple[str, str, Any]] | None = None,
+    columns: Sequence[str] | None = None,
+) -> Iterator[Dict[str, Any]]:
+    """Features intersecting ``bbox`` (by bounding box) that match ``where``.
+
+    Args:
+        path: City dataset GeoPackage.
+        bbox: ``(minx, miny, maxx, maxy)`` in the dataset's SRS; None for all.
+        where: ``{column: value}`` (lists mean IN) or ``(column, op, value)``
+            tuples with op one of ``= != < <= > >= like in``; all must hold.
+        columns: Attribute columns to return (default all).
+
+    Yields:
+        Dicts of the requested attributes plus ``fid``, ``tile`` and
+        ``geometry`` (WKB bytes).
+    """
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        available = [r[1] for r in con.execute(f'PRAGMA table_info("{TABLE}")')]
+        wanted = [c for c in (columns or available) if c not in (GEOM_COLUMN,)]
+        unknown = [c for c in wanted if c not in available]
+        if unknown:
+            raise KeyError(f"Unknown columns {unknown}")
+        select = ", ".join(f't."{c}"' for c in dict.fromkeys(["fid", "tile", *wanted]))
+        sql = f'SELECT {select}, t."{GEOM_COLUMN}" FROM "{TABLE}" t'
+        clauses, params = _filters(where, available)
+        if bbox is not None:
+            sql += f" JOIN {RTREE} r ON r.id = t.fid"
+            clauses = [
+                "r.minx <= ?",
+                "r.maxx >= ?",
+                "r.miny <= ?",
+                "r.maxy >= ?",
+                *clauses,
+            ]
+            params = [bbox[2], bbox[0], bbox[3], bbox[1], *params]
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        cur = con.execute(sql, params)
+        names = [d[0] for d in cur.description][:-1]
+        for *values, blob in cur:
+            row = dict(zip(names, values))
+            row["geometry"] = split_gpkg_blob(blob)[0] if blob else None
+            yield row
+    finally:
+        con.close()
+
+
+def tiles_in_bbox(path: str, bbox: BBox | None = None) -> List[Dict[str, Any]]:
+    """Partitions (tiles) of the dataset whose bounds intersect ``bbox``."""
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        sql = f"SELECT * FROM {TILES_TABLE}"
+        params: List[Any] = []
+        if bbox is not None:
+            sql += " WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?"
+            params = [bbox[2], bbox[0], bbox[3], bbox[1]]
+        cur = con.execute(sql + " ORDER BY first_fid", params)
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, r)) for r in cur]
+    finally:
+        con.close()
+
+
+def to_geodataframe(
+    rows: Iterable[Mapping[str, Any]], crs: Any = DEFAULT_SRS_ID
+) -> Any:
+    """GeoDataFrame of :func:`query` rows (imports geopandas/shapely)."""
+    import geopandas as gpd
+    import shapely
+
+    rows = list(rows)
+    geoms = shapely.from_wkb([r["geometry"] for r in rows])
+    data = [{k: v for k, v in r.items() if k != "geometry"} for r in rows]
+    return gpd.GeoDataFrame(data, geometry=geoms, crs=crs)
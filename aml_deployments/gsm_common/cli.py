@@ -0,0 +1,13 @@
+"""Argument parsing helpers shared by the entry scripts and gsm_common."""
+
+from __future__ import annotations
+
+
+def str_to_bool(value: str) -> bool:
+    """Parse a boolean program argument (``True`` / ``1`` / ``yes``, any case).
+
+    AML passes pipeline booleans as ``True`` / ``False`` strings, so flags are
+    declared as ``nargs="?", const=True, type=str_to_bool`` and accept both
+    ``--flag`` and ``--flag False``.
+    """
+    return value.lower() in ("true", "1", "yes")
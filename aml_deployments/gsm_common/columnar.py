@@ -0,0 +1,181 @@
+"""Columnar, memory-mappable point clouds for intermediates between stages.
+
+A columnar point cloud is a folder ``<name>.npc`` holding one NumPy array per
+point attribute and a ``meta.json``::
+
+    tile.npc/
+        meta.json        # point count, bounds, scales/offsets, columns
+        x.npy y.npy z.npy
+        intensity.npy classification.npy ...
+
+``x``/``y``/``z`` are the scaled coordinates (float64); the other LAS dimensions
+keep their stored integer types. :func:`read_columns` loads only the requested
+columns, memory-mapped, so a stage that needs XYZ and a label never decodes the
+rest. With ``compress`` the arrays are zlib-compressed (``<column>.npy.z``);
+they are then decompressed on read instead of mapped.
+
+Raw input tiles and final outputs stay LAS/LAZ. :func:`load_point_cloud` reads
+either format, so consumers can switch without knowing which one a producer
+wrote; the ``.npc`` suffix in the metadata records the format.
+
+The stage packages still read and write LAS/LAZ, so no production step writes
+the format: only the benchmark stand-ins write it natively. The entry scripts,
+telemetry, sharding and staging cache accept ``.npc`` folders wherever a
+package names them.
+
+numpy is imported on first use, laspy only to read LAS/LAZ.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import zlib
+from typing import Any, Dict, Iterable, Mapping
+
+
+INTERMEDIATE_FORMATS = ("las", "columnar")
+COLUMNAR_SUFFIX = ".npc"
+_META = "meta.json"
+_LAS_SUFFIXES = (".las", ".laz")
+_COORDS = ("x", "y", "z")
+_RAW_COORDS = ("X", "Y", "Z")
+
+
+def is_columnar(path: str) -> bool:
+    """Whether ``path`` is a columnar point cloud folder."""
+    return os.path.isfile(os.path.join(path, _META))
+
+
+def read_meta(path: str) -> Dict[str, Any]:
+    """The ``meta.json`` of a columnar point cloud."""
+    with open(os.path.join(path, _META), encoding="utf-8") as f:
+        meta: Dict[str, Any] = json.load(f)
+    return meta
+
+
+def columnar_point_count(path: str) -> int:
+    """Point count of a columnar point cloud, from its metadata only."""
+    return int(read_meta(path)["points"])
+
+
+def write_columnar(
+    path: str,
+    columns: Mapping[str, Any],
+    header: Mapping[str, Any] | None = None,
+    compress: bool = False,
+) -> None:
+    """Write arrays of equal length as a columnar point cloud at ``path``.
+
+    The folder is written next to ``path`` and renamed into place, so readers
+    never see a partial point cloud.
+    """
+    import numpy as np
+
+    arrays = {name: np.ascontiguousarray(a) for name, a in columns.items()}
+    lengths = {len(a) for a in arrays.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns of different lengths: {sorted(lengths)}")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta_columns: Dict[str, Dict[str, Any]] = {}
+    for name, array in arrays.items():
+        file_name = f"{name}.npy"
+        if compress:
+            file_name += ".z"
+            with open(os.path.join(tmp, file_name), "wb") as f:
+                f.write(zlib.compress(array.tobytes(), 1))
+        else:
+            np.save(os.path.join(tmp, file_name), array, allow_pickle=False)
+        meta_columns[name] = {
+            "file": file_name,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+    meta = {
+        "format": "columnar",
+        "version": 1,
+        "points": lengths.pop() if lengths else 0,
+        "columns": meta_columns,
+        "header": dict(header or {}),
+    }
+    with open(os.path.join(tmp, _META), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def read_columns(path: str, columns: Iterable[str] | None = None) -> Dict[str, Any]:
+    """Arrays of ``columns`` (all if None) of a columnar point cloud.
+
+    Uncompressed columns are memory-mapped read-only; nothing is read from disk
+    until the array is used.
+
+    Raises:
+        KeyError: If a requested column does not exist.
+    """
+    import numpy as np
+
+    meta = read_meta(path)
+    available: Dict[str, Dict[str, Any]] = meta["columns"]
+    names = list(available) if columns is None else list(columns)
+    out: Dict[str, Any] = {}
+    for name in names:
+        if name not in available:
+            raise KeyError(f"No column {name!r} in {path} ({sorted(available)})")
+        info = available[name]
+        file_path = os.path.join(path, info["file"])
+        if info["file"].endswith(".z"):
+            with open(file_path, "rb") as f:
+                data = zlib.decompress(f.read())
+            out[name] = np.frombuffer(data, dtype=info["dtype"]).reshape(info["shape"])
+        else:
+            out[name] = np.load(file_path, mmap_mode="r", allow_pickle=False)
+    return out
+
+
+def _las_columns(las: Any) -> Dict[str, Any]:
+    import numpy as np
+
+    columns = {c: np.asarray(getattr(las, c), dtype=np.float64) for c in _COORDS}
+    for dim in las.point_format.dimension_names:
+        if dim not in _RAW_COORDS:
+            columns[dim] = np.asarray(las[dim])
+    return columns
+
+
+def load_point_cloud(path: str, columns: Iterable[str] | None = None) -> Dict[str, Any]:
+    """Arrays of ``columns`` (all if None) of a columnar or LAS/LAZ point cloud."""
+    if is_columnar(path):
+        return read_columns(path, columns)
+    import laspy
+
+    all_columns = _las_columns(laspy.read(path))
+    if columns is None:
+        return all_columns
+    return {c: all_columns[c] for c in columns}
+
+
+def las_to_columnar(las_path: str, path: str, compress: bool = False) -> None:
+    """Convert a LAS/LAZ file to a columnar point cloud at ``path``."""
+    import laspy
+
+    las = laspy.read(las_path)
+    h = las.header
+    header = {
+        "las_version": str(h.version),
+        "point_format": int(h.point_format.id),
+        "scales": [float(v) for v in h.scales],
+        "offsets": [float(v) for v in h.offsets],
+        "min_xyz": [float(v) for v in h.mins],
+        "max_xyz": [float(v) for v in h.maxs],
+        "source": os.path.basename(las_path),
+    }
+    write_columnar(path, _las_columns(las), header, compress)
+
+
+def columnar_path(rel_path: str) -> str:
+    """Path of the columnar counterpart of a LAS/LAZ path."""
+    return os.path.splitext(rel_path)[0] + COLUMNAR_SUFFIX
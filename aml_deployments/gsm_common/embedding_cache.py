@@ -0,0 +1,184 @@
+"""Image embedding reuse and adaptive batch sizing for the SAM predictor.
+
+:class:`CachingPredictor` wraps a SAM-style predictor (``set_image`` computes
+the image encoder embedding, ``predict`` uses it). When an image that was
+encoded recently is set again, for example for another prompt set or when a
+batch is retried after running out of GPU memory, the stored embedding is
+restored instead of running the encoder again.
+
+:class:`AdaptiveBatchSize` picks the SAM batch size from the measured memory
+per pixel and the size of the images about to be processed (see
+:func:`image_pixels`), and backs off on out-of-memory errors.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Predictor attributes that hold the state of the last set_image call
+# (segment_anything.SamPredictor and sam2.SAM2ImagePredictor naming).
+_STATE_ATTRS = (
+    "features",
+    "original_size",
+    "input_size",
+    "is_image_set",
+    "_features",
+    "_orig_hw",
+    "_is_image_set",
+    "_is_batch",
+)
+
+
+def image_key(image: Any) -> str:
+    """Content hash of an image array (anything exposing the buffer protocol)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(
+        repr((getattr(image, "shape", None), str(getattr(image, "dtype", "")))).encode()
+    )
+    try:
+        h.update(memoryview(image))
+    except (TypeError, ValueError, BufferError):
+        # non-contiguous arrays have to be copied first
+        h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def predictor_state(predictor: Any) -> Dict[str, Any]:
+    """State of the last ``set_image`` call of ``predictor``."""
+    return {
+        name: getattr(predictor, name)
+        for name in _STATE_ATTRS
+        if hasattr(predictor, name)
+    }
+
+
+def restore_state(predictor: Any, state: Dict[str, Any]) -> None:
+    """Make ``predictor`` hold the image of a :func:`predictor_state`."""
+    for name, value in state.items():
+        setattr(predictor, name, value)
+
+
+def image_pixels(path: str) -> int | None:
+    """Pixel count from the header of the image at ``path``, None if unreadable."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        # opening only parses the header; the pixels are not decoded
+        with Image.open(path) as image:
+            width, height = image.size
+    except OSError:
+        return None
+    return int(width) * int(height)
+
+
+def is_oom_error(ex: BaseException) -> bool:
+    """True for CUDA / allocator out-of-memory errors."""
+    return "out of memory" in str(ex).lower() or type(ex).__name__ == "OutOfMemoryError"
+
+
+class CachingPredictor:
+    """Predictor proxy that keeps the last ``capacity`` image embeddings."""
+
+    def __init__(self, predictor: Any, capacity: int = 4) -> None:
+        """Wrap ``predictor``; everything but ``set_image`` is passed through."""
+        object.__setattr__(self, "_predictor", predictor)
+        object.__setattr__(self, "_capacity", max(0, capacity))
+        object.__setattr__(self, "_cache", OrderedDict())
+        object.__setattr__(self, "hits", 0)
+        object.__setattr__(self, "misses", 0)
+        object.__setattr__(self, "pixels", 0)
+
+    def set_image(self, image: Any, *args: Any, **kwargs: Any) -> None:
+        """Restore a stored embedding of ``image``, or compute and store it."""
+        shape = getattr(image, "shape", None)
+        if shape is not None and len(shape) >= 2:
+            object.__setattr__(self, "pixels", int(shape[0]) * int(shape[1]))
+        if not self._capacity:
+            self._predictor.set_image(image, *args, **kwargs)
+            object.__setattr__(self, "misses", self.misses + 1)
+            return
+        key = image_key(image) + repr((args, sorted(kwargs.items())))
+        state = self._cache.get(key)
+        if state is not None:
+            self._cache.move_to_end(key)
+            restore_state(self._predictor, state)
+            object.__setattr__(self, "hits", self.hits + 1)
+            return
+        self._predictor.set_image(image, *args, **kwargs)
+        object.__setattr__(self, "misses", self.misses + 1)
+        self._cache[key] = predictor_state(self._predictor)
+        while len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+
+    def __getattr__(self, name: str) -> Any:
+        """Delegate everything else to the wrapped predictor."""
+        return getattr(self._predictor, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Set attributes on the wrapped predictor."""
+        setattr(self._predictor, name, value)
+
+
+class AdaptiveBatchSize:
+    """Batch size from free memory and the measured peak memory per pixel.
+
+    Without a memory reading the size grows by one after every ``grow_after``
+    successful batches. An out-of-memory error halves it (additive increase,
+    multiplicative decrease).
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        maximum: int,
+        free_memory: Callable[[], int | None],
+        headroom: float = 0.8,
+        grow_after: int = 4,
+    ) -> None:
+        """Start at ``initial`` and never exceed ``maximum``."""
+        self.size = max(1, initial)
+        self.maximum = max(self.size, maximum)
+        self.free_memory = free_memory
+        self.headroom = headroom
+        self.grow_after = grow_after
+        self.bytes_per_pixel: float | None = None
+        self.ceiling = self.maximum
+        self._streak = 0
+
+    def suggest(self, pixels: int) -> int:
+        """Batch size for images of ``pixels`` pixels."""
+        free = self.free_memory()
+        if free and self.bytes_per_pixel and pixels:
+            fit = int(free * self.headroom / (self.bytes_per_pixel * pixels))
+            return max(1, min(fit, self.ceiling))
+        return max(1, min(self.size, self.ceiling))
+
+    def observe(self, batch: int, pixels: int, peak_bytes: int | None) -> None:
+        """Record a successful batch and its peak memory use."""
+        if peak_bytes and batch and pixels:
+            per_pixel = peak_bytes / (batch * pixels)
+            prev = self.bytes_per_pixel
+            self.bytes_per_pixel = per_pixel if prev is None else max(per_pixel, prev)
+        self._streak += 1
+        if self._streak >= self.grow_after and self.size < self.ceiling:
+            self.size += 1
+            self._streak = 0
+
+    def backoff(self, batch: int) -> int:
+        """Halve the size after an out-of-memory error and return the new size."""
+        self.size = max(1, batch // 2)
+        # do not grow back into the size that failed
+        self.ceiling = max(1, min(self.ceiling, batch - 1))
+        self._streak = 0
+        return self.size
+
+    def describe(self) -> Dict[str, Any]:
+        """Current state for the run statistics."""
+        return {"batch_size": self.size, "ceiling": self.ceiling}
@@ -0,0 +1,58 @@
+"""Minimal LAS/LAZ public header reader.
+
+Reads only the fixed-size public header block, which is identical for LAS and
+LAZ files, so point counts and bounds can be obtained without decompressing
+the point records.
+"""
+
+from __future__ import annotations
+
+import struct
+from dataclasses import dataclass
+from typing import Tuple
+
+_HEADER_SIZE = 375
+_SIGNATURE = b"LASF"
+
+
+@dataclass(frozen=True)
+class LasHeader:
+    """Subset of the LAS public header block."""
+
+    version: Tuple[int, int]
+    point_count: int
+    min_xyz: Tuple[float, float, float]
+    max_xyz: Tuple[float, float, float]
+
+    @property
+    def bounds_2d(self) -> Tuple[float, float, float, float]:
+        """Return (minx, miny, maxx, maxy)."""
+        return self.min_xyz[0], self.min_xyz[1], self.max_xyz[0], self.max_xyz[1]
+
+
+def read_las_header(path: str) -> LasHeader:
+    """Read the public header of a LAS/LAZ file.
+
+    Raises:
+        ValueError: If the file is not a LAS/LAZ file.
+    """
+    with open(path, "rb") as f:
+        buf = f.read(_HEADER_SIZE)
+    if len(buf) < 227 or buf[:4] != _SIGNATURE:
+        raise ValueError(f"Not a LAS/LAZ file: {path}")
+
+    version = (buf[24], buf[25])
+    legacy_count = struct.unpack_from("<I", buf, 107)[0]
+    max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from("<6d", buf, 179)
+
+    point_count = legacy_count
+    # LAS 1.4 stores the authoritative 64-bit count further down the header.
+    if version >= (1, 4) and len(buf) >= 255:
+        point_count = struct.unpack_from("<Q", buf, 247)[0] or legacy_count
+
+    return LasHeader(
+        version=version,
+        point_count=int(point_count),
+        min_xyz=(min_x, min_y, min_z),
+        max_xyz=(max_x, max_y, max_z),
+    )
@@ -0,0 +1,329 @@
+"""Content-addressed completion ledger for resumable pipeline runs.
+
+Every completed item is recorded as
+``<ledger_dir>/<stage>/<version>/<fingerprint>.json`` holding the item key and
+the result row the stage produced for it, so one ledger folder serves all runs
+and the entries of an old package version can be removed as a whole. The
+fingerprint hashes the stage, the item key, the item inputs, the package
+version and the parameters that change the output, so an entry is only found
+again when nothing relevant changed. The inputs include the size/mtime
+signatures of the upstream files an item reads (:func:`file_signatures`,
+:func:`record_signatures`), not only their paths, so an upstream stage that
+rewrote a file invalidates the items that read it.
+
+Plan scripts list the stage directory once, leave completed items out of the
+plan, and copy their recorded rows into a ``carried_over`` JSONL that the merge
+step reads before the fresh partial results. The parallel scripts record each
+item as soon as it succeeds (write to a temporary file, then rename), so a
+retry after a node loss only redoes unfinished items.
+
+Outputs are referenced relative to the stage output folders, so an entry must
+only be reused together with the same output folders. The pipelines write them
+per run name and add the run name to ``--ledger_params``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata as importlib_metadata
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from gsm_common.cli import str_to_bool
+from gsm_common.staging_cache import record_paths
+
+logger = logging.getLogger(__name__)
+
+_READ_THREADS = 32
+
+
+def package_version(package: str) -> str:
+    """Installed version of ``package``, or ``unknown``."""
+    try:
+        return importlib_metadata.version(package)
+    except importlib_metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def parse_params(pairs: Sequence[str] | None) -> Dict[str, str]:
+    """Parse ``key=value`` strings into a dict."""
+    params: Dict[str, str] = {}
+    for pair in pairs or ():
+        key, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError(f"Expected key=value, got {pair!r}")
+        params[key.strip()] = value.strip()
+    return params
+
+
+def ledger_version(args: argparse.Namespace, package: str) -> str:
+    """``--ledger_version``, or the installed version of ``package``."""
+    version: str = args.ledger_version or package_version(package)
+    return version
+
+
+def fingerprint(
+    stage: str,
+    key: str,
+    inputs: Any,
+    version: str,
+    params: Mapping[str, Any],
+) -> str:
+    """Content hash of one unit of work."""
+    payload = json.dumps(
+        {
+            "stage": stage,
+            "key": key,
+            "inputs": inputs,
+            "version": version,
+            "params": dict(params),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_signatures(paths: Iterable[str]) -> Dict[str, str]:
+    """Size/mtime signature per file, with one directory listing per parent folder.
+
+    Listing a folder returns the attributes of all its files at once, which is far
+    cheaper than a metadata call per file on blob mounts. Missing files get ``""``.
+    """
+    by_parent: Dict[str, List[str]] = {}
+    for p in paths:
+        by_parent.setdefault(os.path.dirname(p), []).append(p)
+    out: Dict[str, str] = {}
+    for parent, files in by_parent.items():
+        listing: Dict[str, str] = {}
+        try:
+            with os.scandir(parent or ".") as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    listing[entry.name] = f"{st.st_size}:{st.st_mtime_ns}"
+        except OSError as ex:
+            logger.warning("Could not list %s: %s", parent, ex)
+        for p in files:
+            out[p] = listing.get(os.path.basename(p), "")
+    return out
+
+
+def record_signatures(
+    records: Mapping[str, Sequence[Tuple[str, Any]]],
+) -> Dict[str, List[str]]:
+    """Size/mtime signatures of the files metadata records reference, per item.
+
+    ``records`` maps an item key to ``(root, record)`` pairs; the relative paths
+    nested in each record are resolved against its root (records without a root
+    are skipped). All files are signed in one :func:`file_signatures` call, so
+    each folder is listed once for all items. The signatures are returned in
+    record order, without the roots, which differ between mounts.
+    """
+    paths = {
+        key: [
+            os.path.join(root, rel)
+            for root, record in pairs
+            if root
+            for rel in sorted(record_paths(record))
+        ]
+        for key, pairs in records.items()
+    }
+    signatures = file_signatures(p for ps in paths.values() for p in ps)
+    return {key: [signatures[p] for p in ps] for key, ps in paths.items()}
+
+
+class CompletionLedger:
+    """Completion records of one stage."""
+
+    def __init__(self, ledger_dir: str, stage: str, version: str) -> None:
+        """Use ``<ledger_dir>/<stage>/<version>``, creating it if needed."""
+        self.root = Path(ledger_dir) / stage / version
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, fp: str) -> Path:
+        return self.root / f"{fp}.json"
+
+    def completed(self) -> Set[str]:
+        """Fingerprints of all completed items (one directory listing)."""
+        with os.scandir(self.root) as it:
+            return {
+                e.name[: -len(".json")]
+                for e in it
+                if e.name.endswith(".json") and not e.name.startswith(".")
+            }
+
+    def record(self, fp: str, key: str, row: Mapping[str, Any]) -> None:
+        """Atomically record a completed item and the result row it produced."""
+        tmp = self.root / f".{fp}.{os.getpid()}.tmp"
+        tmp.write_text(
+            json.dumps({"key": key, "row": row}, separators=(",", ":")),
+            encoding="utf-8",
+        )
+        os.replace(tmp, self._path(fp))
+
+    def read_row(self, fp: str) -> Dict[str, Any] | None:
+        """Recorded result row of ``fp``, or None if unreadable."""
+        try:
+            entry = json.loads(self._path(fp).read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as ex:
+            logger.warning("Unreadable ledger entry %s: %s", fp, ex)
+            return None
+        row = entry.get("row")
+        return row if isinstance(row, dict) else None
+
+    def read_rows(self, fps: Sequence[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Read recorded rows concurrently, yielding ``(fp, row)`` in input order."""
+        with ThreadPoolExecutor(max_workers=_READ_THREADS) as ex:
+            for fp, row in zip(fps, ex.map(self.read_row, fps)):
+                if row is not None:
+                    yield fp, row
+
+
+def split_completed(
+    ledger: CompletionLedger,
+    items: Sequence[Dict[str, Any]],
+    out_carried_over: str | None,
+) -> List[Dict[str, Any]]:
+    """Drop completed items from a plan and write their rows to ``carried_over``.
+
+    Every item must carry a ``fingerprint``. Completed items whose recorded row
+    cannot be read are kept in the plan, so they are simply recomputed.
+    """
+    done = ledger.completed()
+    candidates = [it["fingerprint"] for it in items if it["fingerprint"] in done]
+    carried: Set[str] = set()
+    if out_carried_over:
+        Path(out_carried_over).parent.mkdir(parents=True, exist_ok=True)
+        with open(out_carried_over, "w", encoding="utf-8") as f:
+            for fp, row in ledger.read_rows(candidates):
+                f.write(json.dumps(row, separators=(",", ":")) + "\n")
+                carried.add(fp)
+    remaining = [it for it in items if it["fingerprint"] not in carried]
+    logger.info(
+        "Ledger %s: %d/%d items already complete, %d to run.",
+        ledger.root,
+        len(carried),
+        len(items),
+        len(remaining),
+    )
+    return remaining
+
+
+def carry_completed(
+    ledger: CompletionLedger,
+    fps: Mapping[str, str],
+    keys: Sequence[str],
+    rows: Dict[str, Any],
+    claims: Any = None,
+) -> List[str]:
+    """Copy the recorded rows of completed ``keys`` into ``rows``; returns the rest.
+
+    With ``claims`` (a ``sharding.ClaimDirectory``) a completed key is only
+    carried by the rank that claims it, so every recorded row ends up in exactly
+    one partial; claimed keys whose row cannot be read are released again.
+    """
+    done = ledger.completed()
+    completed = [k for k in keys if fps[k] in done]
+    if claims is not None:
+        completed = [k for k in completed if claims.try_claim(k)]
+    by_fp = {fps[k]: k for k in completed}
+    carried: Set[str] = set()
+    for fp, row in ledger.read_rows(list(by_fp)):
+        rows.update(row)
+        carried.add(by_fp[fp])
+    if claims is not None:
+        for k in completed:
+            if k not in carried:
+                claims.release(k)
+    return [k for k in keys if k not in carried]
+
+
+def plan_with_ledger(
+    items: List[Dict[str, Any]],
+    args: argparse.Namespace,
+    stage: str,
+    package: str,
+    key_of: Callable[[Dict[str, Any]], str],
+    inputs_of: Callable[[Dict[str, Any]], Any],
+) -> List[Dict[str, Any]]:
+    """Fingerprint plan items and drop the completed ones (see module docstring).
+
+    Without ``--ledger_dir`` the items are returned unchanged and an empty
+    ``carried_over`` file is written, so the merge input always exists. With
+    ``--overwrite`` the items are fingerprinted (so they are recorded again) but
+    none are carried over.
+    """
+    if not args.ledger_dir or args.overwrite:
+        if args.out_carried_over:
+            Path(args.out_carried_over).parent.mkdir(parents=True, exist_ok=True)
+            Path(args.out_carried_over).write_text("", encoding="utf-8")
+        if not args.ledger_dir:
+            return items
+    version = ledger_version(args, package)
+    params = parse_params(args.ledger_params)
+    for it in items:
+        it["fingerprint"] = fingerprint(
+            stage, key_of(it), inputs_of(it), version, params
+        )
+    if args.overwrite:
+        return items
+    return split_completed(
+        CompletionLedger(args.ledger_dir, stage, version),
+        items,
+        args.out_carried_over,
+    )
+
+
+def add_ledger_arguments(ap: argparse.ArgumentParser, plan: bool = False) -> None:
+    """Add the ledger options of plan (``plan=True``) or parallel scripts."""
+    ap.add_argument(
+        "--ledger_dir",
+        default=None,
+        help="Completion ledger folder; resumable runs are disabled when omitted",
+    )
+    ap.add_argument(
+        "--ledger_version",
+        default=None,
+        help="Package version the entries are kept under (default: installed)",
+    )
+    if plan:
+        ap.add_argument(
+            "--ledger_params",
+            nargs="*",
+            action="extend",
+            default=None,
+            help="key=value parameters that change the stage output (repeatable)",
+        )
+        ap.add_argument(
+            "--overwrite",
+            nargs="?",
+            const=True,
+            default=False,
+            type=str_to_bool,
+            help="Plan every item again instead of carrying over completed ones",
+        )
+        ap.add_argument(
+            "--out_carried_over",
+            default=None,
+            help="JSONL with the recorded rows of completed items (merge input)",
+        )
@@ -0,0 +1,156 @@
+"""Key -> record metadata stores with point lookups.
+
+The merge steps can write an SQLite index next to each metadata JSON. Workers
+open it with :func:`open_metadata`, which costs the same for any number of
+tiles, and only read the records of the tiles they process. The same function
+also opens the existing JSON metadata files, so both can be passed wherever a
+metadata path is expected.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Iterator, Mapping
+
+_SQLITE_MAGIC = b"SQLite format 3\x00"
+_COMMIT_EVERY = 10_000
+
+
+def is_sqlite_index(path: str) -> bool:
+    """Return True if ``path`` is an SQLite file (by magic header)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+class SqliteIndexWriter:
+    """Build an SQLite key -> JSON record index.
+
+    The database is built in a local temporary file and copied to ``path`` on
+    close, since SQLite should not be written through a blob mount.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Start a new index that will be written to ``path``."""
+        self.path = path
+        fd, self._tmp = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self._conn = sqlite3.connect(self._tmp)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE records (key TEXT PRIMARY KEY, value TEXT NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        self._pending = 0
+        self.count = 0
+
+    def put(self, key: str, value: Any) -> None:
+        """Insert or replace one record."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)",
+            (key, json.dumps(value, separators=(",", ":"))),
+        )
+        self.count += 1
+        self._pending += 1
+        if self._pending >= _COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        """Finalize the index and copy it to its destination."""
+        self._conn.commit()
+        self._conn.close()
+        try:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._tmp, self.path)
+        finally:
+            os.remove(self._tmp)
+
+
+class SqliteMetadataStore(Mapping[str, Any]):
+    """Read-only mapping backed by an SQLite index.
+
+    The connection is opened lazily so the store can be created before workers
+    are forked and each process gets its own connection.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Wrap the index at ``path``."""
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            # immutable=1 skips locking, which read-only blob mounts do not support
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro&immutable=1"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._conn
+
+    def __getitem__(self, key: str) -> Any:
+        """Look up one record."""
+        row = (
+            self._connection()
+            .execute("SELECT value FROM records WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key: object) -> bool:
+        """Check for a key without decoding its record."""
+        if not isinstance(key, str):
+            return False
+        row = (
+            self._connection()
+            .execute("SELECT 1 FROM records WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row is not None
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over keys in key order."""
+        cursor = self._connection().execute("SELECT key FROM records ORDER BY key")
+        return (r[0] for r in cursor)
+
+    def __len__(self) -> int:
+        """Number of records."""
+        return int(
+            self._connection().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle only the path; connections are per process."""
+        return {"path": self.path}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Restore from a pickled path."""
+        self.__init__(state["path"])  # type: ignore[misc]
+
+
+def open_metadata(path: str) -> Mapping[str, Any]:
+    """Open a metadata file: an SQLite index, or a JSON / JSONL dict (compatibility)."""
+    if is_sqlite_index(path):
+        return SqliteMetadataStore(path)
+    text = Path(path).read_text(encoding="utf-8")
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # JSONL output of the merge steps: one {key: value} object per line
+        data = {}
+        for line in text.splitlines():
+            if line.strip():
+                data.update(json.loads(line))
+    if not isinstance(data, dict):
+        raise ValueError(f"Metadata file {path} does not hold a JSON object")
+    return data
@@ -0,0 +1,138 @@
+"""Append-only JSONL partials that survive the loss of the process writing them.
+
+A distributed rank used to keep its results in memory and write its partial
+once the whole shard was done, so a rank killed by the job timeout or a node
+eviction lost every tile it had finished. :class:`PartialLog` appends one row
+per finished item instead: every row is written with a single ``write`` on a
+file opened in append mode and flushed to disk before the next item, so after
+a crash the file holds every finished row and at most one torn last line,
+which the merge skips as malformed.
+
+The first row of a log names the run (``{"_run_id": ...}``; keys starting
+with ``_`` are never merged). A restarted attempt of the same run appends to
+its log and skips the keys :func:`completed_keys` finds in the logs of all
+ranks; a log of another run is started over. The run is the AML run by
+default, which only covers retries within one job; a job that timed out or
+was killed and is resubmitted as a new run resumes when both are given the
+same ``resume_id`` (the pipelines pass their ``run_name``).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import Any, Iterable, List, Mapping, Sequence, Set, Tuple
+
+from gsm_common.streaming_merge import is_reserved_key
+
+logger = logging.getLogger(__name__)
+
+RUN_ID_KEY = "_run_id"
+
+
+def current_run_id(resume_id: str | None = None) -> str:
+    """Id logs are resumed under: ``resume_id``, else the AML run (``local``)."""
+    return resume_id or os.environ.get("AZUREML_RUN_ID", "local")
+
+
+def _log_run_id(path: str) -> str | None:
+    """Run id in the first row of a log, None if missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            head = json.loads(f.readline())
+    except (OSError, json.JSONDecodeError):
+        return None
+    return head.get(RUN_ID_KEY) if isinstance(head, dict) else None
+
+
+class PartialLog:
+    """Per-rank JSONL partial, appended to one finished item at a time."""
+
+    def __init__(self, path: str, run_id: str, sync: bool = True) -> None:
+        """Open ``path`` for appending, starting over if it is of another run.
+
+        With ``sync`` every row is also ``fsync``-ed, so it survives the loss
+        of the node and not only of the process; rows that are cheap to lose
+        (telemetry) can skip it.
+        """
+        self.path = path
+        self.sync = sync
+        self.rows = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        resumed = os.path.isfile(path) and _log_run_id(path) == run_id
+        # True when an earlier attempt of this run wrote to this log
+        self.resumed = resumed
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not resumed:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0o644)
+        if not resumed:
+            self._append({RUN_ID_KEY: run_id})
+        elif not self._ends_with_newline():
+            # the previous attempt died mid-row: end the torn line
+            os.write(self._fd, b"\n")
+        logger.info("%s partial log %s", "Resuming" if resumed else "Started", path)
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _append(self, row: Mapping[str, Any]) -> None:
+        line = json.dumps(row, separators=(",", ":")) + "\n"
+        os.write(self._fd, line.encode("utf-8"))
+        if self.sync:
+            os.fsync(self._fd)
+
+    def write(self, row: Mapping[str, Any]) -> None:
+        """Append one row."""
+        self._append(row)
+        self.rows += 1
+
+    def close(self) -> None:
+        """Close the file."""
+        os.close(self._fd)
+
+    def __enter__(self) -> PartialLog:
+        """Use as a context manager."""
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        """Close the file."""
+        self.close()
+
+
+def completed_keys(paths: Iterable[str], run_id: str) -> Set[str]:
+    """Keys of the rows that the logs of ``run_id`` among ``paths`` hold."""
+    keys: Set[str] = set()
+    for path in paths:
+        if _log_run_id(path) != run_id:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a torn row
+                if isinstance(row, dict):
+                    keys.update(k for k in row if not is_reserved_key(k))
+    return keys
+
+
+def skip_completed(
+    keys: Sequence[str], paths: Iterable[str], run_id: str
+) -> Tuple[List[str], Set[str]]:
+    """``keys`` not yet in the logs of ``run_id`` among ``paths``, and those logged."""
+    done = completed_keys(paths, run_id)
+    left = [k for k in keys if k not in done]
+    if len(left) < len(keys):
+        logger.info(
+            "Resuming: %d items finished by an earlier attempt skipped, %d left.",
+            len(keys) - len(left),
+            len(left),
+        )
+    return left, done
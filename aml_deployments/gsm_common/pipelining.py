@@ -0,0 +1,149 @@
+"""Overlapping blob I/O with compute in the parallel entry scripts.
+
+- :func:`iter_prefetched` loads the next work units in a thread pool while the
+  caller processes the current one.
+- :class:`WriteBehind` runs output uploads in the background, with a bound on
+  the number of pending uploads so a slow mount applies back-pressure.
+- :class:`PhaseTimer` accumulates wall time per phase (read / compute / write
+  wait) so the overlap can be checked in the logs.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class PhaseTimer:
+    """Wall time and call count per named phase."""
+
+    def __init__(self) -> None:
+        """Start with no phases."""
+        self.seconds: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the enclosed block under ``name``."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - t0
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def describe(self) -> str:
+        """One-line summary, e.g. ``read 1.2s (3) | compute 40.1s (3)``."""
+        return " | ".join(
+            f"{name} {secs:.1f}s ({self.counts[name]})"
+            for name, secs in self.seconds.items()
+        )
+
+
+def iter_prefetched(
+    units: Sequence[T],
+    load: Callable[[T], R],
+    depth: int,
+    executor: ThreadPoolExecutor,
+) -> Iterator[Tuple[T, Future[R]]]:
+    """Yield ``(unit, future)`` in order, keeping up to ``depth`` loads ahead.
+
+    The caller waits on the future when it needs the data; the next loads are
+    already running while it processes the current unit.
+    """
+    pending: Deque[Tuple[T, Future[R]]] = deque()
+    it = iter(units)
+    for unit in it:
+        pending.append((unit, executor.submit(load, unit)))
+        if len(pending) > depth:
+            break
+    while pending:
+        yield pending.popleft()
+        for unit in it:
+            pending.append((unit, executor.submit(load, unit)))
+            break
+
+
+class WriteBehind:
+    """Background uploads with at most ``max_pending`` in flight."""
+
+    def __init__(self, max_pending: int, threads: int) -> None:
+        """Create the upload pool."""
+        self.max_pending = max(1, max_pending)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, threads), thread_name_prefix="write-behind"
+        )
+        self._pending: Deque[Future[Any]] = deque()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        """Queue an upload, first waiting for the oldest one if the queue is full."""
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._pool.submit(fn, *args))
+
+    def drain(self) -> None:
+        """Wait for all queued uploads; re-raises the first failure."""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self) -> None:
+        """Drain and stop the pool."""
+        try:
+            self.drain()
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+def stage_files(src_root: str, rel_paths: Iterable[str], dst_root: str) -> None:
+    """Copy ``rel_paths`` from ``src_root`` to the same relative paths in ``dst_root``.
+
+    Unreadable files are logged and left out, so the consumer sees them as missing
+    just like on the mount.
+    """
+    for rel in rel_paths:
+        dst = os.path.join(dst_root, rel)
+        os.makedirs(os.path.dirname(dst) or dst_root, exist_ok=True)
+        try:
+            shutil.copyfile(os.path.join(src_root, rel), dst)
+        except OSError as ex:
+            logger.warning("Could not stage %s: %s", rel, ex)
+
+
+def publish_tree(src: str, dst: str) -> None:
+    """Copy everything under ``src`` into ``dst`` and remove ``src``."""
+    shutil.copytree(src, dst, dirs_exist_ok=True)
+    shutil.rmtree(src, ignore_errors=True)
+
+
+def rebase_paths(value: Any, old_root: str, new_root: str) -> Any:
+    """Replace the ``old_root`` prefix of any path string nested in ``value``."""
+    if isinstance(value, str):
+        if value == old_root or value.startswith(old_root.rstrip("/") + "/"):
+            return new_root.rstrip("/") + value[len(old_root.rstrip("/")) :]
+        return value
+    if isinstance(value, list):
+        return [rebase_paths(v, old_root, new_root) for v in value]
+    if isinstance(value, dict):
+        return {k: rebase_paths(v, old_root, new_root) for k, v in value.items()}
+    return value
@@ -0,0 +1,151 @@
+"""Writing and reading the work items of the plan steps.
+
+Two plan formats are supported:
+
+- ``folder``: one small JSON file per item (AML ``uri_folder`` input, every item
+  is a file the parallel step has to open through the mount).
+- ``manifest``: a single ``items.jsonl`` with one item per line plus an
+  ``MLTable`` file, so the parallel step can consume it as tabular (``mltable``)
+  input and receives the rows directly in ``run()``.
+
+Items are written in Z-order of their tiles by default (``--item_order``), so
+the mini-batches AML cuts from the plan hold neighbouring tiles.
+
+Entry scripts use :func:`iter_plan_items` to read either kind of mini-batch.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence
+
+from gsm_common.tile_index import zorder
+
+logger = logging.getLogger(__name__)
+
+PLAN_FORMATS = ("folder", "manifest")
+ITEM_ORDERS = ("zorder", "input")
+MANIFEST_NAME = "items.jsonl"
+
+_MLTABLE = """paths:
+  - file: ./{name}
+transformations:
+  - read_json_lines:
+      encoding: utf8
+      include_path_column: false
+"""
+
+Item = Dict[str, Any]
+
+
+def add_plan_arguments(ap: argparse.ArgumentParser) -> None:
+    """Add the plan output options shared by all plan scripts."""
+    ap.add_argument(
+        "--plan_format",
+        choices=PLAN_FORMATS,
+        default="folder",
+        help="One JSON file per item, or a single JSONL manifest (mltable)",
+    )
+    ap.add_argument(
+        "--item_order",
+        choices=ITEM_ORDERS,
+        default="zorder",
+        help="Order items along a Z-order curve of their tiles, or keep input order",
+    )
+
+
+def order_items(
+    items: Sequence[Item], key_of: Callable[[Item], str], order: str
+) -> List[Item]:
+    """Put ``items`` in ``order`` (``zorder`` or ``input``) by their tile key."""
+    if order == "input":
+        return list(items)
+    by_key: Dict[str, List[Item]] = {}
+    for item in items:
+        by_key.setdefault(key_of(item), []).append(item)
+    return [item for key in zorder(by_key) for item in by_key[key]]
+
+
+def write_plan(items: Sequence[Item], out_dir: str, plan_format: str) -> int:
+    """Write ``items`` in the requested plan format and return their count."""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    if plan_format == "manifest":
+        with (out / MANIFEST_NAME).open("w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, separators=(",", ":")) + "\n")
+        (out / "MLTable").write_text(
+            _MLTABLE.format(name=MANIFEST_NAME), encoding="utf-8"
+        )
+        return len(items)
+
+    # zero-padded so lexical order (used by AML for mini-batches) is plan order
+    width = max(5, len(str(len(items))))
+    for i, item in enumerate(items, start=1):
+        (out / f"{i:0{width}d}.json").write_text(json.dumps(item), encoding="utf-8")
+    return len(items)
+
+
+def _clean(item: Item) -> Item:
+    # tabular rows come back with NaN for missing optional columns
+    return {
+        k: v
+        for k, v in item.items()
+        if v is not None and not (isinstance(v, float) and math.isnan(v))
+    }
+
+
+def _read_item_file(path: Path) -> Iterator[Item]:
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError as ex:
+        logger.warning("Unreadable item %s: %s", path, ex)
+        return
+    if path.suffix.lower() == ".jsonl":
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+        return
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as ex:
+        logger.warning("Unreadable item %s: %s", path, ex)
+        return
+    if isinstance(data, dict):
+        yield data
+
+
+def iter_plan_items(mini_batch: Any) -> Iterator[Item]:
+    """Yield item dicts from any AML mini-batch.
+
+    Accepts a pandas DataFrame (``mltable`` input), a list of item dicts, or a
+    list of item file paths (``uri_folder`` input, ``.json`` or ``.jsonl``).
+    """
+    rows: Iterable[Any]
+    if hasattr(mini_batch, "to_dict"):
+        rows = mini_batch.to_dict(orient="records")
+    else:
+        rows = mini_batch
+    for row in rows:
+        if isinstance(row, dict):
+            yield _clean(row)
+            continue
+        p = Path(str(row))
+        if p.suffix.lower() in (".json", ".jsonl"):
+            for item in _read_item_file(p):
+                yield _clean(item)
+        else:
+            logger.warning("Skipping unrecognised item %s", row)
+
+
+def read_plan(items_dir: str) -> List[Item]:
+    """Read back all items of a plan folder, in plan order."""
+    root = Path(items_dir)
+    manifest = root / MANIFEST_NAME
+    if manifest.exists():
+        return list(iter_plan_items([manifest]))
+    return list(iter_plan_items(sorted(root.glob("*.json"))))
@@ -0,0 +1,381 @@
+"""Encode only the parts of a tile raster that hold prompts.
+
+pc_prep rasterizes whole tiles, and the SAM image encoder used to run on every
+raster, also when its prompts cover a small part of it or when there are no
+prompts at all. :func:`read_prompts` reads a prompt file so that tiles without
+prompts can be skipped before they reach the GPU, and
+:class:`WindowedPredictor` wraps the predictor so that a prompt is decoded on a
+window of the raster around the prompts instead of on the whole raster.
+
+The encoder has a fixed input size (1024 px for SAM and SAM 2) and a larger
+raster is downscaled to it, in one pass. :func:`plan_windows` only windows a
+raster whose prompts, each at least ``margin`` pixels inside, all fit one
+window of that size: the window is encoded instead of the raster, still in one
+pass. This is a resolution change, not a saving in encoder passes: the prompts
+are segmented at the native resolution of the raster instead of downscaled. A
+raster that already fits the encoder, or whose prompts are spread wider than
+one window, is encoded whole as before. Masks are pasted back into raster
+coordinates, so the code calling ``predict`` and the masks it writes do not
+change.
+
+Only JSON prompt files are read (``{"points": [[x, y], ...], "boxes": [[x0, y0,
+x1, y1], ...]}``, or a bare list of points, in pixels); for files in any other
+format :func:`read_prompts` returns None and the tile is processed as before.
+numpy is imported by the predictor wrapper when it is used, in the segment
+environment.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Sequence, Tuple
+
+from gsm_common.cli import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+# encoder input size when the model does not report one (SAM, SAM 2)
+DEFAULT_WINDOW = 1024
+DEFAULT_MARGIN = 192
+
+Box = Tuple[float, float, float, float]
+Window = Tuple[int, int, int, int]
+
+_POINT_KEYS = ("points", "point_coords")
+_BOX_KEYS = ("boxes", "box")
+
+
+@dataclass
+class Prompts:
+    """Point and box prompts of one raster, in pixels."""
+
+    points: List[Tuple[float, float]] = field(default_factory=list)
+    boxes: List[Box] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        """Number of prompts."""
+        return len(self.points) + len(self.boxes)
+
+    def extents(self) -> List[Box]:
+        """``(x0, y0, x1, y1)`` of every prompt."""
+        return [(x, y, x, y) for x, y in self.points] + list(self.boxes)
+
+
+def _pairs(value: Any, size: int) -> List[Tuple[float, ...]]:
+    if not isinstance(value, list):
+        return []
+    if len(value) == size and all(isinstance(v, (int, float)) for v in value):
+        value = [value]  # a single point or box
+    return [
+        tuple(float(v) for v in item[:size])
+        for item in value
+        if isinstance(item, (list, tuple)) and len(item) >= size
+    ]
+
+
+def read_prompts(path: str) -> Prompts | None:
+    """Prompts of a JSON prompt file, or None if it cannot be read as such."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if isinstance(data, list):
+        data = {"points": data}
+    if not isinstance(data, dict) or not any(
+        k in data for k in (*_POINT_KEYS, *_BOX_KEYS)
+    ):
+        return None
+    prompts = Prompts()
+    for key in _POINT_KEYS:
+        prompts.points += [(p[0], p[1]) for p in _pairs(data.get(key), 2)]
+    for key in _BOX_KEYS:
+        prompts.boxes += [(b[0], b[1], b[2], b[3]) for b in _pairs(data.get(key), 4)]
+    return prompts
+
+
+def encoder_size(predictor: Any, default: int = DEFAULT_WINDOW) -> int:
+    """Input size of the image encoder of a SAM or SAM 2 predictor."""
+    model = getattr(predictor, "model", None)
+    for owner, name in (
+        (getattr(model, "image_encoder", None), "img_size"),
+        (model, "image_size"),
+    ):
+        size = getattr(owner, name, None)
+        if isinstance(size, int) and size > 0:
+            return size
+    return default
+
+
+def _fit(lo: float, hi: float, size: int, limit: int) -> Tuple[int, int]:
+    """``[start, end)`` of length ``size`` centred on ``[lo, hi]``, within ``limit``."""
+    if size >= limit:
+        return 0, limit
+    start = int(math.floor((lo + hi - size) / 2))
+    start = min(max(0, start), limit - size)
+    return start, start + size
+
+
+def plan_windows(
+    extents: Sequence[Box], width: int, height: int, window: int, margin: int
+) -> List[Window]:
+    """Window ``(x0, y0, x1, y1)`` that holds every prompt with ``margin`` around it.
+
+    Returns the whole raster as the only window when it fits the encoder or
+    when the prompts with their margins do not fit one ``window`` square, so a
+    raster is never encoded in more passes than downscaling it would take.
+    """
+    full: List[Window] = [(0, 0, width, height)]
+    if not extents or (width <= window and height <= window):
+        return full
+    lo_x = min(e[0] for e in extents) - margin
+    lo_y = min(e[1] for e in extents) - margin
+    hi_x = max(e[2] for e in extents) + margin
+    hi_y = max(e[3] for e in extents) + margin
+    if hi_x - lo_x > window or hi_y - lo_y > window:
+        return full
+    wx0, wx1 = _fit(lo_x, hi_x, window, width)
+    wy0, wy1 = _fit(lo_y, hi_y, window, height)
+    return [(wx0, wy0, wx1, wy1)]
+
+
+def _contains(window: Window, extent: Box) -> bool:
+    x0, y0, x1, y1 = window
+    return x0 <= extent[0] and y0 <= extent[1] and extent[2] <= x1 and extent[3] <= y1
+
+
+def _round(extent: Box) -> Box:
+    return (
+        round(extent[0], 1),
+        round(extent[1], 1),
+        round(extent[2], 1),
+        round(extent[3], 1),
+    )
+
+
+# attributes and methods that refer to the image as a whole
+_WHOLE_IMAGE = (
+    "features",
+    "original_size",
+    "input_size",
+    "is_image_set",
+    "get_image_embedding",
+    "predict_torch",
+    "_features",
+    "_orig_hw",
+)
+
+
+class WindowedPredictor:
+    """Predictor proxy that decodes each prompt on a window of the raster.
+
+    :meth:`register` the prompts of the rasters about to be segmented;
+    ``set_image`` then only records the raster, and ``predict`` encodes the
+    window of the registered prompt set holding the prompt (through the wrapped
+    predictor, so a :class:`~gsm_common.embedding_cache.CachingPredictor`
+    keeps the window embeddings) and returns masks of the whole raster.
+    Prompts that were not registered are decoded on the whole raster. The low
+    resolution logits refer to the window; passed back as ``mask_input`` they
+    are decoded on the window of the previous prompt. Anything else is passed
+    through on the whole raster.
+    """
+
+    def __init__(
+        self, predictor: Any, window: int | None = None, margin: int = DEFAULT_MARGIN
+    ) -> None:
+        """Wrap ``predictor``; ``window`` defaults to the encoder input size."""
+        object.__setattr__(self, "_predictor", predictor)
+        object.__setattr__(self, "_window", window or encoder_size(predictor))
+        object.__setattr__(self, "_margin", margin)
+        object.__setattr__(self, "_prompt_sets", [])
+        object.__setattr__(self, "_sets", {})
+        object.__setattr__(self, "_plans", {})
+        object.__setattr__(self, "_image", None)
+        object.__setattr__(self, "_image_args", ((), {}))
+        object.__setattr__(self, "_current", None)
+        # rasters seen and split into windows, windows set, prompts decoded
+        object.__setattr__(
+            self, "stats", {"images": 0, "windowed": 0, "windows": 0, "prompts": 0}
+        )
+
+    def register(self, prompt_sets: Sequence[Prompts]) -> None:
+        """Prompt sets of the rasters that are segmented next."""
+        sets: Dict[Box, int] = {}
+        for i, prompts in enumerate(prompt_sets):
+            for extent in prompts.extents():
+                sets.setdefault(_round(extent), i)
+        object.__setattr__(self, "_sets", sets)
+        object.__setattr__(self, "_plans", {})
+        object.__setattr__(self, "_prompt_sets", list(prompt_sets))
+
+    def set_image(self, image: Any, *args: Any, **kwargs: Any) -> None:
+        """Record the raster; windows of it are encoded when they are needed."""
+        self.stats["images"] += 1
+        shape = getattr(image, "shape", None)
+        if shape is None or len(shape) < 2:
+            object.__setattr__(self, "_image", None)
+            self._predictor.set_image(image, *args, **kwargs)
+            return
+        object.__setattr__(self, "_image", image)
+        object.__setattr__(self, "_image_args", (args, kwargs))
+        object.__setattr__(self, "_current", None)
+
+    def _windows_for(self, extent: Box) -> List[Window]:
+        image = self._image
+        height, width = int(image.shape[0]), int(image.shape[1])
+        index = self._sets.get(_round(extent))
+        if index is None:
+            return [(0, 0, width, height)]
+        key = (index, width, height)
+        if key not in self._plans:
+            extents = self._prompt_sets[index].extents()
+            planned = plan_windows(extents, width, height, self._window, self._margin)
+            self._plans[key] = planned
+            if planned != [(0, 0, width, height)]:
+                self.stats["windowed"] += 1
+        windows: List[Window] = self._plans[key]
+        return windows
+
+    def _show(self, window: Window) -> None:
+        """Make ``window`` of the raster the image of the wrapped predictor."""
+        if self._current == window:
+            return
+        x0, y0, x1, y1 = window
+        height, width = int(self._image.shape[0]), int(self._image.shape[1])
+        if (x0, y0, x1, y1) == (0, 0, width, height):
+            crop = self._image
+        else:
+            import numpy as np
+
+            crop = np.ascontiguousarray(self._image[y0:y1, x0:x1])
+            self.stats["windows"] += 1
+        args, kwargs = self._image_args
+        self._predictor.set_image(crop, *args, **kwargs)
+        object.__setattr__(self, "_current", window)
+
+    def _ensure_whole(self) -> None:
+        if self._image is not None:
+            height, width = int(self._image.shape[0]), int(self._image.shape[1])
+            self._show((0, 0, width, height))
+
+    def predict(
+        self,
+        point_coords: Any = None,
+        point_labels: Any = None,
+        box: Any = None,
+        mask_input: Any = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        **kwargs: Any,
+    ) -> Tuple[Any, Any, Any]:
+        """Decode the prompt on its window; masks are of the whole raster."""
+        if self._image is None:
+            out: Tuple[Any, Any, Any] = self._predictor.predict(
+                point_coords=point_coords,
+                point_labels=point_labels,
+                box=box,
+                mask_input=mask_input,
+                multimask_output=multimask_output,
+                return_logits=return_logits,
+                **kwargs,
+            )
+            return out
+        import numpy as np
+
+        self.stats["prompts"] += 1
+        coords = (
+            []
+            if point_coords is None
+            else np.asarray(point_coords, float).reshape(-1, 2).tolist()
+        )
+        boxes = [] if box is None else np.asarray(box, float).reshape(-1, 4).tolist()
+        xs = [c[0] for c in coords] + [b[0] for b in boxes] + [b[2] for b in boxes]
+        ys = [c[1] for c in coords] + [b[1] for b in boxes] + [b[3] for b in boxes]
+        height, width = int(self._image.shape[0]), int(self._image.shape[1])
+        if mask_input is not None and self._current is not None:
+            window = self._current
+        elif xs:
+            extent = (min(xs), min(ys), max(xs), max(ys))
+            window = next(
+                (w for w in self._windows_for(extent) if _contains(w, extent)),
+                (0, 0, width, height),
+            )
+        else:
+            window = (0, 0, width, height)
+        self._show(window)
+        x0, y0, x1, y1 = window
+        masks, scores, logits = self._predictor.predict(
+            point_coords=(
+                None
+                if point_coords is None
+                else np.asarray(point_coords, float) - (x0, y0)
+            ),
+            point_labels=point_labels,
+            box=None if box is None else np.asarray(box, float) - (x0, y0, x0, y0),
+            mask_input=mask_input,
+            multimask_output=multimask_output,
+            return_logits=return_logits,
+            **kwargs,
+        )
+        if (x0, y0, x1, y1) == (0, 0, width, height):
+            return masks, scores, logits
+        masks = np.asarray(masks)
+        fill = False if masks.dtype == bool else np.finfo(masks.dtype).min
+        whole = np.full((*masks.shape[:-2], height, width), fill, dtype=masks.dtype)
+        whole[..., y0:y1, x0:x1] = masks
+        return whole, scores, logits
+
+    def describe(self) -> Dict[str, Any]:
+        """Counts for the run statistics."""
+        return {**self.stats, "window_size": self._window}
+
+    def __getattr__(self, name: str) -> Any:
+        """Delegate everything else to the wrapped predictor."""
+        if name in _WHOLE_IMAGE:
+            self._ensure_whole()
+        return getattr(self._predictor, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Set attributes on the wrapped predictor."""
+        setattr(self._predictor, name, value)
+
+
+def add_window_arguments(ap: argparse.ArgumentParser, windows: bool = True) -> None:
+    """Add the prompt skipping and (for the entry script) windowing options."""
+    ap.add_argument(
+        "--skip_empty_prompts",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help="Leave out images whose prompt file holds no prompts",
+    )
+    if not windows:
+        return
+    ap.add_argument(
+        "--prompt_windows",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help=(
+            "Encode the prompts of a raster larger than the encoder input at "
+            "native resolution when they fit one window (a resolution change)"
+        ),
+    )
+    ap.add_argument(
+        "--prompt_window_size",
+        type=int,
+        default=None,
+        help="Window size in pixels (default: the encoder input size)",
+    )
+    ap.add_argument(
+        "--prompt_window_margin",
+        type=int,
+        default=DEFAULT_MARGIN,
+        help="Pixels kept between a prompt and the edge of its window",
+    )
@@ -0,0 +1,342 @@
+"""Processes and threads per process for the worker pools of a node.
+
+Every pool worker of pc_ops, tree_modeling and pc_prep can start full-width
+OpenMP/BLAS/CloudComPy thread pools, so ``num_workers`` processes on a node
+easily run ``num_workers * cores`` threads. :func:`plan_resources` looks at the
+CPUs this process may use (affinity, cgroup CPU quota, NUMA nodes, physical
+cores) and the memory limit, and chooses the number of processes and the
+threads per process so that ``processes * threads`` fits the CPU budget.
+
+The thread caps are exported as environment variables
+(:data:`THREAD_ENV_VARS`) before the workers start, so they apply when a worker
+imports the numeric libraries, and again in the worker with ``threadpoolctl``
+if it is installed, for libraries that were already loaded (``fork``). With
+pinning, every worker is bound to its own set of CPUs, the threads of a worker
+on one NUMA node and on distinct physical cores where possible.
+"""
+
+from __future__ import annotations
+
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+from gsm_common.cli import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+# the variables the AML parallel steps set in environment_variables as well
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_MAX_THREADS",
+    "GDAL_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+
+_SYS_CPU = Path("/sys/devices/system/cpu")
+_SYS_NODE = Path("/sys/devices/system/node")
+_CGROUP = Path("/sys/fs/cgroup")
+
+# worker slot of this process, set by pools that replace workers in place
+_SLOT: Dict[str, int] = {}
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """CPUs of a kernel cpulist such as ``0-3,8-11``."""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def _read(path: Path) -> str | None:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_cpu_quota() -> float | None:
+    """CPUs allowed by the cgroup CPU quota (v2 or v1), None if unlimited."""
+    v2 = _read(_CGROUP / "cpu.max")
+    if v2:
+        quota, _, period = v2.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    quota_v1 = _read(_CGROUP / "cpu" / "cpu.cfs_quota_us")
+    period_v1 = _read(_CGROUP / "cpu" / "cpu.cfs_period_us")
+    if quota_v1 and period_v1 and int(quota_v1) > 0:
+        return int(quota_v1) / int(period_v1)
+    return None
+
+
+def _memory_limit() -> int | None:
+    """Bytes allowed by the cgroup memory limit, else the physical memory."""
+    for path in (_CGROUP / "memory.max", _CGROUP / "memory" / "memory.limit_in_bytes"):
+        value = _read(path)
+        # v1 reports "no limit" as a huge page-aligned number
+        if value and value != "max" and int(value) < 1 << 60:
+            return int(value)
+    meminfo = _read(Path("/proc/meminfo")) or ""
+    for line in meminfo.splitlines():
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def _core_of(cpu: int) -> Tuple[int, int]:
+    """(package, core) of a CPU; hyperthreads of one core share it."""
+    topo = _SYS_CPU / f"cpu{cpu}" / "topology"
+    package = _read(topo / "physical_package_id")
+    core = _read(topo / "core_id")
+    if package is None or core is None:
+        return (0, cpu)
+    return (int(package), int(core))
+
+
+@dataclass
+class CpuTopology:
+    """What this process may use on the node."""
+
+    cpus: List[int]
+    numa_nodes: List[List[int]]
+    cores: Dict[int, Tuple[int, int]]
+    cpu_quota: float | None = None
+    memory_bytes: int | None = None
+
+    @property
+    def usable_cpus(self) -> int:
+        """CPUs that can be kept busy: affinity, capped by the cgroup quota."""
+        n = len(self.cpus)
+        if self.cpu_quota is not None:
+            n = min(n, max(1, math.floor(self.cpu_quota)))
+        return n
+
+    @property
+    def physical_cores(self) -> int:
+        """Distinct physical cores among :attr:`cpus`."""
+        return len(set(self.cores.values()))
+
+    def describe(self) -> str:
+        """One line for the log."""
+        quota = f"{self.cpu_quota:g}" if self.cpu_quota is not None else "none"
+        memory = f"{self.memory_bytes / 1e9:.1f} GB" if self.memory_bytes else "unknown"
+        return (
+            f"{len(self.cpus)} CPUs ({self.physical_cores} cores, "
+            f"{len(self.numa_nodes)} NUMA nodes), cgroup quota {quota}, "
+            f"memory {memory}"
+        )
+
+
+def detect_topology() -> CpuTopology:
+    """Inspect the CPUs, NUMA nodes and cgroup limits of this process."""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = list(range(os.cpu_count() or 1))
+    allowed = set(cpus)
+    nodes = []
+    for node in sorted(_SYS_NODE.glob("node[0-9]*")):
+        cpulist = _read(node / "cpulist")
+        members = [c for c in parse_cpulist(cpulist or "") if c in allowed]
+        if members:
+            nodes.append(members)
+    if not nodes:
+        nodes = [cpus]
+    return CpuTopology(
+        cpus=cpus,
+        numa_nodes=nodes,
+        cores={c: _core_of(c) for c in cpus},
+        cpu_quota=_cgroup_cpu_quota(),
+        memory_bytes=_memory_limit(),
+    )
+
+
+def _node_order(topology: CpuTopology, node: List[int]) -> List[int]:
+    """CPUs of a NUMA node, first one hyperthread of every core, then the others."""
+    seen: Dict[Tuple[int, int], int] = {}
+    ranked = []
+    for cpu in node:
+        core = topology.cores.get(cpu, (0, cpu))
+        ranked.append((seen.get(core, 0), cpu))
+        seen[core] = seen.get(core, 0) + 1
+    return [cpu for _, cpu in sorted(ranked)]
+
+
+def _cpu_sets(topology: CpuTopology, processes: int, threads: int) -> List[List[int]]:
+    """``threads`` CPUs for each of ``processes`` workers.
+
+    Workers are spread over the NUMA nodes in turn, each within one node while
+    the nodes have room; the CPUs left over in the nodes serve the rest.
+    """
+    orders = [_node_order(topology, node) for node in topology.numa_nodes]
+    sets: List[List[int]] = []
+    while len(sets) < processes:
+        free = [order for order in orders if len(order) >= threads]
+        if not free:
+            break
+        for order in free[: processes - len(sets)]:
+            sets.append(order[:threads])
+            del order[:threads]
+    spare = [cpu for order in orders for cpu in order]
+    while spare and len(sets) < processes:
+        sets.append(spare[:threads])
+        spare = spare[threads:]
+    return sets
+
+
+@dataclass
+class ResourcePlan:
+    """Processes and threads per process chosen for one stage on one node."""
+
+    stage: str
+    processes: int
+    threads: int
+    cpu_sets: List[List[int]] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    def describe(self) -> str:
+        """One line for the log."""
+        pinned = f", pinned to {self.cpu_sets}" if self.cpu_sets else ""
+        notes = f" ({'; '.join(self.notes)})" if self.notes else ""
+        return (
+            f"{self.stage}: {self.processes} processes x {self.threads} threads"
+            f"{pinned}{notes}"
+        )
+
+    def pool_kwargs(self, ctx: Any) -> Dict[str, Any]:
+        """``initializer``/``initargs`` for a ``Pool`` of ``ctx``."""
+        counter = ctx.Value("i", 0) if self.cpu_sets else None
+        return {
+            "initializer": init_worker,
+            "initargs": (self.threads, self.cpu_sets, counter),
+        }
+
+
+def plan_resources(
+    stage: str,
+    processes: int | None = None,
+    threads: int | None = None,
+    memory_per_process_gb: float | None = None,
+    pin: bool = False,
+    reserve: int = 1,
+    topology: CpuTopology | None = None,
+) -> ResourcePlan:
+    """Choose processes and threads per process for ``stage`` on this node.
+
+    ``reserve`` CPUs are left to the parent process. By default every usable
+    CPU gets one single-threaded process; a requested process count is kept if
+    it fits, and the CPUs left over are given to the processes as threads. The
+    process count is also capped so that ``memory_per_process_gb`` fits the
+    memory limit.
+    """
+    topo = topology or detect_topology()
+    budget = max(1, topo.usable_cpus - reserve)
+    notes: List[str] = []
+    if processes is None or processes <= 0:
+        procs = budget if threads is None else max(1, budget // max(1, threads))
+    elif processes > budget:
+        notes.append(f"{processes} requested, capped to the CPU budget")
+        procs = budget
+    else:
+        procs = processes
+    if memory_per_process_gb and topo.memory_bytes:
+        fit = max(1, int(topo.memory_bytes / (memory_per_process_gb * 1e9)))
+        if fit < procs:
+            notes.append(f"memory limit fits {fit}")
+            procs = fit
+    if threads is None:
+        n_threads = max(1, budget // procs)
+    else:
+        n_threads = max(1, min(threads, budget // procs or 1))
+        if n_threads < threads:
+            notes.append(f"{threads} threads requested, capped to the CPU budget")
+    cpu_sets: List[List[int]] = []
+    if pin:
+        cpu_sets = _cpu_sets(topo, procs, n_threads)
+    plan = ResourcePlan(stage, procs, n_threads, cpu_sets, notes)
+    logger.info("Node: %s", topo.describe())
+    logger.info("Resource plan %s", plan.describe())
+    return plan
+
+
+def cap_threads(threads: int) -> None:
+    """Cap the thread pools of the numeric libraries of this process.
+
+    The environment variables take effect for libraries imported afterwards
+    (and in processes started afterwards); ``threadpoolctl``, when installed,
+    also limits the libraries already loaded.
+    """
+    for var in THREAD_ENV_VARS:
+        previous = os.environ.get(var)
+        if previous is not None and previous != str(threads):
+            logger.debug("%s=%s overridden with %d", var, previous, threads)
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+def set_worker_slot(slot: int) -> None:
+    """Give this worker process the CPU set of ``slot`` in :func:`init_worker`.
+
+    Pools that replace a retired worker by a new one in its slot call this
+    before the initializer, so the new worker takes over the retired worker's
+    CPUs instead of the next ones in turn (usually a live worker's).
+    """
+    _SLOT["slot"] = slot
+
+
+def init_worker(threads: int, cpu_sets: Sequence[List[int]], counter: Any) -> None:
+    """Pool initializer: cap the threads and bind the worker to its CPU set.
+
+    The CPU set is the one of the worker's slot if its pool set one, else the
+    next one in the order the workers start.
+    """
+    cap_threads(threads)
+    if not cpu_sets:
+        return
+    index = _SLOT.get("slot")
+    if index is None:
+        if counter is None:
+            return
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+    os.sched_setaffinity(0, cpu_sets[index % len(cpu_sets)])
+
+
+def add_resource_arguments(ap: Any, pinning: bool = True) -> None:
+    """Add the resource planner options of the entry scripts."""
+    ap.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Threads per worker process (default: CPUs left over per process)",
+    )
+    ap.add_argument(
+        "--memory_per_worker_gb",
+        type=float,
+        default=None,
+        help="Run no more workers than the memory limit fits at this size",
+    )
+    if pinning:
+        ap.add_argument(
+            "--pin_workers",
+            nargs="?",
+            const=True,
+            default=False,
+            type=str_to_bool,
+            help="Bind every worker to its own CPUs (NUMA-local)",
+        )
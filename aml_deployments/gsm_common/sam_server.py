@@ -0,0 +1,809 @@
+"""One SAM model per node, shared by the segment workers through a local server.
+
+Every segment worker used to load its own copy of the model in ``init()``, so
+the segmentation step ran one worker per node (``max_concurrency_per_instance:
+1``) and image decoding, prompt loading and mask writing were limited to one
+CPU process. With ``--sam_server`` the first worker of a node starts a server
+process (``python -m gsm_common.sam_server``) that loads the model once, and
+every worker connects to it with :func:`connect_or_start` and gets a
+:class:`RemotePredictor` with the ``set_image`` / ``predict`` /
+``predict_torch`` / ``get_image_embedding`` interface of the SAM predictor.
+A worker starts at most one server per call and fails when its server exits;
+a worker that loses its server (e.g. to the idle shutdown) reconnects once,
+sets its image again and retries the request.
+
+Workers talk to the server over a Unix socket in a node-local folder
+(``--sam_server_dir``, authenticated with a key kept in that folder). Images
+are not pickled: each worker writes them into its own shared memory block and
+only sends the block name, shape and dtype. The server collects the requests
+of all workers and encodes the images that arrive within ``max_wait_ms`` of
+each other as one batch of at most ``max_batch`` images (through a predictor's
+``encode_batch`` method, the image encoder of a ``SamPredictor``, or one at a
+time otherwise). It keeps the embedding of the current image of every worker
+and the last ``cache_size`` embeddings for reuse, so ``predict`` calls of
+different workers can be interleaved. The server exits ``idle_s`` seconds
+after its last worker disconnected.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fcntl
+import hashlib
+import importlib
+import logging
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from gsm_common.cli import str_to_bool
+from gsm_common.embedding_cache import image_key, predictor_state, restore_state
+from gsm_common.prompt_windows import encoder_size
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FACTORY = "pc_segment.segment_pc:initialize_model"
+SOCKET_FILE = "sam.sock"
+AUTHKEY_FILE = "authkey"
+LOCK_FILE = "server.lock"
+LOG_FILE = "server.log"
+
+# state entries that stay in the server (the image embedding)
+_FEATURES = ("features", "_features")
+
+Reply = Tuple[str, Any]
+EncodeBatch = Callable[[Sequence[Tuple[Any, str]]], List[Dict[str, Any]]]
+
+
+def add_server_arguments(ap: argparse.ArgumentParser) -> None:
+    """Add the shared SAM server options of the segment entry script."""
+    ap.add_argument(
+        "--sam_server",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help="Share one SAM model per node through a local server process",
+    )
+    ap.add_argument(
+        "--sam_server_max_batch",
+        type=int,
+        default=4,
+        help="Images the server encodes in one batch at most",
+    )
+    ap.add_argument(
+        "--sam_server_max_wait_ms",
+        type=float,
+        default=20.0,
+        help="How long the server waits for more images to fill a batch",
+    )
+    ap.add_argument(
+        "--sam_server_cache_size",
+        type=int,
+        default=16,
+        help="Image embeddings the server keeps for reuse",
+    )
+    ap.add_argument(
+        "--sam_server_dir",
+        type=str,
+        default=None,
+        help="Node-local folder of the server socket (default: under the temp dir)",
+    )
+    ap.add_argument(
+        "--sam_server_factory",
+        type=str,
+        default=DEFAULT_FACTORY,
+        help="module:function that loads the model from its path",
+    )
+    ap.add_argument("--sam_server_idle_s", type=float, default=30.0)
+    ap.add_argument("--sam_server_start_timeout", type=float, default=900.0)
+
+
+def server_dir(folder: str | None, factory: str, model_path: str) -> str:
+    """Folder of the server of ``model_path``: ``folder`` or one under the temp dir."""
+    if folder:
+        return folder
+    digest = hashlib.blake2b(
+        f"{factory}|{os.path.abspath(model_path)}|{os.getuid()}".encode(),
+        digest_size=6,
+    ).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f"gsm_sam_{digest}")
+
+
+def load_factory(spec: str) -> Callable[..., Any]:
+    """The function ``module:function`` names."""
+    module, _, name = spec.partition(":")
+    factory: Callable[..., Any] = getattr(importlib.import_module(module), name)
+    return factory
+
+
+def batch_encoder(predictor: Any) -> EncodeBatch | None:
+    """Function that encodes several images in one call, None if unsupported.
+
+    Predictors may offer ``encode_batch(images)`` returning one
+    :func:`~gsm_common.embedding_cache.predictor_state` per ``(image, format)``.
+    A ``segment_anything.SamPredictor`` is batched through its image encoder;
+    anything else (e.g. SAM 2) is encoded one image at a time.
+    """
+    encode: EncodeBatch | None = getattr(predictor, "encode_batch", None)
+    if encode is not None:
+        return encode
+    model = getattr(predictor, "model", None)
+    if hasattr(predictor, "transform") and hasattr(model, "image_encoder"):
+        return lambda images: _encode_sam_batch(predictor, images)
+    return None
+
+
+def _encode_sam_batch(
+    predictor: Any, images: Sequence[Tuple[Any, str]]
+) -> List[Dict[str, Any]]:
+    """``SamPredictor.set_image`` for several images in one encoder call."""
+    import torch
+
+    model = predictor.model
+    inputs = []
+    sizes = []
+    for image, image_format in images:
+        if image_format != model.image_format:
+            image = image[..., ::-1]
+        resized = predictor.transform.apply_image(image)
+        tensor = torch.as_tensor(resized, device=predictor.device)
+        tensor = tensor.permute(2, 0, 1).contiguous()[None, :, :, :]
+        sizes.append((tuple(image.shape[:2]), tuple(tensor.shape[-2:])))
+        # preprocess pads to the encoder size, so images of any shape stack
+        inputs.append(model.preprocess(tensor))
+    with torch.no_grad():
+        features = model.image_encoder(torch.cat(inputs))
+    return [
+        {
+            "features": features[i : i + 1],
+            "original_size": original,
+            "input_size": resized_size,
+            "is_image_set": True,
+        }
+        for i, (original, resized_size) in enumerate(sizes)
+    ]
+
+
+def _moved(value: Any, device: Any) -> Any:
+    """``value`` with its tensors (also in tuples, lists and dicts) on ``device``."""
+    if hasattr(value, "to") and hasattr(value, "device"):
+        return value.to(device)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_moved(v, device) for v in value)
+    if isinstance(value, dict):
+        return {k: _moved(v, device) for k, v in value.items()}
+    return value
+
+
+def _device_of(values: Sequence[Any]) -> Any:
+    """Device of the first tensor in ``values``, None without one."""
+    for value in values:
+        if hasattr(value, "to") and hasattr(value, "device"):
+            return value.device
+    return None
+
+
+def _attach(name: str) -> Any:
+    """Open the shared memory block ``name`` of a worker without owning it."""
+    from multiprocessing import resource_tracker, shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    # the worker unlinks its block; the tracker of this process must not
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+    return shm
+
+
+@dataclass
+class _Client:
+    """A connected worker: its shared memory block and current image."""
+
+    id: int
+    shm: Any = None
+    state: Dict[str, Any] | None = None
+
+
+@dataclass
+class _Request:
+    client: _Client
+    op: str
+    payload: Dict[str, Any]
+    reply: Reply = ("error", "no reply")
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def answer(self, reply: Reply) -> None:
+        self.reply = reply
+        self.done.set()
+
+
+class SamServer:
+    """Serves one predictor to many workers, batching their encoder calls."""
+
+    def __init__(
+        self,
+        predictor: Any,
+        max_batch: int = 4,
+        max_wait_ms: float = 20.0,
+        cache_size: int = 16,
+    ) -> None:
+        """Serve ``predictor``; see :func:`add_server_arguments` for the rest."""
+        self.predictor = predictor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.cache_size = max(0, cache_size)
+        self._encode_batch = batch_encoder(predictor)
+        self._cache: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._queue: queue.Queue[_Request] = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._clients = 0
+        self._last_active = time.monotonic()
+        self.stats: Dict[str, Any] = {
+            "clients": 0,
+            "requests": 0,
+            "encoded": 0,
+            "encode_calls": 0,
+            "largest_batch": 0,
+            "reused": 0,
+            "predicts": 0,
+            "errors": 0,
+            "busy_s": 0.0,
+        }
+
+    def serve(self, listener: Listener, idle_s: float = 30.0) -> None:
+        """Answer requests until no worker was connected for ``idle_s`` seconds."""
+        threading.Thread(
+            target=self._accept, args=(listener,), name="accept", daemon=True
+        ).start()
+        while True:
+            batch = self._next_batch(0.5)
+            if batch:
+                self._run(batch)
+                continue
+            with self._lock:
+                idle = not self._clients and (
+                    time.monotonic() - self._last_active > idle_s
+                )
+            if idle:
+                return
+
+    def _accept(self, listener: Listener) -> None:
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError as ex:
+                logger.warning("Rejected a connection: %s", ex)
+                continue
+            except OSError:
+                return  # the listener was closed
+            with self._lock:
+                self._next_id += 1
+                client = _Client(self._next_id)
+                self._clients += 1
+                self.stats["clients"] = max(self.stats["clients"], self._clients)
+                self._last_active = time.monotonic()
+            threading.Thread(
+                target=self._serve_client,
+                args=(conn, client),
+                name=f"client{client.id}",
+                daemon=True,
+            ).start()
+
+    def _serve_client(self, conn: Connection, client: _Client) -> None:
+        """Pass the requests of one worker to the model thread, one at a time."""
+        try:
+            while True:
+                try:
+                    op, payload = conn.recv()
+                except (EOFError, OSError):
+                    break
+                request = _Request(client, op, payload)
+                self._queue.put(request)
+                request.done.wait()
+                try:
+                    conn.send(request.reply)
+                except OSError:
+                    break
+        finally:
+            # the model thread releases the client's memory block and image
+            self._queue.put(_Request(client, "bye", {}))
+            with self._lock:
+                self._clients -= 1
+                self._last_active = time.monotonic()
+            conn.close()
+
+    def _next_batch(self, timeout: float) -> List[_Request]:
+        """Images to encode together, or a single request of another kind.
+
+        Requests other than ``set_image`` that arrive while a batch is filling
+        are answered right away, so their workers can send their next image.
+        """
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        if batch[0].op != "set_image":
+            return batch
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            with self._lock:
+                # every worker has at most one request in flight
+                everyone = len(batch) >= self._clients
+            remaining = deadline - time.monotonic()
+            if everyone or remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request.op == "set_image":
+                batch.append(request)
+            else:
+                self._run([request])
+        return batch
+
+    def _run(self, batch: List[_Request]) -> None:
+        t0 = time.perf_counter()
+        self.stats["requests"] += len(batch)
+        self._set_images([r for r in batch if r.op == "set_image"])
+        for request in batch:
+            if request.op == "set_image":
+                continue
+            try:
+                request.answer(("ok", self._call(request)))
+            except Exception as ex:
+                self.stats["errors"] += 1
+                request.answer(("error", f"{type(ex).__name__}: {ex}"))
+        self.stats["busy_s"] += time.perf_counter() - t0
+
+    def _call(self, request: _Request) -> Any:
+        client, payload = request.client, request.payload
+        if request.op in ("predict", "predict_torch", "embedding"):
+            if client.state is None:
+                raise RuntimeError(f"An image must be set before {request.op}")
+            restore_state(self.predictor, client.state)
+        if request.op == "predict":
+            self.stats["predicts"] += 1
+            return self.predictor.predict(*payload["args"], **payload["kwargs"])
+        if request.op == "predict_torch":
+            # tensors travel on the CPU; the model's device may differ per process
+            device = getattr(self.predictor, "device", "cpu")
+            self.stats["predicts"] += 1
+            out = self.predictor.predict_torch(
+                *_moved(payload["args"], device), **_moved(payload["kwargs"], device)
+            )
+            return _moved(out, "cpu")
+        if request.op == "embedding":
+            return _moved(self.predictor.get_image_embedding(), "cpu")
+        if request.op == "hello":
+            return {"encoder_size": encoder_size(self.predictor), "pid": os.getpid()}
+        if request.op == "stats":
+            return self.describe()
+        if request.op == "bye":
+            if client.shm is not None:
+                client.shm.close()
+            client.shm = client.state = None
+            return None
+        raise ValueError(f"Unknown request {request.op!r}")
+
+    def _image(self, request: _Request) -> Any:
+        """The image a worker wrote into its shared memory block."""
+        client, payload = request.client, request.payload
+        if client.shm is None or client.shm.name != payload["shm"]:
+            # the worker replaced its block with a larger one
+            if client.shm is not None:
+                client.shm.close()
+            client.shm = _attach(payload["shm"])
+        with client.shm.buf[: payload["nbytes"]] as raw:
+            if payload["shape"] is None:
+                return bytes(raw)
+            import numpy as np
+
+            return (
+                np.frombuffer(raw, dtype=payload["dtype"])
+                .reshape(payload["shape"])
+                .copy()
+            )
+
+    def _set_images(self, requests: List[_Request]) -> None:
+        """Encode the images of ``requests`` that are not cached, as one batch."""
+        pending: Dict[str, List[_Request]] = {}
+        for request in requests:
+            key = request.payload["key"]
+            state = self._cache.get(key)
+            if state is not None:
+                self._cache.move_to_end(key)
+                self.stats["reused"] += 1
+                self._image_set(request, state, reused=True)
+            else:
+                pending.setdefault(key, []).append(request)
+        if not pending:
+            return
+        keys, images = [], []
+        for key, waiting in pending.items():
+            try:
+                images.append((self._image(waiting[0]), waiting[0].payload["format"]))
+                keys.append(key)
+            except Exception as ex:
+                self._fail(waiting, ex)
+        for key, encoded in zip(keys, self._encode(images)):
+            if isinstance(encoded, BaseException):
+                self._fail(pending[key], encoded)
+                continue
+            if self.cache_size:
+                self._cache[key] = encoded
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for i, request in enumerate(pending[key]):
+                # the same image sent by several workers is encoded once
+                self._image_set(request, encoded, reused=i > 0)
+
+    def _encode(
+        self, images: List[Tuple[Any, str]]
+    ) -> List[Dict[str, Any] | BaseException]:
+        """One state per image, or the error that encoding it raised."""
+        if not images:
+            return []
+        if len(images) > 1 and self._encode_batch is not None:
+            try:
+                states = self._encode_batch(images)
+                self.stats["encode_calls"] += 1
+                self.stats["encoded"] += len(images)
+                self.stats["largest_batch"] = max(
+                    self.stats["largest_batch"], len(images)
+                )
+                return list(states)
+            except Exception as ex:
+                # e.g. out of memory: one image at a time may still fit
+                logger.warning(
+                    "Batched encoding of %s images failed (%s), encoding them "
+                    "one at a time",
+                    len(images),
+                    ex,
+                )
+        out: List[Dict[str, Any] | BaseException] = []
+        for image, image_format in images:
+            try:
+                self.predictor.set_image(image, image_format)
+                out.append(predictor_state(self.predictor))
+            except Exception as ex:
+                out.append(ex)
+            self.stats["encode_calls"] += 1
+            self.stats["encoded"] += 1
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], 1)
+        return out
+
+    def _image_set(
+        self, request: _Request, state: Dict[str, Any], reused: bool
+    ) -> None:
+        request.client.state = state
+        shown = {k: v for k, v in state.items() if k not in _FEATURES}
+        request.answer(("ok", {"state": shown, "reused": reused}))
+
+    def _fail(self, requests: List[_Request], ex: BaseException) -> None:
+        self.stats["errors"] += len(requests)
+        for request in requests:
+            request.client.state = None
+            request.answer(("error", f"{type(ex).__name__}: {ex}"))
+
+    def describe(self) -> Dict[str, Any]:
+        """Counts for the run statistics."""
+        calls = self.stats["encode_calls"]
+        return {
+            **self.stats,
+            "busy_s": round(self.stats["busy_s"], 3),
+            "mean_batch": round(self.stats["encoded"] / calls, 2) if calls else None,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+
+class _ImageBuffer:
+    """Shared memory block a worker writes its images into, grown as needed."""
+
+    def __init__(self) -> None:
+        self._shm: Any = None
+
+    def put(self, image: Any) -> Dict[str, Any]:
+        """Copy ``image`` into the block; returns what the server needs to read it."""
+        from multiprocessing import shared_memory
+
+        shape = getattr(image, "shape", None)
+        if shape is not None:
+            import numpy as np
+
+            image = np.ascontiguousarray(image)
+        data = memoryview(image).cast("B")
+        if self._shm is None or self._shm.size < data.nbytes:
+            self.close()
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(1, data.nbytes)
+            )
+        self._shm.buf[: data.nbytes] = data
+        return {
+            "shm": self._shm.name,
+            "nbytes": data.nbytes,
+            "shape": None if shape is None else tuple(image.shape),
+            "dtype": None if shape is None else str(image.dtype),
+        }
+
+    def close(self) -> None:
+        """Release the block."""
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class RemotePredictor:
+    """``set_image`` / ``predict`` of the model in the node's SAM server.
+
+    The attributes ``set_image`` leaves on a SAM predictor (``original_size``,
+    ``input_size``, ...) are mirrored, but the embedding itself stays in the
+    server: ``predict_torch`` and ``get_image_embedding`` (and ``features``)
+    are proxied, with their tensors sent through the CPU. ``hits`` and
+    ``misses`` count images the server had cached and images it encoded.
+    """
+
+    def __init__(self, connect: Callable[[], Connection]) -> None:
+        """Use the server ``connect`` returns a connection to."""
+        self._connect = connect
+        self._conn = connect()
+        self._buffer = _ImageBuffer()
+        # the last set_image request, sent again to a new server
+        self._image: Dict[str, Any] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.reconnects = 0
+        self.wait_s = 0.0
+        self.original_size: Tuple[int, ...] | None = None
+        self.input_size: Tuple[int, ...] | None = None
+        self.is_image_set = False
+        self.server_pid = 0
+        self._hello(retry=True)
+
+    def _hello(self, retry: bool) -> None:
+        info = self._call("hello", {"pid": os.getpid()}, retry)
+        self.server_pid = info["pid"]
+        # what prompt_windows.encoder_size reads
+        self.model = SimpleNamespace(image_size=info["encoder_size"])
+
+    def _call(self, op: str, payload: Dict[str, Any], retry: bool = True) -> Any:
+        t0 = time.perf_counter()
+        try:
+            self._conn.send((op, payload))
+            status, value = self._conn.recv()
+        except (EOFError, OSError) as ex:
+            if not retry:
+                raise
+            # e.g. the server stopped when idle just as this worker called it
+            logger.warning("Lost the SAM server (%s), reconnecting", ex)
+            self._reconnect()
+            return self._call(op, payload, retry=False)
+        self.requests += 1
+        self.wait_s += time.perf_counter() - t0
+        if status != "ok":
+            # RuntimeError, like torch's, so out-of-memory errors are recognised
+            raise RuntimeError(f"SAM server: {value}")
+        return value
+
+    def _reconnect(self) -> None:
+        """Connect to a (possibly new) server and set the current image again."""
+        self._conn.close()
+        self._conn = self._connect()
+        self.reconnects += 1
+        self._hello(retry=False)
+        if self._image is not None:
+            self._call("set_image", self._image, retry=False)
+
+    def set_image(self, image: Any, image_format: str = "RGB") -> None:
+        """Have the server encode ``image`` (or restore its cached embedding)."""
+        # the buffer is overwritten, so the previous image cannot be resent
+        self._image = None
+        payload = {
+            "key": image_key(image) + image_format,
+            "format": image_format,
+            **self._buffer.put(image),
+        }
+        out = self._call("set_image", payload)
+        self._image = payload
+        for name, value in out["state"].items():
+            setattr(self, name, value)
+        if out["reused"]:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def predict(self, *args: Any, **kwargs: Any) -> Any:
+        """``predict`` on the image this worker set last."""
+        return self._call("predict", {"args": args, "kwargs": kwargs})
+
+    def predict_torch(self, *args: Any, **kwargs: Any) -> Any:
+        """``predict_torch``; the outputs are on the device of the inputs."""
+        device = _device_of([*args, *kwargs.values()])
+        out = self._call(
+            "predict_torch",
+            {"args": _moved(args, "cpu"), "kwargs": _moved(kwargs, "cpu")},
+        )
+        return out if device is None else _moved(out, device)
+
+    def get_image_embedding(self) -> Any:
+        """Embedding of the image this worker set last, on the CPU."""
+        return self._call("embedding", {})
+
+    @property
+    def features(self) -> Any:
+        """Alias of :meth:`get_image_embedding`, as on ``SamPredictor``."""
+        return self.get_image_embedding()
+
+    def describe(self) -> Dict[str, Any]:
+        """Requests of this worker and the counts of the server."""
+        return {
+            "requests": self.requests,
+            "reconnects": self.reconnects,
+            "round_trip_s": round(self.wait_s, 3),
+            "server": self._call("stats", {}),
+        }
+
+    def close(self) -> None:
+        """Disconnect and release the image buffer."""
+        self._conn.close()
+        self._buffer.close()
+
+
+def _authkey(folder: str) -> bytes:
+    """Key of the servers in ``folder``, created by the first worker."""
+    path = os.path.join(folder, AUTHKEY_FILE)
+    if not os.path.exists(path):
+        # written in full under another name and linked into place, so a
+        # worker starting at the same time never reads a partial key
+        fd, tmp = tempfile.mkstemp(prefix=AUTHKEY_FILE, dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_bytes(32))
+            os.link(tmp, path)
+        except FileExistsError:
+            pass  # another worker linked its key first
+        finally:
+            os.unlink(tmp)
+    return Path(path).read_bytes()
+
+
+def _start_server(
+    folder: str, factory: str, model_path: str, args: Any
+) -> subprocess.Popen[bytes] | None:
+    """Start a server unless one is running; None if one is."""
+    fd = os.open(os.path.join(folder, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            # held by the running server for its whole life
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        cmd = [
+            sys.executable,
+            "-m",
+            "gsm_common.sam_server",
+            "--dir",
+            folder,
+            "--factory",
+            factory,
+            "--model_path",
+            model_path,
+            "--max_batch",
+            str(args.sam_server_max_batch),
+            "--max_wait_ms",
+            str(args.sam_server_max_wait_ms),
+            "--cache_size",
+            str(args.sam_server_cache_size),
+            "--idle_s",
+            str(args.sam_server_idle_s),
+            "--lock_fd",
+            str(fd),
+        ]
+        # the server imports gsm_common and the stage package like this worker
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(p for p in sys.path if p)}
+        with open(os.path.join(folder, LOG_FILE), "ab") as log:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=env,
+                pass_fds=(fd,),
+                start_new_session=True,
+            )
+        logger.info("Started the SAM server (pid %s) in %s", proc.pid, folder)
+        return proc
+    finally:
+        # the lock stays with the server's copy of the descriptor
+        os.close(fd)
+
+
+def _wait_for_server(folder: str, model_path: str, args: Any) -> Connection:
+    """Connect to the server in ``folder``, starting it at most once."""
+    authkey = _authkey(folder)
+    address = os.path.join(folder, SOCKET_FILE)
+    log = os.path.join(folder, LOG_FILE)
+    deadline = time.monotonic() + args.sam_server_start_timeout
+    started: subprocess.Popen[bytes] | None = None
+    while True:
+        try:
+            return Client(address, "AF_UNIX", authkey=authkey)
+        except (OSError, EOFError, AuthenticationError) as ex:
+            error: BaseException = ex
+        if started is None:
+            # only succeeds while no server holds the lock, e.g. one still loading
+            started = _start_server(folder, args.sam_server_factory, model_path, args)
+        elif started.poll() is not None:
+            raise RuntimeError(
+                f"The SAM server exited with status {started.returncode}, see {log}"
+            ) from error
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"No SAM server in {folder}, see {log}") from error
+        time.sleep(0.2)
+
+
+def connect_or_start(args: Any, model_path: str) -> RemotePredictor:
+    """Connect to the SAM server of this node, starting it if needed."""
+    folder = server_dir(args.sam_server_dir, args.sam_server_factory, model_path)
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    predictor = RemotePredictor(lambda: _wait_for_server(folder, model_path, args))
+    logger.info(
+        "Connected to the SAM server (pid %s) in %s", predictor.server_pid, folder
+    )
+    return predictor
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    """Run a server (started by :func:`connect_or_start`)."""
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--dir", required=True)
+    ap.add_argument("--factory", default=DEFAULT_FACTORY)
+    ap.add_argument("--model_path", required=True)
+    ap.add_argument("--max_batch", type=int, default=4)
+    ap.add_argument("--max_wait_ms", type=float, default=20.0)
+    ap.add_argument("--cache_size", type=int, default=16)
+    ap.add_argument("--idle_s", type=float, default=30.0)
+    ap.add_argument(
+        "--lock_fd", type=int, default=None, help="Server lock taken by the starter"
+    )
+    args = ap.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if args.lock_fd is None:
+        fd = os.open(os.path.join(args.dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("A SAM server is already running in %s", args.dir)
+            return
+    t0 = time.perf_counter()
+    predictor = load_factory(args.factory)(model_path=args.model_path)
+    logger.info("Loaded the model in %.1fs", time.perf_counter() - t0)
+    server = SamServer(predictor, args.max_batch, args.max_wait_ms, args.cache_size)
+    address = os.path.join(args.dir, SOCKET_FILE)
+    if os.path.exists(address):
+        os.unlink(address)  # left behind by a server that was killed
+    with Listener(address, "AF_UNIX", authkey=_authkey(args.dir)) as listener:
+        logger.info("Serving on %s", address)
+        server.serve(listener, args.idle_s)
+    logger.info("Stopped: %s", server.describe())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+"""Cost-aware sharding of tiles across distributed ranks.
+
+Four modes are supported:
+
+- ``modulo``: the original round-robin striping (``i % world == rank``).
+- ``lpt``: longest-processing-time-first bin packing on estimated tile costs.
+- ``zorder``: tiles in Z-order of their grid coordinates, cut into contiguous
+  ranges of about equal estimated cost, so every rank gets a compact area.
+- ``dynamic``: ranks claim tiles one at a time from a shared claims directory,
+  visiting them in LPT order, so faster ranks keep pulling work.
+
+Tile costs are estimated from the prepared-tile metadata: an explicit point count
+when the record carries one, otherwise the size of the files it references in
+``pc_dir`` (from one bulk directory walk), weighted by the number of segment masks.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import queue
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Tuple,
+)
+
+from gsm_common.columnar import COLUMNAR_SUFFIX, columnar_point_count
+from gsm_common.tile_index import zorder
+
+logger = logging.getLogger(__name__)
+
+SHARDING_MODES = ("modulo", "lpt", "zorder", "dynamic")
+
+# Relative extra cost of every 2D mask that has to be lifted to 3D.
+_MASK_COST_FACTOR = 0.05
+# Rough LAZ bytes per point, used to put point counts and file sizes on one scale.
+COST_BYTES_PER_POINT = 4.0
+_POINT_COUNT_KEYS = ("point_count", "num_points", "n_points", "points")
+_STATS_SUBDIR = "_stats"
+
+
+def _iter_strings(record: Any) -> Iterable[str]:
+    if isinstance(record, str):
+        yield record
+    elif isinstance(record, Mapping):
+        for v in record.values():
+            yield from _iter_strings(v)
+    elif isinstance(record, (list, tuple)):
+        for v in record:
+            yield from _iter_strings(v)
+
+
+def _find_point_count(record: Any) -> int | None:
+    if isinstance(record, Mapping):
+        for k in _POINT_COUNT_KEYS:
+            v = record.get(k)
+            if isinstance(v, (int, float)) and v > 0:
+                return int(v)
+        for v in record.values():
+            found = _find_point_count(v)
+            if found:
+                return found
+    return None
+
+
+def count_masks(segment_record: Any) -> int:
+    """Count the mask entries referenced by a segment metadata record."""
+    if isinstance(segment_record, str):
+        return 1
+    if isinstance(segment_record, (list, tuple)):
+        return len(segment_record)
+    if isinstance(segment_record, Mapping):
+        return sum(count_masks(v) for v in segment_record.values())
+    return 0
+
+
+def scan_file_sizes(root: str) -> Dict[str, int]:
+    """Map file paths under ``root`` to their size using one recursive listing.
+
+    Keys are both the POSIX path relative to ``root`` and the bare file name, so
+    records holding either form (or an absolute path from another mount) match.
+    Columnar point cloud folders count as files, sized by their point count.
+    """
+    sizes: Dict[str, int] = {}
+    if not root or not os.path.isdir(root):
+        return sizes
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    try:
+                        if is_dir and entry.name.endswith(COLUMNAR_SUFFIX):
+                            points = columnar_point_count(entry.path)
+                            size = int(points * COST_BYTES_PER_POINT)
+                        elif is_dir:
+                            stack.append(entry.path)
+                            continue
+                        else:
+                            size = entry.stat(follow_symlinks=False).st_size
+                    except (OSError, ValueError, KeyError):
+                        continue
+                    rel = Path(os.path.relpath(entry.path, root)).as_posix()
+                    sizes[rel] = size
+                    sizes.setdefault(entry.name, size)
+        except OSError as ex:
+            logger.warning("Could not list %s: %s", current, ex)
+    return sizes
+
+
+def _lookup_size(path: str, sizes: Mapping[str, int]) -> int:
+    posix = Path(path).as_posix()
+    if posix in sizes:
+        return sizes[posix]
+    return sizes.get(Path(path).name, 0)
+
+
+def estimate_tile_costs(
+    pc_paths: Sequence[str],
+    segment_metadata: Mapping[str, Any],
+    pc_metadata: Mapping[str, Any],
+    pc_dir: str | None,
+) -> Dict[str, float]:
+    """Estimate a relative processing cost per tile.
+
+    Costs are in "bytes of LAZ" units. Tiles without any usable signal get the
+    median cost of the others (or 1.0), so they still spread evenly.
+    """
+    sizes = scan_file_sizes(pc_dir) if pc_dir else {}
+    costs: Dict[str, float] = {}
+    unknown: List[str] = []
+    for pc_path in pc_paths:
+        record = pc_metadata.get(pc_path)
+        points = _find_point_count(record)
+        if points:
+            base = points * COST_BYTES_PER_POINT
+        else:
+            base = float(sum(_lookup_size(s, sizes) for s in _iter_strings(record)))
+            if not base:
+                base = float(_lookup_size(pc_path, sizes))
+        if not base:
+            unknown.append(pc_path)
+            continue
+        masks = count_masks(segment_metadata.get(pc_path))
+        costs[pc_path] = base * (1.0 + _MASK_COST_FACTOR * masks)
+
+    known = sorted(costs.values())
+    fallback = known[len(known) // 2] if known else 1.0
+    for pc_path in unknown:
+        costs[pc_path] = fallback
+    if unknown:
+        logger.info("No cost signal for %d/%d tiles.", len(unknown), len(pc_paths))
+    return costs
+
+
+def shard_modulo(pc_paths: Sequence[str], world: int) -> List[List[str]]:
+    """Round-robin striping by position."""
+    shards: List[List[str]] = [[] for _ in range(world)]
+    for i, p in enumerate(pc_paths):
+        shards[i % world].append(p)
+    return shards
+
+
+def lpt_order(costs: Mapping[str, float]) -> List[str]:
+    """Keys sorted by descending cost, ties broken by key for determinism."""
+    return sorted(costs, key=lambda k: (-costs[k], k))
+
+
+def shard_lpt(costs: Mapping[str, float], world: int) -> List[List[str]]:
+    """Longest-processing-time-first bin packing.
+
+    Each shard is returned in descending cost order so the in-node pool also
+    starts the big tiles first.
+    """
+    shards: List[List[str]] = [[] for _ in range(world)]
+    heap = [(0.0, r) for r in range(world)]
+    for key in lpt_order(costs):
+        load, r = heapq.heappop(heap)
+        shards[r].append(key)
+        heapq.heappush(heap, (load + costs[key], r))
+    return shards
+
+
+def shard_contiguous(
+    order: Sequence[str], costs: Mapping[str, float], world: int
+) -> List[List[str]]:
+    """Cut ``order`` into ``world`` contiguous ranges of about equal total cost.
+
+    A range ends at the item whose cost midpoint crosses its share of the
+    total, so neighbouring items in ``order`` stay on one rank.
+    """
+    shards: List[List[str]] = [[] for _ in range(world)]
+    total = sum(costs.get(k, 0.0) for k in order) or 1.0
+    done = 0.0
+    for key in order:
+        cost = costs.get(key, 0.0)
+        r = min(world - 1, int((done + cost / 2) * world / total))
+        shards[r].append(key)
+        done += cost
+    return shards
+
+
+def plan_shard(
+    mode: str,
+    pc_paths: Sequence[str],
+    costs: Mapping[str, float],
+    rank: int,
+    world: int,
+) -> List[str]:
+    """Items of ``rank`` in ``mode``; all of them, in LPT order, for ``dynamic``."""
+    if mode == "dynamic":
+        shard = lpt_order(costs)
+        logger.info(
+            "Sharding [dynamic]: rank %s claims from %s items in LPT order.",
+            rank,
+            len(shard),
+        )
+        return shard
+    if mode == "lpt":
+        shard = shard_lpt(costs, world)[rank]
+    elif mode == "zorder":
+        shard = shard_contiguous(zorder(pc_paths), costs, world)[rank]
+    else:
+        shard = shard_modulo(pc_paths, world)[rank]
+    logger.info(
+        "Sharding [%s]: rank %s owns %s items out of %s total.",
+        mode,
+        rank,
+        len(shard),
+        len(pc_paths),
+    )
+    total = sum(costs.values())
+    if total:
+        logger.info(
+            "Rank %s predicted load: %.1f%% of total (ideal %.1f%%).",
+            rank,
+            100.0 * sum(costs[p] for p in shard) / total,
+            100.0 / world,
+        )
+    return shard
+
+
+class ClaimDirectory:
+    """First-come claims on work items through exclusive file creation.
+
+    The directory has to live on a filesystem where ``O_CREAT | O_EXCL`` is atomic
+    across nodes for claims to be exclusive. On filesystems where it is not, a
+    tile may occasionally be processed twice, which is wasteful but harmless
+    since outputs are keyed by tile and merged with a last-wins policy.
+    """
+
+    def __init__(self, root: str, rank: int) -> None:
+        """Create the claims directory if needed."""
+        self.root = root
+        self.rank = rank
+        os.makedirs(root, exist_ok=True)
+
+    def _claim_path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, f"{digest}.claim")
+
+    def try_claim(self, key: str) -> bool:
+        """Return True if this rank now owns ``key``."""
+        try:
+            fd = os.open(self._claim_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{self.rank}\n")
+        return True
+
+    def release(self, key: str) -> None:
+        """Give up a claim so another rank (or this one) can claim ``key`` again."""
+        try:
+            os.remove(self._claim_path(key))
+        except FileNotFoundError:
+            pass
+
+    def release_stale(self, done: Iterable[str], world: int) -> int:
+        """Release the claims an earlier attempt left on unfinished items.
+
+        Call before claiming anything: the claims of this rank, and of ranks
+        that no longer exist at ``world``, on items not in ``done`` are removed.
+        Returns the number of claims released.
+        """
+        finished = {os.path.basename(self._claim_path(k)) for k in done}
+        released = 0
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.endswith(".claim") or entry.name in finished:
+                    continue
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        owner = int(f.read().strip() or -1)
+                except (OSError, ValueError):
+                    continue
+                if owner == self.rank or owner >= world:
+                    try:
+                        os.remove(entry.path)
+                        released += 1
+                    except FileNotFoundError:
+                        pass
+        return released
+
+
+def iter_claimed(
+    pool: Any,
+    fn: Callable[[Any], Any],
+    keys: Sequence[str],
+    make_task: Callable[[str], Any],
+    max_in_flight: int,
+    claims: ClaimDirectory | None = None,
+    claimed: List[str] | None = None,
+) -> Iterator[Tuple[str, bool, Any]]:
+    """Run ``fn(make_task(key))`` on ``pool`` with at most ``max_in_flight`` queued.
+
+    Keys are claimed lazily, only when a local worker is about to become free,
+    so a rank never hoards items that a faster rank could have taken. Without
+    ``claims`` every key is taken, still submitted lazily. Yields ``(key, ok,
+    value)`` as the calls finish, ``value`` being the result or the error;
+    started keys are appended to ``claimed``.
+    """
+    done: queue.Queue[Tuple[str, bool, Any]] = queue.Queue()
+    pending = iter(keys)
+    in_flight = 0
+
+    def _submit_next() -> bool:
+        for key in pending:
+            if claims is None or claims.try_claim(key):
+                if claimed is not None:
+                    claimed.append(key)
+                pool.apply_async(
+                    fn,
+                    (make_task(key),),
+                    callback=lambda r, k=key: done.put((k, True, r)),
+                    error_callback=lambda e, k=key: done.put((k, False, e)),
+                )
+                return True
+        return False
+
+    while in_flight < max_in_flight and _submit_next():
+        in_flight += 1
+    while in_flight:
+        item = done.get()
+        in_flight -= 1
+        if _submit_next():
+            in_flight += 1
+        yield item
+
+
+def stats_dir(partials_dir: str) -> str:
+    """Folder for per-rank run statistics, next to (not among) the partials."""
+    return os.path.join(partials_dir, _STATS_SUBDIR)
+
+
+def write_rank_stats(partials_dir: str, rank: int, stats: Dict[str, Any]) -> None:
+    """Write per-rank sharding stats next to (not among) the partial outputs."""
+    os.makedirs(stats_dir(partials_dir), exist_ok=True)
+    with open(
+        os.path.join(stats_dir(partials_dir), f"sharding.rank{rank}.json"), "w"
+    ) as f:
+        json.dump(stats, f)
+
+
+def read_rank_stats(partials_dir: str) -> List[Dict[str, Any]]:
+    """Read all per-rank sharding stats, sorted by rank."""
+    out: List[Dict[str, Any]] = []
+    for p in sorted(Path(stats_dir(partials_dir)).glob("sharding.rank*.json")):
+        try:
+            out.append(json.loads(p.read_text(encoding="utf-8")))
+        except (OSError, json.JSONDecodeError) as ex:
+            logger.warning("Skipping unreadable stats file %s: %s", p, ex)
+    return sorted(out, key=lambda s: int(s.get("rank", 0)))
+
+
+def _imbalance(values: Sequence[float]) -> float:
+    mean = sum(values) / len(values) if values else 0.0
+    return max(values) / mean if mean else 0.0
+
+
+def _staging_note(staging: Mapping[str, Any] | None) -> str:
+    if not staging or staging.get("hit_rate") is None:
+        return ""
+    return " | staging hit rate {h:.1%}, {s:.0f} MB saved".format(
+        h=staging["hit_rate"], s=staging.get("bytes_saved", 0) / 1e6
+    )
+
+
+def _admission_note(admission: Mapping[str, Any] | None) -> str:
+    if not admission:
+        return ""
+    return " | held back {h}x, {r} workers recycled, {k} killed".format(
+        h=admission.get("held_back", 0),
+        r=admission.get("recycled", 0),
+        k=admission.get("killed", 0),
+    )
+
+
+def summarize_makespan(stats: Sequence[Mapping[str, Any]]) -> List[str]:
+    """Format predicted vs. actual per-rank makespan as log lines.
+
+    Predicted load is the rank's share of the estimated cost; actual load is its
+    wall-clock processing time. Imbalance is ``max / mean`` (1.0 is perfect).
+    """
+    if not stats:
+        return ["No sharding stats found."]
+    total_cost = sum(float(s.get("predicted_cost", 0.0)) for s in stats) or 1.0
+    total_time = sum(float(s.get("actual_seconds", 0.0)) for s in stats) or 1.0
+    lines = []
+    for s in stats:
+        lines.append(
+            "rank {rank} [{mode}]: {n} tiles | predicted share {p:.1%} | "
+            "actual {t:.0f}s ({a:.1%})".format(
+                rank=s.get("rank"),
+                mode=s.get("mode"),
+                n=s.get("num_items", 0),
+                p=float(s.get("predicted_cost", 0.0)) / total_cost,
+                t=float(s.get("actual_seconds", 0.0)),
+                a=float(s.get("actual_seconds", 0.0)) / total_time,
+            )
+            + _staging_note(s.get("staging"))
+            + _admission_note(s.get("admission"))
+        )
+    lines.append(
+        "Makespan imbalance (max/mean): predicted {p:.2f} | actual {a:.2f}".format(
+            p=_imbalance([float(s.get("predicted_cost", 0.0)) for s in stats]),
+            a=_imbalance([float(s.get("actual_seconds", 0.0)) for s in stats]),
+        )
+    )
+    return lines
@@ -0,0 +1,185 @@
+"""Per-process cache of city-wide vector layers, clipped per tile.
+
+The parallel pc_prep workers process many tiles each, but the per-tile code
+reads its vector inputs (BGT pavements, reference trees) from file paths. Without
+a cache every tile re-reads and re-filters the whole city-wide layer.
+
+:class:`SpatialLayerCache` reads each layer once per process, indexes it with a
+shapely ``STRtree`` and, per tile, writes only the features that intersect the
+tile bounds (plus a margin) to a small file in local scratch. The tile is then
+processed with its arguments pointing at those files. The cached frames are
+only read after loading, so all tiles of a worker share them. With tree
+ownership, a layer can be limited to the features whose centroid lies in the
+boxes the tile owns.
+
+geopandas, pandas and shapely are imported on first use; they are available
+in the pc_prep environment but not in the merge environments.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Mapping, Sequence, Tuple
+
+from gsm_common.tree_ownership import owned_mask
+
+logger = logging.getLogger(__name__)
+
+Bounds = Tuple[float, float, float, float]
+
+PICKLE_SUFFIXES = (".pkl", ".pickle")
+_XY_COLUMNS = (("x", "y"), ("X", "Y"), ("x_coord", "y_coord"))
+
+
+@dataclass
+class _Layer:
+    path: str
+    frame: Any
+    tree: Any
+
+
+def _read_frame(path: str) -> Any:
+    if Path(path).suffix.lower() in PICKLE_SUFFIXES:
+        import pandas as pd
+
+        return pd.read_pickle(path)
+    import geopandas as gpd
+
+    return gpd.read_file(path)
+
+
+def layer_geometries(frame: Any) -> Any:
+    """Geometries of a GeoDataFrame, or points from x/y columns; None if neither."""
+    import shapely
+
+    if hasattr(frame, "set_geometry"):
+        return frame.geometry.values
+    columns = getattr(frame, "columns", ())
+    for x, y in _XY_COLUMNS:
+        if x in columns and y in columns:
+            return shapely.points(frame[x].to_numpy(), frame[y].to_numpy())
+    return None
+
+
+def _write_frame(frame: Any, path: str) -> None:
+    if Path(path).suffix.lower() in PICKLE_SUFFIXES:
+        frame.to_pickle(path)
+    else:
+        # the driver follows the suffix, so the subset has the source's format
+        frame.to_file(path)
+
+
+class SpatialLayerCache:
+    """City-wide layers loaded once, written out per tile as clipped subsets."""
+
+    def __init__(self, scratch_dir: str, margin: float = 10.0) -> None:
+        """Write tile subsets under ``scratch_dir``, ``margin`` around the tile."""
+        self.scratch_dir = scratch_dir
+        self.margin = margin
+        self._layers: Dict[str, _Layer] = {}
+        self.tiles = 0
+        self.features_written = 0
+        self.features_not_owned = 0
+
+    def add(self, name: str, path: str) -> bool:
+        """Load and index the layer at ``path``; False if it cannot be indexed."""
+        t0 = time.perf_counter()
+        try:
+            from shapely import STRtree
+
+            frame = _read_frame(path)
+        except Exception as ex:
+            logger.warning("Not caching %s (%s): %s", name, path, ex)
+            return False
+        geoms = layer_geometries(frame)
+        if geoms is None:
+            logger.warning("Not caching %s: no geometry or x/y columns", name)
+            return False
+        self._layers[name] = _Layer(path, frame, STRtree(geoms))
+        logger.info(
+            "Cached %s: %d features from %s in %.1fs",
+            name,
+            len(frame),
+            path,
+            time.perf_counter() - t0,
+        )
+        return True
+
+    def clip(self, name: str, bounds: Bounds) -> Any:
+        """Features of layer ``name`` intersecting ``bounds`` grown by the margin."""
+        import numpy as np
+        import shapely
+
+        layer = self._layers[name]
+        minx, miny, maxx, maxy = bounds
+        m = self.margin
+        box = shapely.box(minx - m, miny - m, maxx + m, maxy + m)
+        idx = np.sort(layer.tree.query(box, predicate="intersects"))
+        return layer.frame.iloc[idx]
+
+    def owned(self, subset: Any, boxes: Sequence[Sequence[float]]) -> Any:
+        """Features of ``subset`` whose centroid lies in one of ``boxes``."""
+        import shapely
+
+        xy = shapely.get_coordinates(shapely.centroid(layer_geometries(subset)))
+        kept = subset.iloc[owned_mask(xy[:, 0], xy[:, 1], boxes)]
+        self.features_not_owned += len(subset) - len(kept)
+        return kept
+
+    def write_tile(
+        self,
+        tile: str,
+        bounds: Bounds,
+        owned: Mapping[str, Sequence[Sequence[float]]] | None = None,
+    ) -> Dict[str, str]:
+        """Write the clipped subset of every layer for ``tile``.
+
+        Layers named in ``owned`` keep only the features owned by the tile (see
+        :meth:`owned`). Returns ``{layer name: subset path}``. The subsets keep
+        the file name of their source layer. A layer whose subset cannot be
+        written is left out, so the caller falls back to the full layer.
+        """
+        out_dir = os.path.join(self.scratch_dir, tile)
+        os.makedirs(out_dir, exist_ok=True)
+        paths: Dict[str, str] = {}
+        for name, layer in self._layers.items():
+            subset = self.clip(name, bounds)
+            if owned and name in owned:
+                subset = self.owned(subset, owned[name])
+            dst = os.path.join(out_dir, os.path.basename(layer.path))
+            try:
+                _write_frame(subset, dst)
+            except Exception as ex:
+                logger.warning("Could not write %s subset of %s: %s", name, tile, ex)
+                continue
+            paths[name] = dst
+            self.features_written += len(subset)
+        self.tiles += 1
+        return paths
+
+    def release_tile(self, tile: str) -> None:
+        """Remove the subsets written for ``tile``."""
+        shutil.rmtree(os.path.join(self.scratch_dir, tile), ignore_errors=True)
+
+    def close(self) -> None:
+        """Drop the layers and remove the scratch folder."""
+        self._layers.clear()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def describe(self) -> str:
+        """One-line summary of the subsets written."""
+        avg = self.features_written / self.tiles if self.tiles else 0.0
+        not_owned = (
+            f", {self.features_not_owned} owned by other tiles"
+            if self.features_not_owned
+            else ""
+        )
+        return (
+            f"{len(self._layers)} cached layer(s), {self.tiles} tiles, "
+            f"{avg:.1f} features per tile{not_owned}"
+        )
@@ -0,0 +1,243 @@
+"""Read-through cache of blob-mounted inputs on the local disk.
+
+:class:`StagingCache` mirrors files of a mounted folder (``pc_raw``, ``img_dir``,
+``pc_dir``, ...) under a local folder, keeping their relative paths. Callers
+stage the files an item needs, run the item with the mount argument pointed at
+the mirror, and release the files afterwards. The next items can be staged in
+the background (:meth:`StagingCache.prefetch`) while the current one runs.
+
+A file that is read again (a retried mini-batch, a point count read before the
+tile itself, the fused pc_ops + tree_modeling pass) is served from the local
+copy. When the cache grows over its byte budget, the least recently used files
+that are not in use are evicted.
+
+Every process has its own cache folder, so eviction never removes a file that
+another worker is reading. ``--stage_cache_gb`` is the budget of the node's
+local disk: it is divided over the ``--stage_cache_processes`` processes of the
+node that open a cache (the AML workers per node of a parallel step; one for
+``pc_ops_dist``, whose workers read from the cache of their rank).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+_Key = Tuple[str, str]
+
+
+@dataclass
+class _Entry:
+    size: int
+    pins: int = 0
+
+
+def _tree_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(d, f))
+        for d, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def record_paths(record: Any) -> List[str]:
+    """Relative file paths (strings with a suffix) nested in a metadata record."""
+    out: List[str] = []
+    stack = [record]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            if value and not os.path.isabs(value) and os.path.splitext(value)[1]:
+                out.append(value)
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return out
+
+
+class StagingCache:
+    """LRU cache of mounted files on local disk, bounded by ``max_bytes``."""
+
+    def __init__(self, root: str, max_bytes: int, threads: int = 4) -> None:
+        """Cache under a new per-process folder in ``root``."""
+        os.makedirs(root, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix=f"stage_{os.getpid()}_", dir=root)
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[_Key, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, threads), thread_name_prefix="stage"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.bytes_copied = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def mirror(self, src_root: str) -> str:
+        """Local folder mirroring ``src_root``."""
+        digest = hashlib.sha1(os.path.abspath(src_root).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:12])
+
+    def stage(self, src_root: str, rel_paths: Iterable[str]) -> str:
+        """Make ``rel_paths`` of ``src_root`` available locally and pin them.
+
+        Returns the mirror folder. Files missing on the mount are left out, so
+        the consumer sees them as missing just like on the mount.
+        """
+        mirror = self.mirror(src_root)
+        missing: List[str] = []
+        with self._lock:
+            for rel in dict.fromkeys(rel_paths):
+                entry = self._entries.get((mirror, rel))
+                if entry is None:
+                    missing.append(rel)
+                    continue
+                entry.pins += 1
+                self._entries.move_to_end((mirror, rel))
+                self.hits += 1
+                self.bytes_saved += entry.size
+        for rel in missing:
+            self._copy(src_root, mirror, rel)
+        self._evict()
+        return mirror
+
+    def prefetch(self, src_root: str, rel_paths: Sequence[str]) -> Future[str]:
+        """:meth:`stage` in the background."""
+        return self._pool.submit(self.stage, src_root, list(rel_paths))
+
+    def release(self, src_root: str, rel_paths: Iterable[str]) -> None:
+        """Unpin files staged for an item that is done."""
+        mirror = self.mirror(src_root)
+        with self._lock:
+            for rel in dict.fromkeys(rel_paths):
+                entry = self._entries.get((mirror, rel))
+                if entry is not None and entry.pins:
+                    entry.pins -= 1
+        self._evict()
+
+    def _copy(self, src_root: str, mirror: str, rel: str) -> None:
+        dst = os.path.join(mirror, rel)
+        os.makedirs(os.path.dirname(dst) or mirror, exist_ok=True)
+        tmp = f"{dst}.{threading.get_ident()}.part"
+        src = os.path.join(src_root, rel)
+        try:
+            if os.path.isdir(src):
+                # columnar point clouds are folders
+                shutil.copytree(src, tmp)
+                size = _tree_size(tmp)
+            else:
+                shutil.copyfile(src, tmp)
+                size = os.path.getsize(tmp)
+            os.replace(tmp, dst)
+        except OSError as ex:
+            logger.debug("Not staged %s: %s", rel, ex)
+            _remove(tmp)
+            return
+        with self._lock:
+            old = self._entries.get((mirror, rel))
+            if old is not None:
+                # staged concurrently by another thread; keep a single entry
+                old.pins += 1
+                return
+            self._entries[(mirror, rel)] = _Entry(size, pins=1)
+            self._bytes += size
+            self.misses += 1
+            self.bytes_copied += size
+
+    def _evict(self) -> None:
+        with self._lock:
+            if self._bytes <= self.max_bytes:
+                return
+            for key in list(self._entries):
+                if self._bytes <= self.max_bytes:
+                    break
+                entry = self._entries[key]
+                if entry.pins:
+                    continue
+                del self._entries[key]
+                self._bytes -= entry.size
+                self.evictions += 1
+                _remove(os.path.join(*key))
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate and byte counters."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "bytes_copied": self.bytes_copied,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+            "cached_bytes": self._bytes,
+        }
+
+    def describe(self) -> str:
+        """One-line summary for the worker log."""
+        s = self.stats()
+        rate = f"{s['hit_rate']:.1%}" if s["hit_rate"] is not None else "-"
+        return (
+            f"hit rate {rate} ({s['hits']} hits, {s['misses']} misses), "
+            f"{s['bytes_copied'] / 1e6:.1f} MB copied, "
+            f"{s['bytes_saved'] / 1e6:.1f} MB saved, {s['evictions']} evictions"
+        )
+
+    def close(self) -> None:
+        """Stop the prefetch threads and remove the cache folder."""
+        self._pool.shutdown(wait=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def add_staging_arguments(ap: Any) -> None:
+    """Add the opt-in staging cache options of the entry scripts."""
+    ap.add_argument(
+        "--stage_cache_dir",
+        default=None,
+        help="Local disk folder for a read-through cache of mounted inputs "
+        "(disabled if not given)",
+    )
+    ap.add_argument(
+        "--stage_cache_gb",
+        type=float,
+        default=50.0,
+        help="Budget of the staging caches in GB per node (0 disables them)",
+    )
+    ap.add_argument(
+        "--stage_cache_processes",
+        type=int,
+        default=1,
+        help="Processes per node that share --stage_cache_gb",
+    )
+
+
+def open_staging_cache(args: Any) -> StagingCache | None:
+    """The staging cache configured by ``args``, or None if disabled."""
+    if not args.stage_cache_dir or args.stage_cache_gb <= 0:
+        return None
+    processes = max(1, args.stage_cache_processes)
+    return StagingCache(
+        args.stage_cache_dir, int(args.stage_cache_gb * 1e9 / processes)
+    )
@@ -0,0 +1,330 @@
+"""Streaming merge of per-item partial results into metadata files.
+
+Partials are read one row at a time and outputs are written one entry at a time,
+so memory use does not grow with the size of the values. Only the keys are kept
+in memory to resolve duplicates:
+
+- ``first``: the first occurrence of a key wins (single pass).
+- ``last``: the last occurrence of a key wins (second pass over the partials).
+
+Outputs are compact JSON objects by default (drop-in for the previous
+``json.dump`` output), optionally indented for debugging, or JSONL with one
+``{key: value}`` object per line.
+
+Each output can also get an SQLite index for point lookups by key (see
+:mod:`gsm_common.metadata_store`).
+
+Row keys starting with ``_`` and the ``skip`` marker are run bookkeeping and are
+never merged into metadata.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+)
+
+from gsm_common.metadata_store import SqliteIndexWriter
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_POLICIES = ("last", "first")
+OUTPUT_FORMATS = ("json", "jsonl")
+SKIP_KEY = "skip"
+
+Row = Dict[str, Any]
+Selector = Callable[[Row], Iterable[Tuple[str, Any]]]
+
+
+def is_reserved_key(key: str) -> bool:
+    """Return True for row keys that carry bookkeeping rather than metadata."""
+    return key == SKIP_KEY or key.startswith("_")
+
+
+def select_entries(row: Row) -> Iterable[Tuple[str, Any]]:
+    """Use every non-reserved ``key: value`` pair of a row."""
+    return ((k, v) for k, v in row.items() if not is_reserved_key(k))
+
+
+def select_section(name: str) -> Selector:
+    """Use the ``key: value`` pairs nested under ``row[name]``."""
+
+    def _select(row: Row) -> Iterable[Tuple[str, Any]]:
+        section = row.get(name)
+        return section.items() if isinstance(section, dict) else ()
+
+    return _select
+
+
+def select_value(name: str) -> Selector:
+    """Use ``row[name]`` itself as the key (for list-style outputs)."""
+
+    def _select(row: Row) -> Iterable[Tuple[str, Any]]:
+        value = row.get(name)
+        return ((value, None),) if isinstance(value, str) else ()
+
+    return _select
+
+
+@dataclass
+class MergeOutput:
+    """One merged output file and how to pick its entries from a row.
+
+    Attributes:
+        path: Output file path.
+        select: Yields ``(key, value)`` pairs of a row for this output.
+        fmt: ``json`` (one object) or ``jsonl`` (one object per line).
+        indent: Indentation for ``json`` output; ``None`` writes compact JSON.
+        list_key: If set, write only the keys as ``{list_key: [key, ...]}``.
+        index_path: If set, also write an SQLite key -> record index there.
+    """
+
+    path: str
+    select: Selector
+    fmt: str = "json"
+    indent: int | None = None
+    list_key: str | None = None
+    index_path: str | None = None
+
+
+@dataclass
+class MergeStats:
+    """Counts reported for one merged output."""
+
+    entries_seen: int = 0
+    written: int = 0
+    duplicates: int = 0
+
+    def describe(self) -> str:
+        """One-line summary."""
+        return (
+            f"{self.written} entries written, {self.entries_seen} seen, "
+            f"{self.duplicates} duplicate keys resolved"
+        )
+
+
+@dataclass
+class SourceStats:
+    """Counts for the rows read from the partials."""
+
+    files: int = 0
+    rows: int = 0
+    malformed: int = 0
+    skipped: int = 0
+
+
+def iter_partial_rows(paths: Sequence[str], stats: SourceStats) -> Iterator[Row]:
+    """Yield rows from JSONL partials, or ``{key: value}`` rows from JSON dicts."""
+    for path in paths:
+        stats.files += 1
+        if Path(path).suffix.lower() == ".json":
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    part = json.load(f)
+            except (OSError, json.JSONDecodeError) as ex:
+                logger.warning("Skipping malformed partial %s: %s", path, ex)
+                stats.malformed += 1
+                continue
+            if isinstance(part, dict):
+                for k, v in part.items():
+                    stats.rows += 1
+                    yield {k: v}
+            continue
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                s = line.strip()
+                if not s:
+                    continue
+                try:
+                    row = json.loads(s)
+                except json.JSONDecodeError:
+                    stats.malformed += 1
+                    continue
+                if not isinstance(row, dict):
+                    stats.malformed += 1
+                    continue
+                stats.rows += 1
+                if SKIP_KEY in row:
+                    stats.skipped += 1
+                yield row
+
+
+class _Writer:
+    """Incremental writer for one output."""
+
+    def __init__(self, out: MergeOutput) -> None:
+        self._out = out
+        Path(out.path).parent.mkdir(parents=True, exist_ok=True)
+        self._f: TextIO = open(out.path, "w", encoding="utf-8")
+        self._first = True
+        self._index = SqliteIndexWriter(out.index_path) if out.index_path else None
+        if out.fmt == "json":
+            self._f.write("{")
+            if out.list_key is not None:
+                self._f.write(self._newline(1) + json.dumps(out.list_key))
+                self._f.write(": [" if out.indent is not None else ":[")
+
+    def _newline(self, level: int) -> str:
+        if self._out.indent is None:
+            return ""
+        return "\n" + " " * (self._out.indent * level)
+
+    def write(self, key: str, value: Any) -> None:
+        out = self._out
+        if self._index is not None:
+            self._index.put(key, value)
+        if out.fmt == "jsonl":
+            obj: Any = key if out.list_key is not None else {key: value}
+            self._f.write(json.dumps(obj, separators=(",", ":")) + "\n")
+            return
+
+        if not self._first:
+            self._f.write(",")
+        self._first = False
+        level = 2 if out.list_key is not None else 1
+        self._f.write(self._newline(level) + json.dumps(key))
+        if out.list_key is not None:
+            return
+        if out.indent is None:
+            self._f.write(":" + json.dumps(value, separators=(",", ":")))
+        else:
+            dumped = json.dumps(value, indent=out.indent)
+            self._f.write(": " + dumped.replace("\n", self._newline(level)))
+
+    def close(self) -> None:
+        out = self._out
+        if out.fmt == "json":
+            if out.list_key is not None:
+                self._f.write((self._newline(1) if not self._first else "") + "]")
+                self._f.write(self._newline(0) + "}")
+            else:
+                self._f.write((self._newline(0) if not self._first else "") + "}")
+            if out.indent is not None:
+                self._f.write("\n")
+        self._f.close()
+        if self._index is not None:
+            self._index.close()
+
+
+def merge_partials(
+    sources: Sequence[str],
+    outputs: Mapping[str, MergeOutput],
+    on_duplicate: str = "last",
+    observers: Sequence[Callable[[Row], None]] = (),
+) -> Tuple[Dict[str, MergeStats], SourceStats]:
+    """Stream ``sources`` into every output in ``outputs``.
+
+    Args:
+        sources: Partial files, read in order (JSONL, or JSON dict per file).
+        outputs: Named outputs to produce in the same pass.
+        on_duplicate: ``last`` or ``first`` occurrence of a key wins.
+        observers: Called with every row read (e.g. to collect telemetry).
+
+    Returns:
+        Per-output stats and stats of the rows read.
+    """
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy: {on_duplicate}")
+
+    stats = {name: MergeStats() for name in outputs}
+
+    # For last-wins, remember the ordinal of the last occurrence of every key.
+    last_seen: Dict[str, Dict[str, int]] = {name: {} for name in outputs}
+    if on_duplicate == "last":
+        counters = dict.fromkeys(outputs, 0)
+        for row in iter_partial_rows(sources, SourceStats()):
+            for name, out in outputs.items():
+                for key, _ in out.select(row):
+                    last_seen[name][key] = counters[name]
+                    counters[name] += 1
+
+    source_stats = SourceStats()
+    writers = {name: _Writer(out) for name, out in outputs.items()}
+    seen: Dict[str, Set[str]] = {name: set() for name in outputs}
+    ordinals = dict.fromkeys(outputs, 0)
+    try:
+        for row in iter_partial_rows(sources, source_stats):
+            for observe in observers:
+                observe(row)
+            for name, out in outputs.items():
+                for key, value in out.select(row):
+                    st = stats[name]
+                    st.entries_seen += 1
+                    ordinal = ordinals[name]
+                    ordinals[name] += 1
+                    if on_duplicate == "last":
+                        keep = last_seen[name][key] == ordinal
+                    else:
+                        keep = key not in seen[name]
+                        seen[name].add(key)
+                    if not keep:
+                        st.duplicates += 1
+                        continue
+                    writers[name].write(key, value)
+                    st.written += 1
+    finally:
+        for w in writers.values():
+            w.close()
+    return stats, source_stats
+
+
+def add_merge_arguments(ap: argparse.ArgumentParser) -> None:
+    """Add the output format options shared by all merge scripts."""
+    ap.add_argument("--format", choices=OUTPUT_FORMATS, default="json")
+    ap.add_argument(
+        "--indent",
+        type=int,
+        default=None,
+        help="Indent JSON output (debugging); compact when omitted",
+    )
+    ap.add_argument("--on_duplicate", choices=DUPLICATE_POLICIES, default="last")
+    ap.add_argument(
+        "--telemetry_summary",
+        default=None,
+        help="Write the per-stage telemetry summary of the rows as JSON",
+    )
+
+
+def list_partials(partials: str, pattern: str = "*.json*") -> List[str]:
+    """Expand a partial argument: a single file, or the matching files of a folder."""
+    if os.path.isdir(partials):
+        return sorted(str(p) for p in Path(partials).glob(pattern) if p.is_file())
+    return [partials]
+
+
+def with_carried_over(partials: List[str], carried_over: str | None) -> List[str]:
+    """Prepend the ``carried_over`` rows of a resumed run to the partials.
+
+    They are read first so fresh results win under the ``last`` policy. A missing
+    or empty file (no ledger, or nothing completed yet) is left out.
+    """
+    if carried_over and os.path.isfile(carried_over) and os.path.getsize(carried_over):
+        return [carried_over, *partials]
+    return partials
+
+
+def describe_run(source_stats: SourceStats, stats: Mapping[str, MergeStats]) -> str:
+    """Human-readable summary of a merge."""
+    parts = [
+        f"{source_stats.rows} rows from {source_stats.files} partial(s), "
+        f"{source_stats.malformed} malformed, {source_stats.skipped} skipped"
+    ]
+    parts += [f"{name}: {st.describe()}" for name, st in stats.items()]
+    return " | ".join(parts)
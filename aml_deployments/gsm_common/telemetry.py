@@ -0,0 +1,235 @@
+"""Per-item timing and resource telemetry of the parallel stages.
+
+Entry scripts wrap the processing of every item in :class:`ItemTelemetry` and
+attach the record to the item's result row under the reserved ``_telemetry``
+key, which the merge steps never write into metadata. The merge steps feed all
+rows to a :class:`TelemetrySummary` and print per-stage percentiles and the
+slowest items.
+
+Record fields:
+
+- ``wall_s`` / ``cpu_s``: wall-clock and CPU time (whole process, so including
+  helper threads) spent on the item.
+- ``rss_growth_mb``: resident memory the item added, i.e. the higher of the
+  resident memory at its end and a new process peak reached during it, minus
+  the resident memory at its start.
+- ``read_bytes`` / ``write_bytes``: bytes passed through read/write calls during
+  the item (``/proc/self/io``, includes blob mounts).
+- ``points``: point count of the tile when its LAS/LAZ header is readable.
+- ``halo_points`` / ``unowned_segments``: with tree ownership, the points of
+  neighbouring tiles added by pc_prep, and the segments of trees owned by other
+  tiles that pc_ops dropped.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import os
+import resource
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+from gsm_common.admission import current_rss
+from gsm_common.columnar import columnar_point_count, is_columnar
+from gsm_common.las_header import read_las_header
+
+TELEMETRY_KEY = "_telemetry"
+SUMMARY_FIELDS = (
+    "wall_s",
+    "cpu_s",
+    "rss_growth_mb",
+    "read_bytes",
+    "write_bytes",
+    "points",
+    "halo_points",
+    "unowned_segments",
+)
+_SLOWEST = 10
+
+Record = Dict[str, Any]
+
+
+def _proc_io() -> Tuple[int, int]:
+    counters: Dict[str, int] = {}
+    try:
+        with open("/proc/self/io", "r", encoding="ascii") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name.strip()] = int(value)
+    except (OSError, ValueError):
+        return 0, 0
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def _maxrss() -> int:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def point_count(*paths: str | None) -> int | None:
+    """Point count from the header of the first readable point cloud in ``paths``.
+
+    LAS/LAZ files and columnar folders are both read from their header only.
+    """
+    for path in paths:
+        if not path:
+            continue
+        try:
+            if is_columnar(path):
+                return columnar_point_count(path)
+            return read_las_header(path).point_count
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class ItemTelemetry:
+    """Measure the enclosed block; the record is filled in on exit.
+
+    The caller may add fields (e.g. ``points``) to the record inside the block.
+    ``ok`` is False if the block raised.
+    """
+
+    def __init__(self, stage: str, key: str) -> None:
+        """Start a record for ``key`` of ``stage``."""
+        self.record: Record = {"stage": stage, "key": key}
+        self._start = (0.0, 0.0, 0, 0)
+        self._rss = (0, 0)
+
+    def __enter__(self) -> Record:
+        """Take the start readings."""
+        read0, write0 = _proc_io()
+        self._start = (time.perf_counter(), time.process_time(), read0, write0)
+        self._rss = (current_rss(), _maxrss())
+        return self.record
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        """Fill in the deltas."""
+        wall0, cpu0, read0, write0 = self._start
+        read1, write1 = _proc_io()
+        rss0, maxrss0 = self._rss
+        # a lifetime peak set during the item bounds its own peak from below
+        maxrss1 = _maxrss()
+        peak = max(current_rss(), maxrss1 if maxrss1 > maxrss0 else 0)
+        self.record.update(
+            wall_s=round(time.perf_counter() - wall0, 3),
+            cpu_s=round(time.process_time() - cpu0, 3),
+            rss_growth_mb=round(max(0, peak - rss0) / 2**20, 1),
+            read_bytes=read1 - read0,
+            write_bytes=write1 - write0,
+        )
+        self.record.setdefault("ok", exc_type is None)
+
+
+def split_record(record: Record, keys: List[str]) -> List[Record]:
+    """Spread a record measured over a batch evenly across its items."""
+    n = max(1, len(keys))
+    out = []
+    for key in keys:
+        item = dict(record, key=key, batch_items=n)
+        for name in ("wall_s", "cpu_s"):
+            item[name] = round(record[name] / n, 3)
+        for name in ("read_bytes", "write_bytes"):
+            item[name] = record[name] // n
+        out.append(item)
+    return out
+
+
+def with_telemetry(row: Dict[str, Any], record: Record) -> Dict[str, Any]:
+    """Copy of ``row`` with ``record`` attached under the reserved key."""
+    return {**row, TELEMETRY_KEY: record}
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+class TelemetrySummary:
+    """Collects ``_telemetry`` records and summarizes them per stage."""
+
+    def __init__(self, slowest: int = _SLOWEST) -> None:
+        """Keep the ``slowest`` items by wall time per stage."""
+        self._values: Dict[str, Dict[str, List[float]]] = {}
+        self._slowest: Dict[str, List[Tuple[float, str]]] = {}
+        self._failed: Dict[str, int] = {}
+        self._n_slowest = slowest
+
+    def add_row(self, row: Dict[str, Any]) -> None:
+        """Add the record of a result row, if it has one."""
+        record = row.get(TELEMETRY_KEY)
+        if isinstance(record, dict):
+            self.add(record)
+
+    def add(self, record: Record) -> None:
+        """Add one record."""
+        stage = str(record.get("stage", "unknown"))
+        values = self._values.setdefault(stage, {f: [] for f in SUMMARY_FIELDS})
+        for field in SUMMARY_FIELDS:
+            v = record.get(field)
+            if isinstance(v, (int, float)):
+                values[field].append(float(v))
+        if record.get("ok") is False:
+            self._failed[stage] = self._failed.get(stage, 0) + 1
+        wall = record.get("wall_s")
+        if isinstance(wall, (int, float)):
+            heap = self._slowest.setdefault(stage, [])
+            entry = (float(wall), str(record.get("key", "")))
+            if len(heap) < self._n_slowest:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+    def summary(self) -> Dict[str, Any]:
+        """Per-stage count, failures, p50/p95/max per field and slowest items."""
+        out: Dict[str, Any] = {}
+        for stage, values in self._values.items():
+            fields = {}
+            for field, vs in values.items():
+                if not vs:
+                    continue
+                vs.sort()
+                fields[field] = {
+                    "p50": _percentile(vs, 0.50),
+                    "p95": _percentile(vs, 0.95),
+                    "max": vs[-1],
+                    "sum": sum(vs),
+                }
+            out[stage] = {
+                "items": len(values["wall_s"]),
+                "failed": self._failed.get(stage, 0),
+                "fields": fields,
+                "slowest": [
+                    {"key": k, "wall_s": w}
+                    for w, k in sorted(self._slowest.get(stage, []), reverse=True)
+                ],
+            }
+        return out
+
+    def describe(self) -> Iterable[str]:
+        """Human-readable lines of :meth:`summary`."""
+        for stage, s in self.summary().items():
+            yield f"[{stage}] {s['items']} items, {s['failed']} failed"
+            for field, st in s["fields"].items():
+                yield (
+                    f"  {field}: p50 {st['p50']:.6g} | p95 {st['p95']:.6g} | "
+                    f"max {st['max']:.6g}"
+                )
+            for item in s["slowest"]:
+                yield f"  slow: {item['wall_s']:.1f}s {item['key']}"
+
+    def write(self, path: str) -> None:
+        """Write :meth:`summary` as JSON."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.summary(), indent=2), encoding="utf-8")
+
+
+def write_records(path: str, records: Iterable[Record]) -> None:
+    """Write records as ``{"_telemetry": ...}`` JSONL rows."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps({TELEMETRY_KEY: record}, separators=(",", ":")) + "\n")
@@ -0,0 +1,188 @@
+"""Tile names, tile selection and locality ordering.
+
+Raw tiles follow the Cyclomedia layout::
+
+    <pc_raw>/nl-rott-yymmdd-areacode-laz/filtered_xxxx_xxxx.laz
+
+:func:`list_tiles` maps every tile code (``xxxx_xxxx``) to its relative path
+with one listing of ``pc_raw`` and one per area folder. :func:`select_tiles`
+joins the tree points to the tile polygons of ``pc_raw_metadata`` with a single
+vectorized STRtree query and returns the codes of the tiles that contain trees.
+:func:`tree_ownership` uses the same join to give every tree one owning tile
+(:mod:`gsm_common.tree_ownership`).
+
+:func:`zorder` sorts tile keys along a Z-order (Morton) curve over the tile
+grid coordinates, so consecutive items are spatial neighbours that share
+context data (BGT polygons, reference trees, trees crossing tile borders).
+
+geopandas is imported on first use (pc_prep environment).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+from typing import Any, Collection, Dict, Iterable, List, Tuple
+
+from gsm_common.spatial_cache import layer_geometries
+from gsm_common.tree_ownership import OwnershipPlan, assign_owners
+
+logger = logging.getLogger(__name__)
+
+TILE_FILE = re.compile(r"^filtered_(\d+_\d+)\.la[sz]$", re.IGNORECASE)
+TILE_CODE = re.compile(r"(?:^|[^\d])(\d+_\d+)(?:\.la[sz])?$", re.IGNORECASE)
+_FILTERED = re.compile(r"filtered_(\d+)_(\d+)", re.IGNORECASE)
+_NAME_HINTS = ("name", "file", "tile", "path", "code")
+
+
+def tile_code(name: str) -> str | None:
+    """The ``xxxx_xxxx`` code of a tile name, file name or path."""
+    m = TILE_CODE.search(os.path.basename(str(name)))
+    return m.group(1) if m else None
+
+
+def tile_xy(name: str) -> Tuple[int, int] | None:
+    """Grid coordinates ``(x, y)`` from a ``filtered_xxxx_yyyy`` name or path."""
+    m = _FILTERED.search(str(name))
+    if m:
+        return int(m.group(1)), int(m.group(2))
+    code = tile_code(name)
+    if code is None:
+        return None
+    x, y = code.split("_")
+    return int(x), int(y)
+
+
+def morton(x: int, y: int) -> int:
+    """Interleave the bits of ``x`` and ``y`` (Z-order curve index)."""
+    key = 0
+    for bit in range(max(x.bit_length(), y.bit_length())):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def zorder(keys: Iterable[str]) -> List[str]:
+    """``keys`` along the Z-order curve of their tiles.
+
+    Keys without tile coordinates keep their relative order after the others.
+    """
+    keyed = []
+    rest = []
+    for k in keys:
+        xy = tile_xy(k)
+        if xy is None:
+            rest.append(k)
+        else:
+            keyed.append((morton(*xy), k))
+    keyed.sort()
+    return [k for _, k in keyed] + rest
+
+
+def list_tiles(pc_raw: str) -> Dict[str, str]:
+    """Map tile code -> path relative to ``pc_raw`` from bulk directory listings.
+
+    Area folders are read in name order (``nl-rott-yymmdd-...``), so when a tile
+    was flown more than once the most recent flight wins.
+    """
+    tiles: Dict[str, str] = {}
+    duplicates = 0
+
+    def _add(folder: str, prefix: str) -> None:
+        nonlocal duplicates
+        with os.scandir(folder) as it:
+            names = sorted(e.name for e in it if e.is_file())
+        for name in names:
+            m = TILE_FILE.match(name)
+            if m:
+                duplicates += m.group(1) in tiles
+                tiles[m.group(1)] = prefix + name
+
+    with os.scandir(pc_raw) as it:
+        areas = sorted(e.name for e in it if e.is_dir())
+    _add(pc_raw, "")
+    for area in areas:
+        try:
+            _add(os.path.join(pc_raw, area), area + "/")
+        except OSError as ex:
+            logger.warning("Could not list %s: %s", area, ex)
+    if duplicates:
+        logger.info("%d tiles found in more than one area folder", duplicates)
+    return tiles
+
+
+def _name_column(frame: Any) -> str:
+    """The column of ``frame`` holding tile names, preferring name-like columns."""
+    columns = sorted(
+        (c for c in frame.columns if c != frame.geometry.name),
+        key=lambda c: not any(h in str(c).lower() for h in _NAME_HINTS),
+    )
+    for col in columns:
+        values = frame[col].dropna()
+        if len(values) and isinstance(values.iloc[0], str):
+            if tile_code(values.iloc[0]) is not None:
+                return str(col)
+    raise ValueError("No column with tile names (filtered_xxxx_xxxx) found")
+
+
+def _join_inputs(tree_df_path: str, pc_metadata_path: str) -> Tuple[Any, Any]:
+    """Tile polygons and tree geometries, in the CRS of the tiles."""
+    import geopandas as gpd
+    import pandas as pd
+
+    tiles = gpd.read_file(pc_metadata_path)
+    trees = pd.read_pickle(tree_df_path)
+    if hasattr(trees, "set_geometry") and trees.crs and tiles.crs:
+        if trees.crs != tiles.crs:
+            trees = trees.to_crs(tiles.crs)
+    geoms = layer_geometries(trees)
+    if geoms is None:
+        raise ValueError(f"No geometry or x/y columns in {tree_df_path}")
+    return tiles, geoms
+
+
+def select_tiles(
+    tree_df_path: str, pc_metadata_path: str, name_column: str | None = None
+) -> List[str]:
+    """Codes of the tiles whose polygon contains at least one tree."""
+    import numpy as np
+
+    tiles, geoms = _join_inputs(tree_df_path, pc_metadata_path)
+    column = name_column or _name_column(tiles)
+    # one bulk query: rows are (tree index, tile index) pairs
+    pairs = tiles.sindex.query(geoms, predicate="intersects")
+    hit = np.unique(pairs[1])
+    codes = (tile_code(v) for v in tiles[column].iloc[hit])
+    return sorted({c for c in codes if c})
+
+
+def tree_ownership(
+    tree_df_path: str,
+    pc_metadata_path: str,
+    name_column: str | None = None,
+    halo: float = 10.0,
+    owners: Collection[str] | None = None,
+) -> OwnershipPlan:
+    """Owning tile of every tree, keyed by tile code (see ``tree_ownership``).
+
+    With ``owners`` only those tile codes own trees; the others still provide
+    halo points.
+    """
+    import numpy as np
+    import shapely
+
+    tiles, geoms = _join_inputs(tree_df_path, pc_metadata_path)
+    column = name_column or _name_column(tiles)
+    codes = [tile_code(v) if isinstance(v, str) else None for v in tiles[column]]
+    reach = shapely.buffer(geoms, halo) if halo > 0 else geoms
+    pairs = tiles.sindex.query(reach, predicate="intersects")
+    named = np.array([codes[i] is not None for i in pairs[1]], dtype=bool)
+    return assign_owners(
+        [c or "" for c in codes],
+        tiles.geometry.bounds.to_numpy(),
+        shapely.get_coordinates(shapely.centroid(geoms)),
+        shapely.bounds(geoms),
+        pairs[:, named],
+        halo,
+        owners,
+    )
@@ -0,0 +1,381 @@
+"""One owning tile per tree, so trees near tile edges are processed once.
+
+A tree near a tile edge is within reach of two to four Cyclomedia tiles. Each
+of them used to get its prompt, segment, point cloud and model, and
+``resolve_overlapping_trees`` then reconciled the copies. With ownership the
+pc_prep planner assigns every tree of ``tree_df_path`` to one tile: the tile
+whose footprint contains the tree's centroid. Footprints are half-open
+(``minx <= x < maxx``), so a centroid on a shared edge has a single owner. A
+tree whose centroid lies in no footprint (a gap in the coverage) is adopted by
+the nearest tile with a small box around its centroid.
+
+Every plan item carries the boxes its tile owns (``own``) and its halo
+(``halo``): per neighbouring tile, the box of points within the halo distance
+of the tile's owned trees. pc_prep keeps only the reference trees whose
+centroid lies in the owned boxes and adds the halo points of the neighbours to
+the tile, so a tree crossing the edge is reconstructed whole, from one tile.
+pc_ops drops the segment point clouds whose centre lies outside the owned
+boxes of their tile before they are modeled (fused) or listed in the ops
+metadata, so tree_modeling does not see them either.
+
+The ownership file of the planner maps tile codes to their owned boxes and
+records the duplicate reconstructions the run avoided
+(:meth:`OwnershipPlan.stats`).
+
+numpy is imported on first use, laspy only to write halo tiles.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Mapping, Sequence, Tuple
+
+from gsm_common.cli import str_to_bool
+from gsm_common.columnar import is_columnar, read_columns, read_meta
+from gsm_common.las_header import read_las_header
+
+logger = logging.getLogger(__name__)
+
+Bounds = Tuple[float, float, float, float]
+
+OWN_KEY = "own"
+HALO_KEY = "halo"
+# half-size of the box owning a tree adopted from a gap in the coverage
+ADOPT_RADIUS = 1.0
+_HALO_CHUNK_POINTS = 2_000_000
+_POINT_CLOUD_SUFFIXES = (".las", ".laz", ".npc")
+
+
+@dataclass
+class TileOwnership:
+    """What one tile owns: boxes, owned tree count and halo boxes."""
+
+    boxes: List[Bounds]
+    trees: int = 0
+    # neighbour tile key -> box of its points to add to this tile
+    halo: Dict[str, Bounds] = field(default_factory=dict)
+
+
+@dataclass
+class OwnershipPlan:
+    """Owners of the trees of a run, per tile, with the run totals."""
+
+    halo: float
+    tiles: Dict[str, TileOwnership]
+    trees: int = 0
+    adopted: int = 0
+    # trees within reach of none of the tiles allowed to own them
+    unowned: int = 0
+    # (tree, tile) reconstructions without ownership, and tiles with trees
+    reconstructions: int = 0
+    candidate_tiles: int = 0
+
+    @property
+    def avoided(self) -> int:
+        """Duplicate tree reconstructions that ownership avoids."""
+        return max(0, self.reconstructions - self.trees)
+
+    @property
+    def tiles_dropped(self) -> int:
+        """Tiles with trees that own none of them and are not processed."""
+        return max(0, self.candidate_tiles - len(self.tiles))
+
+    def stats(self) -> Dict[str, Any]:
+        """Run totals for the ownership file and the logs."""
+        return {
+            "halo": self.halo,
+            "trees": self.trees,
+            "adopted": self.adopted,
+            "unowned": self.unowned,
+            "reconstructions_without_ownership": self.reconstructions,
+            "duplicates_avoided": self.avoided,
+            "owner_tiles": len(self.tiles),
+            "tiles_dropped": self.tiles_dropped,
+            "halo_links": sum(len(t.halo) for t in self.tiles.values()),
+        }
+
+    def describe(self) -> str:
+        """One line for the log."""
+        return (
+            f"{self.trees} trees owned by {len(self.tiles)} tiles "
+            f"({self.adopted} adopted from gaps, {self.unowned} unowned); "
+            f"{self.reconstructions} reconstructions without ownership, "
+            f"{self.avoided} duplicates avoided, {self.tiles_dropped} tiles left out"
+        )
+
+    def write(self, path: str) -> None:
+        """Write the owned boxes per tile and :meth:`stats` as JSON."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        body = {
+            "stats": self.stats(),
+            "tiles": {k: [list(b) for b in t.boxes] for k, t in self.tiles.items()},
+        }
+        Path(path).write_text(json.dumps(body), encoding="utf-8")
+
+
+def assign_owners(
+    keys: Sequence[str],
+    footprints: Any,
+    centroids: Any,
+    extents: Any,
+    pairs: Any,
+    halo: float,
+    owners: Collection[str] | None = None,
+) -> OwnershipPlan:
+    """Assign every tree to one tile.
+
+    Args:
+        keys: Key of every tile (its code); tiles sharing a key are merged.
+        footprints: ``(tiles, 4)`` footprint bounds of the tiles.
+        centroids: ``(trees, 2)`` tree centroids.
+        extents: ``(trees, 4)`` bounds of the tree geometries.
+        pairs: ``(2, n)`` tree and tile indices of the trees within ``halo``
+            of a tile, as returned by a spatial index query.
+        halo: Distance around an owned tree whose points the owner loads.
+        owners: Keys of the tiles that may own trees (all when None); the
+            other tiles only provide halo points.
+    """
+    import numpy as np
+
+    fp = np.asarray(footprints, dtype=np.float64).reshape(-1, 4)
+    xy = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+    ext = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    t, j = (np.asarray(a, dtype=np.int64) for a in pairs)
+    valid = np.isfinite(xy[t]).all(axis=1)
+    t, j = t[valid], j[valid]
+    plan = OwnershipPlan(halo=halo, tiles={})
+    if not len(t):
+        return plan
+
+    x, y = xy[t, 0], xy[t, 1]
+    f = fp[j]
+    inside = (f[:, 0] <= x) & (x < f[:, 2]) & (f[:, 1] <= y) & (y < f[:, 3])
+    dx = np.maximum(np.maximum(f[:, 0] - x, x - f[:, 2]), 0.0)
+    dy = np.maximum(np.maximum(f[:, 1] - y, y - f[:, 3]), 0.0)
+    dist = np.where(inside, -1.0, np.hypot(dx, dy))
+    eligible = np.ones(len(j), dtype=bool)
+    if owners is not None:
+        eligible = np.array([keys[k] in owners for k in j], dtype=bool)
+        dist = np.where(eligible, dist, np.inf)
+    key_rank = np.argsort(np.argsort(np.asarray(keys, dtype=object), kind="stable"))
+    # per tree: the containing tile, else the nearest, ties by tile key
+    order = np.lexsort((key_rank[j], dist, t))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = t[order][1:] != t[order][:-1]
+    best = order[first]
+    best = best[eligible[best]]
+    owner = np.full(len(xy), -1, dtype=np.int64)
+    owner[t[best]] = j[best]
+
+    # without ownership, every tile with trees processes every tree within reach
+    touching = (
+        (ext[t, 0] <= f[:, 2])
+        & (ext[t, 2] >= f[:, 0])
+        & (ext[t, 1] <= f[:, 3])
+        & (ext[t, 3] >= f[:, 1])
+    )
+    candidates = np.unique(j[touching])
+    plan.reconstructions = int(np.isin(j, candidates).sum())
+    plan.candidate_tiles = len({keys[i] for i in candidates})
+
+    r = ADOPT_RADIUS
+    for i in best:
+        tree, tile = int(t[i]), int(j[i])
+        own = plan.tiles.setdefault(keys[tile], TileOwnership([]))
+        box = tuple(float(v) for v in fp[tile])
+        if not inside[i]:
+            cx, cy = float(xy[tree, 0]), float(xy[tree, 1])
+            box = (cx - r, cy - r, cx + r, cy + r)
+            plan.adopted += 1
+        if box not in own.boxes:
+            own.boxes.append(box)  # type: ignore[arg-type]
+        own.trees += 1
+    plan.trees = int(len(best))
+    plan.unowned = int(len(np.unique(t))) - plan.trees
+
+    # halo: the points of the other tiles within reach of an owned tree
+    for i in np.flatnonzero((owner[t] >= 0) & (j != owner[t])):
+        tree, tile = int(t[i]), int(j[i])
+        owner_key, key = keys[owner[tree]], keys[tile]
+        if key == owner_key:
+            continue
+        box = (
+            max(ext[tree, 0] - halo, fp[tile, 0]),
+            max(ext[tree, 1] - halo, fp[tile, 1]),
+            min(ext[tree, 2] + halo, fp[tile, 2]),
+            min(ext[tree, 3] + halo, fp[tile, 3]),
+        )
+        if box[0] > box[2] or box[1] > box[3]:
+            continue
+        halos = plan.tiles[owner_key].halo
+        old = halos.get(key)
+        halos[key] = tuple(  # type: ignore[assignment]
+            float(v)
+            for v in (
+                box
+                if old is None
+                else (
+                    min(old[0], box[0]),
+                    min(old[1], box[1]),
+                    max(old[2], box[2]),
+                    max(old[3], box[3]),
+                )
+            )
+        )
+    return plan
+
+
+def owned_mask(xs: Any, ys: Any, boxes: Sequence[Sequence[float]]) -> Any:
+    """Which of the points ``(xs, ys)`` lie in one of the half-open ``boxes``."""
+    import numpy as np
+
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    mask = np.zeros(xs.shape, dtype=bool)
+    for minx, miny, maxx, maxy in boxes:
+        mask |= (minx <= xs) & (xs < maxx) & (miny <= ys) & (ys < maxy)
+    return mask
+
+
+def read_ownership(path: str) -> Dict[str, List[Bounds]]:
+    """Owned boxes per tile code from an ownership file; empty if it has none."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            body = json.load(f)
+    except (OSError, json.JSONDecodeError) as ex:
+        logger.warning("No tree ownership from %s: %s", path, ex)
+        return {}
+    tiles = body.get("tiles") if isinstance(body, dict) else None
+    if not isinstance(tiles, dict):
+        return {}
+    return {str(k): [tuple(b) for b in v] for k, v in tiles.items()}
+
+
+def point_cloud_centre(path: str) -> Tuple[float, float] | None:
+    """Centre of the XY bounds of a LAS/LAZ or columnar point cloud."""
+    try:
+        if is_columnar(path):
+            header = read_meta(path).get("header") or {}
+            lo, hi = header.get("min_xyz"), header.get("max_xyz")
+            if lo and hi:
+                return (lo[0] + hi[0]) / 2, (lo[1] + hi[1]) / 2
+            cols = read_columns(path, ("x", "y"))
+            if not len(cols["x"]):
+                return None
+            return (
+                (float(cols["x"].min()) + float(cols["x"].max())) / 2,
+                (float(cols["y"].min()) + float(cols["y"].max())) / 2,
+            )
+        minx, miny, maxx, maxy = read_las_header(path).bounds_2d
+    except (OSError, ValueError, KeyError) as ex:
+        logger.debug("No centre for %s: %s", path, ex)
+        return None
+    return (minx + maxx) / 2, (miny + maxy) / 2
+
+
+def filter_owned(record: Any, boxes: Sequence[Bounds], root: str) -> Tuple[Any, int]:
+    """Drop the point clouds of ``record`` whose centre lies outside ``boxes``.
+
+    Paths are relative to ``root``. Point clouds without a readable centre,
+    and all other values, are kept. Returns the record and the number dropped.
+    """
+    if isinstance(record, list):
+        kept: List[Any] = []
+        dropped = 0
+        for value in record:
+            if isinstance(value, str) and value.lower().endswith(_POINT_CLOUD_SUFFIXES):
+                centre = point_cloud_centre(os.path.join(root, value))
+                if centre is not None and not bool(
+                    owned_mask([centre[0]], [centre[1]], boxes)[0]
+                ):
+                    dropped += 1
+                    continue
+                kept.append(value)
+            else:
+                value, n = filter_owned(value, boxes, root)
+                kept.append(value)
+                dropped += n
+        return kept, dropped
+    if isinstance(record, dict):
+        out: Dict[str, Any] = {}
+        dropped = 0
+        for k, v in record.items():
+            out[k], n = filter_owned(v, boxes, root)
+            dropped += n
+        return out, dropped
+    return record, 0
+
+
+def write_halo_tile(pc_path: str, halo: Mapping[str, Sequence[float]], dst: str) -> int:
+    """Write ``pc_path`` with the points of its neighbours in their halo boxes.
+
+    ``halo`` maps neighbour tile paths to the box of their points to add. The
+    neighbours are read in chunks; their points are rescaled to the tile's
+    header. Returns the number of points added.
+    """
+    import laspy
+    import numpy as np
+
+    las = laspy.read(pc_path)
+    header = las.header
+    parts = [las.points.array]
+    added = 0
+    for path, (minx, miny, maxx, maxy) in halo.items():
+        try:
+            reader = laspy.open(path)
+        except (OSError, laspy.LaspyException) as ex:
+            logger.warning("No halo from %s: %s", path, ex)
+            continue
+        with reader:
+            for chunk in reader.chunk_iterator(_HALO_CHUNK_POINTS):
+                x, y = np.asarray(chunk.x), np.asarray(chunk.y)
+                mask = (minx <= x) & (x <= maxx) & (miny <= y) & (y <= maxy)
+                if not mask.any():
+                    continue
+                part = chunk[mask]
+                part.change_scaling(header.scales, header.offsets)
+                points = laspy.ScaleAwarePointRecord.zeros(len(part), header=header)
+                points.copy_fields_from(part)
+                parts.append(points.array)
+                added += len(part)
+    las.points = laspy.ScaleAwarePointRecord(
+        np.concatenate(parts), header.point_format, header.scales, header.offsets
+    )
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    las.update_header()
+    las.write(dst)
+    return added
+
+
+def add_ownership_arguments(ap: Any, plan: bool = False) -> None:
+    """Add the tree ownership options of the planner or the consuming steps."""
+    if not plan:
+        ap.add_argument(
+            "--ownership",
+            default=None,
+            help="Ownership file of the pc_prep plan: skip trees owned by other tiles",
+        )
+        return
+    ap.add_argument(
+        "--tree_ownership",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help="Assign every tree to one tile; plan halos and skip tiles owning none",
+    )
+    ap.add_argument(
+        "--ownership_halo",
+        type=float,
+        default=10.0,
+        help="Distance (map units) around an owned tree whose points are loaded",
+    )
+    ap.add_argument(
+        "--out_ownership",
+        default=None,
+        help="Write the owned boxes per tile and the run totals to this file",
+    )
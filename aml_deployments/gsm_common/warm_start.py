@@ -0,0 +1,193 @@
+"""Start method of the worker pools and a report of their start-up cost.
+
+The entry scripts used to force the ``spawn`` start method: every pool worker
+starts a fresh interpreter and imports the stage package (CloudComPy, Open3D,
+GeoPandas, PDAL, ...) again before it can take a tile. With ``forkserver`` a
+server process imports the modules given to :func:`start_context` once, and
+every worker is forked from it with those modules already loaded, so a worker
+is ready in milliseconds instead of tens of seconds. ``spawn`` stays the
+default; ``fork`` is offered for completeness but copies the parent with its
+threads and open handles.
+
+Only modules that are safe to fork may be preloaded: importing them must not
+start threads or initialise a GPU. Optional subsystems (debug plotting,
+reference-tree comparison, tree_modeling outside the fused mode) are left out
+of the preload lists and imported by the code that needs them.
+
+:class:`StartupProbe` records how long each pool worker took to become ready
+and :func:`import_times` measures the import time of modules in a fresh
+interpreter (``python -X importtime``); :func:`write_startup_report` writes
+both as JSON (``--startup_report``).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from multiprocessing.context import BaseContext
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+START_METHODS = ("spawn", "forkserver", "fork")
+
+# fork-safe modules worth importing once in the fork server, per stage
+PRELOAD = {
+    "pc_prep": ("pc_prep.tree_prep.prep_pc",),
+    "pc_ops": ("pc_ops.ops_pc",),
+    "tree_modeling": ("tree_modeling.modeling_tree",),
+}
+
+
+def add_start_arguments(ap: Any) -> None:
+    """Add the worker start options of the entry scripts."""
+    ap.add_argument(
+        "--start_method",
+        choices=START_METHODS,
+        default="spawn",
+        help="How pool workers are started; forkserver imports the stage "
+        "modules once and forks every worker from there",
+    )
+    ap.add_argument(
+        "--preload",
+        nargs="*",
+        default=None,
+        help="Modules imported by the fork server (default: the stage modules)",
+    )
+    ap.add_argument(
+        "--startup_report",
+        default=None,
+        help="Write worker start-up times and module import times as JSON",
+    )
+
+
+def start_context(
+    method: str,
+    preload: Sequence[str] = (),
+    set_default: bool = True,
+) -> BaseContext:
+    """Multiprocessing context for ``method``, with ``preload`` for forkserver.
+
+    With ``set_default`` the method also becomes the process-wide default, for
+    pools created inside the stage packages. The fork server is started right
+    away instead of with the first worker, so its imports overlap with whatever
+    the caller does before creating the pool.
+    """
+    ctx = multiprocessing.get_context(method)
+    if method == "forkserver":
+        # __main__ first, as multiprocessing does by default, so the workers do
+        # not import the entry script again either
+        modules = ["__main__", *preload]
+        ctx.set_forkserver_preload(modules)
+        logger.info("Fork server preloads %s", ", ".join(modules))
+        from multiprocessing import forkserver
+
+        forkserver.ensure_running()
+    if set_default:
+        multiprocessing.set_start_method(method, force=True)
+    return ctx
+
+
+def _worker_ready(
+    queue: Any, started: float, initializer: Any, initargs: Tuple[Any, ...]
+) -> None:
+    if initializer is not None:
+        initializer(*initargs)
+    queue.put((os.getpid(), time.time() - started))
+
+
+class StartupProbe:
+    """Record when each worker of a pool is ready to take tasks.
+
+    Pass :meth:`pool_kwargs` to ``ctx.Pool``; the initializer runs after a
+    worker has imported what it needs, so its delay since the pool was created
+    is that worker's start-up cost.
+    """
+
+    def __init__(self, ctx: BaseContext) -> None:
+        """Create the probe just before the pool."""
+        self._queue = ctx.SimpleQueue()
+        self._started = time.time()
+
+    def pool_kwargs(
+        self, initializer: Any = None, initargs: Tuple[Any, ...] = ()
+    ) -> Dict[str, Any]:
+        """``initializer``/``initargs`` for ``Pool``, running ``initializer`` first."""
+        return {
+            "initializer": _worker_ready,
+            "initargs": (self._queue, self._started, initializer, initargs),
+        }
+
+    def startups(self) -> List[float]:
+        """Seconds until each worker that started so far was ready."""
+        out: List[float] = []
+        while not self._queue.empty():
+            out.append(self._queue.get()[1])
+        return sorted(out)
+
+
+def import_times(modules: Sequence[str], top: int = 20) -> List[Dict[str, Any]]:
+    """Import time of ``modules`` and their slowest dependencies, in seconds.
+
+    The modules are imported in a fresh interpreter with ``-X importtime``, so
+    nothing is shared with the calling process. Returns the ``top`` modules by
+    cumulative time, with ``self_s`` the time of the module body alone.
+    """
+    if not modules:
+        return []
+    code = "; ".join(f"import {m}" for m in modules)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if proc.returncode:
+        logger.warning("Import of %s failed: %s", modules, proc.stderr[-500:])
+    rows: List[Tuple[float, float, str]] = []
+    for line in proc.stderr.splitlines():
+        # import time:   self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:") :].split("|")
+        try:
+            self_us, cum_us = int(parts[0]), int(parts[1])
+        except (IndexError, ValueError):
+            continue  # the header line
+        rows.append((cum_us / 1e6, self_us / 1e6, parts[2].strip()))
+    rows.sort(reverse=True)
+    return [{"module": m, "cumulative_s": c, "self_s": s} for c, s, m in rows[:top]]
+
+
+def write_startup_report(
+    path: str,
+    method: str,
+    preload: Sequence[str],
+    startups: Sequence[float] = (),
+    modules: Sequence[str] = (),
+) -> Dict[str, Any]:
+    """Write the worker start-up times and the import times of ``modules``."""
+    report: Dict[str, Any] = {
+        "start_method": method,
+        "preload": list(preload),
+        "workers": len(startups),
+        "worker_startup_s": list(startups),
+        "worker_startup_max_s": max(startups, default=None),
+        "imports": import_times(modules),
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    logger.info(
+        "Start-up report (%s): %d workers, slowest ready after %s s",
+        method,
+        len(startups),
+        report["worker_startup_max_s"],
+    )
+    return report
@@ -0,0 +1,353 @@
+"""Work queues between the stages of a streaming run.
+
+A streaming run (``streaming/stream_runner.py``) hands every tile to the next
+stage as soon as the previous stage finished it. The stages exchange work
+through a queue with two backends of the same interface:
+
+- :class:`SqliteQueue` — one SQLite file (``*.sqlite``); for runs on a single
+  machine, where all workers see the same local disk.
+- :class:`DirectoryQueue` — one folder of small JSON files, claimed by renaming
+  them; for workers on several nodes sharing a mount. As with
+  :class:`gsm_common.sharding.ClaimDirectory`, claims are only exclusive where
+  rename is atomic; on other filesystems an item may occasionally run twice,
+  which is harmless since outputs are keyed by tile.
+
+Items of a stage are ``(key, item)`` pairs, claimed in the order they were put.
+Workers report the rows ``run()`` returned for the claimed items; the driver
+collects them with ``results()``. A stage's backlog (ready plus claimed items)
+is what upstream workers check to apply back-pressure.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+Item = Dict[str, Any]
+Row = Dict[str, Any]
+
+
+def worker_id(pid: int | None = None) -> str:
+    """Identifier of a process on this node (default: the caller), unique across nodes."""
+    return f"{socket.gethostname()}-{pid or os.getpid()}"
+
+
+class SqliteQueue:
+    """Work queue in a single SQLite file."""
+
+    def __init__(self, path: str) -> None:
+        """Open (and create if needed) the queue at ``path``."""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.con = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                stage TEXT NOT NULL, key TEXT NOT NULL, item TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'ready', worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0, error TEXT,
+                updated REAL NOT NULL, UNIQUE (stage, key));
+            CREATE INDEX IF NOT EXISTS items_state ON items (stage, state, seq);
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                stage TEXT NOT NULL, rows TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY);
+            """
+        )
+
+    def put(self, stage: str, items: Sequence[Tuple[str, Item]]) -> int:
+        """Add items to ``stage``; keys already queued are ignored. Returns the count added."""
+        now = time.time()
+        before = self.con.total_changes
+        self.con.execute("BEGIN IMMEDIATE")
+        self.con.executemany(
+            "INSERT OR IGNORE INTO items (stage, key, item, updated) VALUES (?, ?, ?, ?)",
+            [(stage, key, json.dumps(item), now) for key, item in items],
+        )
+        self.con.execute("COMMIT")
+        return self.con.total_changes - before
+
+    def claim(self, stage: str, worker: str, limit: int) -> List[Tuple[str, Item]]:
+        """Claim up to ``limit`` ready items of ``stage`` for ``worker``."""
+        self.con.execute("BEGIN IMMEDIATE")
+        rows = self.con.execute(
+            "SELECT seq, key, item FROM items WHERE stage = ? AND state = 'ready' "
+            "ORDER BY seq LIMIT ?",
+            (stage, max(1, limit)),
+        ).fetchall()
+        self.con.executemany(
+            "UPDATE items SET state = 'claimed', worker = ?, updated = ? WHERE seq = ?",
+            [(worker, time.time(), seq) for seq, _, _ in rows],
+        )
+        self.con.execute("COMMIT")
+        return [(key, json.loads(item)) for _, key, item in rows]
+
+    def complete(
+        self, stage: str, worker: str, keys: Sequence[str], rows: Sequence[Row]
+    ) -> None:
+        """Mark claimed items done and store the rows their run returned."""
+        self.con.execute("BEGIN IMMEDIATE")
+        self.con.execute(
+            "INSERT INTO results (stage, rows) VALUES (?, ?)", (stage, json.dumps(rows))
+        )
+        self.con.executemany(
+            "UPDATE items SET state = 'done', updated = ? WHERE stage = ? AND key = ?",
+            [(time.time(), stage, k) for k in keys],
+        )
+        self.con.execute("COMMIT")
+
+    def fail(
+        self,
+        stage: str,
+        worker: str,
+        keys: Sequence[str],
+        error: str,
+        max_attempts: int,
+    ) -> None:
+        """Return failed items to the queue, or mark them failed after ``max_attempts``."""
+        self.con.execute("BEGIN IMMEDIATE")
+        self.con.executemany(
+            "UPDATE items SET attempts = attempts + 1, error = ?, worker = NULL, "
+            "updated = ?, state = CASE WHEN attempts + 1 >= ? THEN 'failed' "
+            "ELSE 'ready' END WHERE stage = ? AND key = ?",
+            [(error, time.time(), max_attempts, stage, k) for k in keys],
+        )
+        self.con.execute("COMMIT")
+
+    def requeue(
+        self, worker: str | None = None, older_than_s: float | None = None
+    ) -> int:
+        """Return the claims of ``worker``, or claims older than ``older_than_s``."""
+        sql = "UPDATE items SET state = 'ready', worker = NULL WHERE state = 'claimed'"
+        params: List[Any] = []
+        if worker is not None:
+            sql += " AND worker = ?"
+            params.append(worker)
+        if older_than_s is not None:
+            sql += " AND updated < ?"
+            params.append(time.time() - older_than_s)
+        return self.con.execute(sql, params).rowcount
+
+    def results(self) -> Iterator[Tuple[str, List[Row]]]:
+        """Pop the stored rows of completed items, oldest first (driver only)."""
+        rows = self.con.execute(
+            "SELECT id, stage, rows FROM results ORDER BY id"
+        ).fetchall()
+        for rid, stage, data in rows:
+            yield stage, json.loads(data)
+            self.con.execute("DELETE FROM results WHERE id = ?", (rid,))
+
+    def backlog(self, stage: str) -> int:
+        """Ready and claimed items of ``stage``."""
+        (n,) = self.con.execute(
+            "SELECT count(*) FROM items WHERE stage = ? AND state IN ('ready', 'claimed')",
+            (stage,),
+        ).fetchone()
+        return int(n)
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Item counts per stage and state."""
+        out: Dict[str, Dict[str, int]] = {}
+        for stage, state, n in self.con.execute(
+            "SELECT stage, state, count(*) FROM items GROUP BY stage, state"
+        ):
+            out.setdefault(stage, {})[state] = n
+        return out
+
+    def close(self) -> None:
+        """Tell the workers that no more work will come."""
+        self.con.execute("INSERT OR IGNORE INTO flags VALUES ('closed')")
+
+    def is_closed(self) -> bool:
+        """Whether the driver has closed the queue."""
+        return bool(
+            self.con.execute("SELECT 1 FROM flags WHERE name = 'closed'").fetchone()
+        )
+
+
+class DirectoryQueue:
+    """Work queue in a folder, for workers that only share a mounted filesystem.
+
+    Layout::
+
+        <root>/<stage>/keys/<hash>              one marker per key ever put
+        <root>/<stage>/{ready,done,failed}/<seq>_<hash>.json
+        <root>/<stage>/claimed/<worker>/<seq>_<hash>.json
+        <root>/results/<time>_<worker>.json     rows waiting for the driver
+        <root>/CLOSED
+    """
+
+    def __init__(self, root: str) -> None:
+        """Use (and create if needed) the queue folder ``root``."""
+        self.root = Path(root)
+        (self.root / "results").mkdir(parents=True, exist_ok=True)
+
+    def _dir(self, stage: str, state: str, worker: str | None = None) -> Path:
+        d = self.root / stage / state
+        if worker is not None:
+            d = d / worker
+        d.mkdir(parents=True, exist_ok=True)
+        return d
+
+    @staticmethod
+    def _hash(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _write(path: Path, data: Any) -> None:
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def _find(self, stage: str, worker: str, key: str) -> Path | None:
+        suffix = f"_{self._hash(key)}.json"
+        for p in self._dir(stage, "claimed", worker).iterdir():
+            if p.name.endswith(suffix):
+                return p
+        return None
+
+    def put(self, stage: str, items: Sequence[Tuple[str, Item]]) -> int:
+        """Add items to ``stage``; keys already queued are ignored. Returns the count added."""
+        keys, ready = self._dir(stage, "keys"), self._dir(stage, "ready")
+        added = 0
+        for key, item in items:
+            h = self._hash(key)
+            try:
+                os.close(os.open(keys / h, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            name = f"{time.time_ns():020d}_{h}.json"
+            self._write(ready / name, {"key": key, "item": item, "attempts": 0})
+            added += 1
+        return added
+
+    def claim(self, stage: str, worker: str, limit: int) -> List[Tuple[str, Item]]:
+        """Claim up to ``limit`` ready items of ``stage`` for ``worker``."""
+        ready, mine = self._dir(stage, "ready"), self._dir(stage, "claimed", worker)
+        out: List[Tuple[str, Item]] = []
+        for name in sorted(n for n in os.listdir(ready) if not n.startswith(".")):
+            try:
+                os.rename(ready / name, mine / name)
+            except FileNotFoundError:
+                continue  # another worker was first
+            os.utime(mine / name)  # claim time, for requeue(older_than_s)
+            data = json.loads((mine / name).read_text(encoding="utf-8"))
+            out.append((data["key"], data["item"]))
+            if len(out) >= max(1, limit):
+                break
+        return out
+
+    def complete(
+        self, stage: str, worker: str, keys: Sequence[str], rows: Sequence[Row]
+    ) -> None:
+        """Mark claimed items done and store the rows their run returned."""
+        # rows first: the driver only finishes once no item is claimed
+        name = f"{time.time_ns():020d}_{worker}.json"
+        self._write(self.root / "results" / name, {"stage": stage, "rows": list(rows)})
+        done = self._dir(stage, "done")
+        for key in keys:
+            p = self._find(stage, worker, key)
+            if p is not None:
+                os.replace(p, done / p.name)
+
+    def fail(
+        self,
+        stage: str,
+        worker: str,
+        keys: Sequence[str],
+        error: str,
+        max_attempts: int,
+    ) -> None:
+        """Return failed items to the queue, or mark them failed after ``max_attempts``."""
+        for key in keys:
+            p = self._find(stage, worker, key)
+            if p is None:
+                continue
+            data = json.loads(p.read_text(encoding="utf-8"))
+            data.update(attempts=data["attempts"] + 1, error=error)
+            state = "failed" if data["attempts"] >= max_attempts else "ready"
+            self._write(self._dir(stage, state) / p.name, data)
+            p.unlink()
+
+    def requeue(
+        self, worker: str | None = None, older_than_s: float | None = None
+    ) -> int:
+        """Return the claims of ``worker``, or claims older than ``older_than_s``."""
+        moved = 0
+        now = time.time()
+        for stage_dir in self.root.iterdir():
+            claimed = stage_dir / "claimed"
+            if not claimed.is_dir():
+                continue
+            for wdir in claimed.iterdir():
+                if worker is not None and wdir.name != worker:
+                    continue
+                for p in list(wdir.iterdir()):
+                    if (
+                        older_than_s is not None
+                        and now - p.stat().st_mtime < older_than_s
+                    ):
+                        continue
+                    try:
+                        os.rename(p, stage_dir / "ready" / p.name)
+                        moved += 1
+                    except FileNotFoundError:
+                        continue
+        return moved
+
+    def results(self) -> Iterator[Tuple[str, List[Row]]]:
+        """Pop the stored rows of completed items, oldest first (driver only)."""
+        folder = self.root / "results"
+        for name in sorted(n for n in os.listdir(folder) if not n.startswith(".")):
+            data = json.loads((folder / name).read_text(encoding="utf-8"))
+            yield data["stage"], data["rows"]
+            (folder / name).unlink()
+
+    def backlog(self, stage: str) -> int:
+        """Ready and claimed items of ``stage``."""
+        n = len(
+            [n for n in os.listdir(self._dir(stage, "ready")) if not n.startswith(".")]
+        )
+        claimed = self._dir(stage, "claimed")
+        return n + sum(len(os.listdir(w)) for w in claimed.iterdir())
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Item counts per stage and state."""
+        out: Dict[str, Dict[str, int]] = {}
+        for stage_dir in sorted(
+            p for p in self.root.iterdir() if (p / "keys").is_dir()
+        ):
+            stage = stage_dir.name
+            for state in ("ready", "done", "failed"):
+                out.setdefault(stage, {})[state] = len(
+                    os.listdir(self._dir(stage, state))
+                )
+            out[stage]["claimed"] = self.backlog(stage) - out[stage]["ready"]
+        return out
+
+    def close(self) -> None:
+        """Tell the workers that no more work will come."""
+        (self.root / "CLOSED").touch()
+
+    def is_closed(self) -> bool:
+        """Whether the driver has closed the queue."""
+        return (self.root / "CLOSED").exists()
+
+
+WorkQueue = SqliteQueue | DirectoryQueue
+
+
+def open_queue(path: str) -> WorkQueue:
+    """A :class:`SqliteQueue` for ``*.sqlite``/``*.db`` paths, else a :class:`DirectoryQueue`."""
+    if path.lower().endswith((".sqlite", ".db")):
+        return SqliteQueue(path)
+    return DirectoryQueue(path)
@@ -0,0 +1,189 @@
+"""Tree-level work units for tree_modeling.
+
+In ``tree`` mode the plan step emits one item per group of ``trees_per_unit``
+tree segments of a tile instead of one item per tile. The entry script picks the
+segments of its unit from the ``trees`` list of the tile's ops metadata record
+(:func:`split_units`), models them into a unit folder under
+``<modeling_dir>/_units/`` and returns a ``modeled_unit`` row. The merge step
+reassembles the unit folders of every tile whose units all succeeded into the
+tile outputs (:func:`reassemble`) and lists the tile as modeled.
+
+Only outputs that can be combined are reassembled: JSON files (lists
+concatenated, objects merged per key, scalars only when the units agree), text
+files, and files that all units wrote identically. A tile with any other output
+written by several units (GeoPackage, LAS/LAZ, meshes) raises
+:class:`UnmergeableOutputError` and is reported as incomplete, with nothing
+written to the modeling folder; model such packages per tile.
+
+A failed or hanging tree costs one unit: its retry, and a resumed run with the
+completion ledger, only redo that unit.
+"""
+
+from __future__ import annotations
+
+import filecmp
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+WORK_UNITS = ("tile", "tree")
+UNIT_KEY = "modeled_unit"
+UNITS_DIR = "_units"
+# ops metadata field listing the tree segments of a tile
+TREES_FIELD = "trees"
+
+# files concatenated line by line when several units write them
+_TEXT_SUFFIXES = (".jsonl", ".txt", ".csv", ".xyz")
+
+
+class UnmergeableOutputError(ValueError):
+    """An output file of several units that cannot be combined into one."""
+
+
+def split_units(record: Any, trees_per_unit: int) -> List[Any]:
+    """Split an ops metadata record into per-unit records.
+
+    A list is split into chunks of ``trees_per_unit`` entries. In a dict, the
+    ``trees`` list is split, together with every other list of the same length
+    (per-tree values stay with their tree); the other values are shared by all
+    units. Any other record, or a dict without a ``trees`` list, is a single
+    unit.
+    """
+    size = max(1, trees_per_unit)
+    if isinstance(record, list):
+        return [record[i : i + size] for i in range(0, len(record), size)] or [record]
+    if isinstance(record, dict):
+        trees = record.get(TREES_FIELD)
+        if not isinstance(trees, list) or not trees:
+            return [record]
+        parallel = [
+            k for k, v in record.items() if isinstance(v, list) and len(v) == len(trees)
+        ]
+        return [
+            {**record, **{k: record[k][i : i + size] for k in parallel}}
+            for i in range(0, len(trees), size)
+        ]
+    return [record]
+
+
+def unit_key(pc_path: str, unit: int) -> str:
+    """Ledger and log key of a unit."""
+    return f"{pc_path}#{unit}"
+
+
+def unit_dir(pc_path: str, unit: int) -> str:
+    """Folder of a unit's outputs, relative to the modeling folder."""
+    return f"{UNITS_DIR}/{pc_path.lstrip('/')}/{unit:05d}"
+
+
+def _merge_json(a: Any, b: Any) -> Any:
+    """Lists are concatenated, objects merged per key and equal values kept."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        out = dict(a)
+        for k, v in b.items():
+            out[k] = _merge_json(out[k], v) if k in out else v
+        return out
+    if isinstance(a, list) and isinstance(b, list):
+        return a + b
+    if a != b:
+        raise UnmergeableOutputError(f"units disagree: {a!r} != {b!r}")
+    return a
+
+
+def _write_merged(sources: List[str], dst: str) -> None:
+    """Write the combination of the same output file from several units."""
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    name = dst.lower()
+    if name.endswith((".json", ".geojson")):
+        merged: Any = None
+        for i, src in enumerate(sources):
+            with open(src, encoding="utf-8") as f:
+                data = json.load(f)
+            merged = data if i == 0 else _merge_json(merged, data)
+        with open(dst, "w", encoding="utf-8") as f:
+            json.dump(merged, f)
+    elif name.endswith(_TEXT_SUFFIXES):
+        with open(dst, "w", encoding="utf-8") as out:
+            for i, src in enumerate(sources):
+                with open(src, encoding="utf-8") as f:
+                    lines = f.readlines()
+                if i and name.endswith(".csv"):
+                    lines = lines[1:]  # header once
+                out.writelines(lines)
+    elif all(filecmp.cmp(sources[0], src, shallow=False) for src in sources[1:]):
+        shutil.copyfile(sources[0], dst)
+    else:
+        raise UnmergeableOutputError(
+            f"{len(sources)} units wrote {os.path.basename(dst)}, which cannot be "
+            "combined"
+        )
+
+
+def reassemble(modeling_dir: str, pc_path: str, units: Iterable[int]) -> int:
+    """Combine the unit folders of a tile into ``modeling_dir``.
+
+    Returns the number of files written. The tile is combined in a scratch
+    folder first, so when an output cannot be combined
+    (:class:`UnmergeableOutputError`) or a unit file cannot be read, nothing is
+    written. The unit folders are kept, so a later run that redoes only some
+    units can reassemble the tile again.
+    """
+    by_rel: Dict[str, List[str]] = {}
+    for unit in sorted(units):
+        root = os.path.join(modeling_dir, unit_dir(pc_path, unit))
+        for folder, _, files in os.walk(root):
+            for f in sorted(files):
+                src = os.path.join(folder, f)
+                by_rel.setdefault(os.path.relpath(src, root), []).append(src)
+    scratch = tempfile.mkdtemp(
+        prefix=".reassemble_", dir=os.path.join(modeling_dir, UNITS_DIR)
+    )
+    try:
+        for rel, sources in by_rel.items():
+            tmp = os.path.join(scratch, rel)
+            if len(sources) == 1:
+                os.makedirs(os.path.dirname(tmp), exist_ok=True)
+                shutil.copyfile(sources[0], tmp)
+            else:
+                _write_merged(sources, tmp)
+        for rel in by_rel:
+            dst = os.path.join(modeling_dir, rel)
+            os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+            shutil.move(os.path.join(scratch, rel), dst)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return len(by_rel)
+
+
+class UnitCollector:
+    """Collect ``modeled_unit`` rows to find the tiles whose units all succeeded."""
+
+    def __init__(self) -> None:
+        """Start without units."""
+        self.done: Dict[str, Set[int]] = {}
+        self.expected: Dict[str, int] = {}
+
+    def add_row(self, row: Dict[str, Any]) -> None:
+        """Observer for :func:`gsm_common.streaming_merge.merge_partials`."""
+        info = row.get(UNIT_KEY)
+        if isinstance(info, dict) and "pc_path" in info:
+            pc_path = info["pc_path"]
+            self.done.setdefault(pc_path, set()).add(int(info["unit"]))
+            self.expected[pc_path] = int(info["units"])
+
+    def complete(self) -> Tuple[List[str], Dict[str, int]]:
+        """Tiles with all units modeled, and the number missing per other tile."""
+        ok: List[str] = []
+        missing: Dict[str, int] = {}
+        for pc_path, units in self.done.items():
+            left = self.expected[pc_path] - len(units)
+            if left > 0:
+                missing[pc_path] = left
+            else:
+                ok.append(pc_path)
+        return ok, missing
@@ -2,26 +2,101 @@
 
 It does the following:
 - Determines rank/world_size from env vars (OMPI/PMI or fallback to 0/1).
-- Loads metadata, shards the pc_paths by rank.
-- Reuses existing process_point_cloud() for each item in the shard.
-- Keeps per-node multiprocessing (args.num_workers) for in-node parallelism.
-- Writes a per-rank partial JSON: <dirname(ops_metadata)>/_partials/ops_metadata.rank{rank}.json
+- Loads metadata, shards the pc_paths by rank (see --sharding).
+- Reuses existing process_point_cloud() for each item in the shard, or also
+  tree_modeling with --fuse_tree_modeling.
+- Keeps per-node multiprocessing for in-node parallelism (gsm_common.resources).
+- Appends each finished tile to <partials_dir>/ops_metadata.rank{rank}.jsonl,
+  and skips the tiles an earlier attempt or the ledger already completed.
 """
 
 from __future__ import annotations
 
 import argparse
-import json
-import multiprocessing
 import os
+import shutil
 import sys
-from typing import Dict, List, Tuple, Union
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Mapping, Set, Tuple, Union
 
 from pc_ops.helper_functions import load_processed_files
 from pc_ops.logger import logger
 from pc_ops.ops_pc import configure_arg_parser, process_point_cloud_wrapper
 from tqdm import tqdm
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.admission import (  # noqa: E402
+    AdmissionPool,
+    MemoryModel,
+    add_admission_arguments,
+    memory_budget,
+)
+from gsm_common.cli import str_to_bool  # noqa: E402
+from gsm_common.columnar import columnar_path  # noqa: E402
+from gsm_common.ledger import (  # noqa: E402
+    CompletionLedger,
+    add_ledger_arguments,
+    carry_completed,
+    fingerprint,
+    ledger_version,
+    parse_params,
+    record_signatures,
+)
+from gsm_common.metadata_store import is_sqlite_index, open_metadata  # noqa: E402
+from gsm_common.partial_log import (  # noqa: E402
+    PartialLog,
+    current_run_id,
+    skip_completed,
+)
+from gsm_common.resources import (  # noqa: E402
+    add_resource_arguments,
+    cap_threads,
+    detect_topology,
+    plan_resources,
+)
+from gsm_common.sharding import (  # noqa: E402
+    COST_BYTES_PER_POINT,
+    SHARDING_MODES,
+    ClaimDirectory,
+    estimate_tile_costs,
+    iter_claimed,
+    plan_shard,
+    stats_dir,
+    write_rank_stats,
+)
+from gsm_common.staging_cache import (  # noqa: E402
+    StagingCache,
+    add_staging_arguments,
+    open_staging_cache,
+    record_paths,
+)
+from gsm_common.telemetry import (  # noqa: E402
+    TELEMETRY_KEY,
+    ItemTelemetry,
+    Record,
+    point_count,
+)
+from gsm_common.tile_index import tile_code  # noqa: E402
+from gsm_common.tree_ownership import (  # noqa: E402
+    add_ownership_arguments,
+    filter_owned,
+    read_ownership,
+)
+from gsm_common.warm_start import (  # noqa: E402
+    PRELOAD,
+    StartupProbe,
+    add_start_arguments,
+    start_context,
+    write_startup_report,
+)
+
+ResultDict = Dict[str, Dict[str, Union[str, List[str]]]]
+TileOutcome = Tuple[Union[ResultDict, None], Record]
+
 
 def _get_rank_and_world() -> Tuple[int, int]:
     """Derive rank/world_size from common launcher env vars (OMPI/PMI), with sane fallbacks."""
@@ -43,30 +118,466 @@ def _get_rank_and_world() -> Tuple[int, int]:
     return r, w
 
 
-def _choose_num_workers(requested: int | None) -> int:
-    """Choose per-node worker count (local multiprocessing)."""
-    cpu = multiprocessing.cpu_count()
-    if requested is None:
-        return max(1, cpu - 1)
-    if 0 < requested <= max(1, cpu - 1):
-        return requested
-    logger.error("Invalid num_workers=%s. Defaulting to cpu_count - 1.", requested)
-    return max(1, cpu - 1)
+def _load_metadata(
+    args: argparse.Namespace,
+) -> Tuple[Mapping[str, Any], Mapping[str, Any], Mapping[str, Any], bool]:
+    """Load segment/img/pc metadata.
 
+    If any of the metadata inputs is an SQLite index, all three are opened with
+    point lookups instead of being parsed in full. Returns the three mappings and
+    whether indexes are in use.
+    """
+    paths = (args.segment_metadata, args.img_metadata, args.pc_metadata)
+    if any(is_sqlite_index(p) for p in paths):
+        segment_metadata, img_metadata, pc_metadata = (open_metadata(p) for p in paths)
+        return segment_metadata, img_metadata, pc_metadata, True
+    segment_metadata, img_metadata, pc_metadata = load_processed_files(args)
+    return segment_metadata, img_metadata, pc_metadata, False
+
+
+def _tile_metadata(metadata: Mapping[str, Any], pc_path: str) -> Dict[str, Any]:
+    """Single-tile view of a metadata mapping."""
+    record = metadata.get(pc_path)
+    return {pc_path: record} if record is not None else {}
+
+
+def _owned_only(
+    result: ResultDict, root: str, args: argparse.Namespace, rec: Record
+) -> ResultDict:
+    """``result`` without the point clouds of trees owned by other tiles."""
+    boxes = getattr(args, "owned", None)
+    if not boxes:
+        return result
+    out: ResultDict = {}
+    dropped = 0
+    for pc_path, record in result.items():
+        out[pc_path], n = filter_owned(record, boxes, root)
+        dropped += n
+    rec["unowned_segments"] = dropped
+    return out
+
+
+def _process_tile(ops_args: Tuple[Any, ...], rec: Record) -> ResultDict | None:
+    """Run pc_ops on one tile, keeping the segments its tile owns."""
+    args = ops_args[-1]
+    result: ResultDict | None = process_point_cloud_wrapper(ops_args)
+    if result:
+        result = _owned_only(result, args.ops_dir, args, rec)
+    return result
+
+
+def _process_fused(
+    task: Tuple[Tuple[Any, ...], str | None], rec: Record
+) -> ResultDict | None:
+    """Run pc_ops and then tree_modeling on one tile in the same worker.
+
+    pc_ops writes into a scratch folder on the local disk and tree_modeling reads
+    from there, so the intermediate segment point clouds never go through blob
+    storage. Trees owned by other tiles are not modeled. Returns the pc_ops
+    result only if both steps succeeded; without ``keep_ops_outputs`` its files
+    are gone with the scratch folder, so only the tile keys are returned.
+    """
+    ops_args, bgt_path = task
+    pc_path, args = ops_args[0], ops_args[-1]
+    if not bgt_path:
+        logger.warning("Skipping %s: no bgt metadata.", pc_path)
+        return None
+    # imported here so the unfused mode does not need tree_modeling installed
+    from tree_modeling.modeling_tree import process_point_cloud
+
+    scratch = tempfile.mkdtemp(prefix="pc_ops_", dir=args.scratch_dir)
+    try:
+        tile_args = argparse.Namespace(**vars(args))
+        tile_args.ops_dir = scratch
+        result: ResultDict | None = process_point_cloud_wrapper(
+            (*ops_args[:-1], tile_args)
+        )
+        if not result or pc_path not in result:
+            return None
+        result = _owned_only(result, scratch, args, rec)
+        process_point_cloud(
+            pc_path=pc_path,
+            pc_ops_files=result[pc_path],
+            bgt_pavements_path=bgt_path,
+            args=SimpleNamespace(
+                ops_dir=scratch,
+                bgt_dir=args.bgt_dir,
+                modeling_dir=args.modeling_dir,
+                overwrite=args.overwrite,
+                debug=args.debug,
+            ),
+        )
+        if args.keep_ops_outputs:
+            shutil.copytree(scratch, args.ops_dir, dirs_exist_ok=True)
+            return result
+        return {key: {} for key in result}
+    except Exception:
+        logger.exception("Fused processing failed for %s", pc_path)
+        return None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _measured(job: Tuple[Any, Any, str, Tuple[str, ...]]) -> TileOutcome:
+    """Run ``worker(task)`` for one tile and record its telemetry.
+
+    A tile that raises is returned as ``(None, rec)`` with the error in the
+    record, so every mode logs it and releases its staged inputs.
+    """
+    worker, task, pc_path, header_paths = job
+    stage = "pc_ops_tree_modeling" if worker is _process_fused else "pc_ops"
+    with ItemTelemetry(stage, pc_path) as rec:
+        try:
+            rec["points"] = point_count(*header_paths)
+            result = worker(task, rec)
+        except Exception as ex:
+            logger.exception("Tile %s failed", pc_path)
+            rec["error"] = f"{type(ex).__name__}: {ex}"
+            result = None
+    rec["ok"] = bool(result)
+    return result, rec
 
-def main() -> None:
-    """Main script."""
-    # pre-parse our extra arg and remove it from argv so ops_pc's parser won't choke
-    _pre = argparse.ArgumentParser(add_help=False)
-    _pre.add_argument("--partials_dir", required=True)
-    _pre_args, _remaining = _pre.parse_known_args()
-    sys.argv = [sys.argv[0], *_remaining]  # drop --partials_dir from argv
+
+def _outcomes_of(
+    finished: Iterator[Tuple[str, bool, Any]], stage: str
+) -> Iterator[TileOutcome]:
+    """Outcomes of ``(pc_path, ok, value)``; a failed worker call gets a record."""
+    for pc_path, ok, value in finished:
+        if ok:
+            yield value
+            continue
+        logger.error("Tile %s failed: %s", pc_path, value)
+        yield None, {"stage": stage, "key": pc_path, "ok": False, "error": str(value)}
+
+
+class _TileJobs:
+    """Worker jobs of the tiles of a rank, with their inputs staged when cached."""
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        metadata: Dict[str, Mapping[str, Any]],
+        indexed: bool,
+        fused: bool,
+        ownership: Mapping[str, Any],
+        cache: StagingCache | None,
+    ) -> None:
+        """Jobs reading the records of ``metadata`` (segment/img/pc/bgt)."""
+        self.args = args
+        self.metadata = metadata
+        self.indexed = indexed
+        self.fused = fused
+        self.ownership = ownership
+        self.cache = cache
+        self._staged: Dict[str, List[Tuple[str, List[str]]]] = {}
+        # input folder argument -> metadata whose records name its files
+        mounts = {"pc_dir": "pc", "img_dir": "img", "segment_dir": "segment"}
+        if fused:
+            mounts["bgt_dir"] = "bgt"
+        self._mounts = {
+            a: metadata[m]
+            for a, m in mounts.items()
+            if isinstance(getattr(args, a, None), str)
+        }
+
+    def inputs(self, pc_path: str) -> Dict[str, List[str]]:
+        """Relative paths of the files a tile reads, per input folder argument."""
+        return {
+            attr: record_paths(
+                [pc_path, metadata.get(pc_path)]
+                if attr == "pc_dir"
+                else metadata.get(pc_path)
+            )
+            for attr, metadata in self._mounts.items()
+        }
+
+    def _stage(self, pc_path: str, cache: StagingCache) -> argparse.Namespace:
+        """Copy the inputs of a tile to the cache and point its args at them."""
+        tile_args = argparse.Namespace(**vars(self.args))
+        self._staged[pc_path] = []
+        for attr, rels in self.inputs(pc_path).items():
+            mount = getattr(self.args, attr)
+            setattr(tile_args, attr, cache.stage(mount, rels))
+            self._staged[pc_path].append((mount, rels))
+        return tile_args
+
+    def release(self, pc_path: str) -> None:
+        """Release the staged inputs of a finished tile."""
+        for mount, rels in self._staged.pop(pc_path, []):
+            self.cache.release(mount, rels)  # type: ignore[union-attr]
+
+    def _ops_args(self, pc_path: str, tile_args: argparse.Namespace) -> Tuple[Any, ...]:
+        meta = self.metadata
+        if self.indexed:
+            # only ship the records of this tile to the worker
+            return (
+                pc_path,
+                _tile_metadata(meta["segment"], pc_path),
+                _tile_metadata(meta["img"], pc_path),
+                _tile_metadata(meta["pc"], pc_path),
+                tile_args,
+            )
+        return (pc_path, meta["segment"], meta["img"], meta["pc"], tile_args)
+
+    def __call__(self, pc_path: str) -> Tuple[Any, Any, str, Tuple[str, ...]]:
+        """The ``_measured`` job of a tile."""
+        tile_args = self.args
+        if self.cache is not None:
+            tile_args = self._stage(pc_path, self.cache)
+        owned = self.ownership.get(tile_code(pc_path) or "")
+        if owned:
+            # only the boxes of this tile travel to the worker
+            tile_args = argparse.Namespace(**{**vars(tile_args), "owned": owned})
+        pc_dir = getattr(tile_args, "pc_dir", None)
+        header_paths: Tuple[str, ...] = (pc_path,)
+        if pc_dir:
+            header_paths = (
+                pc_path,
+                os.path.join(pc_dir, pc_path),
+                os.path.join(pc_dir, columnar_path(pc_path)),
+            )
+        ops_args = self._ops_args(pc_path, tile_args)
+        if self.fused:
+            task = (ops_args, self.metadata["bgt"].get(pc_path))
+            return (_process_fused, task, pc_path, header_paths)
+        return (_process_tile, ops_args, pc_path, header_paths)
+
+
+class _RankLogs:
+    """The partials of a rank: ops metadata, modeled tiles and telemetry."""
+
+    def __init__(self, partials_dir: str, rank: int, run_id: str, fused: bool):
+        """Open (or resume) the logs of ``rank`` for ``run_id``."""
+        self.ops = PartialLog(
+            os.path.join(partials_dir, f"ops_metadata.rank{rank}.jsonl"), run_id
+        )
+        self.modeled = (
+            PartialLog(os.path.join(partials_dir, f"modeled.rank{rank}.jsonl"), run_id)
+            if fused
+            else None
+        )
+        self.telemetry = PartialLog(
+            os.path.join(stats_dir(partials_dir), f"telemetry.rank{rank}.jsonl"),
+            run_id,
+            sync=False,
+        )
+
+    def emit(self, result: ResultDict) -> None:
+        """Log the results of finished tiles."""
+        # modeled first: a tile in the ops partial is always in the modeled one
+        if self.modeled is not None:
+            for pc_path in result:
+                self.modeled.write({"modeled": pc_path})
+        self.ops.write(result)
+
+    def close(self) -> None:
+        """Close every log."""
+        for log in (self.ops, self.modeled, self.telemetry):
+            if log is not None:
+                log.close()
+
+
+def _parse_args() -> Tuple[argparse.Namespace, argparse.Namespace]:
+    """Our options and ops_pc's, with ours attached to the latter as needed."""
+    # pre-parse our extra args and remove them from argv so ops_pc's parser won't choke
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--partials_dir", required=True)
+    pre.add_argument("--sharding", choices=SHARDING_MODES, default="modulo")
+    pre.add_argument(
+        "--claims_dir",
+        default=None,
+        help="Shared directory for --sharding dynamic (default: <partials_dir>/_claims)",
+    )
+    pre.add_argument(
+        "--resume_id",
+        default=None,
+        help="Resume the partials of earlier jobs with this id, e.g. the pipeline "
+        "run name (default: only retries of the same AML run)",
+    )
+    add_ledger_arguments(pre)
+    pre.add_argument("--ledger_params", nargs="*", action="extend", default=None)
+    pre.add_argument(
+        "--fuse_tree_modeling",
+        action="store_true",
+        help="Run tree_modeling on each tile right after pc_ops, in the same worker",
+    )
+    pre.add_argument("--bgt_dir", default=None)
+    pre.add_argument("--bgt_metadata", default=None)
+    pre.add_argument("--modeling_dir", default=None)
+    pre.add_argument(
+        "--keep_ops_outputs",
+        nargs="?",
+        const=True,
+        default=False,
+        type=str_to_bool,
+        help="With --fuse_tree_modeling, also copy pc_ops outputs to ops_dir",
+    )
+    pre.add_argument(
+        "--scratch_dir",
+        default=None,
+        help="Local folder for fused intermediates (default: system temp)",
+    )
+    add_staging_arguments(pre)
+    add_start_arguments(pre)
+    add_resource_arguments(pre)
+    add_admission_arguments(pre)
+    add_ownership_arguments(pre)
+    ours, remaining = pre.parse_known_args()
+    sys.argv = [sys.argv[0], *remaining]  # drop our args from argv
 
     # now parse the existing args as usual
     args = configure_arg_parser()
 
-    # attach our extra value to the parsed namespace
-    args.partials_dir = _pre_args.partials_dir
+    # attach our extra values to the parsed namespace
+    args.partials_dir = ours.partials_dir
+    args.sharding = ours.sharding
+    if ours.fuse_tree_modeling:
+        if not (ours.bgt_dir and ours.bgt_metadata and ours.modeling_dir):
+            raise ValueError(
+                "--fuse_tree_modeling needs --bgt_dir, --bgt_metadata and "
+                "--modeling_dir"
+            )
+        args.bgt_dir = ours.bgt_dir
+        args.modeling_dir = ours.modeling_dir
+        args.keep_ops_outputs = ours.keep_ops_outputs
+        args.scratch_dir = ours.scratch_dir
+        os.makedirs(args.modeling_dir, exist_ok=True)
+    return ours, args
+
+
+def _fingerprints(
+    ours: argparse.Namespace,
+    args: argparse.Namespace,
+    stage: str,
+    shard: List[str],
+    jobs: _TileJobs,
+) -> Tuple[CompletionLedger, Dict[str, str]]:
+    """The ledger of the stage and the fingerprints of the tiles of ``shard``."""
+    version = ledger_version(ours, "pc_ops")
+    params = parse_params(ours.ledger_params)
+    # stage options that change the outputs
+    for name in ("resolution", "resolve_overlapping_trees"):
+        params.setdefault(name, str(getattr(args, name, None)))
+    # the upstream files of a tile are identified by size/mtime, listed once
+    # per folder for the whole shard
+    signatures = record_signatures(
+        {
+            p: [(getattr(args, a), rels) for a, rels in jobs.inputs(p).items()]
+            for p in shard
+        }
+    )
+    fps: Dict[str, str] = {}
+    for p in shard:
+        inputs = [jobs.metadata[m].get(p) for m in ("segment", "img", "pc", "bgt")]
+        inputs.append(signatures[p])
+        # owned boxes only with ownership, so earlier fingerprints stay valid
+        owned = jobs.ownership.get(tile_code(p) or "")
+        fps[p] = fingerprint(
+            stage, p, [*inputs, owned] if owned else inputs, version, params
+        )
+    return CompletionLedger(ours.ledger_dir, stage, version), fps
+
+
+def _open_claims(
+    ours: argparse.Namespace,
+    args: argparse.Namespace,
+    rank: int,
+    world: int,
+    run_id: str,
+    done: Set[str],
+    resumed: bool,
+) -> ClaimDirectory:
+    """Claims of this job for ``--sharding dynamic``."""
+    # Scope claims to this job so a re-run does not see stale claims
+    claims_root = ours.claims_dir or os.path.join(args.partials_dir, "_claims")
+    claims = ClaimDirectory(os.path.join(claims_root, run_id), rank)
+    if resumed:
+        released = claims.release_stale(done, world)
+        logger.info("Rank %s released %d stale claims.", rank, released)
+    return claims
+
+
+def _carry_over(
+    ledger: CompletionLedger,
+    fps: Dict[str, str],
+    shard: List[str],
+    claims: ClaimDirectory | None,
+    logs: _RankLogs,
+    rank: int,
+) -> List[str]:
+    """Log the recorded results of completed tiles; returns the tiles left."""
+    carried: ResultDict = {}
+    left = carry_completed(ledger, fps, shard, carried, claims)
+    for pc_path, row in carried.items():
+        logs.emit({pc_path: row})
+    logger.info(
+        "Ledger: rank %s carried %d completed tiles, %d left.",
+        rank,
+        len(shard) - len(left),
+        len(left),
+    )
+    return left
+
+
+def _admission_pool(
+    ours: argparse.Namespace, ctx: Any, num_workers: int, pool_init: Dict[str, Any]
+) -> AdmissionPool:
+    """Pool that starts tiles while their predicted memory fits the node."""
+    budget = (
+        ours.memory_budget_gb * 1e9
+        if ours.memory_budget_gb
+        else memory_budget(detect_topology().memory_bytes)
+    )
+    return AdmissionPool(
+        ctx,
+        num_workers,
+        _measured,
+        budget,
+        MemoryModel(ours.memory_per_point_bytes / COST_BYTES_PER_POINT),
+        max_tasks_per_worker=ours.max_tasks_per_worker,
+        recycle_rss_bytes=ours.recycle_rss_gb * 1e9 if ours.recycle_rss_gb else None,
+        **pool_init,
+    )
+
+
+def _outcomes(
+    pool: Any,
+    shard: List[str],
+    claims: ClaimDirectory | None,
+    jobs: _TileJobs,
+    costs: Dict[str, float],
+    num_workers: int,
+    processed: List[str],
+    stage: str,
+) -> Tuple[Iterator[TileOutcome], int | None]:
+    """Outcomes of the tiles of ``shard`` and their count, if known up front.
+
+    The tiles this rank runs are added to ``processed`` as they start.
+    """
+    total = None if claims is not None else len(shard)
+    if isinstance(pool, AdmissionPool):
+        # claims, staging and memory all decided when a worker is free
+        claim = claims.try_claim if claims is not None else None
+        finished = pool.imap(shard, jobs, costs, claim, processed)
+    elif claims is not None or jobs.cache is not None:
+        # stage lazily rather than copying the whole shard up front; with a
+        # cache, one staged tile waits ready for the next free worker
+        in_flight = num_workers + (jobs.cache is not None)
+        finished = iter_claimed(
+            pool, _measured, shard, jobs, in_flight, claims, processed
+        )
+    else:
+        processed += shard
+        return pool.imap_unordered(_measured, [jobs(p) for p in shard]), total
+    return _outcomes_of(finished, stage), total
+
+
+def main() -> None:
+    """Main script."""
+    ours, args = _parse_args()
+    fused = ours.fuse_tree_modeling
+    # telemetry and ledger stage: fused results also imply modeled tiles
+    stage = "pc_ops_tree_modeling" if fused else "pc_ops"
 
     # MPI/PMI rank & world size from env
     rank, world = _get_rank_and_world()
@@ -74,66 +585,164 @@ def main() -> None:
         "Distributed wrapper: rank %s / %s on host %s", rank, world, os.uname().nodename
     )
 
+    # Per-node workers and their threads; the thread caps go into the
+    # environment before any worker (or the fork server) imports the stage
+    resources = plan_resources(
+        stage,
+        getattr(args, "num_workers", None),
+        ours.threads_per_worker,
+        ours.memory_per_worker_gb,
+        ours.pin_workers,
+    )
+    cap_threads(resources.threads)
+
     # Avoid accidental double-forks if the launcher also starts >1 process per node:
-    multiprocessing.set_start_method("spawn", force=True)
+    # never plain fork by default; forkserver forks from a clean preloaded server
+    preload = ours.preload
+    if preload is None:
+        preload = [*PRELOAD["pc_ops"], *(PRELOAD["tree_modeling"] if fused else ())]
+    ctx = start_context(ours.start_method, preload)
 
     # Load preprocessed metadata (same as point_cloud_operations)
     logger.info("Loading processed files.")
-    segment_metadata, img_metadata, pc_metadata = load_processed_files(args)
+    segment_metadata, img_metadata, pc_metadata, indexed = _load_metadata(args)
+    metadata: Dict[str, Mapping[str, Any]] = {
+        "segment": segment_metadata,
+        "img": img_metadata,
+        "pc": pc_metadata,
+        "bgt": open_metadata(ours.bgt_metadata) if fused else {},
+    }
+    ownership = read_ownership(ours.ownership) if ours.ownership else {}
+    if ownership:
+        logger.info("Tree ownership: owned boxes of %d tiles.", len(ownership))
+    cache = open_staging_cache(ours)
+    jobs = _TileJobs(args, metadata, indexed, fused, ownership, cache)
 
     # Build the list of work items (keys are pc_paths in segment_metadata)
     pc_paths: List[str] = list(segment_metadata.keys())
-
-    # Shard deterministically by rank
-    shard: List[str] = [p for i, p in enumerate(pc_paths) if (i % world) == rank]
-    logger.info(
-        "Sharding: rank %s owns %s items out of %s total.",
-        rank,
-        len(shard),
-        len(pc_paths),
+    # Costs are also estimated for modulo so predicted imbalance can be compared
+    costs = estimate_tile_costs(
+        pc_paths, segment_metadata, pc_metadata, getattr(args, "pc_dir", None)
     )
+    shard = plan_shard(args.sharding, pc_paths, costs, rank, world)
+
+    # Results go to disk tile by tile; an earlier attempt of this run (timeout,
+    # node eviction) left the tiles it finished in the partials
+    run_id = current_run_id(ours.resume_id)
+    logs = _RankLogs(args.partials_dir, rank, run_id, fused)
+    partials = Path(args.partials_dir).glob("ops_metadata.rank*.jsonl")
+    shard, done = skip_completed(shard, sorted(str(p) for p in partials), run_id)
+    claims = None
+    if args.sharding == "dynamic":
+        claims = _open_claims(ours, args, rank, world, run_id, done, logs.ops.resumed)
+    ledger: CompletionLedger | None = None
+    fps: Dict[str, str] = {}
+    if ours.ledger_dir:
+        ledger, fps = _fingerprints(ours, args, stage, shard, jobs)
+        if not args.overwrite:
+            shard = _carry_over(ledger, fps, shard, claims, logs, rank)
 
     if not shard:
         logger.warning("Rank %s has no items. Exiting early.", rank)
-        _write_partial({}, args.partials_dir, rank)
+        _write_stats(args, rank, [], costs, 0.0, None)
+        logs.close()
+        if cache is not None:
+            cache.close()
         return
 
     # Respect in-node parallelism (existing per-item code is CPU-bound)
-    num_workers = _choose_num_workers(getattr(args, "num_workers", None))
-    logger.info("Processing shard with %s local workers.", num_workers)
-
-    # Prepare process args for existing wrapper
-    process_args = [
-        (pc_path, segment_metadata, img_metadata, pc_metadata, args)
-        for pc_path in shard
-    ]
-
-    result_dict: Dict[str, Dict[str, Union[str, List[str]]]] = {}
-    with multiprocessing.Pool(processes=num_workers) as pool:
-        for result in tqdm(
-            pool.imap_unordered(process_point_cloud_wrapper, process_args),
-            total=len(process_args),
-            desc=f"Rank {rank}: Processing Point Clouds",
+    num_workers = resources.processes
+    logger.info("Processing shard with %s.", resources.describe())
+    processed: List[str] = []
+    t0 = time.perf_counter()
+    probe = StartupProbe(ctx)
+    init = resources.pool_kwargs(ctx)
+    pool_init = probe.pool_kwargs(init["initializer"], init["initargs"])
+    admission = (
+        _admission_pool(ours, ctx, num_workers, pool_init) if ours.admission else None
+    )
+    with admission or ctx.Pool(processes=num_workers, **pool_init) as pool:
+        results, total = _outcomes(
+            pool, shard, claims, jobs, costs, num_workers, processed, stage
+        )
+        for result, record in tqdm(
+            results, total=total, desc=f"Rank {rank}: Processing Point Clouds"
         ):
+            logs.telemetry.write({TELEMETRY_KEY: record})
+            if cache is not None:
+                jobs.release(record["key"])
             if result:
-                result_dict.update(result)
+                logs.emit(result)
+                if ledger is not None:
+                    for pc_path, row in result.items():
+                        if pc_path in fps:
+                            ledger.record(fps[pc_path], pc_path, {pc_path: row})
+    elapsed = time.perf_counter() - t0
+    if admission is not None:
+        logger.info("Rank %s admission: %s", rank, admission.describe())
+    if ours.startup_report:
+        report = Path(ours.startup_report)
+        if world > 1:
+            report = report.with_name(f"{report.stem}.rank{rank}{report.suffix}")
+        write_startup_report(
+            str(report), ours.start_method, preload, probe.startups(), preload
+        )
+    staging = None
+    if cache is not None:
+        logger.info("Rank %s staging cache: %s", rank, cache.describe())
+        staging = cache.stats()
+        cache.close()
 
-    # Write per-rank partial (rank-0 will merge later)
-    _write_partial(result_dict, args.partials_dir, rank)
-    logger.info("Rank %s wrote %d entries.", rank, len(result_dict))
+    logs.close()
+    _write_stats(
+        args,
+        rank,
+        processed,
+        costs,
+        elapsed,
+        staging,
+        admission.stats if admission is not None else None,
+    )
+    logger.info(
+        "Rank %s wrote %d entries to %s (%d tiles in %.0fs).",
+        rank,
+        logs.ops.rows,
+        logs.ops.path,
+        len(processed),
+        elapsed,
+    )
 
 
-def _write_partial(
-    result_dict: Dict[str, Dict[str, Union[str, List[str]]]],
-    partial_dir: str,
+def _write_stats(
+    args: argparse.Namespace,
     rank: int,
+    processed: List[str],
+    costs: Dict[str, float],
+    elapsed: float,
+    staging: Dict[str, Any] | None,
+    admission: Dict[str, Any] | None = None,
 ) -> None:
-    """Write a per-rank partial JSON next to the final output path."""
-    os.makedirs(partial_dir, exist_ok=True)
-    partial_path = os.path.join(partial_dir, f"ops_metadata.rank{rank}.json")
-    with open(partial_path, "w") as f:
-        json.dump(result_dict, f, indent=4)
-    logger.info("Wrote partial metadata to %s", partial_path)
+    """Record predicted vs. actual load of this rank for the merge step."""
+    predicted = sum(costs.get(p, 0.0) for p in processed)
+    stats: Dict[str, Any] = {
+        "rank": rank,
+        "mode": args.sharding,
+        "num_items": len(processed),
+        "predicted_cost": predicted,
+        "actual_seconds": elapsed,
+    }
+    if staging is not None:
+        stats["staging"] = staging
+    if admission is not None:
+        stats["admission"] = admission
+    write_rank_stats(args.partials_dir, rank, stats)
+    logger.info(
+        "Rank %s makespan: predicted cost %.3g | actual %.0fs for %d tiles.",
+        rank,
+        predicted,
+        elapsed,
+        len(processed),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+"""Per-item entry script for pc_ops (init/run/shutdown).
+
+The batch pc_ops step is the MPI job in ``dist_pc_ops_script.py``, which loads
+the merged segment/img/pc metadata of the whole city. This entry script runs
+pc_ops on items that carry their own metadata records instead::
+
+    {"pc_path": "...", "segment": <segment record>, "img": <img record>,
+     "pc": <pc record>}
+
+so tiles can be processed as soon as segmentation finished them (see
+``streaming/stream_runner.py``). Items without records are looked up in the
+metadata files given with ``--segment_metadata``/``--img_metadata``/
+``--pc_metadata``, if any.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Mapping
+
+from pc_ops.logger import logger
+from pc_ops.ops_pc import configure_arg_parser, process_point_cloud_wrapper
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.columnar import columnar_path  # noqa: E402
+from gsm_common.ledger import (  # noqa: E402
+    CompletionLedger,
+    add_ledger_arguments,
+    ledger_version,
+)
+from gsm_common.metadata_store import open_metadata  # noqa: E402
+from gsm_common.plan_io import iter_plan_items  # noqa: E402
+from gsm_common.telemetry import (  # noqa: E402
+    TELEMETRY_KEY,
+    ItemTelemetry,
+    point_count,
+    with_telemetry,
+)
+
+_G: Dict[str, Any] = {
+    "args": None,
+    "metadata": None,
+    "ledger": None,
+}
+
+# item section -> metadata argument of ops_pc
+_SECTIONS = {
+    "segment": "segment_metadata",
+    "img": "img_metadata",
+    "pc": "pc_metadata",
+}
+
+
+def _parse_args() -> argparse.Namespace:
+    pre = argparse.ArgumentParser(add_help=False)
+    add_ledger_arguments(pre)
+    ours, remaining = pre.parse_known_args()
+    # ops_pc requires the metadata files; items carry their records instead
+    for arg in _SECTIONS.values():
+        if f"--{arg}" not in remaining:
+            remaining += [f"--{arg}", f"__unused_{arg}.json"]
+    argv = sys.argv
+    sys.argv = [argv[0], *remaining]
+    try:
+        args: argparse.Namespace = configure_arg_parser()
+    finally:
+        sys.argv = argv
+    for k, v in vars(ours).items():
+        setattr(args, k, v)
+    return args
+
+
+def init() -> None:
+    """Init script."""
+    args = _parse_args()
+    _G["args"] = args
+    Path(args.ops_dir).mkdir(parents=True, exist_ok=True)
+    _G["metadata"] = {
+        section: (
+            open_metadata(getattr(args, arg))
+            if Path(getattr(args, arg)).is_file()
+            else {}
+        )
+        for section, arg in _SECTIONS.items()
+    }
+    if args.ledger_dir:
+        _G["ledger"] = CompletionLedger(
+            args.ledger_dir, "pc_ops", ledger_version(args, "pc_ops")
+        )
+    logger.info("init(): ops_dir=%s", args.ops_dir)
+
+
+def _records(item: Dict[str, Any], pc_path: str) -> Dict[str, Mapping[str, Any]]:
+    """Single-tile metadata mappings of an item, per section."""
+    out: Dict[str, Mapping[str, Any]] = {}
+    for section in _SECTIONS:
+        record = item.get(section)
+        if record is None:
+            record = _G["metadata"][section].get(pc_path)
+        out[section] = {pc_path: record} if record is not None else {}
+    return out
+
+
+def run(mini_batch: List[Any]) -> List[Dict[str, Any]]:
+    """Run script."""
+    args = _G["args"]
+    rows: List[Dict[str, Any]] = []
+    for it in iter_plan_items(mini_batch):
+        pc_path = it.get("pc_path")
+        if not isinstance(pc_path, str):
+            rows.append({"skip": {"item": str(it), "reason": "no pc_path"}})
+            continue
+        records = _records(it, pc_path)
+        pc_file = Path(args.pc_dir, pc_path)
+        with ItemTelemetry("pc_ops", pc_path) as rec:
+            rec["points"] = point_count(
+                str(pc_file), str(Path(args.pc_dir, columnar_path(pc_path)))
+            )
+            result = process_point_cloud_wrapper(
+                (pc_path, records["segment"], records["img"], records["pc"], args)
+            )
+        if not result:
+            rec["ok"] = False
+            rows.append({TELEMETRY_KEY: rec})
+            continue
+        rows.append(with_telemetry(result, rec))
+        if _G["ledger"] is not None and it.get("fingerprint"):
+            _G["ledger"].record(it["fingerprint"], pc_path, result)
+    ok = sum(1 for r in rows if r.get(TELEMETRY_KEY, {}).get("ok"))
+    logger.info("Succeeded on %d/%d", ok, len(rows))
+    return rows
+
+
+def shutdown() -> None:
+    """Shutdown script."""
+    logger.info("shutdown()")
@@ -1,9 +1,29 @@
 """Merge ops metadata."""
 
 import argparse
-import glob
-import json
 import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.sharding import (  # noqa: E402
+    read_rank_stats,
+    stats_dir,
+    summarize_makespan,
+)
+from gsm_common.streaming_merge import (  # noqa: E402
+    MergeOutput,
+    SourceStats,
+    add_merge_arguments,
+    describe_run,
+    iter_partial_rows,
+    list_partials,
+    merge_partials,
+    select_entries,
+    select_value,
+)
+from gsm_common.telemetry import TelemetrySummary  # noqa: E402
 
 
 def main() -> None:
@@ -11,22 +31,66 @@ def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--partials_dir", required=True)
     ap.add_argument("--final_path", required=True)
+    ap.add_argument("--final_index", default=None, help="Optional SQLite index")
+    ap.add_argument(
+        "--modeling_index",
+        default=None,
+        help="Also merge the modeled.rank*.jsonl partials of a fused run",
+    )
+    add_merge_arguments(ap)
     args = ap.parse_args()
 
-    merged = {}
-    for p in sorted(glob.glob(os.path.join(args.partials_dir, "*.json"))):
-        with open(p, "r") as f:
-            try:
-                part = json.load(f)
-                if isinstance(part, dict):
-                    merged.update(part)
-            except Exception as e:
-                print(f"Exception: {e}")  # noqa: T201
-                # skip malformed
-    os.makedirs(os.path.dirname(args.final_path), exist_ok=True)
-    with open(args.final_path, "w") as f:
-        json.dump(merged, f, indent=4)
-    print(f"Merged {len(merged)} entries into {args.final_path}")  # noqa: T201
+    out = MergeOutput(
+        path=args.final_path,
+        select=select_entries,
+        fmt=args.format,
+        indent=args.indent,
+        index_path=args.final_index,
+    )
+    # per-rank partials are merged in rank order, malformed ones are skipped;
+    # the dist ranks append their tiles to ops_metadata.rank*.jsonl (a torn
+    # last row of a killed rank is skipped), a streaming run writes its rows
+    # (with telemetry) to ops_metadata.*.jsonl
+    telemetry = TelemetrySummary()
+    stats, source_stats = merge_partials(
+        list_partials(args.partials_dir, "ops_metadata.*.json*"),
+        {"ops": out},
+        args.on_duplicate,
+        observers=[telemetry.add_row],
+    )
+    print(f"Merged {stats['ops'].written} entries into {args.final_path}")  # noqa: T201
+    print(describe_run(source_stats, stats))  # noqa: T201
+    if args.modeling_index:
+        modeled = MergeOutput(
+            path=args.modeling_index,
+            select=select_value("modeled"),
+            fmt=args.format,
+            indent=args.indent,
+            list_key="modeled",
+        )
+        stats, source_stats = merge_partials(
+            list_partials(args.partials_dir, "modeled.*.jsonl"),
+            {"modeled": modeled},
+            args.on_duplicate,
+        )
+        print(  # noqa: T201
+            f"Wrote {stats['modeled'].written} modeled keys -> {args.modeling_index}"
+        )
+        print(describe_run(source_stats, stats))  # noqa: T201
+    for line in summarize_makespan(read_rank_stats(args.partials_dir)):
+        print(line)  # noqa: T201
+
+    # per-tile telemetry is written by every rank next to its sharding stats
+    if os.path.isdir(stats_dir(args.partials_dir)):
+        for row in iter_partial_rows(
+            list_partials(stats_dir(args.partials_dir), "telemetry.*.jsonl"),
+            SourceStats(),
+        ):
+            telemetry.add_row(row)
+    for line in telemetry.describe():
+        print(line)  # noqa: T201
+    if args.telemetry_summary:
+        telemetry.write(args.telemetry_summary)
 
 
 if __name__ == "__main__":
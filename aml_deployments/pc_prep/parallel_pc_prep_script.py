@@ -1,15 +1,59 @@
-"""Parallel entry script for pc_prep."""
+"""Parallel entry script for pc_prep.
+
+With ``--layer_cache`` (default on) the BGT pavements and reference trees are
+loaded once per worker process and indexed; every tile is processed with small
+tile-clipped copies of them from local scratch instead of the city-wide files.
+
+With ``--stage_cache_dir`` the raw tiles are copied to local disk first, the
+next tile of the mini-batch in the background, and processed from there.
+
+Items planned with tree ownership (``gsm_common.tree_ownership``) keep only the
+reference trees their tile owns (with ``--layer_cache``), and their tile is
+processed with the halo points of its neighbours added, from local scratch.
+"""
 
 import argparse
-import json
 import os
+import shutil
+import sys
+import tempfile
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 from pc_prep.logger import logger
 from pc_prep.tree_prep.prep_pc import process_single_pc
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.cli import str_to_bool  # noqa: E402
+from gsm_common.ledger import (  # noqa: E402
+    CompletionLedger,
+    add_ledger_arguments,
+    ledger_version,
+)
+from gsm_common.las_header import read_las_header  # noqa: E402
+from gsm_common.plan_io import iter_plan_items  # noqa: E402
+from gsm_common.spatial_cache import SpatialLayerCache  # noqa: E402
+from gsm_common.staging_cache import (  # noqa: E402
+    StagingCache,
+    add_staging_arguments,
+    open_staging_cache,
+)
+from gsm_common.telemetry import (  # noqa: E402
+    TELEMETRY_KEY,
+    ItemTelemetry,
+    point_count,
+    with_telemetry,
+)
+from gsm_common.tree_ownership import HALO_KEY, OWN_KEY, write_halo_tile  # noqa: E402
+
 _G_ARGS = None
+_G_LEDGER: CompletionLedger | None = None
+_G_LAYERS: SpatialLayerCache | None = None
+_G_STAGE: StagingCache | None = None
+
+# cached layer name -> the argument holding its path
+_LAYER_ARGS = {"bgt": "bgt_pavements_raw", "trees": "reference_trees_path"}
 
 
 def _parse_args_from_program_arguments() -> argparse.Namespace:
@@ -34,61 +78,187 @@ def _parse_args_from_program_arguments() -> argparse.Namespace:
     parser.add_argument("--img_metadata", default="__unused_img_metadata.json")
     parser.add_argument("--pc_metadata", default="__unused_pc_metadata.json")
     parser.add_argument("--bgt_metadata", default="__unused_bgt_metadata.json")
+    parser.add_argument(
+        "--layer_cache",
+        nargs="?",
+        const=True,
+        default=True,
+        type=str_to_bool,
+        help="Load BGT pavements and reference trees once per process, clip per tile",
+    )
+    parser.add_argument(
+        "--clip_margin",
+        type=float,
+        default=10.0,
+        help="Margin (map units) around the tile bounds kept when clipping layers",
+    )
+    parser.add_argument("--scratch_dir", type=str, default=None)
+    add_staging_arguments(parser)
+    add_ledger_arguments(parser)
     args, _ = parser.parse_known_args()
     return args
 
 
 def init() -> None:
     """Init script."""
-    global _G_ARGS  # noqa: PLW0603
+    global _G_ARGS, _G_LEDGER, _G_LAYERS, _G_STAGE  # noqa: PLW0603
     _G_ARGS = _parse_args_from_program_arguments()
     for d in (_G_ARGS.img_dir, _G_ARGS.pc_dir, _G_ARGS.bgt_dir):
         os.makedirs(d, exist_ok=True)
+    if _G_ARGS.ledger_dir:
+        _G_LEDGER = CompletionLedger(
+            _G_ARGS.ledger_dir, "pc_prep", ledger_version(_G_ARGS, "pc_prep")
+        )
+    if _G_ARGS.layer_cache:
+        _G_LAYERS = SpatialLayerCache(
+            tempfile.mkdtemp(prefix="pc_prep_layers_", dir=_G_ARGS.scratch_dir),
+            _G_ARGS.clip_margin,
+        )
+        for name, arg in _LAYER_ARGS.items():
+            _G_LAYERS.add(name, getattr(_G_ARGS, arg))
+    _G_STAGE = open_staging_cache(_G_ARGS)
+    if not _G_ARGS.layer_cache:
+        logger.info("Without --layer_cache, trees owned by other tiles are kept")
     logger.info("Init complete. pc_raw mount: %s", _G_ARGS.pc_raw)
 
 
-def _row_to_abs_path(row: str) -> str | None:
-    # If string points to a JSON file, read {"rel_path": "..."}
-    if isinstance(row, str):
-        p = Path(row)
-        if p.suffix.lower() == ".json" and p.exists():
-            try:
-                data = json.loads(p.read_text(encoding="utf-8"))
-                rel = data.get("rel_path")
-                if rel:
-                    return str(Path(_G_ARGS.pc_raw) / rel)  # type: ignore[union-attr]
-            except Exception as ex:
-                logger.exception("Failed to read item file %s: %s", p, ex)
-                return None
+def _item_to_abs_path(item: Dict[str, Any]) -> str | None:
+    # Plan items look like {"rel_path": "..."} (relative to this step's pc_raw mount)
+    rel = item.get("rel_path")
+    if isinstance(rel, str) and rel:
+        return str(Path(_G_ARGS.pc_raw) / rel)  # type: ignore[union-attr]
+    logger.warning("Skipping item without rel_path: %s", item)
     return None
 
 
-def _process_paths(paths: List[str]) -> Tuple[List[Dict[str, Any]], int]:
+def _tile_args(
+    pc_path: str, tile: str, pc_raw: str, item: Dict[str, Any]
+) -> argparse.Namespace:
+    """Arguments for one tile, pointing at the staged tile and clipped layers.
+
+    With tree ownership the reference trees are limited to the owned ones.
+    """
+    args = argparse.Namespace(**vars(_G_ARGS))
+    args.pc_raw = pc_raw
+    if _G_LAYERS is None:
+        return args
+    try:
+        header = read_las_header(pc_path)
+    except (OSError, ValueError) as ex:
+        logger.warning("No bounds for %s, using the full layers: %s", pc_path, ex)
+        return args
+    bounds = (*header.min_xyz[:2], *header.max_xyz[:2])
+    owned = {"trees": item[OWN_KEY]} if item.get(OWN_KEY) else None
+    for name, path in _G_LAYERS.write_tile(tile, bounds, owned).items():
+        setattr(args, _LAYER_ARGS[name], path)
+    return args
+
+
+def _staged(
+    items: List[Tuple[Dict[str, Any], str]],
+) -> Iterator[Tuple[Dict[str, Any], str, str]]:
+    """Yield ``(item, pc_path, pc_raw)``, from the staging cache when enabled.
+
+    The next tile is copied in the background while the current one runs.
+    """
+    pc_raw = _G_ARGS.pc_raw  # type: ignore[union-attr]
+    if _G_STAGE is None:
+        for item, pc_path in items:
+            yield item, pc_path, pc_raw
+        return
+    rels = [[item.get("rel_path", "")] for item, _ in items]
+    ahead = _G_STAGE.prefetch(pc_raw, rels[0]) if items else None
+    for i, (item, _) in enumerate(items):
+        current = ahead
+        ahead = _G_STAGE.prefetch(pc_raw, rels[i + 1]) if i + 1 < len(items) else None
+        mirror = current.result()  # type: ignore[union-attr]
+        try:
+            yield item, os.path.join(mirror, rels[i][0]), mirror
+        finally:
+            _G_STAGE.release(pc_raw, rels[i])
+
+
+def _with_halo(
+    item: Dict[str, Any], pc_path: str, pc_raw: str, rec: Dict[str, Any]
+) -> Tuple[str, str, str | None]:
+    """``(pc_path, pc_raw, scratch)`` of the tile with its neighbours' halo points.
+
+    The tile is copied with the points added to a scratch folder mirroring
+    ``pc_raw``, so its relative path, and with it the output names, stay the
+    same; the caller removes ``scratch``. Items without a halo are passed
+    through with no scratch folder.
+    """
+    halo = item.get(HALO_KEY)
+    if not halo:
+        return pc_path, pc_raw, None
+    args: argparse.Namespace = _G_ARGS  # type: ignore[assignment]
+    mirror = tempfile.mkdtemp(prefix="pc_prep_halo_", dir=args.scratch_dir)
+    dst = os.path.join(mirror, os.path.relpath(pc_path, pc_raw))
+    neighbours = {os.path.join(args.pc_raw, rel): box for rel, box in halo.items()}
+    try:
+        rec["halo_points"] = write_halo_tile(pc_path, neighbours, dst)
+    except Exception as ex:
+        logger.warning("No halo for %s, processing the tile alone: %s", pc_path, ex)
+        shutil.rmtree(mirror, ignore_errors=True)
+        return pc_path, pc_raw, None
+    return dst, mirror, mirror
+
+
+def _process_items(
+    items: List[Tuple[Dict[str, Any], str]],
+) -> Tuple[List[Dict[str, Any]], int]:
     rows: List[Dict[str, Any]] = []
     ok = 0
-    for pc_path in paths:
+    for item, pc_path, pc_raw in _staged(items):
         if not pc_path:
             continue
         pc_path_norm = os.path.normpath(pc_path)
 
-        res = process_single_pc(pc_path=pc_path_norm, args=_G_ARGS)
+        tile = str(len(rows))
+        with ItemTelemetry("pc_prep", item.get("rel_path", pc_path_norm)) as rec:
+            rec["points"] = point_count(pc_path_norm)
+            tile_path, tile_raw, scratch = _with_halo(item, pc_path_norm, pc_raw, rec)
+            try:
+                res = process_single_pc(
+                    pc_path=tile_path, args=_tile_args(tile_path, tile, tile_raw, item)
+                )
+            finally:
+                if _G_LAYERS is not None:
+                    _G_LAYERS.release_tile(tile)
+                if scratch is not None:
+                    shutil.rmtree(scratch, ignore_errors=True)
         if res:
-            rows.append(res)
+            rows.append(with_telemetry(res, rec))
             ok += 1
+            if _G_LEDGER is not None and item.get("fingerprint"):
+                _G_LEDGER.record(item["fingerprint"], item["rel_path"], res)
+        else:
+            rec["ok"] = False
+            rows.append({TELEMETRY_KEY: rec})
     return rows, ok
 
 
 def run(mini_batch: List[Any]) -> List[Dict[str, Any]]:
     """Run script.
-    Translate each row to an absolute path under this step's mount.
+    Translate each item (file or manifest row) to an absolute path under this step's mount.
     """
-    abs_paths = [p for p in (_row_to_abs_path(r) for r in mini_batch) if p]
-    logger.info("Mini-batch: %d items", len(abs_paths))
-    rows, ok = _process_paths(abs_paths)
-    logger.info("Succeeded on %d/%d", ok, len(abs_paths))
+    items: List[Tuple[Dict[str, Any], str]] = []
+    for it in iter_plan_items(mini_batch):
+        abs_path = _item_to_abs_path(it)
+        if abs_path:
+            items.append((it, abs_path))
+    logger.info("Mini-batch: %d items", len(items))
+    rows, ok = _process_items(items)
+    logger.info("Succeeded on %d/%d", ok, len(items))
     return rows
 
 
 def shutdown() -> None:
     """Shutdown script."""
+    if _G_LAYERS is not None:
+        logger.info("Layer cache: %s", _G_LAYERS.describe())
+        _G_LAYERS.close()
+    if _G_STAGE is not None:
+        logger.info("Staging cache: %s", _G_STAGE.describe())
+        _G_STAGE.close()
     logger.info("Shutdown.")
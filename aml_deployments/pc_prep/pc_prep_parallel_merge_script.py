@@ -1,43 +1,73 @@
 """Script for merging pc_prep results."""
 
 import argparse
-import json
+import sys
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.streaming_merge import (  # noqa: E402
+    MergeOutput,
+    add_merge_arguments,
+    describe_run,
+    merge_partials,
+    select_section,
+    with_carried_over,
+)
+from gsm_common.telemetry import TelemetrySummary  # noqa: E402
+
 
 def main() -> None:
     """Main script."""
     ap = argparse.ArgumentParser()
     ap.add_argument("--partial", required=True, help="JSONL from append_row_to")
+    ap.add_argument(
+        "--carried_over",
+        default=None,
+        help="JSONL of items completed in an earlier run (from the plan step)",
+    )
     ap.add_argument("--img_metadata", required=True)
     ap.add_argument("--pc_metadata", required=True)
     ap.add_argument("--bgt_metadata", required=True)
+    # optional SQLite indexes for point lookups by pc_path
+    ap.add_argument("--img_metadata_index", default=None)
+    ap.add_argument("--pc_metadata_index", default=None)
+    ap.add_argument("--bgt_metadata_index", default=None)
+    add_merge_arguments(ap)
     args = ap.parse_args()
 
-    img_meta, pc_meta, bgt_meta = {}, {}, {}
-
-    partial_path = Path(args.partial)
     # file may be named "job_output_file" under parallel step
-    with partial_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            if not line.strip():
-                continue
-            row = json.loads(line)
-            # row == {"pc": {...}, "img": {...}, "bgt": {...}}
-            pc_meta.update(row.get("pc", {}))
-            img_meta.update(row.get("img", {}))
-            bgt_meta.update(row.get("bgt", {}))
-
-    # Write final dicts (your original component format)
-    for out, data in [
-        (args.pc_metadata, pc_meta),
-        (args.img_metadata, img_meta),
-        (args.bgt_metadata, bgt_meta),
-    ]:
-        Path(out).parent.mkdir(parents=True, exist_ok=True)
-        with open(out, "w", encoding="utf-8") as jf:
-            json.dump(data, jf, indent=4)
-        print(f"Wrote {out}")  # noqa: T201
+    # row == {"pc": {...}, "img": {...}, "bgt": {...}}
+    outputs = {
+        section: MergeOutput(
+            path=out,
+            select=select_section(section),
+            fmt=args.format,
+            indent=args.indent,
+            index_path=index,
+        )
+        for section, out, index in [
+            ("pc", args.pc_metadata, args.pc_metadata_index),
+            ("img", args.img_metadata, args.img_metadata_index),
+            ("bgt", args.bgt_metadata, args.bgt_metadata_index),
+        ]
+    }
+    telemetry = TelemetrySummary()
+    stats, source_stats = merge_partials(
+        with_carried_over([args.partial], args.carried_over),
+        outputs,
+        args.on_duplicate,
+        observers=[telemetry.add_row],
+    )
+    for out in outputs.values():
+        print(f"Wrote {out.path}")  # noqa: T201
+        if out.index_path:
+            print(f"Wrote {out.index_path}")  # noqa: T201
+    print(describe_run(source_stats, stats))  # noqa: T201
+    for line in telemetry.describe():
+        print(line)  # noqa: T201
+    if args.telemetry_summary:
+        telemetry.write(args.telemetry_summary)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,165 @@
-"""Script for planning files for parallel processing pc_prep."""
+"""Script for planning files for parallel processing pc_prep.
+
+The tiles come from pc_prep's own ``prepare_pc_paths`` by default. With
+``--tile_selection index`` they are found with a vectorized spatial join of the
+tree points and the tile polygons, and their paths come from one bulk listing
+of pc_raw (Cyclomedia naming), so planning makes no metadata call per tile;
+``prepare_pc_paths`` is the fallback when the index cannot be used.
+``compare`` plans with ``prepare_pc_paths`` and logs the tiles on which the
+index disagrees, to check it on real inputs before switching.
+
+With ``--tree_ownership`` every tree is assigned to the selected tile
+containing its centroid (``gsm_common.tree_ownership``); planning fails when
+ownership cannot be computed. Only selected tiles that own trees are planned; each item carries the boxes its tile owns and the halo boxes of its
+neighbours, and ``--out_ownership`` gets the owned boxes per tile for the
+downstream stages and the duplicate reconstructions avoided.
+"""
 
 import argparse
-import json
 import os
+import sys
+import time
 from pathlib import Path
+from typing import Any, Dict, List, Tuple
 
 from pc_prep.logger import logger
 from pc_prep.tree_prep.metadata_handler import prepare_pc_paths
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.ledger import (  # noqa: E402
+    add_ledger_arguments,
+    file_signatures,
+    plan_with_ledger,
+)
+from gsm_common.plan_io import (  # noqa: E402
+    add_plan_arguments,
+    order_items,
+    write_plan,
+)
+from gsm_common.tile_index import (  # noqa: E402
+    list_tiles,
+    select_tiles,
+    tile_code,
+    tree_ownership,
+)
+from gsm_common.tree_ownership import (  # noqa: E402
+    HALO_KEY,
+    OWN_KEY,
+    OwnershipPlan,
+    add_ownership_arguments,
+)
+
+
+def _indexed_rel_paths(args: argparse.Namespace) -> List[str]:
+    """Relative paths of the tiles with trees, from the spatial join and listing."""
+    t0 = time.perf_counter()
+    codes = select_tiles(args.tree_df_path, args.pc_raw_metadata, args.tile_name_column)
+    t1 = time.perf_counter()
+    listed = list_tiles(args.pc_raw)
+    t2 = time.perf_counter()
+    missing = [c for c in codes if c not in listed]
+    if missing:
+        logger.warning(
+            "%d selected tiles not found under pc_raw (e.g. %s)",
+            len(missing),
+            missing[:5],
+        )
+    logger.info(
+        "Spatial join: %d tiles in %.1fs; listing: %d files in %.1fs",
+        len(codes),
+        t1 - t0,
+        len(listed),
+        t2 - t1,
+    )
+    return [listed[c] for c in codes if c in listed]
+
+
+def _owned_items(
+    args: argparse.Namespace, rels: List[str]
+) -> Tuple[List[Dict[str, Any]], OwnershipPlan]:
+    """Items of the selected tiles owning trees, with their owned and halo boxes."""
+    t0 = time.perf_counter()
+    selected: Dict[str, str] = {}
+    for rel in rels:
+        code = tile_code(rel)
+        if code is None:
+            raise ValueError(f"No tile code in selected tile {rel}")
+        selected[code] = rel
+    plan = tree_ownership(
+        args.tree_df_path,
+        args.pc_raw_metadata,
+        args.tile_name_column,
+        args.ownership_halo,
+        owners=selected,
+    )
+    if plan.unowned:
+        logger.warning(
+            "%d trees are within reach of no selected tile and are not planned",
+            plan.unowned,
+        )
+    # halo neighbours may be any tile under pc_raw, selected or not
+    listed = {**list_tiles(args.pc_raw), **selected}
+    items: List[Dict[str, Any]] = []
+    for code in sorted(plan.tiles):
+        own = plan.tiles[code]
+        items.append(
+            {
+                "rel_path": listed[code],
+                OWN_KEY: [list(b) for b in own.boxes],
+                HALO_KEY: {
+                    listed[k]: list(b)
+                    for k, b in sorted(own.halo.items())
+                    if k in listed
+                },
+            }
+        )
+    logger.info(
+        "Tree ownership in %.1fs: %s", time.perf_counter() - t0, plan.describe()
+    )
+    return items, plan
+
+
+def _compare_selection(args: argparse.Namespace, rels: List[str]) -> None:
+    """Log where the indexed selection differs from ``rels`` (pc_prep's)."""
+    try:
+        indexed = set(_indexed_rel_paths(args))
+    except Exception as ex:
+        logger.warning("Indexed tile selection failed: %s", ex)
+        return
+    package = set(rels)
+    missing, extra = sorted(package - indexed), sorted(indexed - package)
+    if not missing and not extra:
+        logger.info("Indexed tile selection matches all %d tiles.", len(package))
+        return
+    logger.warning(
+        "Indexed tile selection differs: %d of %d tiles missing (%s), %d extra (%s)",
+        len(missing),
+        len(package),
+        ", ".join(missing[:10]),
+        len(extra),
+        ", ".join(extra[:10]),
+    )
+
+
+def _package_rel_paths(args: argparse.Namespace) -> List[str]:
+    """Relative paths from pc_prep's prepare_pc_paths."""
+    pc_paths_abs = prepare_pc_paths(
+        tree_df_path=args.tree_df_path,
+        pc_metadata_df_path=args.pc_raw_metadata,
+        mounted_pc_path=args.pc_raw,
+    )
+    # pure path arithmetic: resolve() would stat every path component on the mount
+    root = os.path.abspath(args.pc_raw)
+    rels: List[str] = []
+    for p in pc_paths_abs:
+        rel = os.path.relpath(os.path.abspath(p), root)
+        if rel.startswith(os.pardir):
+            logger.warning("Skipping path not under pc_raw: %s", p)
+            continue
+        rels.append(rel)
+    return rels
+
 
 def main() -> None:
     """Main script."""
@@ -16,33 +168,85 @@ def main() -> None:
     ap.add_argument("--pc_raw_metadata", required=True)
     ap.add_argument("--pc_raw", required=True)
     ap.add_argument(
-        "--out_items_folder", required=True, help="Output folder for item JSON files"
+        "--out_items_folder", required=True, help="Output folder for plan items"
+    )
+    ap.add_argument(
+        "--tile_selection",
+        choices=("package", "index", "compare"),
+        default="package",
+        help="pc_prep's prepare_pc_paths, spatial join + bulk listing, or the "
+        "first with the differences of the second logged",
     )
+    ap.add_argument(
+        "--tile_name_column",
+        default=None,
+        help="Column of pc_raw_metadata with the tile names (detected when omitted)",
+    )
+    add_plan_arguments(ap)
+    add_ledger_arguments(ap, plan=True)
+    add_ownership_arguments(ap, plan=True)
     args = ap.parse_args()
 
-    out_dir = Path(args.out_items_folder)
-    out_dir.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    rels: List[str] | None = None
+    if args.tile_selection == "index":
+        try:
+            rels = _indexed_rel_paths(args)
+        except Exception as ex:
+            logger.warning("Indexed tile selection failed, using pc_prep's: %s", ex)
+    if rels is None:
+        rels = _package_rel_paths(args)
+    if args.tile_selection == "compare":
+        _compare_selection(args, rels)
+    ownership: OwnershipPlan | None = None
+    if args.tree_ownership:
+        # no fallback: the downstream stages would read a plan without owners
+        items, ownership = _owned_items(args, rels)
+    else:
+        items = [{"rel_path": rel} for rel in rels]
+    t_select = time.perf_counter() - t0
+    if args.out_ownership:
+        # written without ownership too, so the downstream input always exists
+        (ownership or OwnershipPlan(args.ownership_halo, {})).write(args.out_ownership)
 
-    pc_paths_abs = prepare_pc_paths(
-        tree_df_path=args.tree_df_path,
-        pc_metadata_df_path=args.pc_raw_metadata,
-        mounted_pc_path=args.pc_raw,
+    # raw tiles are identified by size/mtime from one listing per area folder;
+    # a tile with a halo also depends on its neighbours and its owned boxes
+    root = Path(args.pc_raw)
+    signatures = (
+        file_signatures(
+            str(root / rel)
+            for it in items
+            for rel in (it["rel_path"], *it.get(HALO_KEY, ()))
+        )
+        if args.ledger_dir
+        else {}
     )
 
-    root = Path(args.pc_raw).resolve()
-    written = 0
-    for i, p in enumerate(pc_paths_abs, start=1):
-        p_abs = Path(p).resolve()
-        try:
-            rel = os.path.relpath(p_abs, root)
-        except Exception as ex:
-            logger.warning("Skipping path not under pc_raw: %s (%s)", p_abs, ex)
-            continue
-        with (out_dir / f"{i:05d}.json").open("w", encoding="utf-8") as f:
-            json.dump({"rel_path": rel}, f)
-        written += 1
+    def _inputs_of(it: Dict[str, Any]) -> Any:
+        raw = signatures.get(str(root / it["rel_path"]), "")
+        if OWN_KEY not in it:
+            return raw
+        halo = [signatures.get(str(root / rel), "") for rel in it.get(HALO_KEY, ())]
+        return [raw, it[OWN_KEY], it.get(HALO_KEY), halo]
 
-    logger.info("Wrote %d item files to %s", written, out_dir)
+    items = plan_with_ledger(
+        items,
+        args,
+        stage="pc_prep",
+        package="pc_prep",
+        key_of=lambda it: it["rel_path"],
+        inputs_of=_inputs_of,
+    )
+    items = order_items(items, lambda it: it["rel_path"], args.item_order)
+    written = write_plan(items, args.out_items_folder, args.plan_format)
+    logger.info(
+        "Wrote %d items (%s) to %s", written, args.plan_format, args.out_items_folder
+    )
+    logger.info(
+        "Planning took %.1fs (tile selection %.1fs)",
+        time.perf_counter() - t0,
+        t_select,
+    )
 
 
 if __name__ == "__main__":
@@ -1,13 +1,53 @@
 """Component script for green_space_monitoring preprocessing.."""
 
-import multiprocessing
+import argparse
+import sys
+from pathlib import Path
 
 from pc_prep.logger import logger
 from pc_prep.tree_prep.prep_pc import main
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.resources import (  # noqa: E402
+    add_resource_arguments,
+    cap_threads,
+    plan_resources,
+)
+from gsm_common.warm_start import (  # noqa: E402
+    PRELOAD,
+    add_start_arguments,
+    start_context,
+    write_startup_report,
+)
+
 if __name__ == "__main__":
     try:
-        multiprocessing.set_start_method("spawn", force=True)
+        # our start and resource options are removed from argv before pc_prep
+        # parses it; --num_workers is read here and passed on
+        pre = argparse.ArgumentParser(add_help=False)
+        add_start_arguments(pre)
+        add_resource_arguments(pre, pinning=False)
+        start, sys.argv[1:] = pre.parse_known_args()
+        peek = argparse.ArgumentParser(add_help=False)
+        peek.add_argument("--num_workers", type=int, default=None)
+        requested = peek.parse_known_args()[0].num_workers
+        resources = plan_resources(
+            "pc_prep",
+            requested,
+            start.threads_per_worker,
+            start.memory_per_worker_gb,
+        )
+        logger.info("Resource plan %s", resources.describe())
+        cap_threads(resources.threads)
+        if requested != resources.processes:
+            sys.argv += ["--num_workers", str(resources.processes)]
+        preload = PRELOAD["pc_prep"] if start.preload is None else start.preload
+        start_context(start.start_method, preload)
+        if start.startup_report:
+            write_startup_report(
+                start.startup_report, start.start_method, preload, modules=preload
+            )
         main()
     except Exception as ex:
         logger.exception(f"{ex}")
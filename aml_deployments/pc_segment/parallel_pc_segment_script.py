@@ -1,14 +1,110 @@
-"""Script for parallel processing of pc_segment."""
+"""Script for parallel processing of pc_segment.
+
+With ``--prefetch_depth`` > 0 a mini-batch is split into chunks of
+``batch_size`` items that are pipelined: background threads copy the images and
+prompts of the next chunks from the img_dir mount to local scratch while SAM
+runs on the current chunk, and the masks are written to local scratch and
+uploaded to segment_dir in the background (at most ``--write_behind_depth``
+chunks pending). All uploads finish before run() returns, so the returned rows
+only reference masks that exist.
+
+With ``--stage_cache_dir`` images and prompts are read through a local disk
+cache instead: chunks are staged into it (ahead of use when pipelined) and
+images that are read again, e.g. by a retried mini-batch, are served locally.
+
+The predictor is wrapped so image embeddings are reused when the same image is
+set again (``--embedding_cache_size``). With ``--max_batch_size`` the SAM batch
+size adapts to the free GPU memory and the measured memory per pixel, and a
+batch that runs out of memory is retried at half the size.
+
+With ``--skip_empty_prompts`` images whose prompt file holds no prompts are
+not segmented (a ``skip`` row is returned for them), and with
+``--prompt_windows`` a raster larger than the encoder input whose prompts fit
+one window of that size is encoded on that window, at native resolution,
+instead of downscaled (gsm_common.prompt_windows).
+
+With ``--sam_server`` the workers of a node share one model in a server process
+that batches the images of all workers (gsm_common.sam_server), so the step can
+run several workers per node; the GPU batch size and embedding reuse are then
+handled by the server.
+"""
 
 import argparse
 import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
 from pc_segment.logger import logger
 from pc_segment.segment_pc import initialize_model, segment_batch_items
 
-_G: Dict[str, Any] = {"args": None, "predictor": None}
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.embedding_cache import (  # noqa: E402
+    AdaptiveBatchSize,
+    CachingPredictor,
+    image_pixels,
+    is_oom_error,
+)
+from gsm_common.ledger import (  # noqa: E402
+    CompletionLedger,
+    add_ledger_arguments,
+    ledger_version,
+)
+from gsm_common.pipelining import (  # noqa: E402
+    PhaseTimer,
+    WriteBehind,
+    iter_prefetched,
+    publish_tree,
+    rebase_paths,
+    stage_files,
+)
+from gsm_common.plan_io import iter_plan_items  # noqa: E402
+from gsm_common.prompt_windows import (  # noqa: E402
+    Prompts,
+    WindowedPredictor,
+    add_window_arguments,
+    read_prompts,
+)
+from gsm_common.sam_server import (  # noqa: E402
+    RemotePredictor,
+    add_server_arguments,
+    connect_or_start,
+)
+from gsm_common.staging_cache import (  # noqa: E402
+    StagingCache,
+    add_staging_arguments,
+    open_staging_cache,
+)
+from gsm_common.telemetry import (  # noqa: E402
+    ItemTelemetry,
+    split_record,
+    with_telemetry,
+)
+
+_G: Dict[str, Any] = {
+    "args": None,
+    "predictor": None,
+    "windows": None,
+    "prompts": {},
+    "ledger": None,
+    "io_pool": None,
+    "writer": None,
+    "scratch": None,
+    "timer": None,
+    "sizer": None,
+    "stats": None,
+    "stage": None,
+}
+
+_STATS_KEY = "_segment_stats"
+
+Chunk = Tuple[int, List[str], List[Dict[str, str]]]
 
 
 def _parse_args() -> argparse.Namespace:
@@ -18,6 +114,31 @@ def _parse_args() -> argparse.Namespace:
     p.add_argument("--segment_dir", type=str, required=True)
     p.add_argument("--batch_size", type=int, default=2)
     p.add_argument("--debug", action="store_true")
+    p.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=0,
+        help="Chunks of batch_size items to read ahead; 0 disables pipelining",
+    )
+    p.add_argument("--write_behind_depth", type=int, default=2)
+    p.add_argument("--io_threads", type=int, default=4)
+    p.add_argument("--scratch_dir", type=str, default=None)
+    p.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=None,
+        help="Adapt the SAM batch size up to this value; fixed batch_size when omitted",
+    )
+    p.add_argument(
+        "--embedding_cache_size",
+        type=int,
+        default=4,
+        help="Image embeddings kept for reuse; 0 disables the cache",
+    )
+    add_staging_arguments(p)
+    add_ledger_arguments(p)
+    add_window_arguments(p)
+    add_server_arguments(p)
     args, _ = p.parse_known_args()
     return args
 
@@ -26,7 +147,42 @@ def init() -> None:
     """Init script."""
     _G["args"] = _parse_args()
     Path(_G["args"].segment_dir).mkdir(parents=True, exist_ok=True)
-    _G["predictor"] = initialize_model(model_path=_G["args"].model_mount)
+    if _G["args"].sam_server:
+        # the server keeps the embeddings; a local cache would not restore them
+        _G["predictor"] = connect_or_start(_G["args"], _G["args"].model_mount)
+    else:
+        _G["predictor"] = CachingPredictor(
+            initialize_model(model_path=_G["args"].model_mount),
+            _G["args"].embedding_cache_size,
+        )
+    if _G["args"].prompt_windows:
+        # windows are encoded through the cache, so revisited windows are reused
+        _G["windows"] = WindowedPredictor(
+            _G["predictor"],
+            _G["args"].prompt_window_size,
+            _G["args"].prompt_window_margin,
+        )
+    if _G["args"].max_batch_size and not _G["args"].sam_server:
+        _G["sizer"] = AdaptiveBatchSize(
+            _G["args"].batch_size, _G["args"].max_batch_size, _free_gpu_memory
+        )
+    if _G["args"].ledger_dir:
+        _G["ledger"] = CompletionLedger(
+            _G["args"].ledger_dir,
+            "pc_segment",
+            ledger_version(_G["args"], "pc_segment"),
+        )
+    _G["timer"] = PhaseTimer()
+    _G["stage"] = open_staging_cache(_G["args"])
+    _G["stats"] = {"images": 0, "seconds": 0.0, "oom_retries": 0, "no_prompts": 0}
+    if _G["args"].prefetch_depth > 0:
+        _G["io_pool"] = ThreadPoolExecutor(
+            max_workers=max(1, _G["args"].io_threads), thread_name_prefix="prefetch"
+        )
+        _G["writer"] = WriteBehind(_G["args"].write_behind_depth, _G["args"].io_threads)
+        _G["scratch"] = tempfile.mkdtemp(
+            prefix="pc_segment_", dir=_G["args"].scratch_dir
+        )
     logger.info(
         "init(): model=%s | img_dir=%s | segment_dir=%s | batch_size=%s",
         _G["args"].model_mount,
@@ -36,27 +192,26 @@ def init() -> None:
     )
 
 
-def _read_items(mini_batch: List[Any]) -> Tuple[List[str], List[Dict[str, str]]]:
+def _read_items(
+    mini_batch: List[Any],
+) -> Tuple[List[str], List[Dict[str, str]], Dict[str, str], List[str]]:
     """Function to read items.
 
-    Each item is usually a JSON file path created by the planner.
+    Each item is a JSON file path or a manifest row created by the planner.
       {"key":"<pc_path-like key>", "img_rel":"<rel to img_dir>", "prompt_rel":"<optional rel>"}
-    Returns (keys, preprocessing_list) where each prep dict matches what your code expects:
+    Returns (keys, preprocessing_list, fingerprints, no_prompts) where each prep dict matches what your code expects:
       {"img_path": "...", "prompt_path": "...?"}
+    fingerprints maps keys to their ledger fingerprint (when planned with a ledger)
+    and no_prompts lists the keys left out because their prompt file is empty.
+    The prompts of the items are kept in _G["prompts"] for the prompt windows.
     """
+    args = _G["args"]
     keys: List[str] = []
     preps: List[Dict[str, str]] = []
-    for it in mini_batch:
-        if isinstance(it, dict):
-            data = it
-        else:
-            p = Path(str(it))
-            try:
-                data = json.loads(p.read_text(encoding="utf-8"))
-            except Exception as ex:
-                logger.warning("Unreadable item %s: %s", it, ex)
-                continue
-
+    fingerprints: Dict[str, str] = {}
+    no_prompts: List[str] = []
+    _G["prompts"] = {}
+    for data in iter_plan_items(mini_batch):
         key = data.get("key")
         img_rel = data.get("img_rel")
         prompt_rel = data.get("prompt_rel")
@@ -67,39 +222,230 @@ def _read_items(mini_batch: List[Any]) -> Tuple[List[str], List[Dict[str, str]]]
         prep = {"img_path": img_rel}
         if prompt_rel:
             prep["prompt_path"] = prompt_rel
+            if args.skip_empty_prompts or args.prompt_windows:
+                prompts = read_prompts(os.path.join(args.img_dir_mount, prompt_rel))
+                if prompts is not None and not prompts and args.skip_empty_prompts:
+                    no_prompts.append(key)
+                    continue
+                if prompts is not None:
+                    _G["prompts"][key] = prompts
         keys.append(key)
         preps.append(prep)
-    return keys, preps
+        if data.get("fingerprint"):
+            fingerprints[key] = data["fingerprint"]
+    return keys, preps, fingerprints, no_prompts
+
+
+def _cuda() -> Any:
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch.cuda if torch.cuda.is_available() else None
+
+
+def _free_gpu_memory() -> int | None:
+    cuda = _cuda()
+    return int(cuda.mem_get_info()[0]) if cuda is not None else None
+
+
+def _largest_image(preps: List[Dict[str, str]], img_dir: str) -> int:
+    """Pixel count of the largest image of a batch (0 if no header is readable)."""
+    sizes = [image_pixels(os.path.join(img_dir, prep["img_path"])) for prep in preps]
+    return max((s for s in sizes if s), default=0)
+
+
+def _segment(
+    keys: List[str], preps: List[Dict[str, str]], img_dir: str, segment_dir: str
+) -> Dict[str, Any]:
+    """Run segment_batch_items, retrying at a smaller batch size on GPU OOM."""
+    sizer: AdaptiveBatchSize | None = _G["sizer"]
+    predictor: CachingPredictor = _G["predictor"]
+    windows: WindowedPredictor | None = _G["windows"]
+    if windows is not None:
+        prompts: Dict[str, Prompts] = _G["prompts"]
+        windows.register([prompts[k] for k in keys if k in prompts])
+    # size the batch from the images about to be segmented, not the last one
+    pixels = _largest_image(preps, img_dir) if sizer else 0
+    batch = sizer.suggest(pixels) if sizer else _G["args"].batch_size
+    # GPU memory is measured (for the sizer) only when the model is in-process
+    cuda = _cuda() if sizer is not None else None
+    while True:
+        if cuda is not None:
+            baseline = cuda.memory_allocated()
+            cuda.reset_peak_memory_stats()
+        try:
+            mapping: Dict[str, Any] = segment_batch_items(
+                keys=keys,
+                preprocessing_list=preps,
+                img_dir=img_dir,
+                segment_dir=segment_dir,
+                predictor=windows if windows is not None else predictor,
+                debug=_G["args"].debug,
+                batch_size=batch,
+            )
+        except Exception as ex:
+            if sizer is None or not is_oom_error(ex) or batch <= 1:
+                raise
+            if cuda is not None:
+                cuda.empty_cache()
+            smaller = sizer.backoff(batch)
+            logger.warning(
+                "Out of memory at batch_size=%s, retrying at %s", batch, smaller
+            )
+            _G["stats"]["oom_retries"] += 1
+            batch = smaller
+            continue
+        if sizer is not None:
+            peak = cuda.max_memory_allocated() - baseline if cuda is not None else None
+            sizer.observe(batch, pixels or predictor.pixels, peak)
+        return mapping
+
+
+def _input_rels(preps: List[Dict[str, str]]) -> List[str]:
+    return [v for prep in preps for v in prep.values()]
+
+
+def _stage_chunk(chunk: Chunk) -> str:
+    """Copy the images and prompts of a chunk to local scratch or the cache."""
+    idx, _, preps = chunk
+    cache: StagingCache | None = _G["stage"]
+    if cache is not None:
+        return cache.stage(_G["args"].img_dir_mount, _input_rels(preps))
+    local_in = os.path.join(_G["scratch"], f"in{idx}")
+    stage_files(_G["args"].img_dir_mount, _input_rels(preps), local_in)
+    return local_in
+
+
+def _unstage_chunk(local_in: str, preps: List[Dict[str, str]]) -> None:
+    cache: StagingCache | None = _G["stage"]
+    if cache is not None:
+        cache.release(_G["args"].img_dir_mount, _input_rels(preps))
+    else:
+        shutil.rmtree(local_in, ignore_errors=True)
+
+
+def _run_pipelined(keys: List[str], preps: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Segment chunk by chunk, overlapping reads and mask uploads with SAM."""
+    args, timer = _G["args"], _G["timer"]
+    size = max(1, _G["sizer"].size if _G["sizer"] else args.batch_size)
+    chunks: List[Chunk] = [
+        (i, keys[i : i + size], preps[i : i + size]) for i in range(0, len(keys), size)
+    ]
+    mapping: Dict[str, Any] = {}
+    for (idx, chunk_keys, chunk_preps), staged in iter_prefetched(
+        chunks, _stage_chunk, args.prefetch_depth, _G["io_pool"]
+    ):
+        with timer.phase("read_wait"):
+            local_in = staged.result()
+        local_out = os.path.join(_G["scratch"], f"out{idx}")
+        os.makedirs(local_out, exist_ok=True)
+        try:
+            with timer.phase("segment"):
+                result = _segment(chunk_keys, chunk_preps, local_in, local_out)
+        finally:
+            _unstage_chunk(local_in, chunk_preps)
+        # outputs are recorded relative to segment_dir; rebase any absolute ones
+        mapping.update(rebase_paths(result, local_out, args.segment_dir))
+        with timer.phase("write_wait"):
+            _G["writer"].submit(publish_tree, local_out, args.segment_dir)
+    with timer.phase("write_wait"):
+        _G["writer"].drain()
+    return mapping
+
+
+def _run_direct(keys: List[str], preps: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Segment the whole mini-batch, reading inputs from the mount or the cache."""
+    img_dir = _G["args"].img_dir_mount
+    cache: StagingCache | None = _G["stage"]
+    if cache is not None:
+        with _G["timer"].phase("read_wait"):
+            img_dir = cache.stage(img_dir, _input_rels(preps))
+    try:
+        with _G["timer"].phase("segment"):
+            return _segment(keys, preps, img_dir, _G["args"].segment_dir)
+    finally:
+        if cache is not None:
+            cache.release(_G["args"].img_dir_mount, _input_rels(preps))
 
 
 def run(mini_batch: List[Any]) -> List[str]:
     """Run script."""
     # Build inputs for batched function
-    keys, preps = _read_items(mini_batch)
+    keys, preps, fingerprints, no_prompts = _read_items(mini_batch)
+    skipped = [
+        json.dumps({"skip": {"key": k, "reason": "no prompts"}}) for k in no_prompts
+    ]
+    _G["stats"]["no_prompts"] += len(no_prompts)
     if not keys:
         # Always return at least one line so AML marks the mini-batch as non-empty
-        return [json.dumps({"skip": {"reason": "empty mini-batch"}})]
-
-    mapping = segment_batch_items(
-        keys=keys,
-        preprocessing_list=preps,
-        img_dir=_G["args"].img_dir_mount,
-        segment_dir=_G["args"].segment_dir,
-        predictor=_G["predictor"],
-        debug=_G["args"].debug,
-        batch_size=_G["args"].batch_size,
-    )
+        return skipped or [json.dumps({"skip": {"reason": "empty mini-batch"}})]
+    t0 = time.perf_counter()
+
+    # SAM runs on the whole mini-batch, so its telemetry is spread over the items
+    with ItemTelemetry("pc_segment", keys[0]) as batch_rec:
+        if _G["args"].prefetch_depth > 0:
+            mapping = _run_pipelined(keys, preps)
+            logger.info("Phase times so far: %s", _G["timer"].describe())
+        else:
+            mapping = _run_direct(keys, preps)
 
     # Emit one JSON line per *input key* (success or skip if not produced)
-    lines: List[str] = []
-    for k in keys:
+    lines: List[str] = skipped
+    for k, rec in zip(keys, split_record(batch_rec, keys)):
         if k in mapping:
-            lines.append(json.dumps({k: mapping[k]}))
+            lines.append(json.dumps(with_telemetry({k: mapping[k]}, rec)))
+            if _G["ledger"] is not None and k in fingerprints:
+                _G["ledger"].record(fingerprints[k], k, {k: mapping[k]})
         else:
-            lines.append(json.dumps({"skip": {"key": k}}))
+            rec["ok"] = False
+            lines.append(json.dumps(with_telemetry({"skip": {"key": k}}, rec)))
+    lines.append(
+        json.dumps({_STATS_KEY: _run_stats(len(keys), time.perf_counter() - t0)})
+    )
     return lines  # JSON strings → proper JSONL
 
 
+def _run_stats(images: int, seconds: float) -> Dict[str, Any]:
+    """Throughput and embedding reuse of this mini-batch and of the process so far."""
+    stats = _G["stats"]
+    stats["images"] += images
+    stats["seconds"] += seconds
+    predictor: CachingPredictor | RemotePredictor = _G["predictor"]
+    out = {
+        "images": images,
+        "images_per_sec": round(images / seconds, 3) if seconds > 0 else None,
+        "total_images_per_sec": (
+            round(stats["images"] / stats["seconds"], 3) if stats["seconds"] else None
+        ),
+        "embeddings_computed": predictor.misses,
+        "embeddings_reused": predictor.hits,
+        "oom_retries": stats["oom_retries"],
+        "skipped_no_prompts": stats["no_prompts"],
+    }
+    if _G["windows"] is not None:
+        out["prompt_windows"] = _G["windows"].describe()
+    if _G["sizer"] is not None:
+        out.update(_G["sizer"].describe())
+    if _G["stage"] is not None:
+        out["staging"] = _G["stage"].stats()
+    if isinstance(predictor, RemotePredictor):
+        out["sam_server"] = predictor.describe()
+    logger.info("Segment stats: %s", out)
+    return out
+
+
 def shutdown() -> None:
     """Shutdown script."""
+    if _G["writer"] is not None:
+        _G["writer"].close()
+        _G["io_pool"].shutdown(wait=True)
+        shutil.rmtree(_G["scratch"], ignore_errors=True)
+    if _G["timer"] is not None:
+        logger.info("Phase times: %s", _G["timer"].describe())
+    if _G["stage"] is not None:
+        logger.info("Staging cache: %s", _G["stage"].describe())
+        _G["stage"].close()
+    if isinstance(_G["predictor"], RemotePredictor):
+        _G["predictor"].close()
     logger.info("shutdown()")
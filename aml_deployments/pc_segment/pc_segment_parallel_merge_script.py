@@ -1,35 +1,58 @@
 """Script for merging of parallel pc_segment results."""
 
 import argparse
-import json
+import sys
 from pathlib import Path
-from typing import Dict
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.streaming_merge import (  # noqa: E402
+    MergeOutput,
+    add_merge_arguments,
+    describe_run,
+    merge_partials,
+    select_entries,
+    with_carried_over,
+)
+from gsm_common.telemetry import TelemetrySummary  # noqa: E402
 
 
 def main() -> None:
     """Main script."""
     ap = argparse.ArgumentParser()
     ap.add_argument("--partial", required=True)
+    ap.add_argument(
+        "--carried_over",
+        default=None,
+        help="JSONL of items completed in an earlier run (from the plan step)",
+    )
     ap.add_argument("--segment_metadata", required=True)
+    ap.add_argument("--segment_metadata_index", default=None)
+    add_merge_arguments(ap)
     args = ap.parse_args()
 
-    out: Dict[str, str] = {}
-    partial_path = Path(args.partial)
-
-    with partial_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            s = line.strip()
-            if not s:
-                continue
-            try:
-                row = json.loads(s)
-            except json.JSONDecodeError:
-                continue
-            out.update(row)
-
-    Path(args.segment_metadata).parent.mkdir(parents=True, exist_ok=True)
-    Path(args.segment_metadata).write_text(json.dumps(out, indent=4), encoding="utf-8")
-    print(f"Merged {len(out)} entries -> {args.segment_metadata}")  # noqa: T201
+    out = MergeOutput(
+        path=args.segment_metadata,
+        select=select_entries,
+        fmt=args.format,
+        indent=args.indent,
+        index_path=args.segment_metadata_index,
+    )
+    telemetry = TelemetrySummary()
+    stats, source_stats = merge_partials(
+        with_carried_over([args.partial], args.carried_over),
+        {"segment": out},
+        args.on_duplicate,
+        observers=[telemetry.add_row],
+    )
+    print(  # noqa: T201
+        f"Merged {stats['segment'].written} entries -> {args.segment_metadata}"
+    )
+    print(describe_run(source_stats, stats))  # noqa: T201
+    for line in telemetry.describe():
+        print(line)  # noqa: T201
+    if args.telemetry_summary:
+        telemetry.write(args.telemetry_summary)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,49 @@
-"""Script for planning files for parallel processing of pc_segment."""
+"""Script for planning files for parallel processing of pc_segment.
+
+With ``--skip_empty_prompts`` and ``--img_dir`` the prompt files are read and
+images without prompts are left out of the plan, so they never reach the GPU.
+With ``--ledger_dir`` and ``--img_dir`` the item fingerprints include the
+size/mtime of the image and prompt files, so images that pc_prep rewrote are
+segmented again.
+"""
 
 import argparse
-import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.ledger import (  # noqa: E402
+    add_ledger_arguments,
+    plan_with_ledger,
+    record_signatures,
+)
+from gsm_common.metadata_store import open_metadata  # noqa: E402
+from gsm_common.plan_io import (  # noqa: E402
+    add_plan_arguments,
+    order_items,
+    write_plan,
+)
+from gsm_common.prompt_windows import add_window_arguments, read_prompts  # noqa: E402
+
+# prompt files are small; reading them is dominated by mount latency
+_READ_THREADS = 32
+
+
+def _has_prompts(img_dir: str, items: List[Dict[str, Any]]) -> List[bool]:
+    """Whether each item may have prompts (unreadable or unknown files count)."""
+
+    def _check(it: Dict[str, Any]) -> bool:
+        if not it.get("prompt_rel"):
+            return True
+        prompts = read_prompts(os.path.join(img_dir, it["prompt_rel"]))
+        return prompts is None or len(prompts) > 0
+
+    with ThreadPoolExecutor(max_workers=_READ_THREADS) as ex:
+        return list(ex.map(_check, items))
 
 
 def main() -> None:
@@ -10,25 +51,58 @@ def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--img_metadata", required=True)
     ap.add_argument("--out_items_folder", required=True)
+    ap.add_argument(
+        "--img_dir",
+        default=None,
+        help="Image folder, to read the prompt files and fingerprint items",
+    )
+    add_window_arguments(ap, windows=False)
+    add_plan_arguments(ap)
+    add_ledger_arguments(ap, plan=True)
     args = ap.parse_args()
 
-    out_dir = Path(args.out_items_folder)
-    out_dir.mkdir(parents=True, exist_ok=True)
-
     # img_metadata is a JSON dict like: { "<tile_key>": {"img_path": "...", "prompt_path": "..."} }
-    meta = json.loads(Path(args.img_metadata).read_text(encoding="utf-8"))
-    written = 0
-    for i, (key, rec) in enumerate(meta.items(), start=1):
+    meta = open_metadata(args.img_metadata)
+    items: List[Dict[str, Any]] = []
+    for key, rec in meta.items():
         rel = rec.get("img_path")
         if not rel:
             # skip entries with no image
             continue
         # store as RELATIVE path (relative to img_dir)
-        item = {"key": key, "img_rel": rel, "prompt_rel": rec.get("prompt_path")}
-        (out_dir / f"{i:05d}.json").write_text(json.dumps(item), encoding="utf-8")
-        written += 1
+        items.append({"key": key, "img_rel": rel, "prompt_rel": rec.get("prompt_path")})
+
+    if args.skip_empty_prompts and args.img_dir:
+        keep = _has_prompts(args.img_dir, items)
+        before = len(items)
+        items = [it for it, k in zip(items, keep) if k]
+        print(f"Left out {before - len(items)} images without prompts")  # noqa: T201
+
+    signatures = (
+        record_signatures(
+            {
+                it["key"]: [(args.img_dir, [it["img_rel"], it.get("prompt_rel")])]
+                for it in items
+            }
+        )
+        if args.ledger_dir and args.img_dir
+        else {}
+    )
+
+    def _inputs_of(it: Dict[str, Any]) -> List[Any]:
+        return [it["img_rel"], it.get("prompt_rel"), signatures.get(it["key"])]
 
-    print(f"Wrote {written} segment items to {out_dir}")  # noqa: T201
+    items = plan_with_ledger(
+        items,
+        args,
+        stage="pc_segment",
+        package="pc_segment",
+        key_of=lambda it: it["key"],
+        inputs_of=_inputs_of,
+    )
+    items = order_items(items, lambda it: it["key"], args.item_order)
+    written = write_plan(items, args.out_items_folder, args.plan_format)
+    print(f"Wrote {written} segment items to {args.out_items_folder}")  # noqa: T201
 
 
 if __name__ == "__main__":
@@ -0,0 +1,556 @@
+"""Streaming run of pc_prep -> pc_segment -> pc_ops -> tree_modeling.
+
+The staged pipeline waits for every tile of a stage (and its merge) before the
+next stage starts. Here all stages run at once: a tile is handed to the next
+stage as soon as its previous stage finished it, so the run takes about as long
+as its slowest stage instead of the sum of all stages.
+
+The stages exchange work through a queue (:mod:`gsm_common.work_queue`; an
+SQLite file, or a folder on a shared mount). Three roles use it:
+
+- ``driver`` puts the items of the pc_prep plan on the queue, turns the rows of
+  every finished mini-batch into the items of the next stage (carrying the
+  metadata records they need), and appends the rows to a partial per stage.
+  When all items are done it closes the queue. The usual merge steps then turn
+  the partials into the stage metadata.
+- ``worker`` runs the entry script of one stage (``init()``, ``run()`` per
+  mini-batch of claimed items, ``shutdown()``) in ``--workers`` processes. A
+  worker only claims work while the next stage has fewer than
+  ``--max_pending`` items waiting (back-pressure), so a fast stage cannot fill
+  the disk with intermediates that a slow stage has not consumed yet. A failed
+  mini-batch is retried up to ``--max_attempts`` times.
+- ``local`` runs the driver and the workers of every stage on this machine.
+
+On AML, submit the driver and one ``worker`` command job per stage (each with
+the environment and compute of that stage) with the same ``--queue`` folder on a
+``rw_mount`` datastore path. Use the directory queue there: SQLite locking is
+not reliable on blobfuse mounts.
+
+Items created by the driver carry no ledger fingerprint, so only pc_prep items
+skip completed work on a resumed run.
+
+Example::
+
+    python streaming/stream_runner.py local --prep_items prep_items \\
+        --partials_dir partials --queue queue.sqlite \\
+        --workers pc_prep=4 pc_segment=1 pc_ops=4 tree_modeling=4 \\
+        --pc_prep_args "--pc_raw ... --img_dir img --pc_dir pc --bgt_dir bgt ..." \\
+        --pc_segment_args "--model_mount ... --img_dir_mount img ..." \\
+        --pc_ops_args "--segment_dir seg --img_dir img --pc_dir pc --ops_dir ops" \\
+        --tree_modeling_args "--ops_dir_mount ops --bgt_dir_mount bgt ..."
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Set, TextIO, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.plan_io import read_plan  # noqa: E402
+from gsm_common.resources import cap_threads, plan_resources  # noqa: E402
+from gsm_common.streaming_merge import (  # noqa: E402
+    SourceStats,
+    iter_partial_rows,
+    select_entries,
+)
+from gsm_common.warm_start import PRELOAD, START_METHODS, start_context  # noqa: E402
+from gsm_common.work_queue import WorkQueue, open_queue, worker_id  # noqa: E402
+from gsm_common.work_units import WORK_UNITS, split_units, unit_key  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[1]
+STAGES = ("pc_prep", "pc_segment", "pc_ops", "tree_modeling")
+ENTRY_SCRIPTS = {
+    "pc_prep": "pc_prep/parallel_pc_prep_script.py",
+    "pc_segment": "pc_segment/parallel_pc_segment_script.py",
+    "pc_ops": "pc_ops/parallel_pc_ops_script.py",
+    "tree_modeling": "tree_modeling/parallel_tree_modeling_script.py",
+}
+NEXT_STAGE = dict(zip(STAGES, STAGES[1:]))
+# partial of each stage, relative to --partials_dir in local mode; pc_ops rows
+# go to a folder, the partials_dir the pc_ops merge step reads
+PARTIALS = {
+    "pc_prep": "pc_prep.jsonl",
+    "pc_segment": "pc_segment.jsonl",
+    "pc_ops": "pc_ops/ops_metadata.stream.jsonl",
+    "tree_modeling": "tree_modeling.jsonl",
+}
+
+
+# ------------------------------------------------------------------- worker
+
+
+def _as_row(row: Any) -> Dict[str, Any]:
+    # entry scripts return dicts or JSON lines
+    value = json.loads(row) if isinstance(row, str) else row
+    return value if isinstance(value, dict) else {"skip": {"row": str(row)}}
+
+
+def work(
+    queue_path: str,
+    stage: str,
+    program_args: List[str],
+    mini_batch_size: int,
+    max_pending: int,
+    max_attempts: int,
+    poll_s: float,
+    threads: int = 1,
+) -> None:
+    """Run the entry script of ``stage`` on queued items until the queue closes."""
+    # before the entry script imports the stage package
+    cap_threads(threads)
+    entry_script = str(ROOT / ENTRY_SCRIPTS[stage])
+    sys.argv = [entry_script, *program_args]
+    queue = open_queue(queue_path)
+    me = worker_id()
+    entry = runpy.run_path(entry_script, run_name="__stream_entry__")
+    entry["init"]()
+    downstream = NEXT_STAGE.get(stage)
+    try:
+        while True:
+            if downstream and queue.backlog(downstream) >= max_pending:
+                claimed = []
+            else:
+                claimed = queue.claim(stage, me, mini_batch_size)
+            if not claimed:
+                if queue.is_closed():
+                    break
+                time.sleep(poll_s)
+                continue
+            keys = [key for key, _ in claimed]
+            try:
+                rows = entry["run"]([item for _, item in claimed])
+            except Exception as ex:
+                traceback.print_exc()
+                queue.fail(stage, me, keys, repr(ex), max_attempts)
+                continue
+            queue.complete(stage, me, keys, [_as_row(r) for r in rows])
+    finally:
+        entry["shutdown"]()
+
+
+def _context(method: str, stages: Sequence[str]) -> Any:
+    # one fork server serves every stage started from this process
+    preload = [m for stage in stages for m in PRELOAD.get(stage, ())]
+    return start_context(method, preload, set_default=False)
+
+
+def _start_workers(
+    ctx: Any,
+    args: argparse.Namespace,
+    stage: str,
+    count: int,
+    program_args: List[str],
+    batch: int,
+) -> List[Any]:
+    procs = [
+        ctx.Process(
+            target=work,
+            args=(
+                args.queue,
+                stage,
+                program_args,
+                batch,
+                args.max_pending,
+                args.max_attempts,
+                args.poll_s,
+                args.threads,
+            ),
+            name=f"{stage}-{i}",
+        )
+        for i in range(count)
+    ]
+    for p in procs:
+        p.start()
+    return procs
+
+
+# ------------------------------------------------------------------- driver
+
+
+class Driver:
+    """Feed the plan, hand finished tiles on to the next stage, write the partials."""
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        partials: Dict[str, str],
+        work_unit: str = "tile",
+        trees_per_unit: int = 1,
+    ) -> None:
+        """Append the rows of each stage to ``partials[stage]``."""
+        self.queue = queue
+        self.work_unit = work_unit
+        self.trees_per_unit = trees_per_unit
+        # pc_path -> pc/img/bgt records of pc_prep, until tree_modeling needs bgt
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.files: Dict[str, TextIO] = {}
+        for stage, path in partials.items():
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.files[stage] = open(path, "a", encoding="utf-8")  # noqa: SIM115
+        self.started = time.time()
+        self.spans: Dict[str, List[float]] = {}
+
+    def feed(self, items: Sequence[Dict[str, Any]]) -> int:
+        """Queue the pc_prep plan items."""
+        return self.queue.put(
+            "pc_prep", [(str(it.get("rel_path", json.dumps(it))), it) for it in items]
+        )
+
+    def replay(self, stage: str, rows: Sequence[Dict[str, Any]]) -> int:
+        """Hand on the rows of items completed in an earlier run (not written again)."""
+        items = [i for row in rows for i in self._next_items(stage, row)]
+        return self.queue.put(NEXT_STAGE[stage], items) if items else 0
+
+    def step(self) -> int:
+        """Handle the finished mini-batches; returns the number of rows."""
+        n = 0
+        for stage, rows in self.queue.results():
+            now = time.time()
+            span = self.spans.setdefault(stage, [now, now])
+            span[1] = now
+            out = self.files.get(stage)
+            items: List[Tuple[str, Dict[str, Any]]] = []
+            for row in rows:
+                if out is not None:
+                    out.write(json.dumps(row) + "\n")
+                items += self._next_items(stage, row)
+            if out is not None:
+                out.flush()
+            if items:
+                self.queue.put(NEXT_STAGE[stage], items)
+            n += len(rows)
+        return n
+
+    def _next_items(
+        self, stage: str, row: Dict[str, Any]
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        if stage == "pc_prep":
+            for section in ("pc", "img", "bgt"):
+                values = row.get(section)
+                if isinstance(values, dict):
+                    for key, value in values.items():
+                        self.records.setdefault(key, {})[section] = value
+            img = row.get("img")
+            if not isinstance(img, dict):
+                return []
+            return [
+                (key, _segment_item(key, rec))
+                for key, rec in img.items()
+                if isinstance(rec, dict) and rec.get("img_path")
+            ]
+        if stage == "pc_segment":
+            return [
+                (
+                    key,
+                    {
+                        "pc_path": key,
+                        "segment": value,
+                        "img": self.records.get(key, {}).get("img"),
+                        "pc": self.records.get(key, {}).get("pc"),
+                    },
+                )
+                for key, value in select_entries(row)
+            ]
+        if stage == "pc_ops":
+            out: List[Tuple[str, Dict[str, Any]]] = []
+            for key, value in select_entries(row):
+                bgt = self.records.pop(key, {}).get("bgt")
+                item = {"pc_path": key, "ops_files": value, "bgt_path": bgt}
+                if self.work_unit == "tile":
+                    out.append((key, item))
+                    continue
+                units = len(split_units(value, self.trees_per_unit))
+                out += [
+                    (
+                        unit_key(key, i),
+                        {
+                            **item,
+                            "unit": i,
+                            "units": units,
+                            "trees_per_unit": self.trees_per_unit,
+                        },
+                    )
+                    for i in range(units)
+                ]
+            return out
+        return []
+
+    def idle(self) -> bool:
+        """Whether no stage has work queued or running."""
+        return all(self.queue.backlog(s) == 0 for s in STAGES)
+
+    def close(self) -> None:
+        """Close the queue and the partials."""
+        self.queue.close()
+        for f in self.files.values():
+            f.close()
+
+    def describe(self) -> List[str]:
+        """Item counts and the time span in which each stage finished items."""
+        wall = time.time() - self.started
+        counts = self.queue.counts()
+        lines = [f"Streaming run: {wall:.1f}s wall"]
+        for stage in STAGES:
+            c = counts.get(stage, {})
+            first, last = self.spans.get(stage, [self.started, self.started])
+            lines.append(
+                f"  {stage:<14} {c.get('done', 0)} done, {c.get('failed', 0)} failed | "
+                f"finished items from {first - self.started:.1f}s "
+                f"to {last - self.started:.1f}s"
+            )
+        return lines
+
+
+def _segment_item(key: str, rec: Dict[str, Any]) -> Dict[str, Any]:
+    """pc_segment item of a tile, as the pc_segment plan step writes it."""
+    item = {"key": key, "img_rel": rec["img_path"]}
+    if rec.get("prompt_path"):
+        item["prompt_rel"] = rec["prompt_path"]
+    return item
+
+
+def drive(
+    driver: Driver,
+    poll_s: float,
+    lease_s: float | None,
+    workers: Dict[str, List[Any]] | None = None,
+) -> None:
+    """Run ``driver`` until every queued item is done or failed.
+
+    With local ``workers``, the claims of a worker process that died are put
+    back on the queue; the run stops if every worker of a stage with pending
+    work is gone.
+    """
+    lost: Set[int] = set()
+    while True:
+        moved = driver.step()
+        if lease_s:
+            driver.queue.requeue(older_than_s=lease_s)
+        for stage, procs in (workers or {}).items():
+            for p in procs:
+                if p.exitcode and p.pid not in lost:
+                    lost.add(p.pid)
+                    n = driver.queue.requeue(worker=worker_id(p.pid))
+                    print(  # noqa: T201
+                        f"Worker {p.name} exited with {p.exitcode}; requeued {n} items"
+                    )
+            if driver.queue.backlog(stage) and not any(p.is_alive() for p in procs):
+                driver.close()
+                sys.exit(f"No {stage} worker left with items pending")
+        # a worker stores its rows before its claims are released, so an idle
+        # queue after one more step means every row was handed on
+        if not moved and driver.idle() and not driver.step():
+            break
+        if not moved:
+            time.sleep(poll_s)
+    driver.close()
+
+
+# ---------------------------------------------------------------------- CLI
+
+
+def _per_stage(values: Sequence[str], default: int) -> Dict[str, int]:
+    """Parse ``stage=N`` pairs; a bare ``N`` sets every stage."""
+    out = dict.fromkeys(STAGES, default)
+    for v in values:
+        stage, _, n = v.rpartition("=")
+        if stage and stage not in STAGES:
+            raise SystemExit(f"Unknown stage {stage!r} in {v!r}")
+        for s in [stage] if stage else STAGES:
+            out[s] = int(n)
+    return out
+
+
+def _add_queue_arguments(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument(
+        "--queue",
+        required=True,
+        help="Queue: an SQLite file (*.sqlite) or a folder on a shared mount",
+    )
+    ap.add_argument("--poll_s", type=float, default=0.2)
+
+
+def _add_worker_arguments(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument(
+        "--max_pending",
+        type=int,
+        default=32,
+        help="Stop claiming while the next stage has this many items waiting",
+    )
+    ap.add_argument("--max_attempts", type=int, default=2)
+    ap.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Threads per worker (default: the CPUs of the node left over per worker)",
+    )
+    ap.add_argument(
+        "--start_method",
+        choices=START_METHODS,
+        default="spawn",
+        help="forkserver imports the stage modules once for all workers",
+    )
+
+
+def _add_driver_arguments(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument("--prep_items", required=True, help="pc_prep plan folder")
+    ap.add_argument(
+        "--carried_over",
+        default=None,
+        help="pc_prep rows completed in an earlier run (from the plan step)",
+    )
+    ap.add_argument("--work_unit", choices=WORK_UNITS, default="tile")
+    ap.add_argument("--trees_per_unit", type=int, default=1)
+    ap.add_argument(
+        "--lease_s",
+        type=float,
+        default=None,
+        help="Requeue items claimed longer ago than this (workers on lost nodes)",
+    )
+
+
+def _driver(args: argparse.Namespace, partials: Dict[str, str]) -> Driver:
+    driver = Driver(
+        open_queue(args.queue), partials, args.work_unit, args.trees_per_unit
+    )
+    fed = driver.feed(read_plan(args.prep_items))
+    print(f"Queued {fed} pc_prep items from {args.prep_items}")  # noqa: T201
+    if args.carried_over and os.path.isfile(args.carried_over):
+        rows = list(iter_partial_rows([args.carried_over], SourceStats()))
+        n = driver.replay("pc_prep", rows)
+        print(  # noqa: T201
+            f"Queued {n} pc_segment items of {len(rows)} tiles carried over"
+        )
+    return driver
+
+
+def _main_driver(args: argparse.Namespace) -> None:
+    partials = {stage: getattr(args, f"{stage}_partial") for stage in STAGES}
+    if args.pc_ops_partials_dir:
+        partials["pc_ops"] = os.path.join(
+            args.pc_ops_partials_dir, os.path.basename(PARTIALS["pc_ops"])
+        )
+    driver = _driver(args, {s: p for s, p in partials.items() if p})
+    drive(driver, args.poll_s, args.lease_s)
+    for line in driver.describe():
+        print(line)  # noqa: T201
+
+
+def _main_worker(args: argparse.Namespace) -> None:
+    program_args = args.program_args
+    if program_args[:1] == ["--"]:
+        program_args = program_args[1:]
+    resources = plan_resources(args.stage, args.workers, args.threads_per_worker)
+    args.threads = resources.threads
+    procs = _start_workers(
+        _context(args.start_method, [args.stage]),
+        args,
+        args.stage,
+        resources.processes,
+        program_args,
+        args.mini_batch_size,
+    )
+    for p in procs:
+        p.join()
+    failed = [p.exitcode for p in procs if p.exitcode]
+    if failed:
+        sys.exit(f"{len(failed)} {args.stage} worker(s) failed: exit codes {failed}")
+
+
+def _main_local(args: argparse.Namespace) -> None:
+    workers = _per_stage(args.workers, 1)
+    batches = _per_stage(args.mini_batch_size, 1)
+    partials = {s: os.path.join(args.partials_dir, p) for s, p in PARTIALS.items()}
+    driver = _driver(args, partials)
+    # the workers of all stages share this machine
+    args.threads = plan_resources(
+        "streaming",
+        sum(max(1, workers[stage]) for stage in STAGES),
+        args.threads_per_worker,
+    ).threads
+    ctx = _context(args.start_method, STAGES)
+    procs = {
+        stage: _start_workers(
+            ctx,
+            args,
+            stage,
+            max(1, workers[stage]),
+            shlex.split(getattr(args, f"{stage}_args")),
+            batches[stage],
+        )
+        for stage in STAGES
+    }
+    try:
+        drive(driver, args.poll_s, args.lease_s, procs)
+    finally:
+        for stage_procs in procs.values():
+            for p in stage_procs:
+                p.join()
+    for line in driver.describe():
+        print(line)  # noqa: T201
+
+
+def main() -> None:
+    """Main script."""
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = ap.add_subparsers(dest="role", required=True)
+
+    drv = sub.add_parser("driver", help="Feed the plan and hand tiles on")
+    _add_queue_arguments(drv)
+    _add_driver_arguments(drv)
+    for stage in STAGES:
+        if stage != "pc_ops":
+            drv.add_argument(f"--{stage}_partial", default=None)
+    drv.add_argument(
+        "--pc_ops_partials_dir",
+        default=None,
+        help="Folder for the pc_ops rows (the pc_ops merge step's partials_dir)",
+    )
+    drv.set_defaults(func=_main_driver)
+
+    wrk = sub.add_parser("worker", help="Run one stage's entry script on the queue")
+    _add_queue_arguments(wrk)
+    _add_worker_arguments(wrk)
+    wrk.add_argument("--stage", choices=STAGES, required=True)
+    wrk.add_argument("--workers", type=int, default=1)
+    wrk.add_argument("--mini_batch_size", type=int, default=1)
+    wrk.add_argument("program_args", nargs=argparse.REMAINDER)
+    wrk.set_defaults(func=_main_worker)
+
+    loc = sub.add_parser("local", help="Driver and all workers on this machine")
+    _add_queue_arguments(loc)
+    _add_worker_arguments(loc)
+    _add_driver_arguments(loc)
+    loc.add_argument("--partials_dir", required=True)
+    loc.add_argument(
+        "--workers", nargs="*", default=[], help="Processes per stage, e.g. pc_ops=4"
+    )
+    loc.add_argument(
+        "--mini_batch_size",
+        nargs="*",
+        default=[],
+        help="Items per run() call, e.g. pc_segment=8",
+    )
+    for stage in STAGES:
+        loc.add_argument(
+            f"--{stage}_args",
+            default="",
+            help=f"Program arguments of the {stage} entry script (one string)",
+        )
+    loc.set_defaults(func=_main_local)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
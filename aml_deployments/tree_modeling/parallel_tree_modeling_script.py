@@ -1,26 +1,79 @@
-"""Script for parallel processing of tree_modeling."""
+"""Script for parallel processing of tree_modeling.
+
+With ``--stage_cache_dir`` the pc_ops outputs and BGT file of each item are
+copied to a local disk cache (the next item's in the background) and read from
+there; BGT files shared by neighbouring tiles are copied once.
+
+Items planned with ``--work_unit tree`` model only the tree segments of their
+unit, into a unit folder that the merge step reassembles into the tile outputs.
+
+Items may carry their ops and BGT records (``ops_files``, ``bgt_path``), as the
+streaming runner hands them over; otherwise they are looked up in
+``--ops_metadata`` and ``--bgt_metadata``.
+"""
 
 import argparse
 import json
+import os
+import sys
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Tuple
 
 from tree_modeling.logger import logger
 from tree_modeling.modeling_tree import process_point_cloud
 
-_G: Dict[str, Any] = {"args": None, "ops_metadata": None, "bgt_metadata": None}
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.ledger import (  # noqa: E402
+    CompletionLedger,
+    add_ledger_arguments,
+    ledger_version,
+)
+from gsm_common.metadata_store import open_metadata  # noqa: E402
+from gsm_common.plan_io import iter_plan_items  # noqa: E402
+from gsm_common.staging_cache import (  # noqa: E402
+    StagingCache,
+    add_staging_arguments,
+    open_staging_cache,
+    record_paths,
+)
+from gsm_common.telemetry import (  # noqa: E402
+    ItemTelemetry,
+    point_count,
+    with_telemetry,
+)
+from gsm_common.work_units import (  # noqa: E402
+    UNIT_KEY,
+    split_units,
+    unit_dir,
+    unit_key,
+)
+
+_G: Dict[str, Any] = {
+    "args": None,
+    "ops_metadata": None,
+    "bgt_metadata": None,
+    "ledger": None,
+    "stage": None,
+}
+
+# (plan item, pc_path, ops files, bgt path)
+Work = Tuple[Dict[str, Any], str, Any, Any]
 
 
 def _parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(add_help=False)
     p.add_argument("--ops_dir_mount", type=str, required=True)
-    p.add_argument("--ops_metadata", type=str, required=True)
+    # JSON metadata or the SQLite index written by the merge step
+    p.add_argument("--ops_metadata", type=str, default=None)
     p.add_argument("--bgt_dir_mount", type=str, required=True)
-    p.add_argument("--bgt_metadata", type=str, required=True)
+    p.add_argument("--bgt_metadata", type=str, default=None)
     p.add_argument("--modeling_dir", type=str, required=True)
     p.add_argument("--overwrite", action="store_true")
     p.add_argument("--debug", action="store_true")
+    add_staging_arguments(p)
+    add_ledger_arguments(p)
     args, _ = p.parse_known_args()
     return args
 
@@ -28,25 +81,23 @@ def _parse_args() -> argparse.Namespace:
 def init() -> None:
     """Init script."""
     _G["args"] = _parse_args()
-    _G["ops_metadata"] = json.loads(
-        Path(_G["args"].ops_metadata).read_text(encoding="utf-8")
-    )
-    _G["bgt_metadata"] = json.loads(
-        Path(_G["args"].bgt_metadata).read_text(encoding="utf-8")
-    )
+    for name in ("ops_metadata", "bgt_metadata"):
+        path = getattr(_G["args"], name)
+        _G[name] = open_metadata(path) if path else {}
     Path(_G["args"].modeling_dir).mkdir(parents=True, exist_ok=True)
+    if _G["args"].ledger_dir:
+        _G["ledger"] = CompletionLedger(
+            _G["args"].ledger_dir,
+            "tree_modeling",
+            ledger_version(_G["args"], "tree_modeling"),
+        )
+    _G["stage"] = open_staging_cache(_G["args"])
     logger.info("init(): modeling_dir=%s", _G["args"].modeling_dir)
 
 
-def _read_item(it: str) -> str | None:
-    p = Path(str(it))
-    if p.suffix.lower() == ".json" and p.exists():
-        try:
-            val = json.loads(p.read_text(encoding="utf-8")).get("pc_path")
-            return val if isinstance(val, str) else None
-        except Exception:
-            return None
-    return None
+def _read_item(it: Dict[str, Any]) -> str | None:
+    val = it.get("pc_path")
+    return val if isinstance(val, str) else None
 
 
 def _make_cli_args(base: argparse.Namespace) -> SimpleNamespace:
@@ -60,36 +111,111 @@ def _make_cli_args(base: argparse.Namespace) -> SimpleNamespace:
     )
 
 
+def _staged(work: List[Work]) -> Iterator[Tuple[Work, SimpleNamespace]]:
+    """Yield each work item with its args, pointing at staged inputs when enabled.
+
+    The inputs of the next item are copied in the background while the current
+    one runs.
+    """
+    base = _G["args"]
+    cli_args = _make_cli_args(base)
+    cache: StagingCache | None = _G["stage"]
+    if cache is None:
+        for w in work:
+            yield w, cli_args
+        return
+
+    def _prefetch(w: Work) -> Tuple[Any, Any]:
+        return (
+            cache.prefetch(base.ops_dir_mount, record_paths(w[2])),
+            cache.prefetch(base.bgt_dir_mount, record_paths(w[3])),
+        )
+
+    ahead = _prefetch(work[0]) if work else None
+    for i, w in enumerate(work):
+        current = ahead
+        ahead = _prefetch(work[i + 1]) if i + 1 < len(work) else None
+        ops_dir, bgt_dir = (f.result() for f in current)  # type: ignore[union-attr]
+        try:
+            yield (
+                w,
+                SimpleNamespace(
+                    **{**vars(cli_args), "ops_dir": ops_dir, "bgt_dir": bgt_dir}
+                ),
+            )
+        finally:
+            cache.release(base.ops_dir_mount, record_paths(w[2]))
+            cache.release(base.bgt_dir_mount, record_paths(w[3]))
+
+
 def run(mini_batch: List[Any]) -> List[str]:
     """Run script."""
     lines: List[str] = []
-    cli_args = _make_cli_args(_G["args"])
-    for it in mini_batch:
+    work: List[Work] = []
+    for it in iter_plan_items(mini_batch):
         pc_path = _read_item(it)
         if not pc_path:
             lines.append(
                 json.dumps({"skip": {"item": str(it), "reason": "no pc_path"}})
             )
             continue
-        ops_files = _G["ops_metadata"].get(pc_path)
-        bgt_path = _G["bgt_metadata"].get(pc_path)
+        ops_files = it.get("ops_files") or _G["ops_metadata"].get(pc_path)
+        bgt_path = it.get("bgt_path") or _G["bgt_metadata"].get(pc_path)
         if not ops_files or not bgt_path:
             lines.append(
                 json.dumps({"skip": {"pc_path": pc_path, "reason": "missing metadata"}})
             )
             continue
-
+        if "unit" in it:
+            units = split_units(ops_files, int(it.get("trees_per_unit", 1)))
+            if int(it["unit"]) >= len(units):
+                lines.append(
+                    json.dumps({"skip": {"item": str(it), "reason": "unknown unit"}})
+                )
+                continue
+            ops_files = units[int(it["unit"])]
+        work.append((it, pc_path, ops_files, bgt_path))
+
+    for (it, pc_path, ops_files, bgt_path), cli_args in _staged(work):
+        key, row = pc_path, {"modeled": pc_path}
+        if "unit" in it:
+            key, cli_args, row = _unit(it, pc_path, cli_args)
         # process_point_cloud returns None; it writes artifacts under modeling_dir
-        process_point_cloud(
-            pc_path=pc_path,
-            pc_ops_files=ops_files,
-            bgt_pavements_path=bgt_path,
-            args=cli_args,
-        )
-        lines.append(json.dumps({"modeled": pc_path}))
+        with ItemTelemetry("tree_modeling", key) as rec:
+            rec["points"] = point_count(pc_path)
+            process_point_cloud(
+                pc_path=pc_path,
+                pc_ops_files=ops_files,
+                bgt_pavements_path=bgt_path,
+                args=cli_args,
+            )
+        lines.append(json.dumps(with_telemetry(row, rec)))
+        if _G["ledger"] is not None and it.get("fingerprint"):
+            _G["ledger"].record(it["fingerprint"], key, row)
     return lines
 
 
+def _unit(
+    it: Dict[str, Any], pc_path: str, cli_args: SimpleNamespace
+) -> Tuple[str, SimpleNamespace, Dict[str, Any]]:
+    """Key, args writing to the unit folder, and result row of a tree unit."""
+    unit = int(it["unit"])
+    rel = unit_dir(pc_path, unit)
+    out = os.path.join(cli_args.modeling_dir, rel)
+    os.makedirs(out, exist_ok=True)
+    row = {
+        UNIT_KEY: {"pc_path": pc_path, "unit": unit, "units": it["units"], "dir": rel}
+    }
+    return (
+        unit_key(pc_path, unit),
+        SimpleNamespace(**{**vars(cli_args), "modeling_dir": out}),
+        row,
+    )
+
+
 def shutdown() -> None:
     """Shutdown script."""
+    if _G["stage"] is not None:
+        logger.info("Staging cache: %s", _G["stage"].describe())
+        _G["stage"].close()
     logger.info("shutdown()")
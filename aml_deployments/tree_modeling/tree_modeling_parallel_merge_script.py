@@ -1,34 +1,148 @@
-"""Script for merging of parallel processing results for tree_modeling."""
+"""Script for merging of parallel processing results for tree_modeling.
+
+With ``--modeling_dir``, the outputs of tiles planned as tree units are
+reassembled from their unit folders, and tiles whose units all succeeded and
+whose outputs could be combined are added to the modeling index.
+
+With ``--city_dataset``, the per-tile feature outputs in ``--modeling_dir`` are
+also streamed into one GeoPackage with a spatial index (see
+:mod:`gsm_common.city_dataset`).
+"""
 
 import argparse
 import json
+import os
+import sys
+import tempfile
 from pathlib import Path
+from typing import Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.city_dataset import DEFAULT_SRS_ID, write_city_dataset  # noqa: E402
+from gsm_common.streaming_merge import (  # noqa: E402
+    MergeOutput,
+    add_merge_arguments,
+    SourceStats,
+    describe_run,
+    iter_partial_rows,
+    merge_partials,
+    select_value,
+    with_carried_over,
+)
+from gsm_common.telemetry import TelemetrySummary  # noqa: E402
+from gsm_common.work_units import (  # noqa: E402
+    UNITS_DIR,
+    UnitCollector,
+    reassemble,
+)
+
+
+def _reassemble_units(sources: List[str], modeling_dir: str) -> str | None:
+    """Reassemble complete tiles; returns a partial listing them, if any."""
+    units = UnitCollector()
+    for row in iter_partial_rows(sources, SourceStats()):
+        units.add_row(row)
+    if not units.done:
+        return None
+    complete, missing = units.complete()
+    reassembled: List[str] = []
+    failed: Dict[str, str] = {}
+    files = 0
+    for pc_path in complete:
+        try:
+            files += reassemble(modeling_dir, pc_path, units.done[pc_path])
+        except (OSError, ValueError) as ex:
+            # unmergeable or unreadable unit outputs: the tile is not modeled
+            failed[pc_path] = str(ex)
+            continue
+        reassembled.append(pc_path)
+    print(  # noqa: T201
+        f"Reassembled {len(reassembled)} tiles ({files} files) from tree units; "
+        f"{len(missing)} tiles incomplete ({sum(missing.values())} units missing), "
+        f"{len(failed)} not reassembled"
+    )
+    for pc_path in sorted(missing)[:20]:
+        print(f"  incomplete: {pc_path} ({missing[pc_path]} units)")  # noqa: T201
+    for pc_path in sorted(failed)[:20]:
+        print(f"  not reassembled: {pc_path}: {failed[pc_path]}")  # noqa: T201
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for pc_path in reassembled:
+            f.write(json.dumps({"modeled": pc_path}) + "\n")
+    return path
 
 
 def main() -> None:
     """Main script."""
     ap = argparse.ArgumentParser()
     ap.add_argument("--partial", required=True)
+    ap.add_argument(
+        "--carried_over",
+        default=None,
+        help="JSONL of items completed in an earlier run (from the plan step)",
+    )
     ap.add_argument("--modeling_index", required=True)
+    ap.add_argument(
+        "--modeling_dir",
+        default=None,
+        help="Modeling output folder; reassembles tiles planned as tree units",
+    )
+    ap.add_argument(
+        "--city_dataset",
+        default=None,
+        help="Write all per-tile features of --modeling_dir to this GeoPackage",
+    )
+    ap.add_argument(
+        "--srs_id",
+        type=int,
+        default=DEFAULT_SRS_ID,
+        help="EPSG code of the feature coordinates in the city dataset",
+    )
+    add_merge_arguments(ap)
     args = ap.parse_args()
+    if args.city_dataset and not args.modeling_dir:
+        ap.error("--city_dataset needs --modeling_dir")
 
-    modeled = []
-    for line in Path(args.partial).read_text(encoding="utf-8").splitlines():
-        s = line.strip()
-        if not s:
-            continue
-        try:
-            row = json.loads(s)
-        except json.JSONDecodeError:
-            continue
-        if "modeled" in row:
-            modeled.append(row["modeled"])
+    sources = with_carried_over([args.partial], args.carried_over)
+    assembled = (
+        _reassemble_units(sources, args.modeling_dir) if args.modeling_dir else None
+    )
 
-    Path(args.modeling_index).parent.mkdir(parents=True, exist_ok=True)
-    Path(args.modeling_index).write_text(
-        json.dumps({"modeled": modeled}, indent=4), encoding="utf-8"
+    out = MergeOutput(
+        path=args.modeling_index,
+        select=select_value("modeled"),
+        fmt=args.format,
+        indent=args.indent,
+        list_key="modeled",
+    )
+    telemetry = TelemetrySummary()
+    try:
+        stats, source_stats = merge_partials(
+            [*sources, assembled] if assembled else sources,
+            {"modeled": out},
+            args.on_duplicate,
+            observers=[telemetry.add_row],
+        )
+    finally:
+        if assembled:
+            os.remove(assembled)
+    print(  # noqa: T201
+        f"Wrote {stats['modeled'].written} modeled keys -> {args.modeling_index}"
     )
-    print(f"Wrote {len(modeled)} modeled keys -> {args.modeling_index}")  # noqa: T201
+    print(describe_run(source_stats, stats))  # noqa: T201
+    for line in telemetry.describe():
+        print(line)  # noqa: T201
+    if args.telemetry_summary:
+        telemetry.write(args.telemetry_summary)
+    if args.city_dataset:
+        city = write_city_dataset(
+            args.modeling_dir, args.city_dataset, args.srs_id, skip=[UNITS_DIR]
+        )
+        print(  # noqa: T201
+            f"Wrote {city.features} features of {city.tiles} tiles "
+            f"-> {args.city_dataset}"
+        )
 
 
 if __name__ == "__main__":
@@ -1,26 +1,116 @@
-"""Script for planning files for parallel processing of tree_modeling."""
+"""Script for planning files for parallel processing of tree_modeling.
+
+With ``--work_unit tree`` every item is a group of ``--trees_per_unit`` tree
+segments of a tile (see ``gsm_common.work_units``) instead of a whole tile.
+With ``--ledger_dir``, ``--ops_dir`` and ``--bgt_dir`` the item fingerprints
+include the size/mtime of the pc_ops outputs and BGT files of the tile, so tiles
+whose upstream outputs were rewritten are modeled again.
+"""
 
 import argparse
-import json
+import sys
 from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from gsm_common.ledger import (  # noqa: E402
+    add_ledger_arguments,
+    plan_with_ledger,
+    record_signatures,
+)
+from gsm_common.metadata_store import open_metadata  # noqa: E402
+from gsm_common.plan_io import (  # noqa: E402
+    add_plan_arguments,
+    order_items,
+    write_plan,
+)
+from gsm_common.work_units import WORK_UNITS, split_units, unit_key  # noqa: E402
 
 
 def main() -> None:
     """Main script."""
     ap = argparse.ArgumentParser()
     ap.add_argument("--ops_metadata", required=True)
+    ap.add_argument(
+        "--bgt_metadata", default=None, help="Only used to fingerprint items"
+    )
+    ap.add_argument("--ops_dir", default=None, help="Only used to fingerprint items")
+    ap.add_argument("--bgt_dir", default=None, help="Only used to fingerprint items")
     ap.add_argument("--out_items_folder", required=True)
+    ap.add_argument(
+        "--work_unit",
+        choices=WORK_UNITS,
+        default="tile",
+        help="Plan one item per tile, or per group of tree segments",
+    )
+    ap.add_argument("--trees_per_unit", type=int, default=1)
+    add_plan_arguments(ap)
+    add_ledger_arguments(ap, plan=True)
     args = ap.parse_args()
 
-    ops = json.loads(Path(args.ops_metadata).read_text(encoding="utf-8"))
-    out = Path(args.out_items_folder)
-    out.mkdir(parents=True, exist_ok=True)
+    ops = open_metadata(args.ops_metadata)
+    bgt = open_metadata(args.bgt_metadata) if args.bgt_metadata else {}
+    items: List[Dict[str, Any]] = []
+    # the units of every tile, split once for the items and their fingerprints
+    split: Dict[str, List[Any]] = {}
+    unsplit: List[str] = []
+    for pc_path in ops:
+        if args.work_unit == "tile":
+            items.append({"pc_path": pc_path})
+            continue
+        record = ops.get(pc_path)
+        units = split[pc_path] = split_units(record, args.trees_per_unit)
+        if units[0] is record:
+            unsplit.append(pc_path)
+        items += [
+            {
+                "pc_path": pc_path,
+                "unit": i,
+                "units": len(units),
+                "trees_per_unit": args.trees_per_unit,
+            }
+            for i in range(len(units))
+        ]
+    if unsplit:
+        print(  # noqa: T201
+            f"{len(unsplit)} tiles without a trees list are single units "
+            f"(e.g. {', '.join(unsplit[:5])})"
+        )
 
-    for i, pc_path in enumerate(ops.keys(), start=1):
-        (out / f"{i:05d}.json").write_text(
-            json.dumps({"pc_path": pc_path}), encoding="utf-8"
+    def _key(it: Dict[str, Any]) -> str:
+        return unit_key(it["pc_path"], it["unit"]) if "unit" in it else it["pc_path"]
+
+    # a tile's pc_ops outputs and BGT files are identified by size/mtime
+    signatures = (
+        record_signatures(
+            {
+                p: [(args.ops_dir, ops.get(p)), (args.bgt_dir, bgt.get(p))]
+                for p in dict.fromkeys(it["pc_path"] for it in items)
+            }
         )
-    print(f"Wrote {len(ops)} items -> {out}")  # noqa: T201
+        if args.ledger_dir
+        else {}
+    )
+
+    def _inputs(it: Dict[str, Any]) -> List[Any]:
+        if "unit" in it:
+            record = split[it["pc_path"]][it["unit"]]
+        else:
+            record = ops.get(it["pc_path"])
+        return [record, bgt.get(it["pc_path"]), signatures.get(it["pc_path"])]
+
+    items = plan_with_ledger(
+        items,
+        args,
+        stage="tree_modeling",
+        package="tree_modeling",
+        key_of=_key,
+        inputs_of=_inputs,
+    )
+    items = order_items(items, _key, args.item_order)
+    written = write_plan(items, args.out_items_folder, args.plan_format)
+    print(f"Wrote {written} items -> {args.out_items_folder}")  # noqa: T201
 
 
 if __name__ == "__main__":